@@ -0,0 +1,167 @@
+# coding: utf-8
+"""Python interface of PAIREF for pipelines that run paired refinement
+without the command line, *e.g.*::
+
+    from pairef.api import make_config, run
+    from pairef.commons import PairefError
+
+    config = make_config("model.pdb", "data.mtz", res_init=2.0,
+                         project="ds1")
+    try:
+        results = run(config, workdir="/scratch/ds1")
+    except PairefError as e:
+        print("Paired refinement failed: " + str(e))
+    else:
+        print(results.cutoff, results.statistics)
+
+:func:`run` raises errors derived from :class:`pairef.commons.PairefError`
+instead of exiting the process. Every run has its own settings, warnings,
+working directory and log (:class:`pairef.settings.RunContext`), neither
+the current directory of the process nor `sys.stdout` is changed, so runs
+started from more threads do not wait for each other.
+"""
+from __future__ import print_function
+import copy
+import os
+from collections import OrderedDict
+from .settings import RunContext
+from .commons import PairefError, InputError
+from .scratch import results_dir
+
+
+class Results(object):
+    """Results of a run of PAIREF returned by :func:`run`.
+
+    Attributes:
+        project (str): Name of the project
+        workdir (str): Absolute path of the working directory
+        shells (list): High resolution limits of the finished steps (the
+                       first one is the initial resolution)
+        flag_sets (list): Free reflection sets
+        statistics (OrderedDict): Overall statistics of every step (see
+                                  :func:`read_shell_statistics`)
+        cutoff (tuple): Strict and benevolent suggested cutoff
+        accepted (list): For every high resolution shell, whether it is
+                         accepted by the strict and the benevolent algorithm
+        reasons (list): For every high resolution shell, the reasons of
+                        the decision
+        warnings (list): Warning messages which appeared during the run
+    """
+    def __init__(self, project, workdir, shells, flag_sets, statistics,
+                 cutoff, accepted, reasons, warnings):
+        self.project = project
+        self.workdir = workdir
+        self.shells = shells
+        self.flag_sets = flag_sets
+        self.statistics = statistics
+        self.cutoff = cutoff
+        self.accepted = accepted
+        self.reasons = reasons
+        self.warnings = warnings
+
+    def __repr__(self):
+        return "Results(project=" + repr(self.project) + ", cutoff=" + \
+            repr(self.cutoff) + ")"
+
+
+def make_config(xyzin, hklin, **options):
+    """Returns the configuration of a run. The options are named as the
+    attributes of the arguments processed by `argparse` (*e.g.* `res_init`
+    for the option `-i`, `phenix` for `--phenix`, `complete_cross_validation`
+    for `--complete`) and they are checked as the command-line arguments.
+
+    Args:
+        xyzin (str): Structure model
+        hklin (str): Merged diffraction data
+        **options: Other options, `None` or `False` keeps the default value
+
+    Returns:
+        argparse.Namespace
+
+    Raises:
+        InputError: The options are not valid
+    """
+    from .launcher import make_parser, process_arguments
+    actions = dict((action.dest, action) for action in make_parser()._actions
+                   if action.option_strings and action.dest != "help")
+    input_args = ["pairef", "--XYZIN", str(xyzin), "--HKLIN", str(hklin)]
+    for key in sorted(options):
+        value = options[key]
+        if key not in actions:
+            raise InputError("Unknown option " + key + ".")
+        if value is None or value is False:
+            continue
+        if actions[key].nargs == 0:  # flags (store_true)
+            input_args.append(actions[key].option_strings[0])
+        else:
+            input_args += [actions[key].option_strings[0], str(value)]
+    return process_arguments(input_args)
+
+
+def read_shell_statistics(project, workdir="."):
+    """Reads the overall R-values of the steps of paired refinement from
+    the file `project`_R-values.csv (averages over the free reflection sets
+    in the case of complete cross-validation).
+
+    Args:
+        project (str): Name of the project
+        workdir (str): Working directory
+
+    Returns:
+        OrderedDict: Dictionary of the statistics (*e.g.* `Rfree(diff)`)
+        for every high resolution limit of the steps
+    """
+    statistics = OrderedDict()
+    csvfilename = os.path.join(workdir, project + "_R-values.csv")
+    if not os.path.isfile(csvfilename):
+        return statistics
+    with open(csvfilename, "r") as csvfile:
+        lines = csvfile.readlines()
+    labels = lines[0].split()[2:]  # skip "#" and "Shell"
+    for line in lines[1:]:
+        values = line.split()
+        if not values:
+            continue
+        res_high = float(values[0].split("->")[-1].rstrip("A"))
+        statistics[res_high] = OrderedDict(
+            (label, float(value)) for label, value in zip(labels, values[1:]))
+    return statistics
+
+
+def run(config, workdir=None):
+    """Runs the paired refinement protocol in a new run context.
+
+    Args:
+        config (argparse.Namespace): Configuration of the run (see
+                                     :func:`make_config`), it is not modified
+        workdir (str): Working directory (a new directory
+                       pairef_`project` in the current directory by default)
+
+    Returns:
+        Results: Results of the run (`None` if only the plan or the shards
+        are prepared or if the option `test` is set)
+
+    Raises:
+        PairefError: The run cannot be finished (its subclasses describe
+                     the cause, see :mod:`pairef.commons`)
+    """
+    from .launcher import main
+    args = copy.deepcopy(config)
+    if workdir:
+        args.workdir = os.path.abspath(workdir)
+    with RunContext() as context:
+        try:
+            result = main(args)
+        except SystemExit as e:
+            raise PairefError("Run was stopped (exit code " +
+                              str(e.code) + ").")
+        if result is None:
+            return None
+        shells, flag_sets, (cutoff, accepted, reasons) = result
+        workdir = results_dir()
+        return Results(
+            project=args.project, workdir=workdir,
+            shells=list(shells), flag_sets=list(flag_sets),
+            statistics=read_shell_statistics(args.project, workdir),
+            cutoff=tuple(cutoff), accepted=accepted, reasons=reasons,
+            warnings=list(context.warning_dict.values()))
@@ -0,0 +1,141 @@
+# coding: utf-8
+"""Placing and comparing of files (input files copied to the working
+directory, copies of outputs of the refinement jobs, ...).
+
+A file is placed by a copy-on-write clone (reflink, *e.g.* on Btrfs or
+XFS) if the filesystem supports it, otherwise by a hard link, and by an
+ordinary copy if neither is possible (*e.g.* between two filesystems), so
+that large MTZ files are not copied byte by byte. Files are compared by
+their size and modification time and only if these differ, by a hash of
+their content which is cached. Relative file names refer to the working
+directory of the run (see :func:`pairef.settings.workpath`).
+"""
+import hashlib
+import os
+import shutil
+import threading
+from .settings import workpath
+
+# ioctl FICLONE of Linux
+FICLONE = 0x40049409
+
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+
+def samefile(filename1, filename2):
+    """Returns whether two names refer to the same file (*e.g.* hard links
+    or a symlink)."""
+    if not hasattr(os.path, "samefile"):  # Python 2 on Windows
+        return False
+    return os.path.samefile(filename1, filename2)
+
+
+def reflink(src, dst):
+    """Makes a copy-on-write clone `dst` of the file `src`.
+
+    Args:
+        src (str): Source file
+        dst (str): Destination file (it must not exist)
+
+    Returns:
+        bool: `True` if the clone has been made
+    """
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        return False
+    try:
+        with open(src, "rb") as fsrc:
+            with open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def link_or_copy(src, dst):
+    """Places the file `src` as `dst` using a reflink, a hard link or
+    a copy (whatever is possible first). An existing file `dst` is
+    replaced. Like :func:`shutil.copy2`, `dst` can be a directory.
+
+    Args:
+        src (str): Source file
+        dst (str): Destination file or directory
+
+    Returns:
+        str: Name of the destination file
+    """
+    src = workpath(src)
+    dst = workpath(dst)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and samefile(src, dst):
+            return dst
+        os.remove(dst)
+    if reflink(src, dst):
+        return dst
+    if hasattr(os, "link"):
+        try:
+            os.link(os.path.realpath(src), dst)  # not the symlink itself
+            return dst
+        except OSError:  # e.g. another filesystem
+            pass
+    shutil.copy2(src, dst)
+    return dst
+
+
+def file_hash(filename):
+    """Returns the SHA-1 hash of the content of a file. The hash is cached
+    as long as the size and the modification time of the file do not
+    change.
+
+    Args:
+        filename (str)
+
+    Returns:
+        str
+    """
+    filename = workpath(filename)
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    with _hash_lock:
+        if key in _hash_cache:
+            return _hash_cache[key]
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    with _hash_lock:
+        _hash_cache[key] = sha1.hexdigest()
+    return _hash_cache[key]
+
+
+def same_content(filename1, filename2):
+    """Returns whether two files have the same content. Files of the same
+    size and modification time (*e.g.* a copy made by
+    :func:`link_or_copy`) are considered to be the same, otherwise their
+    hashes are compared (see :func:`file_hash`).
+
+    Args:
+        filename1 (str)
+        filename2 (str)
+
+    Returns:
+        bool
+    """
+    filename1 = workpath(filename1)
+    filename2 = workpath(filename2)
+    if samefile(filename1, filename2):
+        return True
+    stat1 = os.stat(filename1)
+    stat2 = os.stat(filename2)
+    if stat1.st_size != stat2.st_size:
+        return False
+    if stat1.st_mtime == stat2.st_mtime:
+        return True
+    return file_hash(filename1) == file_hash(filename2)
@@ -0,0 +1,250 @@
+# coding: utf-8
+"""Batch mode - paired refinement of many datasets sharing one pool of CPU
+cores (`pairef batch MANIFEST`).
+
+Every non-empty line of the manifest (except lines starting with `#`)
+contains the arguments of one run of PAIREF, *e.g.*::
+
+    --XYZIN ds1/model.pdb --HKLIN ds1/data.mtz -i 2.0 -p ds1
+    --XYZIN ds2/model.pdb --HKLIN ds2/data.mtz -i 1.8 -p ds2 --nproc 4
+
+The runs take place in threads of the current process (at most one run
+per core at once), each in its own run context (see
+:class:`pairef.settings.RunContext`) and in its own working directory in
+the current directory. Their runners of the external programs share one
+pool of cores - every job reserves its cores from the pool only while it
+runs, so the jobs of all the runs are interleaved and a run does not hold
+any cores during its preparation or collection of statistics. The option
+`--nproc` of the line (or `--project-nproc` of the batch) sets the
+threads per job of a run as in a separate run. The largest datasets are
+started first. The suggested cutoffs of all the runs are summarized in a
+file `PAIREF_batch_summary.csv`.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+import traceback
+from .commons import twodec, InputError, ArgumentsError, PairefError
+from .jobs import JobRunner, cpu_count
+from .settings import RunContext
+
+SUMMARY = "PAIREF_batch_summary.csv"
+
+
+def read_manifest(manifestfilename):
+    """Reads and checks the runs listed in a manifest. A run without an
+    option `-p` gets the name of its XYZIN file as the project name.
+
+    Args:
+        manifestfilename (str)
+
+    Returns:
+        list: Runs (dictionaries with keys `line`, `arguments`, `project`,
+        `nproc`, `hklin`, and `xyzin`)
+
+    Raises:
+        InputError: The manifest is not valid
+    """
+    from .launcher import process_arguments
+    entries = []
+    with open(manifestfilename, "r") as manifest:
+        for n_line, line in enumerate(manifest, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            arguments = shlex.split(line)
+            try:
+                args = process_arguments(["pairef"] + arguments)
+            except ArgumentsError as e:
+                raise InputError("Invalid arguments on the line " +
+                                 str(n_line) + " of the manifest " +
+                                 manifestfilename + ": " + str(e))
+            if not args.project:
+                args.project = os.path.splitext(
+                    os.path.basename(args.xyzin))[0]
+                arguments += ["-p", args.project]
+            entries.append({"line": n_line, "arguments": arguments,
+                            "project": args.project, "nproc": args.nproc,
+                            "hklin": args.hklin, "xyzin": args.xyzin})
+    projects = [entry["project"] for entry in entries]
+    for entry in entries:
+        if projects.count(entry["project"]) > 1:
+            raise InputError("Project name " + entry["project"] +
+                             " is used on more lines of the manifest " +
+                             manifestfilename + ".")
+        if os.path.exists("pairef_" + entry["project"]):
+            raise InputError("Working directory pairef_" +
+                             entry["project"] + " already exists.")
+    if not entries:
+        raise InputError("Manifest " + manifestfilename + " does "
+                         "not contain any run.")
+    return entries
+
+
+def estimate_cost(entry):
+    """Returns a relative cost of a run (number of reflections times number
+    of atoms, see :mod:`pairef.planning`) used to start the largest runs
+    first."""
+    from .planning import describe_data
+    curve, n_atoms = describe_data(entry["hklin"], entry["xyzin"])
+    return (curve[0][1] if curve else 0) * n_atoms
+
+
+def run_entry(entry, pool, nproc):
+    """Runs PAIREF for an entry of a manifest in a new run context whose
+    jobs reserve their cores from `pool`. The messages of the run are saved
+    in a file PAIREF_batch_`project`.log.
+
+    Args:
+        entry (dict): See :func:`read_manifest`
+        pool (JobRunner): Runner of the CPU cores shared by the batch
+        nproc (int): Number of cores of a run whose line does not contain
+                     the option `--nproc`
+
+    Returns:
+        dict: `entry` with added keys `returncode` and `wall`
+    """
+    from .launcher import main, process_arguments
+    logfilename = "PAIREF_batch_" + entry["project"] + ".log"
+    start = time.time()
+    with open(logfilename, "w") as logfile, \
+            RunContext(JobRunner(pool=pool)) as context:
+        context.output = logfile
+        try:
+            # The input files might have been removed since the manifest was
+            # read
+            args = process_arguments(["pairef"] + entry["arguments"])
+            args.nproc = min(args.nproc or nproc, pool.n_cores)
+            main(args)
+            entry["returncode"] = 0
+        except PairefError as e:
+            logfile.write("ERROR: " + str(e) + "\nAborting.\n")
+            entry["returncode"] = 1
+        except SystemExit as e:
+            entry["returncode"] = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            # A failure of a run must not stop the other runs
+            traceback.print_exc(file=logfile)
+            entry["returncode"] = 1
+    entry["wall"] = time.time() - start
+    print(" * Project " + entry["project"] + " " +
+          ("finished" if not entry["returncode"] else "FAILED (see " +
+           logfilename + ")") + " after " + str(int(entry["wall"])) + " s.")
+    return entry
+
+
+def run_batch(entries, n_cores=None, project_nproc=None):
+    """Runs PAIREF for all the entries of a manifest in threads sharing
+    `n_cores` CPU cores (at most `n_cores` runs at once, see
+    :func:`run_entry`).
+
+    Args:
+        entries (list): See :func:`read_manifest`
+        n_cores (int): Number of CPU cores of the pool
+        project_nproc (int): Number of cores of a run whose line does not
+                             contain the option `--nproc` (all the runs get
+                             an equal share of the pool by default)
+
+    Returns:
+        list: `entries` with added keys `returncode` and `wall`
+    """
+    pool = JobRunner(n_cores, 1)
+    if not project_nproc:
+        project_nproc = max(1, pool.n_cores // len(entries))
+    for entry in entries:
+        entry["cost"] = estimate_cost(entry)
+    remaining = sorted(entries, key=lambda entry: -entry["cost"])
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                entry = remaining.pop(0)
+            run_entry(entry, pool, project_nproc)
+
+    print("Running " + str(len(entries)) + " projects using " +
+          str(pool.n_cores) + " CPU cores...")
+    workers = [threading.Thread(target=worker)
+               for _ in range(min(pool.n_cores, len(entries)))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return entries
+
+
+def write_batch_summary(entries, summaryfilename=SUMMARY):
+    """Collects the suggested cutoffs of the finished runs (files
+    PAIREF_`project`_summary.json in their working directories), prints them
+    and saves them in the file `summaryfilename`.
+
+    Args:
+        entries (list): See :func:`run_batch`
+        summaryfilename (str)
+
+    Returns:
+        list: Rows of the summary (project, status, strict cutoff,
+        benevolent cutoff, wall-clock time)
+    """
+    rows = []
+    for entry in entries:
+        jsonfilename = os.path.join("pairef_" + entry["project"],
+                                    "PAIREF_" + entry["project"] +
+                                    "_summary.json")
+        strict = benevolent = "N/A"
+        if entry.get("returncode") == 0 and os.path.isfile(jsonfilename):
+            with open(jsonfilename, "r") as jsonfile:
+                cutoff = json.load(jsonfile)["cutoff"]
+            strict = twodec(cutoff["strict"])
+            benevolent = twodec(cutoff["benevolent"])
+            status = "finished"
+        else:
+            status = "failed"
+        rows.append((entry["project"], status, strict, benevolent,
+                     "%.0f" % entry.get("wall", 0)))
+    header = ("# project", "status", "strict", "benevolent", "wall_s")
+    width = max(len(row[0]) for row in rows + [header])
+    with open(summaryfilename, "w") as summaryfile:
+        print("\nSuggested cutoffs (A):")
+        for row in [header] + rows:
+            line = row[0].ljust(width) + " " + row[1].ljust(8) + " " + \
+                row[2].rjust(6) + " " + row[3].rjust(10) + " " + \
+                row[4].rjust(7)
+            summaryfile.write(line + "\n")
+            print(line)
+    print("\nSummary of the batch was saved in a file " +
+          os.path.abspath(summaryfilename))
+    return rows
+
+
+def batch(input_args):
+    """Processes the arguments of the command `pairef batch` and runs it.
+
+    Args:
+        input_args (list): Command and its arguments
+    """
+    parser = argparse.ArgumentParser(prog="pairef batch")
+    parser.add_argument("manifest", help="file with arguments of one run "
+                        "of PAIREF on every line")
+    parser.add_argument("--nproc", type=int, default=None,
+                        help="number of CPU cores shared by all the runs "
+                        "(all available cores by default)")
+    parser.add_argument("--project-nproc", type=int, default=None,
+                        dest="project_nproc",
+                        help="number of CPU cores of a run whose line does "
+                        "not set --nproc, it sets the threads per job (an "
+                        "equal share of the cores by default)")
+    args = parser.parse_args(input_args[1:])
+    entries = read_manifest(args.manifest)
+    run_batch(entries, args.nproc or cpu_count(), args.project_nproc)
+    rows = write_batch_summary(entries)
+    if any(row[1] != "finished" for row in rows):
+        sys.exit(1)
@@ -1,6 +1,44 @@
 # coding: utf-8
+from __future__ import print_function
+import gzip
+import os
 import sys
-from .settings import warning_dict
+import threading
+from .settings import warning_dict, current_output, workpath
+
+_warning_lock = threading.Lock()
+
+
+class PairefError(Exception):
+    """Base class of the errors that stop a run of PAIREF. The command
+    `pairef` writes the message of the error and exits with the return
+    code 1."""
+    pass
+
+
+class InputError(PairefError):
+    """Input files or options are not valid."""
+    pass
+
+
+class ArgumentsError(InputError):
+    """Command-line arguments could not be parsed."""
+    pass
+
+
+class SoftwareError(PairefError):
+    """Required software (CCTBX, CCP4, PHENIX) is not available."""
+    pass
+
+
+class StatisticsError(PairefError):
+    """Statistics could not be found in an output file of a program."""
+    pass
+
+
+class RefinementError(PairefError):
+    """Refinement (or another calculation) failed."""
+    pass
 
 
 def twodec(var):
@@ -51,15 +89,35 @@ def fourdec(var):
     return(i)
 
 
+def open_text(filename):
+    """Opens a text file for reading. If the file `filename` does not exist
+    but its compressed version `filename`.gz does (see
+    :mod:`pairef.retention`), the compressed file is read.
+
+    Args:
+        filename (str): Name of the file (relative to the working directory
+                        of the run, see :func:`pairef.settings.workpath`)
+
+    Returns:
+        file object
+    """
+    filename = workpath(filename)
+    if not os.path.exists(filename) and os.path.exists(filename + ".gz"):
+        if sys.version_info[0] >= 3:
+            return gzip.open(filename + ".gz", "rt")
+        return gzip.open(filename + ".gz", "rb")
+    return open(filename, "r")
+
+
 def extract_from_file(filename, searched, skip_lines, n_lines,
                       nth_word=False, not_found="stop", get_first=False):
     """Returns line(s) or word relating to the search based on
     `searched` string in the file `filename`.
 
-    If the `filename` is not found, abort (always).
+    If the `filename` is not found, raise :class:`StatisticsError` (always).
     Default behavior: The last case of `searched` string match is used
     and if the `searched` string is not found in the file `filename`,
-    the program is stopped with an error message.
+    :class:`StatisticsError` is raised.
 
     Args:
         filename (str): Name of the file
@@ -68,8 +126,8 @@ def extract_from_file(filename, searched, skip_lines, n_lines,
         n_lines (int): Number of lines that should be returned
         nth_word (bool or int): `False` if lines should be returned
             or a order in a line of the word that should be picked
-        not_found (str): If the `searched` string is not found, write an error
-            message and exit (if `not_found="stop"`, default option)
+        not_found (str): If the `searched` string is not found, raise
+            :class:`StatisticsError` (if `not_found="stop"`, default option)
             or (if `not_found="N/A"`) return `"N/A"` or `["N/A"]`.
         get_first (bool): Use the first case of `searched` string match.
 
@@ -79,6 +137,9 @@ def extract_from_file(filename, searched, skip_lines, n_lines,
             with the `skip_line` offset (if `nth_word=False`) or
             picked word (`nth_word`-th word) in the `skip_lines`-th
             following line (if `nth_word=True`)
+
+    Raises:
+        StatisticsError
     """
 
     # Python 2 and 3 compatibility
@@ -90,12 +151,10 @@ def extract_from_file(filename, searched, skip_lines, n_lines,
     try:
         # str() is needed as "TypeError: coercing to Unicode:
         #                     need string or buffer, PosixPath found"
-        with open(str(filename), "r") as f:
+        with open_text(str(filename)) as f:
             file_lines = f.readlines()
     except FileNotFoundError:
-        sys.stderr.write("ERROR: File " + str(filename) + " was not found.\n"
-                         "Aborting.\n")
-        sys.exit(1)
+        raise StatisticsError("File " + str(filename) + " was not found.")
     for i in range(len(file_lines)):
         if searched in file_lines[i]:
             j = i
@@ -103,10 +162,9 @@ def extract_from_file(filename, searched, skip_lines, n_lines,
                 break
     if "j" not in locals():
         if not_found == "stop":
-            sys.stderr.write("ERROR: File " + str(filename) + " is not in a "
-                             "proper format. Statistics could not be found.\n"
-                             "Aborting.\n")
-            sys.exit(1)
+            raise StatisticsError("File " + str(filename) + " is not in a "
+                                  "proper format. Statistics could not be "
+                                  "found.")
         elif not_found == "N/A":
             if not nth_word:
                 lines_array = ["N/A"]
@@ -123,11 +181,9 @@ def extract_from_file(filename, searched, skip_lines, n_lines,
             word = line.split()[nth_word]
         except IndexError:
             if not_found == "stop":
-                sys.stderr.write("ERROR: File " + str(filename) + " is not in "
-                                 "a proper format. "
-                                 "Statistics could not be found.\n"
-                                 "Aborting.\n")
-                sys.exit(1)
+                raise StatisticsError("File " + str(filename) + " is not "
+                                      "in a proper format. Statistics could "
+                                      "not be found.")
             elif not_found == "N/A":
                 word = "N/A"
         return word
@@ -135,17 +191,28 @@ def extract_from_file(filename, searched, skip_lines, n_lines,
 
 def warning_my(key, message):
     message = "WARNING: " + message
-    if key in warning_dict:
-        if not message in warning_dict[key]:
+    # Warnings are also given by the jobs running in parallel threads
+    with _warning_lock:
+        if key in warning_dict:
+            if not message in warning_dict[key]:
+                sys.stderr.write(message + "\n")
+                warning_dict[key] = warning_dict[key] + "<br />\n" + message
+            # else (if message in warning_dict[key]) do nothing
+        else:
             sys.stderr.write(message + "\n")
-            warning_dict[key] = warning_dict[key] + "<br />\n" + message
-        # else (if message in warning_dict[key]) do nothing
-    else:
-        sys.stderr.write(message + "\n")
-        warning_dict[key] = message
+            warning_dict[key] = message
     return True
 
 
+def print_my(*args, **kwargs):
+    """Function `print()` writing to the output of the current thread (see
+    :func:`pairef.settings.current_output`), so that the messages of jobs
+    running in parallel are not mixed."""
+    if kwargs.get("file") is None:
+        kwargs["file"] = current_output()
+    print(*args, **kwargs)
+
+
 def try_symlink(src, dst):
     """Make new symlink to `src` if the `dst` file does not exist yet. If it is
     not possible to make symlinks (difficulties on Windows), just make a copy
@@ -159,20 +226,20 @@ def try_symlink(src, dst):
         bool: True"""
 
     import os
-    import filecmp
+    from .artefacts import link_or_copy, same_content
+    # A relative `src` of the symlink refers to the directory of `dst`
+    dst = workpath(dst)
     # New symlink only if it has not been made previously
     if os.path.isfile(dst):
-        if filecmp.cmp(src, dst):
+        if same_content(os.path.join(os.path.dirname(dst), src), dst):
             return True  # Nothing to do, files are the same
     if hasattr(os, "symlink"):
         try:
             os.symlink(src, dst)
         except OSError:
-            import shutil
-            shutil.copy2(src, dst)
+            link_or_copy(os.path.join(os.path.dirname(dst), src), dst)
     else:  # Windows
-        import shutil
-        shutil.copy2(src, dst)
+        link_or_copy(os.path.join(os.path.dirname(dst), src), dst)
     return True
 
 
@@ -216,3 +283,32 @@ def pick_work_free_from_csv_line(line, values_work_list, values_free_list,
         errors_work_list.append(0)
         errors_free_list.append(0)
     return values_work_list, values_free_list, errors_work_list, errors_free_list, continue_sign
+
+
+def which(program):
+    """Checks if `program` exists and finds its location. Analogy of the
+    `which` GNU/Linux command.
+
+    Args:
+        program (str): Name of an executable
+
+    Returns:
+        str: Path of an executable location
+    """
+
+    def is_exe(fpath):
+        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+
+    fpath, fname = os.path.split(program)
+    if fpath:
+        if is_exe(program) or is_exe(program + ".exe"):
+            return program
+    else:
+        for path in os.environ["PATH"].split(os.pathsep):
+            exe_file = os.path.join(path, program)
+            if is_exe(exe_file):
+                return exe_file
+            exe_file = os.path.join(path, program + ".exe")
+            if is_exe(exe_file):
+                return exe_file
+    return None
@@ -0,0 +1,546 @@
+# coding: utf-8
+"""Suggestion of the high resolution cutoff from the statistics of paired
+refinement.
+
+:class:`CutoffEngine` rates every high resolution shell as soon as its
+statistics are written and keeps the ratings, so that only the new shells
+are rated after every step of paired refinement. The CSV files which grow
+during the run (`project`_R-values.csv and `project`_Rgap.csv) are read
+incrementally. The thresholds of the ratings can be changed (see
+:data:`THRESHOLDS`) and a finished run can be evaluated again with other
+thresholds without any refinement by the command::
+
+    pairef recut WORKDIR --r-shell-max 0.42
+
+Ratings of a shell (the higher the worse):
+
+* 1 - overall Rfree decreased
+* 2 - overall Rfree did not increase more than `rfree_constant` and Rwork
+  increased
+* 3 - `r_shell_warn` <= Rfree < `r_shell_max` in the highest resolution
+  shell but Nfree < `nfree_min`
+* 4 - Rfree >= `r_shell_max` in the highest resolution shell but
+  Nfree < `nfree_min`
+* 5 - `r_shell_warn` <= Rfree < `r_shell_max` in the highest resolution
+  shell
+* 6 - `r_shell_warn` <= Rwork < `r_shell_max` in the highest resolution
+  shell
+* 7 - overall Rfree increased more than `rfree_constant`
+* 8 - Rfree >= `r_shell_max` in the highest resolution shell
+* 9 - Rwork >= `r_shell_max` in the highest resolution shell
+* 10 - CCwork > CC*
+* 11 - CC1/2 <= 0, CC* undefined
+* 12 - overall Rwork increased more than `rwork_increase`
+
+A shell is accepted by the strict algorithm if all its ratings are lower
+than 5 and by the benevolent algorithm if they are lower than 7.
+"""
+from __future__ import print_function
+import argparse
+import glob
+import json
+import os
+from collections import OrderedDict
+from .commons import twodec, twodecname, warning_my, InputError
+from .settings import current_context, workpath
+
+# Default thresholds of the ratings
+THRESHOLDS = OrderedDict([
+    ("r_shell_max", 0.45),    # R-value in the highest resolution shell
+    ("r_shell_warn", 0.40),   # R-value in the highest resolution shell
+    ("nfree_min", 50),        # Number of free reflections in the shell
+    ("rfree_decrease", 0.000009),  # Overall Rfree(diff) still "decreased"
+    ("rfree_constant", 0.000209),  # Overall Rfree(diff) still "constant"
+    ("rwork_increase", 0.01)])     # Overall Rwork(diff) "increased much"
+
+THRESHOLDS_HELP = {
+    "r_shell_max": "Rwork or Rfree in the highest resolution shell which "
+                   "rejects the shell",
+    "r_shell_warn": "Rwork or Rfree in the highest resolution shell which "
+                    "rejects the shell by the strict algorithm",
+    "nfree_min": "number of free reflections in a shell below which its "
+                 "Rfree is not trusted",
+    "rfree_decrease": "largest change of the overall Rfree considered as "
+                      "a decrease",
+    "rfree_constant": "largest change of the overall Rfree considered as "
+                      "constant",
+    "rwork_increase": "change of the overall Rwork considered as a large "
+                      "increase"}
+
+
+def to_float(value):
+    """Converts a value from a CSV file (`nan` if it is not a number)."""
+    try:
+        return float(value)
+    except ValueError:
+        return float("nan")
+
+
+class TableReader(object):
+    """Reads the lines added to a CSV file since the last reading (comment
+    lines are skipped). If the file has been replaced or rewritten, it is
+    read again from the beginning.
+
+    Args:
+        filename (str)
+    """
+    HEAD = 256  # bytes compared to recognize a rewritten file
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.reset()
+
+    def reset(self):
+        self.rows = []
+        self.offset = 0
+        self.inode = None
+        self.head = b""
+
+    def read(self):
+        """Returns the split data lines of the file (an empty list if the
+        file does not exist).
+
+        Returns:
+            list
+        """
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            self.reset()
+            return self.rows
+        with open(self.filename, "rb") as csvfile:
+            if (stat.st_dev, stat.st_ino) != self.inode or \
+                    stat.st_size < self.offset or \
+                    csvfile.read(len(self.head)) != self.head:
+                self.reset()
+                self.inode = (stat.st_dev, stat.st_ino)
+            csvfile.seek(self.offset)
+            data = csvfile.read()
+        data = data[:data.rfind(b"\n") + 1]  # only complete lines
+        self.head = (self.head + data)[:self.HEAD]
+        self.offset += len(data)
+        for line in data.decode("utf-8", "replace").splitlines():
+            if line.strip() and line.lstrip()[0] != "#":
+                self.rows.append(line.split())
+        return self.rows
+
+
+class CutoffEngine(object):
+    """Rates the high resolution shells and suggests the cutoff (see the
+    description of :mod:`pairef.cutoff`).
+
+    Args:
+        project (str): Name of the project
+        n_bins_low (int): Number of resolution bins up to the initial
+                          resolution
+        flag (int): Free reflection set whose statistics are used (not for
+                    the complete cross-validation)
+        complete (bool): Complete cross-validation (only the overall
+                         statistics averaged over the sets are used)
+        thresholds (dict): Thresholds of the ratings which differ from
+                           :data:`THRESHOLDS`
+        directory (str): Working directory of the run (relative to the
+                         directory in which the run takes place, see
+                         :func:`pairef.settings.workpath`)
+    """
+    def __init__(self, project, n_bins_low, flag=0, complete=False,
+                 thresholds=None, directory="."):
+        self.project = project
+        self.n_bins_low = n_bins_low
+        self.flag = flag
+        self.complete = complete
+        self.thresholds = OrderedDict(THRESHOLDS)
+        for key, value in (thresholds or {}).items():
+            if key not in THRESHOLDS:
+                raise InputError("Unknown threshold " + key + ".")
+            if value is not None:
+                self.thresholds[key] = value
+        self.directory = workpath(directory)
+        self.overall = TableReader(self.path(project + "_R-values.csv"))
+        self.gap = TableReader(self.path(project + "_Rgap.csv"))
+        self.files = {}    # filename -> (size, mtime), content
+        self.ratings = {}  # shell -> statistics, rating, reason
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def key(self):
+        """Returns what the engine has been made for (see
+        :func:`engine_for`)."""
+        return (self.project, self.n_bins_low, self.flag, self.complete,
+                tuple(self.thresholds.items()), self.directory)
+
+    def _read(self, filename):
+        """Returns the lines of a file which are read again only if its
+        size or modification time change (`None` if it does not exist)."""
+        try:
+            stat = os.stat(self.path(filename))
+        except OSError:
+            return None
+        state = (stat.st_size, stat.st_mtime)
+        if filename not in self.files or self.files[filename][0] != state:
+            with open(self.path(filename), "r") as csvfile:
+                self.files[filename] = (state, csvfile.readlines())
+        return self.files[filename][1]
+
+    def merging_stats(self):
+        """Returns lists of CC1/2 and CC* in the high resolution shells
+        (`None` if unmerged data have not been processed)."""
+        lines = self._read(self.project + "_merging_stats.csv")
+        if lines is None:
+            return None
+        CChalf_list = []
+        CCstar_list = []
+        for line in lines[1 + self.n_bins_low:]:  # high-res only
+            if line.lstrip()[0] == "#":  # If it is a comment
+                continue                 # do not load data
+            CCstar_list.append(to_float(line.split()[-1]))
+            CChalf_list.append(to_float(line.split()[-3]))
+        return CChalf_list, CCstar_list
+
+    def shell_stats(self, shell):
+        """Returns Nfree, Rwork, Rfree, and CCwork in the highest resolution
+        shell of the model refined up to `shell`."""
+        lines = self._read(self.project + "_R" + str(self.flag).zfill(2) +
+                           "_" + twodecname(shell) + "A.csv")
+        if lines is None:
+            raise InputError("Statistics of the structure model refined at "
+                             "" + twodec(shell) + " A were not found.")
+        line = lines[-1].split()  # highest-res only
+        return tuple(to_float(line[column]) for column in (5, 6, 7, 8))
+
+    def overall_diff(self, i):
+        """Returns the differences of the overall Rwork and Rfree after
+        adding the `i`-th high resolution shell."""
+        rows = self.overall.read()
+        if i >= len(rows):
+            raise InputError("Overall statistics of the high resolution "
+                             "shell " + str(i + 1) + " were not found in "
+                             "" + self.overall.filename + ".")
+        values = []
+        for column in (3, 6):
+            try:
+                values.append(float(rows[i][column]))
+            except ValueError:
+                values.append(None)
+        return tuple(values)
+
+    def rate(self, shells, i):
+        """Returns the ratings and their reasons of the `i`-th high
+        resolution shell. They are calculated again only if the statistics
+        of the shell have changed.
+
+        Args:
+            shells (list): High resolution limits (the first one is the
+                           initial resolution)
+            i (int): Index of the high resolution shell (from 0)
+
+        Returns:
+            (tuple): Lists of the ratings and of the reasons
+        """
+        shell = shells[i + 1]
+        merging = self.merging_stats()
+        statistics = (shells[i], self.overall_diff(i),
+                      None if self.complete else self.shell_stats(shell),
+                      merging and (merging[0][i], merging[1][i]))
+        if shell in self.ratings and self.ratings[shell][0] == statistics:
+            return self.ratings[shell][1:]
+        rating, reason = self._rate(shells[i], shell, *statistics[1:])
+        self.ratings[shell] = (statistics, rating, reason)
+        return rating, reason
+
+    def _rate(self, res_prev, shell, overall, shell_stats, merging):
+        t = self.thresholds
+        rating = []
+        reason = []
+        reason_phrase = " while using data in the shell " + \
+            twodec(res_prev) + "-" + twodec(shell) + " A"
+        if shell_stats:
+            Nfree, Rwork, Rfree, CCwork = shell_stats
+        # If CC* is undefined or smaller than CCwork
+        if merging:
+            CChalf, CCstar = merging
+            if CChalf <= 0 or CChalf == float("nan"):
+                rating.append(11)
+                reason.append("CC1/2 in high resolution is negative or "
+                              "undefined" + reason_phrase)
+            else:
+                if not self.complete:
+                    if CCstar < CCwork or CCstar == float("nan"):
+                        rating.append(10)
+                        reason.append("CC* in high resolution is lower "
+                                      "than CCwork" + reason_phrase)
+        # If an R-value >= r_shell_max or >= r_shell_warn
+        if not self.complete:
+            # Rwork
+            if Rwork >= t["r_shell_max"] or Rwork == float("nan"):
+                rating.append(9)
+                reason.append("Rwork in high resolution is higher than "
+                              "" + twodec(t["r_shell_max"]) + reason_phrase)
+            elif Rwork >= t["r_shell_warn"]:
+                rating.append(6)
+                reason.append("Rwork in high resolution is higher than "
+                              "" + twodec(t["r_shell_warn"]) + reason_phrase)
+            # Rfree
+            if Nfree < t["nfree_min"]:
+                warning_phrase = \
+                    "here are only " + str(int(Nfree)) + " < " + \
+                    str(t["nfree_min"]) + " free reflections in the " + \
+                    "resolution shell " + twodec(res_prev) + "-" + \
+                    twodec(shell) + " A. Values of statistics Rfree and " + \
+                    "CCfree in this shell could be misleading. Consider " + \
+                    "setting thicker resolution shells."
+            if Rfree >= t["r_shell_max"] or Rfree == float("nan"):
+                if Nfree >= t["nfree_min"]:
+                    rating.append(8)
+                    reason.append("Rfree in high resolution is higher than "
+                                  "" + twodec(t["r_shell_max"]) +
+                                  reason_phrase)
+                else:
+                    rating.append(4)
+                    reason.append(
+                        "Rfree in high resolution is higher than "
+                        "" + twodec(t["r_shell_max"]) + reason_phrase +
+                        ". But t" + warning_phrase)
+                    warning_my("lowNfree" + twodec(shell), "T" + warning_phrase)
+            elif Rfree >= t["r_shell_warn"]:
+                if Nfree >= t["nfree_min"]:
+                    rating.append(5)
+                    reason.append("Rfree in high resolution is higher than "
+                                  "" + twodec(t["r_shell_warn"]) +
+                                  reason_phrase)
+                else:
+                    rating.append(3)
+                    reason.append(
+                        "Rfree in high resolution is higher than "
+                        "" + twodec(t["r_shell_warn"]) + reason_phrase +
+                        ". But t" + warning_phrase)
+                    warning_my("lowNfree" + twodec(shell), "T" + warning_phrase)
+        # Differences in overall R-values
+        Rwork_diff, Rfree_diff = overall
+        if Rwork_diff > t["rwork_increase"]:
+            rating.append(12)
+            reason.append("Overall Rwork increased pretty much" +
+                          reason_phrase)
+        elif Rfree_diff <= t["rfree_decrease"]:
+            rating.append(1)
+            reason.append("Overall Rfree decreased" + reason_phrase)
+        elif Rfree_diff <= t["rfree_constant"] and Rwork_diff > 0:
+            rating.append(2)
+            reason.append("Overall Rwork increased and Rfree remained "
+                          "constant" + reason_phrase)
+        else:
+            rating.append(7)
+            reason.append("Overall Rfree increased" + reason_phrase)
+        return rating, reason
+
+    def gap_values(self):
+        """Returns lists of the overall Rwork and Rfree of the structure
+        models calculated at the initial resolution (including the model
+        refined at the initial resolution)."""
+        rows = self.gap.read()
+        return [to_float(row[1]) for row in rows], \
+            [to_float(row[2]) for row in rows]
+
+    def suggest(self, shells):
+        """Suggests the cutoff using the strict and the benevolent
+        algorithm.
+
+        Args:
+            shells (list): High resolution limits (the first one is the
+                           initial resolution)
+
+        Returns:
+            (tuple):
+                * cutoff (*list*): Strict and benevolent cutoff
+                * accepted (*list*): For every high resolution shell,
+                  whether it is accepted by the strict and the benevolent
+                  algorithm
+                * reason (*list*): For every high resolution shell, the
+                  reasons of the decision
+        """
+        t = self.thresholds
+        shells_high = shells[1:]
+        rating = []
+        reason = []
+        for i in range(len(shells_high)):
+            rating_shell, reason_shell = self.rate(shells, i)
+            rating.append(rating_shell)
+            reason.append(list(reason_shell))  # the cached list is kept
+        cutoff = [shells[0], shells[0]]
+        accepted = []  # order in list: [strict, benevolent] algorithm
+        reason_phrase_bad_previous = \
+            "But statistics deteriorate in a previous resolution shell."
+        for i, shell in enumerate(shells_high):
+            accepted.append([None, None])
+            # strict
+            if i != 0 and not accepted[i - 1][0]:
+                accepted[i][0] = False
+                reason[i].insert(0, reason_phrase_bad_previous)
+            elif max(rating[i]) < 5:
+                accepted[i][0] = True
+                cutoff[0] = shell
+            elif max(rating[i]) >= 5:
+                accepted[i][0] = False
+            # benevolent
+            if max(rating[i]) >= 7:
+                accepted[i][1] = False
+            elif max(rating[i]) < 7:
+                if i >= 2 and not accepted[i - 1][1] and \
+                        not accepted[i - 2][1]:
+                    accepted[i][1] = False
+                    reason[i].insert(0, reason_phrase_bad_previous)
+                elif i != 0 and not accepted[i - 1][1] and \
+                        max(rating[i - 1]) > 7:
+                    accepted[i][1] = False
+                    reason[i].insert(0, reason_phrase_bad_previous)
+                elif i != 0 and not accepted[i - 1][1] and \
+                        max(rating[i - 1]) == 7:
+                    # Analyse R-values at initial resolution
+                    # Be aware: the lists have an extra element in the
+                    # beggining - for the initial resolution!
+                    Rwork_overall_alt_list, Rfree_overall_alt_list = \
+                        self.gap_values()
+                    Rfree_overall_alt_diff = Rfree_overall_alt_list[i + 1] - \
+                        Rfree_overall_alt_list[i - 1]
+                    Rwork_overall_alt_diff = Rwork_overall_alt_list[i + 1] - \
+                        Rwork_overall_alt_list[i - 1]
+                    # Decide about the current and previous shell
+                    if Rfree_overall_alt_diff < 0 or \
+                            (Rfree_overall_alt_diff <= t["rfree_constant"] and
+                             Rwork_overall_alt_diff > 0):
+                        accepted[i - 1][1] = True
+                        reason[i - 1][-1] += \
+                            ". But the next shell compensates it."
+                        accepted[i][1] = True
+                        cutoff[1] = shell
+                    else:
+                        accepted[i][1] = False
+                        reason[i].insert(0, reason_phrase_bad_previous)
+                else:
+                    accepted[i][1] = True
+                    cutoff[1] = shell
+        return cutoff, accepted, reason
+
+
+def engine_for(project, n_bins_low, flag=0, complete=False, thresholds=None,
+               directory="."):
+    """Returns the cutoff engine of the current run (see
+    :class:`pairef.settings.RunContext`), a new one is made if the
+    arguments differ from the previous call.
+
+    Returns:
+        CutoffEngine
+    """
+    context = current_context()
+    engine = CutoffEngine(project, n_bins_low, flag, complete, thresholds,
+                          directory)  # nothing is read yet
+    if context.cutoff is None or context.cutoff.key() != engine.key():
+        context.cutoff = engine
+    return context.cutoff
+
+
+def read_summary(workdir, project=None):
+    """Reads the summary of a finished run (file
+    PAIREF_`project`_summary.json written by
+    :func:`pairef.launcher.write_summary`).
+
+    Args:
+        workdir (str): Working directory of the run
+        project (str): Name of the project (required only if the directory
+                       contains more runs)
+
+    Returns:
+        dict
+
+    Raises:
+        InputError: The summary was not found
+    """
+    if project:
+        filenames = [os.path.join(workdir,
+                                  "PAIREF_" + project + "_summary.json")]
+    else:
+        filenames = sorted(glob.glob(os.path.join(workdir,
+                                                  "PAIREF_*_summary.json")))
+    filenames = [f for f in filenames if os.path.isfile(f)]
+    if not filenames:
+        raise InputError("Directory " + workdir + " does not contain "
+                         "a summary of a finished run of PAIREF.")
+    if len(filenames) > 1:
+        raise InputError("Directory " + workdir + " contains more runs of "
+                         "PAIREF. Choose the project using the option -p.")
+    with open(filenames[0], "r") as summaryfile:
+        summary = json.load(summaryfile)
+    # Summaries of older versions
+    if summary.get("complete_cross_validation") is None:
+        summary["complete_cross_validation"] = len(summary["flag_sets"]) > 1
+    if summary.get("flag") is None:
+        summary["flag"] = summary["flag_sets"][-1]
+    if summary.get("n_bins_low") is None:
+        merging = os.path.join(workdir, summary["project"] +
+                               "_merging_stats.csv")
+        n_bins_low = 0
+        if os.path.isfile(merging):
+            with open(merging, "r") as csvfile:
+                n_bins_low = len(csvfile.readlines()) - \
+                    len(summary["shells"])
+        summary["n_bins_low"] = n_bins_low
+    return summary
+
+
+def recut(workdir, thresholds=None, project=None):
+    """Suggests the cutoff of a finished run again using other thresholds
+    (no refinement is performed, no file is changed).
+
+    Args:
+        workdir (str): Working directory of the run
+        thresholds (dict): Thresholds which differ from :data:`THRESHOLDS`
+        project (str): Name of the project
+
+    Returns:
+        (tuple): See :meth:`CutoffEngine.suggest`
+    """
+    summary = read_summary(workdir, project)
+    engine = CutoffEngine(summary["project"], summary["n_bins_low"],
+                          summary["flag"],
+                          summary["complete_cross_validation"],
+                          thresholds, workdir)
+    return engine.suggest(summary["shells"])
+
+
+def recut_command(input_args):
+    """Processes the arguments of the command `pairef recut` and runs it.
+
+    Args:
+        input_args (list): Command and its arguments
+    """
+    parser = argparse.ArgumentParser(prog="pairef recut")
+    parser.add_argument("workdir", help="working directory of a finished run")
+    parser.add_argument("-p", "--project", dest="project",
+                        help="project name (if the directory contains more "
+                        "runs)")
+    for key, default in THRESHOLDS.items():
+        parser.add_argument(
+            "--" + key.replace("_", "-"), dest=key,
+            type=type(default), default=None,
+            help=THRESHOLDS_HELP[key] + " (" + str(default) + " by default)")
+    args = parser.parse_args(input_args[1:])
+    thresholds = dict((key, getattr(args, key)) for key in THRESHOLDS)
+    summary = read_summary(args.workdir, args.project)
+    cutoff, accepted, reason = recut(args.workdir, thresholds,
+                                     summary["project"])
+    shells = summary["shells"]
+    for i, shell in enumerate(shells[1:]):
+        print(twodec(shells[i]) + "-" + twodec(shell) + " A: " +
+              ("accepted" if accepted[i][0] else "rejected") + " (strict), " +
+              ("accepted" if accepted[i][1] else "rejected") +
+              " (benevolent)")
+        for phrase in reason[i]:
+            print("   " + phrase)
+    print("Suggested cutoff: ")
+    if cutoff[0] == cutoff[1]:
+        print(twodec(cutoff[0]) + " A")
+    else:
+        print(twodec(cutoff[0]) + " A  (strict)")
+        print(twodec(cutoff[1]) + " A  (benevolent)")
+
@@ -1,6 +1,8 @@
 # coding: utf-8
 import os
 import sys
+import functools
+import threading
 import matplotlib
 matplotlib.use('agg')  # TKinter makes problems, agg should work
 import matplotlib.pyplot as plt
@@ -12,8 +14,26 @@ import platform
 import shutil
 import warnings
 from .commons import twodec, twodecname, fourdec, pick_work_free_from_csv_line
-from .preparation import which
-from .settings import warning_dict, date_time
+from .commons import StatisticsError
+from .tools import find
+from .settings import warning_dict, current_context, workpath
+from .progress import get_cycles, progress_html
+from .scratch import results_dir
+from .timing import timed, profiler
+
+# The figures of pyplot are global, charts of runs in more threads (see
+# :mod:`pairef.batch`) are drawn one after another
+_pyplot_lock = threading.Lock()
+
+
+def pyplot_locked(function):
+    """Decorator of functions drawing charts by pyplot, only one of them
+    runs at a time."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with _pyplot_lock:
+            return function(*args, **kwargs)
+    return wrapper
 
 
 def xticklabels_compress(list, n_max=13, depth=1):
@@ -51,6 +71,8 @@ def xticklabels_compress(list, n_max=13, depth=1):
     return list
 
 
+@timed("graphs")
+@pyplot_locked
 def matplotlib_bar(args, values="R-values", flag_sets=[], ready_shells=[]):
     """Plots and saves a bar chart using `matplotlib`.
 
@@ -103,7 +125,7 @@ def matplotlib_bar(args, values="R-values", flag_sets=[], ready_shells=[]):
             xticklabels_list.append(xticklabel)
             csvfilename = args.project + "_R" + str(flag).zfill(2) + "_" \
                 "" + values + ".csv"
-            with open(csvfilename, "r") as csvfile:
+            with open(workpath(csvfilename), "r") as csvfile:
                 last_line = csvfile.readlines()[-1]
             values_work_list, values_free_list, errors_work_list, \
                 errors_free_list, continue_sign = \
@@ -120,7 +142,7 @@ def matplotlib_bar(args, values="R-values", flag_sets=[], ready_shells=[]):
         values_free_zero = sum(1 for i in values_free_list if float(i) == 0)
         # Load data - average statistics
         csvfilename = args.project + "_" + values + ".csv"
-        with open(csvfilename, "r") as csvfile:
+        with open(workpath(csvfilename), "r") as csvfile:
             last_line = csvfile.readlines()[-1]
         values_work_list, values_free_list, errors_work_list, \
             errors_free_list, continue_sign = pick_work_free_from_csv_line(
@@ -179,7 +201,7 @@ def matplotlib_bar(args, values="R-values", flag_sets=[], ready_shells=[]):
             color2 = "#6AADE4"
             errors = False
         # Load data
-        with open(csvfilename, "r") as csvfile:
+        with open(workpath(csvfilename), "r") as csvfile:
             for line in csvfile.readlines():
                 values_work_list, values_free_list, errors_work_list, \
                     errors_free_list, continue_sign = \
@@ -224,13 +246,15 @@ def matplotlib_bar(args, values="R-values", flag_sets=[], ready_shells=[]):
         # There is a bug in matplotlib 1.x.x
         # https://github.com/matplotlib/matplotlib/issues/5209
         warnings.simplefilter(action='ignore', category=FutureWarning)
-        plt.savefig(pngfilename, bbox_inches="tight", dpi=96)
+        plt.savefig(workpath(pngfilename), bbox_inches="tight", dpi=96)
         # plt.savefig(pngfilename + ".eps", bbox_inches="tight", format="eps")
     plt.clf()
     plt.close('all')
     return pngfilename
 
 
+@timed("graphs")
+@pyplot_locked
 def matplotlib_line(shells, project, statistics, n_bins_low, title, flag=0,
                     multiscale=False, filename_suffix="", refinement="refmac"):
     """Plots statistics values (choice by `statistics`)
@@ -313,7 +337,7 @@ def matplotlib_line(shells, project, statistics, n_bins_low, title, flag=0,
 
             csvfilename = project + "_R" + str(flag).zfill(2) + "_" \
                 "" + twodecname(shells[-1]) + "A.csv"
-            with open(csvfilename, "r") as csvfile:
+            with open(workpath(csvfilename), "r") as csvfile:
                 for line in csvfile.readlines():
                     if line.lstrip()[0] == "#":  # If it is a comment,
                         continue                 # do not load data
@@ -326,7 +350,7 @@ def matplotlib_line(shells, project, statistics, n_bins_low, title, flag=0,
                 csvfilename = project + "_R" + str(flag).zfill(2) + "_" \
                     "" + twodecname(shells[i]) + "A.csv"
                 values_list_list.append([])
-                with open(csvfilename, "r") as csvfile:
+                with open(workpath(csvfilename), "r") as csvfile:
                     for line in csvfile.readlines():
                         if line.lstrip()[0] == "#":  # If it is a comment,
                             continue                 # do not load data
@@ -368,7 +392,7 @@ def matplotlib_line(shells, project, statistics, n_bins_low, title, flag=0,
             else:  # statistic == "res_opt"
                 csvfilename = project + "_Optical_resolution.csv"
                 values_column = 1
-            with open(csvfilename, "r") as csvfile:
+            with open(workpath(csvfilename), "r") as csvfile:
                 for line in csvfile.readlines():
                     if line.lstrip()[0] == "#":  # If it is a comment,
                         continue                 # do not load data
@@ -399,9 +423,20 @@ def matplotlib_line(shells, project, statistics, n_bins_low, title, flag=0,
                 
             prefix = project + "_R" + str(flag).zfill(2) + "_" + \
                     twodecname(shells[-1]) + "A"
-            if refinement == "refmac":
+            # Values read from the standard output while the job was running
+            cycles = get_cycles(prefix)
+            if cycles:
+                if statistic == "Rfree_cyc":
+                    values_list = cycles[2]
+                else:
+                    values_list = cycles[1]
+                if not len(xticklabels_list) == len(xshell_list):
+                    xticklabels_list = cycles[0]
+                if refinement == "phenix":
+                    xticklabels_rotation = 90
+            elif refinement == "refmac":
                 logfilename = prefix + ".log"
-                with open(logfilename, "r") as logfile:
+                with open(workpath(logfilename), "r") as logfile:
                     lines = logfile.readlines()
                 for i in range(len(lines)):
                     if "    Ncyc    Rfact    Rfree     FOM      -LL     " \
@@ -416,7 +451,7 @@ def matplotlib_line(shells, project, statistics, n_bins_low, title, flag=0,
             elif refinement == "phenix":
                 xticklabels_rotation = 90
                 logfilename = prefix + "_001.log"
-                with open(logfilename, "r") as logfile:
+                with open(workpath(logfilename), "r") as logfile:
                     lines = logfile.readlines()
                 for i in range(len(lines)):
                     if " stage r-work r-free bonds angles " \
@@ -424,11 +459,9 @@ def matplotlib_line(shells, project, statistics, n_bins_low, title, flag=0,
                             in lines[i]:
                         j = i + 1
                 if "j" not in vars():
-                    sys.stderr.write("ERROR: File " + str(logfilename) + " is "
-                                     "not in a proper format. "
-                                     "Statistics could not be found.\n"
-                                     "Aborting.\n")
-                    sys.exit(1)
+                    raise StatisticsError("File " + str(logfilename) +
+                                          " is not in a proper format. "
+                                          "Statistics could not be found.")
                 offset = 0
                 while lines[j][offset] != ":":
                     offset = offset + 1
@@ -454,18 +487,19 @@ def matplotlib_line(shells, project, statistics, n_bins_low, title, flag=0,
             ax.set_xlabel(r'Cycle')
             # dpi=64
 
-    if (os.path.isfile(project + "_merging_stats.csv") and statistics) \
+    if (os.path.isfile(workpath(project + "_merging_stats.csv"))
+            and statistics) \
             or "n_work" in statistics or "n_free" in statistics:
         if "graph_title" not in locals():
             graph_title = title
         if "pngfilename" not in locals():
             pngfilename = project + "_" + title + ".png"
         if "n_work" in statistics or "n_work" in statistics:
-            csvfilename = project + "_R" + str(flag).zfill(2) + "_" + \
-                twodecname(shells[-1]) + "A.csv"
+            csvfilename = workpath(project + "_R" + str(flag).zfill(2) + "_" +
+                                   twodecname(shells[-1]) + "A.csv")
             xticklabels_column = 3
-        elif os.path.isfile(project + "_merging_stats.csv"):
-            csvfilename = project + "_merging_stats.csv"
+        elif os.path.isfile(workpath(project + "_merging_stats.csv")):
+            csvfilename = workpath(project + "_merging_stats.csv")
             xticklabels_column = 2
         if not xshell_list and not xticklabels_list:
             with open(csvfilename, "r") as csvfile:
@@ -561,13 +595,14 @@ def matplotlib_line(shells, project, statistics, n_bins_low, title, flag=0,
     ax.set_xticklabels(xticklabels_list)
     plt.setp(ax.get_xticklabels(), horizontalalignment='center',
              rotation=xticklabels_rotation)
-    plt.savefig(pngfilename, bbox_inches="tight", dpi=dpi)
+    plt.savefig(workpath(pngfilename), bbox_inches="tight", dpi=dpi)
     # plt.savefig(pngfilename + ".eps", bbox_inches="tight", format="eps")
     plt.clf()
     plt.close('all')
     return pngfilename
 
 
+@timed("html")
 def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
                    res_cur=0, ready_merging_statistics=False, done=False,
                    cutoff=[], accepted=[], reason=[]):
@@ -642,6 +677,9 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
         page += """\n\t\t<span class="reload">""" \
             """<a href="javascript:window.location.reload(true)">""" \
             """REFRESH</a></span>\n"""
+        if os.path.isfile(workpath(progress_html(args.project))):
+            page += """\t\t<iframe class="progressframe" src="""" + \
+                progress_html(args.project) + """"></iframe>\n"""
         page += "\t</div>\n"
 
     if cutoff:  # Assuming vars `accepted` and `reason` are also available
@@ -710,7 +748,16 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
     if args.tls_ncyc:
         page += "\t\t<tr><td>Number of cycles of TLS refinement:</td>" \
             "<td>" + str(args.tls_ncyc) + "</td></tr>\n"
-    if args.ncyc:
+    if getattr(args, "ncyc_auto", False):
+        page += "\t\t<tr><td>Number of refinement cycles that " \
+            "will be performed in every resolution step:</td>" \
+            "<td>automatic (up to " + str(args.ncyc_max) + ")"
+        if args.ncyc_chosen:
+            page += "; chosen after step at " + ", ".join(
+                twodec(res) + " &#8491;: " + str(ncyc)
+                for res, ncyc in args.ncyc_chosen)
+        page += "</td></tr>\n"
+    elif args.ncyc:
         page += "\t\t<tr><td>Number of refinement cycles that " \
             "will be performed in every resolution step:</td>" \
             "<td>" + str(args.ncyc) + "</td></tr>\n"
@@ -759,9 +806,9 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
     page += "\t\t<h2>Run details and program versions</h2>\n"
     page += "\t\t<table>\n"
     page += "\t\t<tr><td>Working directory:</td>" \
-        "<td>" + os.getcwd() + "</td></tr>\n"
+        "<td>" + results_dir() + "</td></tr>\n"
     page += "\t\t<tr><td>Run date and time:</td>" \
-        "<td>" + date_time + "</td></tr>\n"
+        "<td>" + current_context().date_time + "</td></tr>\n"
     page += "\t\t<tr><td>user@host:</td><td>" \
         "" + getpass.getuser() + "@" + socket.gethostname() + "</td></tr>\n"
     page += "\t\t<tr><td><i>PAIREF</i> version:</td>" \
@@ -782,7 +829,8 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
     # Show general warnings if there are some
     warning_keys = ["workdir", "low_res", "refinement_version_mismatch",
                     "refinement_not_before", "no_modification",
-                    "mtzdump", "binning", "flags", "amb_labels"]
+                    "mtzdump", "binning", "flags", "amb_labels", "prescreen",
+                    "retry", "failed"]
     page = warning_orangebox(warning_keys, page)
     if ready_shells:
         if len(ready_shells) >= 2:
@@ -802,7 +850,8 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
                 '_R-values.csv">' + args.project + '_R-values.csv' \
                 '</a><br />\n'
             page += '\t\t\t\t<pre>\n'
-            with open(args.project + "_R-values.csv", "r") as csvfile:
+            with open(workpath(args.project + "_R-values.csv"),
+                      "r") as csvfile:
                 page += html.escape(csvfile.read())
             page += '</pre>'
             page += '\n\t\t\t\t<p class="note">Note: For each incremental ' \
@@ -857,7 +906,7 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
                 graphs = ["Rfree", "CCfree", "Rwork", "CCwork"]
             for i, graph in enumerate(graphs):
                 pngfilename = args.project + "_" + graph + ".png"
-                if os.path.isfile(pngfilename):
+                if os.path.isfile(workpath(pngfilename)):
                     page += '\t\t'
                     if not args.ccp4cloud:
                         page += '<a href="' + args.project + '_' + graph + '.png">'
@@ -882,7 +931,7 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
             # Show No. work free reflections graph
             graph = "No_work_free_reflections"
             pngfilename = args.project + "_" + graph + ".png"
-            if os.path.isfile(pngfilename):
+            if os.path.isfile(workpath(pngfilename)):
                 page += '\t\t'
                 if not args.ccp4cloud:
                     page += '<a href="' + args.project + '_' + graph + '.png">'
@@ -896,7 +945,7 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
     # Optical resolution
     pngfilename = args.project + "_Optical_resolution.png"
     csvfilename = args.project + "_Optical_resolution.csv"
-    if os.path.isfile(pngfilename):
+    if os.path.isfile(workpath(pngfilename)):
         page += "\t<h2>Optical resolution</h2>\n"
         if not args.ccp4cloud:
             page += '\t\t<a href="' + pngfilename + '">'
@@ -911,7 +960,7 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
 
     csvfilename = args.project + "_merging_stats.csv"
     if args.hklin_unmerged and ready_merging_statistics \
-            and os.path.isfile(csvfilename):
+            and os.path.isfile(workpath(csvfilename)):
         graphs = ["CC", "Intensities", "Comp_Mult", "Rmerge_Rmeas_Rpim",
                   "No_reflections"]
         page += "\t<h2>Merging statistics</h2>\n"
@@ -930,7 +979,8 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
             '_merging_stats.csv">' \
             '' + args.project + '_merging_stats.csv</a></p>\n'
         page += '\t\t<pre>\n'
-        with open(args.project + "_merging_stats.csv", "r") as csvfile:
+        with open(workpath(args.project + "_merging_stats.csv"),
+                  "r") as csvfile:
             page += html.escape(csvfile.read())
         page += '\t\t</pre>\n'
 
@@ -956,7 +1006,7 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
                     logfilename = prefix + '.log'
                     pdbfilename = prefix + '.pdb'
                     ciffilename = prefix + '.mmcif'
-                if os.path.isfile(pngfilename):
+                if os.path.isfile(workpath(pngfilename)):
                     page += '\t\t\t<div class="column">\n'
                     page += '\t\t\t\t'
                     if not args.ccp4cloud:
@@ -977,6 +1027,28 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
                     page += '\t\t\t</div>\n'
             page += '\t\t</div>\n'
             page += '\t\t</div>\n'
+    # Where the time was spent
+    if done and profiler.events:
+        page += "\t<h2>Time profile</h2>\n"
+        page += "\t\t<table>\n\t\t<tr><th>Stage</th><th>Category</th>" \
+            "<th>Calls</th><th>Wall time (s)</th>" \
+            "<th>CPU time of programs (s)</th>" \
+            "<th>Peak memory (MB)</th></tr>\n"
+        for stage in profiler.summary():
+            page += "\t\t<tr><td>" + stage["name"] + "</td><td>" + \
+                stage["category"] + "</td><td>" + str(stage["calls"]) + \
+                "</td><td>" + twodec(stage["wall"]) + "</td><td>" + \
+                twodec(stage["cpu"] if stage["cpu"] is not None else "-") + \
+                "</td><td>" + \
+                twodec(stage["maxrss"] if stage["maxrss"] is not None
+                       else "-") + "</td></tr>\n"
+        page += "\t\t</table>\n"
+        page += "\t\tStages are nested (<i>e.g.</i> programs run within " \
+            "refinement), so their times overlap. The complete profile is " \
+            "saved in <a href=\"" + args.project + "_profile.json\">" + \
+            args.project + "_profile.json</a> and the timeline in " \
+            "<a href=\"" + args.project + "_profile_trace.json\">" + \
+            args.project + "_profile_trace.json</a> (Chrome trace format).\n"
     page += """
 \t<h2>References</h2>
 \t\tPlease cite the used software:
@@ -991,7 +1063,7 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
         page += "\t\t<li>Towards automated crystallographic structure refinement with <i>phenix.refine</i>. P.V. Afonine, R.W. Grosse-Kunstleve, N. Echols, J.J. Headd, N.W. Moriarty, M. Mustyakimov, T.C. Terwilliger, A. Urzhumtsev, P.H. Zwart, P.D. Adams (2012) <i>Acta Cryst. D</i><b>68</b>:352-67</li>\n"
     else:
         page += "\t\t<li><i>REFMAC</i>5 for the refinement of macromolecular ""crystal structures. G.N. Murshudov, P. Skubak, A.A. Lebedev, N.S. Pannu, R.A. Steiner, R.A. Nicholls, M.D. Winn, F. Long, A.A. Vagin (2011) <i>Acta Cryst. D</i><b>67</b>:355-367</li>\n"
-    if which("sfcheck"):
+    if find("sfcheck"):
         page += "\t\t<li><i>SFCHECK</i>: a unified set of procedures for evaluating the quality of macromolecular structure-factor data and their agreement with the atomic model. A.A. Vaguine, J. Richelle, S.J. Wodak (1999) <i>Acta Cryst. D</i><b>55</b>:191-205</li>\n"
     page += """
 \t\t<li>The <i>Computational Crystallography Toolbox</i>: crystallographic algorithms in a reusable software framework. R.W. Grosse-Kunstleve, N.K. Sauter, N.W. Moriarty, P.D. Adams (2002) <i>J. Appl. Crystallogr.</i> <b>35</b>:126-136</li>
@@ -1009,16 +1081,16 @@ def write_log_html(shells, ready_shells, args, versions_dict, flag_sets,
 
     htmlfilename = "PAIREF_" + args.project + ".html"
     if int(platform.python_version_tuple()[0]) == 2:
-        with open(htmlfilename, "w") as htmlfile:
+        with open(workpath(htmlfilename), "w") as htmlfile:
             htmlfile.write(page)
     else:  # Python 3
-        with open(htmlfilename, "w", encoding="utf-8") as htmlfile:
+        with open(workpath(htmlfilename), "w", encoding="utf-8") as htmlfile:
             htmlfile.write(page)
 
     # Styles
     cssfilepath = str(os.path.dirname(os.path.abspath(__file__))) + \
         "/static/styles.css"
     if os.path.isfile(cssfilepath):
-        shutil.copy2(cssfilepath, ".")
+        shutil.copy2(cssfilepath, workpath("."))
 
     return htmlfilename
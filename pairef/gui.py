@@ -658,7 +658,7 @@ QLineEdit#required {
         if "win" in platform.system().lower() or "mac" in platform.system().lower():
             ccp4_command = sys.executable
         else:
-            from .preparation import which
+            from .commons import which
             if which("ccp4-python"):
                 ccp4_command = "ccp4-python"
             else:
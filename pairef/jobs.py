@@ -0,0 +1,404 @@
+# coding: utf-8
+from __future__ import print_function
+import os
+import subprocess
+import threading
+import time
+from .commons import Popen_my, RefinementError
+from .timing import profiler, maxrss_mb
+from .settings import current_context, current_output, output_to
+from .settings import ContextObject, workpath
+
+
+class JobError(RefinementError):
+    """An external program was killed (timeout, hang) or it has not created
+    the expected output files."""
+    pass
+
+
+def cpu_count():
+    """Returns a number of CPU cores available for this process.
+
+    Returns:
+        int
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Python 2, Windows, macOS
+        import multiprocessing
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+
+class OutputBuffer(object):
+    """Stream keeping the messages written by one item of
+    :meth:`JobRunner.map`."""
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+
+class JobRunner(object):
+    """Runs external programs (REFMAC5, phenix.refine, sfcheck, ...) within
+    a budget of CPU cores.
+
+    Every job gets `threads` cores - the number is passed to the program
+    via the environment variable `OMP_NUM_THREADS` (REFMAC5) and it should
+    be passed as `nproc` to phenix.refine by the caller. A job that does
+    not fit into the free cores waits until other jobs finish. The number
+    of jobs running at once via :meth:`map` follows from the number of
+    cores and threads per job.
+
+    A job is killed if it runs longer than `timeout` seconds or if its log
+    file has not grown for `stall_timeout` seconds. Callers may run a failed
+    job again up to `retries` times.
+
+    Runs of a batch (see :mod:`pairef.batch`) have their own runners
+    created with a common `pool` - the jobs of all the runs then reserve
+    their cores from the pool, one job at a time, and the own number of
+    cores of a runner only sets the threads per job.
+
+    Args:
+        n_cores (int): Number of CPU cores which can be used (all available
+                       cores by default)
+        threads (int): Number of threads per job (`n_cores` by default)
+        timeout (float): Wall-clock limit of a job in seconds (no limit
+                         by default)
+        stall_timeout (float): Limit in seconds for a job whose log file
+                               stopped growing (no limit by default)
+        retries (int): Number of repeated runs of a failed job
+        pool (JobRunner): Runner whose cores are shared with other runners
+    """
+    def __init__(self, n_cores=None, threads=None, timeout=None,
+                 stall_timeout=None, retries=1, pool=None):
+        self.condition = threading.Condition()
+        self.pool = pool
+        self.n_cores = 1
+        self.threads = 1
+        self.n_cores_free = 1
+        self.configure(n_cores, threads, timeout, stall_timeout, retries)
+
+    def configure(self, n_cores=None, threads=None, timeout=None,
+                  stall_timeout=None, retries=1):
+        """Sets the number of cores, threads per job and limits of jobs.
+        It should not be called while some jobs are running."""
+        with self.condition:
+            self.n_cores = max(1, n_cores or cpu_count())
+            self.threads = max(1, min(threads or self.n_cores, self.n_cores))
+            self.n_cores_free = self.n_cores
+            self.timeout = timeout
+            self.stall_timeout = stall_timeout
+            self.retries = retries
+            self.condition.notify_all()
+
+    @property
+    def n_slots(self):
+        """Number of jobs which can run at once."""
+        if self.pool is not None:
+            return max(1, self.pool.n_cores // self.threads)
+        return max(1, self.n_cores // self.threads)
+
+    def acquire(self, threads=None):
+        """Waits until `threads` cores are free and reserves them.
+
+        Returns:
+            int: Number of reserved cores
+        """
+        threads = max(1, min(threads or self.threads, self.n_cores))
+        if self.pool is not None:
+            return self.pool.acquire(threads)
+        with self.condition:
+            while self.n_cores_free < threads:
+                self.condition.wait()
+            self.n_cores_free -= threads
+        return threads
+
+    def release(self, threads):
+        """Returns `threads` cores reserved by :meth:`acquire`."""
+        if self.pool is not None:
+            self.pool.release(threads)
+            return
+        with self.condition:
+            self.n_cores_free = min(self.n_cores,
+                                    self.n_cores_free + threads)
+            self.condition.notify_all()
+
+    def environment(self, threads):
+        """Returns a copy of the environment limiting the number of threads
+        of OpenMP programs."""
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = str(threads)
+        return env
+
+    def run(self, command, com=None, stdout=None, stderr=None, threads=None,
+            shell=False, watch=None, on_line=None, details=None):
+        """Runs an external program when enough cores are free.
+
+        Args:
+            command (list): Program and its arguments
+            com (str): Standard input of the program (keywords)
+            stdout: Standard output (file object or `subprocess.PIPE`)
+            stderr: Standard error output (file object or `subprocess.PIPE`)
+            threads (int): Number of cores for this job (`self.threads`
+                           by default)
+            shell (bool): Execute through the shell
+            watch (str): Name of a log file whose growth is watched
+                         (see `stall_timeout`)
+            on_line (callable): Function called with every line of the
+                                standard output as soon as it is written,
+                                `stdout` has to be a file object then
+            details (dict): Further information about the job saved in the
+                            profile of the run
+
+        Returns:
+            (tuple):
+                * output (*str* or *None*)
+                * err (*str* or *None*)
+                * returncode (*int*)
+
+        Raises:
+            JobError: The job was killed after `timeout` or `stall_timeout`
+        """
+        threads = self.acquire(threads)
+        try:
+            if com is not None:
+                stdin = subprocess.PIPE
+            else:
+                stdin = None
+            logfile = stdout
+            if on_line is not None:
+                stdout = subprocess.PIPE
+                if stderr is logfile:
+                    stderr = subprocess.STDOUT
+            start = time.time()
+            context = current_context()
+            # Relative names of files in the command refer to the directory
+            # of the run
+            p = Popen_my(command, stdin=stdin, stdout=stdout, stderr=stderr,
+                         shell=shell, env=self.environment(threads),
+                         cwd=context.workdir)
+            communicated = {}
+
+            def communicate():
+                with context:  # `on_line` may use the run context
+                    communicated["out"] = self.communicate(p, com, logfile,
+                                                           on_line)
+
+            reason = None
+            if not self.timeout and not (self.stall_timeout and watch):
+                communicate()
+            else:  # communicate in a separate thread and watch the job
+                thread = threading.Thread(target=communicate)
+                thread.daemon = True
+                thread.start()
+                reason = self.watch(thread, watch)
+                if reason:
+                    p.kill()
+                    thread.join()
+            output, err, rusage = communicated["out"]
+            self.record(command, start, rusage, threads, p.returncode,
+                        reason, details)
+            if reason:
+                raise JobError("Job `" + " ".join(command) + "` was "
+                               "killed as " + reason + ".")
+        finally:
+            self.release(threads)
+        return output, err, p.returncode
+
+    def communicate(self, p, com, logfile, on_line):
+        """Passes `com` to the standard input of the process `p` and reads
+        its output until it ends. If `on_line` is given, the standard output
+        is copied to `logfile` line by line and every line is passed to
+        `on_line`.
+
+        Returns:
+            (tuple): Standard output and standard error output (if piped,
+            otherwise *None*) and resource usage of the process
+            (see :meth:`reap`)
+        """
+        if com is not None:
+            def write_stdin():
+                try:
+                    p.stdin.write(com)
+                    p.stdin.close()
+                except (IOError, OSError):  # the program has ended already
+                    pass
+            writer = threading.Thread(target=write_stdin)
+            writer.daemon = True
+            writer.start()
+        err = {}
+        if p.stderr is not None:
+            def read_stderr():
+                err["err"] = p.stderr.read()
+            reader = threading.Thread(target=read_stderr)
+            reader.daemon = True
+            reader.start()
+        output = None
+        if p.stdout is not None and on_line is None:
+            output = p.stdout.read()
+            p.stdout.close()
+        elif p.stdout is not None:
+            for line in iter(p.stdout.readline, ""):
+                logfile.write(line)
+                logfile.flush()
+                if on_line is not None:
+                    try:
+                        on_line(line)
+                    except Exception:
+                        # A failure of parsing must not affect the job
+                        # itself, the complete output is still saved in
+                        # `logfile`
+                        on_line = None
+            p.stdout.close()
+        if p.stderr is not None:
+            reader.join()
+            p.stderr.close()
+        if com is not None:
+            writer.join()
+        rusage = self.reap(p)
+        return output, err.get("err"), rusage
+
+    def reap(self, p):
+        """Waits until the process `p` ends and sets its return code.
+
+        Returns:
+            Resource usage of the process given by :func:`os.wait4` (*None*
+            if it is not available)
+        """
+        if not hasattr(os, "wait4"):  # Windows
+            p.wait()
+            return None
+        try:
+            pid, status, rusage = os.wait4(p.pid, 0)
+        except OSError:  # the process has been waited for already
+            p.wait()
+            return None
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        return rusage
+
+    def record(self, command, start, rusage, threads, returncode,
+               reason=None, details=None):
+        """Records the run of an external program in the profile of the run
+        (see :class:`pairef.timing.Profiler`)."""
+        if isinstance(command, str):
+            command = command.split()
+        details = dict(details or {})
+        details.update({"command": " ".join(command), "threads": threads,
+                        "returncode": returncode})
+        if reason:
+            details["killed"] = reason
+        cpu = maxrss = None
+        if rusage is not None:
+            cpu = rusage.ru_utime + rusage.ru_stime
+            maxrss = maxrss_mb(rusage.ru_maxrss)
+        profiler.record(os.path.basename(command[0]), "program", start,
+                        time.time(), cpu=cpu, maxrss=maxrss, details=details)
+
+    def watch(self, thread, watch=None, interval=1.0):
+        """Waits until `thread` finishes or a limit is exceeded.
+
+        Returns:
+            str: Reason why the job should be killed (*None* if it finished)
+        """
+        start = time.time()
+        last_size = -1
+        last_growth = start
+        while True:
+            thread.join(interval)
+            if not thread.is_alive():
+                return None
+            now = time.time()
+            if self.timeout and now - start > self.timeout:
+                return "it exceeded the time limit of " + \
+                    str(self.timeout) + " s"
+            if self.stall_timeout and watch:
+                try:
+                    size = os.path.getsize(workpath(watch))
+                except OSError:
+                    size = 0
+                if size != last_size:
+                    last_size = size
+                    last_growth = now
+                elif now - last_growth > self.stall_timeout:
+                    return "its log file " + watch + " has not grown " \
+                        "for " + str(self.stall_timeout) + " s"
+
+    def map(self, function, items, catch=()):
+        """Calls `function` for every item of `items` in parallel threads
+        (at most :attr:`n_slots` at once) and returns the results in the
+        order of `items`. Exceptions of types `catch` are returned as results
+        of the particular items, other exceptions (including `SystemExit`)
+        are raised again in the calling thread. The threads use the run
+        context of the calling thread (see
+        :class:`pairef.settings.RunContext`). Messages of the items (see
+        :func:`pairef.commons.print_my`) are kept until all threads finish
+        and then written in the order of `items`.
+
+        Args:
+            function (callable)
+            items (list)
+            catch (tuple): Types of exceptions that are returned
+
+        Returns:
+            list
+        """
+        def call(item):
+            try:
+                return function(item)
+            except catch as e:
+                return e
+
+        items = list(items)
+        if self.n_slots == 1 or len(items) <= 1:
+            return [call(item) for item in items]
+        results = [None] * len(items)
+        buffers = [OutputBuffer() for _ in items]
+        errors = []
+        lock = threading.Lock()
+        remaining = list(range(len(items)))
+        context = current_context()
+
+        def worker():
+            with context:
+                while True:
+                    with lock:
+                        if not remaining or errors:
+                            return
+                        i = remaining.pop(0)
+                    try:
+                        with output_to(buffers[i]):
+                            results[i] = call(items[i])
+                    except BaseException as e:  # including SystemExit
+                        with lock:
+                            errors.append(e)
+
+        workers = [threading.Thread(target=worker)
+                   for _ in range(min(self.n_slots, len(items)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+        output = current_output()
+        for buffer in buffers:
+            output.write(buffer.getvalue())
+        if errors:
+            raise errors[0]
+        return results
+
+
+# Runner of the active run context (see :class:`pairef.settings.RunContext`)
+job_runner = ContextObject("job_runner")
@@ -1,22 +1,26 @@
 # coding: utf-8
 from __future__ import print_function
 import argparse
+import json
 import sys
 import os
 import platform
-import shutil
-from .settings import warning_dict, settings
-from .preparation import welcome, create_workdir, output_log, def_res_shells
-from .preparation import which, res_high_from_xyzin, res_from_mtz, res_opt
-from .preparation import calculate_merging_stats, run_pdbtools
-from .preparation import res_from_hklin_unmerged, check_refinement_software
-from .preparation import suggest_cutoff
-from .commons import twodec, twodecname, warning_my, try_symlink, Popen_my
-from .commons import extract_from_file
-from .refinement import collect_stat_OVERALL, collect_stat_OVERALL_AVG
-from .refinement import collect_stat_BINNED
-from .refinement import calculate_stats_cctbx, get_f_cctbx
-from .graphs import matplotlib_bar, matplotlib_line, write_log_html
+from .settings import warning_dict, settings, RunContext
+from .settings import current_context, current_output, workpath
+from .jobs import job_runner, cpu_count, JobError
+from .progress import read_cycles, choose_ncyc
+from .timing import profiler, profile_call
+from .tools import find, registry as tools_registry
+from .planning import plan, describe_data
+from .shards import SUBCOMMANDS, run_subcommand
+from .scratch import stage, finish, results_dir
+from .artefacts import link_or_copy
+# The modules which import NumPy, matplotlib or CCTBX (preparation,
+# refinement, graphs) are imported by the functions of the protocol, so that
+# processing of the arguments does not wait for them
+from .commons import twodec, twodecname, warning_my, try_symlink, print_my
+from .commons import PairefError, InputError
+from .commons import ArgumentsError, SoftwareError, RefinementError
 
 
 RES_LOW = 50
@@ -61,9 +65,9 @@ class MyArgumentParser(argparse.ArgumentParser):
         self.add_argument(*args, **kwargs)
 
     def error(self, message):
-        sys.stderr.write('error: %s\n' % message)
-        print('Run `ccp4-python -m pairef -h` to show the help message.')
-        sys.exit(2)
+        """Raises :class:`ArgumentsError` instead of exiting, the message
+        is written by :func:`run_pairef`."""
+        raise ArgumentsError(message)
 
 
 # https://stackoverflow.com/questions/14117415/
@@ -76,6 +80,12 @@ def check_positive_int(value):
     return ivalue
 
 
+def check_ncyc(value):
+    if value == "auto":
+        return value
+    return check_positive_int(value)
+
+
 def check_non_negative_int(value):
     ivalue = int(value)
     if ivalue < 0:
@@ -92,15 +102,15 @@ def check_positive_float(value):
     return ivalue
 
 
-def process_arguments(input_args):
-    '''Processes input arguments using `argparse`.
+def make_parser(gui_only=False):
+    """Returns the parser of the input arguments of PAIREF.
 
     Args:
-        input_args (list): Input arguments
+        gui_only (bool): Only the option --GUI is added
 
     Returns:
-        list: Processed arguments
-    '''
+        MyArgumentParser
+    """
     from . import __version__
     # Input processing
     # parser = argparse.ArgumentParser(
@@ -120,11 +130,10 @@ def process_arguments(input_args):
         help='Start graphical user interface (usually requires '
         "to be executed as ccp4-python, not as cctbx.python)")
     ###########################   GUI   ######################################
-    if "--GUI" in input_args or "--gui" in input_args:   
-        args, args_unknown = parser.parse_known_args(input_args)
-        return args
+    if gui_only:
+        return parser
     ###########################   GUI   ######################################
-        
+
     parser.add_argument_with_check(
         '--XYZIN', '--xyzin', dest='xyzin',
         help='PDB or mmCIF file with current structure model', required=True)
@@ -176,6 +185,16 @@ def process_arguments(input_args):
         help='width of the added high resolution shells (in angstrom). '
         'Using this argument, setting of argument -n is required.',
         type=float)
+    group2.add_argument(
+        "--shell-nfree", dest='shell_nfree',
+        help="design high resolution shells so that each of them contains "
+        "at least the given number of free reflections",
+        type=check_positive_int)
+    group2.add_argument(
+        "--shell-nwork", dest='shell_nwork',
+        help="design high resolution shells so that each of them contains "
+        "at least the given number of work reflections",
+        type=check_positive_int)
     group2.add_argument(
         '-i', dest='res_init',
         help='initial high-resolution diffraction limit (in angstrom) '
@@ -183,6 +202,12 @@ def process_arguments(input_args):
         'do not use this option, the script should find resolution '
         'automatically in PDB or mmCIF file',
         type=float)
+    group2.add_argument(
+        "--prescreen", dest='prescreen',
+        help="calculate CC1/2 of the unmerged data in the high resolution "
+        "shells before refinement and skip the trailing shells in which "
+        "CC1/2 is negative or undefined (requires the option -u)",
+        action='store_true')
     group2.add_argument(
         '-f', "--flag", dest='flag',
         help="definition which FreeRflag set will be excluded during "
@@ -194,7 +219,29 @@ def process_arguments(input_args):
     group2.add_argument(
         "--ncyc", dest='ncyc',
         help="number of refinement cycles that will be performed in every "
-        "resolution step", type=check_positive_int)
+        "resolution step or `auto` to choose it from the convergence of "
+        "Rfree in the previous steps", type=check_ncyc)
+    group2.add_argument(
+        "--nproc", dest='nproc',
+        help="number of CPU cores to be used (all available cores by "
+        "default)", type=check_positive_int)
+    group2.add_argument(
+        "--threads", dest='threads',
+        help="number of threads of every REFMAC5 or phenix.refine job (by "
+        "default, the CPU cores are divided among the free reflection sets "
+        "refined at once)", type=check_positive_int)
+    group2.add_argument(
+        "--timeout", dest='timeout',
+        help="kill a REFMAC5 or phenix.refine job running longer than the "
+        "given time (in seconds)", type=check_positive_float)
+    group2.add_argument(
+        "--stall-timeout", dest='stall_timeout',
+        help="kill a REFMAC5 or phenix.refine job whose log file has not "
+        "grown for the given time (in seconds)", type=check_positive_float)
+    group2.add_argument(
+        "--retries", dest='retries',
+        help="number of repeated runs of a failed REFMAC5 or phenix.refine "
+        "job (1 by default)", type=check_non_negative_int)
     group2.add_argument(
         '--constant-grid', dest='constant_grid',
         help="keep the same FFT grid through the whole paired refinement "
@@ -208,6 +255,31 @@ def process_arguments(input_args):
         help="number of cycles of TLS refinement (10 cycles by default, "
         "only for REFMAC5)",
         type=check_positive_int)
+    group2.add_argument(
+        "--plan", action="store_true", dest='plan',
+        help="only list the jobs that would be run and estimate the runtime "
+        "(no working directory is created)")
+    group2.add_argument(
+        "--profile", action="store_true", dest='profile',
+        help="profile the Python code of PAIREF and save the results "
+        "(pstats and collapsed stacks for flame graphs) in the working "
+        "directory")
+    group2.add_argument(
+        "--keep-hklin", action="store_true", dest='keep_hklin',
+        help="copy the whole input MTZ file to the working directory "
+        "(by default, only the columns used for refinement are kept "
+        "unless keywords are given by --comin or --def)")
+    group2.add_argument(
+        "--scratch", dest='scratch',
+        help="run the refinement jobs in a new directory in the given "
+        "directory (e.g. on a local disk) and copy their files to the "
+        "working directory in the background")
+    group2.add_argument(
+        "--keep-intermediates", action="store_true",
+        dest='keep_intermediates',
+        help="keep all the intermediate files of the jobs calculating "
+        "statistics (by default, their logs are compressed and the other "
+        "files are removed when a step is finished)")
     group2.add_argument(
         "--open-browser", action="store_true", dest='open_browser',
         help="open web browser to show results "
@@ -274,6 +346,28 @@ def process_arguments(input_args):
         '-t', dest='test', help=argparse.SUPPRESS, action='store_true')
     parser.add_argument(
         '-q', dest='quick', help=argparse.SUPPRESS, action='store_true')
+    return parser
+
+
+def process_arguments(input_args):
+    '''Processes input arguments using `argparse`.
+
+    Args:
+        input_args (list): Input arguments
+
+    Returns:
+        list: Processed arguments
+
+    Raises:
+        ArgumentsError: The arguments are not valid
+    '''
+    ###########################   GUI   ######################################
+    if "--GUI" in input_args or "--gui" in input_args:
+        args, args_unknown = make_parser(gui_only=True).parse_known_args(
+            input_args)
+        return args
+    ###########################   GUI   ######################################
+    parser = make_parser()
 
     # If the arguments are not set correctly, show help and exit
     if (input_args == [__file__]) or \
@@ -291,7 +385,7 @@ def process_arguments(input_args):
     # CCP4Console on Windows adds an unknown argument (abs path)\__main__.py
     for arg_unknown in args_unknown:
         if "__main__.py" not in arg_unknown:
-            print("WARNING: Unknown argument: " + arg_unknown)
+            print_my("WARNING: Unknown argument: " + arg_unknown)
     # Management of conflicts
     #
     # if ((args.add_to_bfactor and
@@ -306,6 +400,15 @@ def process_arguments(input_args):
     if args.complete_cross_validation and isinstance(args.flag, (int, long)):
         parser.error("It is a non-sense to use the option -f with the option "
                      "--complete.")
+    if args.scratch and not os.path.isdir(args.scratch):
+        parser.error("Scratch directory " + args.scratch + " does not "
+                     "exist.")
+    if args.prescreen and not args.hklin_unmerged:
+        parser.error("The option --prescreen requires the option -u.")
+    if ((args.shell_nfree or args.shell_nwork) and
+            (args.res_shells or args.n_shells or args.step)):
+        parser.error("The options --shell-nfree and --shell-nwork cannot be "
+                     "combined with the options -r, -n, and -s.")
     if (args.no_modification and
             (args.reset_bfactor or args.add_to_bfactor or
              args.set_bfactor or args.shake_sites)):
@@ -327,16 +430,16 @@ def process_arguments(input_args):
                      "pre-refinement at the initial resolution - use the "
                      "required argument --prerefinement-ncyc")
     if (args.no_modification and not args.complete_cross_validation):
-        print("NOTE: The option --prerefinement-no-modification is "
-              "redundant when the option --complete is not used.")
+        print_my("NOTE: The option --prerefinement-no-modification is "
+                 "redundant when the option --complete is not used.")
     if (args.set_bfactor and (args.reset_bfactor or args.add_to_bfactor)):
         parser.error("The option --prerefinement-set-bfactor cannot be "
                      "combined with the options --prerefinement-reset-bfactor "
                      "and --prerefinement-add-to-bfactor.")
     if args.complete_cross_validation and args.reset_bfactor:
-        print("NOTE: The argument --prerefinement-reset-bfactor is "
-              "redundant when the argument --complete is used - the B-factors "
-              "are reseted to their average value by default.")
+        print_my("NOTE: The argument --prerefinement-reset-bfactor is "
+                 "redundant when the argument --complete is used - the "
+                 "B-factors are reseted to their average value by default.")
     if args.complete_cross_validation and args.no_modification:
         warning_my("no_modification", "Modification of the input structure "
                    "model is turned off - be sure that the input structure "
@@ -393,45 +496,418 @@ def process_arguments(input_args):
     return(args)
 
 
+def exclude_failed_flag_sets(flag_sets, results, res_cur):
+    """Removes free reflection sets whose refinement failed (their result
+    is :class:`pairef.jobs.JobError`) and reports them as warnings.
+
+    Args:
+        flag_sets (list)
+        results (list): Results of the refinement for every set in
+                        `flag_sets`
+        res_cur (float): Current high resolution limit
+
+    Returns:
+        list: Free reflection sets that can be refined further
+    """
+    flag_sets_ok = []
+    for flag, result in zip(flag_sets, results):
+        if isinstance(result, JobError):
+            warning_my("failed", "Refinement with the FreeRflag set "
+                       "" + str(flag) + " at " + twodec(res_cur) + " A "
+                       "failed. " + str(result) + " The set is excluded "
+                       "from further calculations.")
+        else:
+            flag_sets_ok.append(flag)
+    return flag_sets_ok
+
+
+def choose_next_ncyc(args, res_cur, flag_sets, refinement):
+    """Chooses the number of refinement cycles for the next resolution step
+    from Rfree vs. cycle of the refinements at `res_cur` (option
+    `--ncyc auto`) - only the step which has just finished is taken into
+    account, so the number can decrease again after a step which needed more
+    cycles. The choice is stored in `args.ncyc` and recorded in
+    `args.ncyc_chosen`.
+
+    Args:
+        args
+        res_cur (float): High resolution limit of the finished step
+        flag_sets (list)
+        refinement (str): "refmac" or "phenix"
+
+    Returns:
+        int: Number of cycles
+    """
+    traces = []
+    for flag in flag_sets:
+        prefix = args.project + "_R" + str(flag).zfill(2) + "_" + \
+            twodecname(res_cur) + "A"
+        cycles = read_cycles(prefix, refinement)
+        if cycles and len(cycles[0]) >= 2:  # not for 0 cycles
+            traces.append(cycles)
+    args.ncyc = choose_ncyc(traces, args.ncyc_max)
+    args.ncyc_chosen.append((res_cur, args.ncyc))
+    print_my("       Number of refinement cycles chosen for the next step: "
+             "" + str(args.ncyc))
+    return args.ncyc
+
+
+def initial_bins(args, refinement, shells, flag, n_bins_low, res_low):
+    """Returns the limits of the resolution bins up to the initial high
+    resolution limit (taken from the statistics of the input structure
+    model).
+
+    Args:
+        args: Input arguments processed by `argparse`
+        refinement (str): "refmac" or "phenix"
+        shells (list): High resolution limits
+        flag (int): Free reflection set
+        n_bins_low (int): Number of resolution bins
+        res_low (float): Low resolution limit
+
+    Returns:
+        list: Limits of the bins (float)
+    """
+    from .refinement import calculate_stats_cctbx, get_f_cctbx
+    if refinement == "refmac":
+        from .refinement import collect_stat_binned_refmac_low
+        logfilename = args.project + "_R" + str(flag).zfill(2) + "_" \
+            "" + twodecname(shells[0]) + "A_comparison" \
+            "_at_" + twodecname(shells[0]) + "A.log"
+        mtzfilename = \
+            args.project + "_R" + str(flag).zfill(2) + "_" \
+            "" + twodecname(shells[0]) + "A.mtz"
+        bins_low = collect_stat_binned_refmac_low(
+            logfilename, mtzfilename, args.hklin, n_bins_low, res_low, flag)[1]
+    elif refinement == "phenix":
+        mtzfilename = \
+            args.project + "_R" + str(flag).zfill(2) + "_" \
+            "" + twodecname(shells[0]) + "A_001.mtz"
+        fobs, fmodel, flags = get_f_cctbx(mtzfilename)
+        bins_low = \
+                calculate_stats_cctbx(fobs, fmodel, flags, n_bins=n_bins_low, bins=True)
+        # pdbfilename = args.project + "_R" + str(flag).zfill(2) + "_" \
+        #     "" + twodecname(shells[0]) + "A_comparison" \
+        #     "_at_" + twodecname(shells[0]) + "A_001.pdb"
+        # bins_low = collect_stat_binned_phenix_low(pdbfilename, n_bins_low)[0]
+        # bins_low = [float(bin) for bin in bins_low]
+    return [float(bin) for bin in bins_low]
+
+
+def write_summary(project, shells, flag_sets, cutoff, n_bins_low=None,
+                  flag=None, complete_cross_validation=None):
+    """Saves the result of the run in a file PAIREF_`project`_summary.json
+    in the working directory (it is read *e.g.* by `pairef batch` and
+    `pairef recut`).
+
+    Args:
+        project (str): Name of the project
+        shells (list): High resolution limits of the finished steps
+        flag_sets (list): Free reflection sets
+        cutoff (tuple): Strict and benevolent suggested cutoff
+        n_bins_low (int): Number of resolution bins
+        flag (int): Free reflection set whose statistics were used
+        complete_cross_validation (bool)
+
+    Returns:
+        str: Name of the file
+    """
+    summaryfilename = "PAIREF_" + project + "_summary.json"
+    with open(workpath(summaryfilename), "w") as summaryfile:
+        json.dump({"project": project, "shells": list(shells),
+                   "flag_sets": list(flag_sets),
+                   "cutoff": {"strict": cutoff[0], "benevolent": cutoff[1]},
+                   "n_bins_low": n_bins_low, "flag": flag,
+                   "complete_cross_validation": complete_cross_validation,
+                   "warnings": [warning_dict[key] for key in warning_dict]},
+                  summaryfile, indent=1)
+    return summaryfilename
+
+
+def finish_run(args, shells, flag_sets, flag, versions_dict, n_bins_low,
+               bins_low, res_unmerged, cutoff, accepted, reason):
+    """Calculates merging statistics (if unmerged data are given), suggests
+    the final cutoff and writes the final HTML log and the profile of the
+    run.
+
+    Args:
+        args: Input arguments processed by `argparse`
+        shells (list): High resolution limits of the finished steps
+        flag_sets (list): Free reflection sets
+        flag (int): Free reflection set whose statistics are plotted
+        versions_dict (dict)
+        n_bins_low (int): Number of resolution bins
+        bins_low (list): See :func:`initial_bins`
+        res_unmerged (tuple): Resolution range of the unmerged data
+        cutoff, accepted, reason: The last preliminary suggestion (see
+                                  :func:`pairef.preparation.suggest_cutoff`)
+
+    Returns:
+        (tuple): Final suggested cutoff, accepted shells and reasons (see
+        :func:`pairef.preparation.suggest_cutoff`)
+    """
+    from .preparation import calculate_merging_stats, suggest_cutoff
+    from .graphs import matplotlib_line, write_log_html
+    # If unmerged data are in disposal, calculate CC1/2 and CC*
+    # for future graphs of CCwork, CCfree
+    if args.hklin_unmerged:
+        write_log_html(shells, shells, args, versions_dict, flag_sets,
+                       cutoff=cutoff, accepted=accepted, reason=reason)
+        calculate_merging_stats(args.hklin_unmerged, shells, args.project,
+                                bins_low, res_unmerged[0], res_unmerged[1])
+        matplotlib_line(shells=[shells[0]], project=args.project,
+                        statistics=["Rmerge", "Rmeas", "Rpim"],
+                        n_bins_low=n_bins_low, title="$\it{R}$-values",
+                        filename_suffix="Rmerge_Rmeas_Rpim")
+        matplotlib_line(shells=[shells[0]], project=args.project,
+                        statistics=["<I/sI>", "<I>"],
+                        n_bins_low=n_bins_low, title="Average intensities",
+                        filename_suffix="Intensities", multiscale=True)
+        matplotlib_line(shells=[shells[0]], project=args.project,
+                        statistics=["Completeness", "Multiplicity"],
+                        n_bins_low=n_bins_low,
+                        title="Completeness and multiplicity",
+                        filename_suffix="Comp_Mult", multiscale=True)
+        matplotlib_line(shells=[shells[0]], project=args.project,
+                        statistics=["CChalf", "CC*"], n_bins_low=n_bins_low,
+                        title="Correlation coefficent", filename_suffix="CC")
+        matplotlib_line(shells=[shells[0]], project=args.project,
+                        statistics=["n_unique", "n_obs"],
+                        n_bins_low=n_bins_low,
+                        title="Number of reflections in resol. bins",
+                        filename_suffix="No_reflections",
+                        multiscale=True)
+
+        if not args.complete_cross_validation:
+            matplotlib_line(shells=shells,
+                            project=args.project,
+                            statistics=["CCwork", "CC*"],
+                            n_bins_low=n_bins_low,
+                            title=r"CC$_\mathrm{work}$",
+                            filename_suffix="CCwork", flag=flag)
+            matplotlib_line(shells=shells,
+                            project=args.project,
+                            statistics=["CCfree", "CC*"],
+                            n_bins_low=n_bins_low,
+                            title=r"CC$_\mathrm{free}$",
+                            filename_suffix="CCfree", flag=flag)
+        cutoff, accepted, reason = suggest_cutoff(
+            args, shells, n_bins_low, flag)
+        write_log_html(shells, shells, args, versions_dict, flag_sets,
+                       ready_merging_statistics=True, done=True,
+                       cutoff=cutoff, accepted=accepted, reason=reason)
+    else:
+        cutoff, accepted, reason = suggest_cutoff(
+            args, shells, n_bins_low, flag)
+        write_log_html(shells, shells, args, versions_dict, flag_sets,
+                       done=True,
+                       cutoff=cutoff, accepted=accepted, reason=reason)
+    print_my("Suggested cutoff: ")
+    if cutoff[0] == cutoff[1]:
+        print_my(twodec(cutoff[0]) + " A")
+    else:
+        print_my(twodec(cutoff[0]) + " A  (strict)")
+        print_my(twodec(cutoff[1]) + " A  (benevolent)")
+    if warning_dict:
+        print_my("\nCalculation ended.")
+        print_my("These warning messages appeared during calculation:")
+        for key in warning_dict:
+            print_my(warning_dict[key])
+    else:
+        print_my("\nCalculation ended successfully.")
+    write_summary(args.project, shells, flag_sets, cutoff, n_bins_low, flag,
+                  bool(args.complete_cross_validation))
+    profiler.write(args.project)
+    print_my("\nResults are listed "
+             "in logfile " + results_dir() + "/PAIREF_" + args.project + ""
+             ".html\n")
+    return cutoff, accepted, reason
+
+
+def refine_first(flag, args, refinement, shells, n_bins_low, res_low,
+                 xyzin_start):
+    """Refines (or only calculates statistics of) the input structure model
+    with the free reflection set `flag` at the initial resolution.
+
+    Statistics of the unmodified input model (0 cycles) are calculated only
+    for one free reflection set - the complete cross-validation always
+    starts with pre-refinement (see `--prerefinement-ncyc`), so the models
+    of the free reflection sets differ already after this step.
+
+    Args:
+        flag (int): Free reflection set
+        args: Input arguments processed by `argparse`
+        refinement (str): "refmac" or "phenix"
+        shells (list): High resolution limits
+        n_bins_low (int): Number of resolution bins
+        res_low (float): Low resolution limit
+        xyzin_start (str): Starting (modified) structure model
+
+    Returns:
+        dict: Results of :func:`pairef.refinement.refinement_refmac` or
+        :func:`pairef.refinement.refinement_phenix`
+    """
+    if refinement == "refmac":
+        from .refinement import refinement_refmac as refine
+        kwargs = {"n_bins_low": n_bins_low}
+    else:
+        from .refinement import refinement_phenix as refine
+        kwargs = {"n_bins": n_bins_low}
+    return refine(res_cur=shells[0], res_prev=args.xyzin, res_high=shells[0],
+                  args=args, mode="first", res_low=res_low,
+                  res_highest=shells[-1], flag=flag, xyzin_start=xyzin_start,
+                  **kwargs)
+
+
+def refine_shell(flag, i, args, refinement, shells, n_bins_low, res_low):
+    """Refines the structure model with the free reflection set `flag`
+    against data up to `shells[i + 1]` and calculates statistics of the
+    refined model (up to the previous resolution limit, in the resolution
+    bins up to the initial limit and in the high resolution shells).
+
+    Args:
+        flag (int): Free reflection set
+        i (int): Index of the previous resolution limit in `shells`
+        args: Input arguments processed by `argparse`
+        refinement (str): "refmac" or "phenix"
+        shells (list): High resolution limits
+        n_bins_low (int): Number of resolution bins up to the initial limit
+        res_low (float): Low resolution limit
+
+    Returns:
+        dict: Results of the last job
+    """
+    res_cur = shells[i + 1]
+    res_prev = shells[i]
+    if refinement == "refmac":
+        from .refinement import refinement_refmac as refine
+        bins = "n_bins_low"
+        n_bins = n_bins_prev = n_bins_low
+        n_bins_shell = n_bins_low
+    else:
+        from .refinement import refinement_phenix as refine
+        bins = "n_bins"
+        # One more bin for every high resolution shell
+        n_bins = n_bins_low + i + 1
+        n_bins_prev = n_bins - 1
+        n_bins_shell = 1
+    results = refine(res_cur=res_cur, res_prev=res_prev, res_high=res_cur,
+                     args=args, mode="refine", res_low=res_low,
+                     res_highest=shells[-1], flag=flag, **{bins: n_bins})
+    print_my("       Calculating statistics of the refined structure "
+             "model...", end="")
+    # Statistics up to prev. res. limit
+    results = refine(res_cur=res_cur, res_prev=res_prev, res_high=res_prev,
+                     args=args, mode="prev_pair", res_low=res_low,
+                     res_highest=shells[-1], flag=flag,
+                     **{bins: n_bins_prev})
+    # Statistics for `n_bins_low` shells up to init. res. limit
+    results = refine(res_cur=res_cur, res_prev=res_prev, res_high=shells[0],
+                     args=args, mode="comp", res_low=res_low,
+                     res_highest=shells[-1], flag=flag,
+                     **{bins: n_bins_low})
+    if not args.complete_cross_validation:
+        # Statistics for high resolution shells
+        for j in range(i + 1):
+            results = refine(res_cur=res_cur, res_prev=res_prev,
+                             res_high=shells[j + 1], args=args, mode="comp",
+                             res_low=shells[j], res_highest=shells[-1],
+                             flag=flag, **{bins: n_bins_shell})
+    return results
+
+
 def main(args):
-    """The main function of the `pairef` module.
+    """The main function of the `pairef` module. If the option `--scratch`
+    is set, the files of the run are copied from the scratch directory to
+    the working directory when the run ends, also after an error (see
+    :mod:`pairef.scratch`).
+
+    Args:
+        args: Input arguments processed by `argparse` (with an optional
+              attribute `workdir` - a working directory to be used instead
+              of a new directory `pairef_`project``)
+
+    Returns:
+        (tuple): Finished resolution shells, free reflection sets and the
+        result of :func:`finish_run` (`None` if only the plan or the shards
+        are prepared)
+
+    Raises:
+        PairefError: The run cannot be finished
+    """
+    try:
+        return run_protocol(args)
+    finally:
+        finish()
+        # The working directory stays set so that the results can be found
+        context = current_context()
+        if context.output is not None:
+            context.output.close()
+            context.output = None
+
+
+def run_protocol(args):
+    """Runs the paired refinement protocol (see :func:`main`).
 
     Args:
         args: Input arguments processed by `argparse`
+
+    Returns:
+        (tuple): See :func:`main`
     """
     # Check software versions (matplotlib should be checked later)
     # if int(platform.python_version_tuple()[0]) != 2:
     #     sys.stderr.write("ERROR: This version of pairef module requires "
     #                      "Python 2.7 from CCTBX.\n")
     #     sys.exit(1)
+    profiler.reset()
+    # Names of the input files refer to the current directory
+    current_context().workdir = None
     from . import __version__
     try:
         import cctbx.miller
     except ImportError:
-        sys.stderr.write("ERROR: This version of pairef module requires "
-                         "Python from CCTBX.\n"
-                         "It has to be executed using command:"
-                         "ccp4-python -m pairef ARGUMENTS\n"
-                         "or\n"
-                         "cctbx.python -m pairef ARGUMENTS\n"
-                         "Aborting.\n")
-        sys.exit(1)
+        raise SoftwareError("This version of pairef module requires "
+                            "Python from CCTBX.\n"
+                            "It has to be executed using command:"
+                            "ccp4-python -m pairef ARGUMENTS\n"
+                            "or\n"
+                            "cctbx.python -m pairef ARGUMENTS")
+    from .preparation import welcome, create_workdir, output_log
+    from .preparation import def_res_shells, res_high_from_xyzin
+    from .preparation import res_from_mtz, res_opt, run_pdbtools, slim_hklin
+    from .preparation import res_from_hklin_unmerged, prescreen_shells
+    from .preparation import check_refinement_software, suggest_cutoff
+    from .refinement import collect_stat_OVERALL, collect_stat_OVERALL_AVG
+    from .refinement import collect_stat_BINNED, default_ncyc
+    from .graphs import matplotlib_bar, matplotlib_line, write_log_html
+    from .retention import prune_step
 
     # Decide which refinement software will be used
     if args.phenix:
         refinement = "phenix"
         refinement_name = "phenix.refine"
-        from .refinement import refinement_phenix
-        # from .refinement import collect_stat_binned_phenix_low
     else:
         refinement = "refmac"  # REFMAC5 as default
         refinement_name = "REFMAC5"
-        from .refinement import refinement_refmac
-        from .refinement import collect_stat_binned_refmac_low
     settings["sh"] = False
     if args.phenix and platform.system() == 'Windows':
         settings["sh"] = True
 
+    # Option --ncyc auto - the default number of cycles is used until
+    # Rfree vs. cycle of some refinement is known
+    args.ncyc_chosen = []
+    args.ncyc_auto = args.ncyc == "auto"
+    if args.ncyc_auto:
+        args.ncyc = None
+        if refinement == "phenix":
+            args.ncyc_max = 3
+        else:
+            args.ncyc_max = 20
+    # Default number of cycles if the keywords given by --comin or --def
+    # do not set it, the jobs of the free reflection sets only read it
+    args.ncyc = default_ncyc(args, refinement) or args.ncyc
+
     versions_dict = {"refmac_version": "N/A",  # It will be found later
                      "phenix_version": "N/A",  # It will be found now
                      "pairef_version": __version__}
@@ -453,20 +929,17 @@ def main(args):
             #          iotbx
             #
         for required_executable in required_executables:
-            if not which(required_executable) and not args.test:
-                sys.stderr.write("ERROR: PAIREF requires installed `"
-                                 "" + required_executable + "` (a part "
-                                 "of the " + cryst_package + ") but it is not "
-                                 "executable."
-                                 "\nAborting.\n")
-                sys.exit(1)
-
-    if refinement == "phenix":
-        with open("phenix_version.txt", 'w') as out:
-            p = Popen_my(["phenix.version"], stdout=out, stderr=out, shell=settings["sh"])
-            p.communicate()
-        versions_dict["phenix_version"] = extract_from_file(
-            "phenix_version.txt", "ersion", 0, 1, nth_word=-1)
+            if not find(required_executable) and not args.test \
+                    and not args.plan:
+                raise SoftwareError("PAIREF requires installed `"
+                                    "" + required_executable + "` (a part "
+                                    "of the " + cryst_package + ") but it is "
+                                    "not executable.")
+
+    if refinement == "phenix" and not args.plan:
+        # Cached for the same installation (see pairef.tools)
+        versions_dict["phenix_version"] = \
+            tools_registry().version("phenix.version") or "N/A"
         try:
             phenix_version_parts = versions_dict["phenix_version"].split(".", 2)
             settings["phenix_version"] = float(".".join(phenix_version_parts[:2]))
@@ -487,23 +960,27 @@ def main(args):
     else:
         settings["pdbORmmcif"] = ".pdb"
 
-    # Create new working directory (name related to the project)
-    workdir = create_workdir(args.project)
+    if not args.plan:
+        # Create new working directory (name related to the project)
+        workdir = getattr(args, "workdir", None)
+        if not workdir:
+            workdir = create_workdir(args.project)
+        elif not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        workdir = os.path.abspath(workdir)
 
-    # Set to write STDOUT to screen and file
-    writer = output_log(sys.stdout, workdir + '/PAIREF_out.log')
-    sys.stdout = writer
+        # Set to write the messages of the run to screen and file
+        current_context().output = output_log(
+            current_output(), os.path.join(workdir, "PAIREF_out.log"))
 
     # Show information about the module and input parameters
     welcome(args, versions_dict["pairef_version"])
 
     # Find resolution range of merged data
-    res_low, res_high_mtz = res_from_mtz(args.hklin)  # uses CCTBX
+    res_low, res_high_mtz = res_from_mtz(args.hklin)
     if not res_high_mtz:
-        sys.stderr.write("ERROR: High-resolution limit of data "
-                         "" + args.hklin + " could not be found."
-                         "\nAborting.\n")
-        sys.exit(1)
+        raise InputError("High-resolution limit of data "
+                         "" + args.hklin + " could not be found.")
     if not res_low:
         warning_my("low_res", "Low resolution limit could not be found."
                    "Setting it to a value " + str(RES_LOW) + " A.")
@@ -514,9 +991,9 @@ def main(args):
                    "" + str(RES_LOW) + "A.")
         res_low = RES_LOW
     else:
-        print("Resolution of the merged diffraction data "
-              "" + args.hklin + ": " + twodec(res_low) + "-"
-              "" + twodec(res_high_mtz) + " A")
+        print_my("Resolution of the merged diffraction data "
+                 "" + args.hklin + ": " + twodec(res_low) + "-"
+                 "" + twodec(res_high_mtz) + " A")
 
     if args.hklin_unmerged:
         # Find resolution range of unmerged data
@@ -524,47 +1001,47 @@ def main(args):
             res_from_hklin_unmerged(args.hklin_unmerged)
         if res_high_from_hklin_unmerged != 0 and \
                 res_low_from_hklin_unmerged != float("inf"):
-            print("Resolution of the unmerged diffraction data "
-                  "" + args.hklin_unmerged + ": "
-                  "" + twodec(res_low_from_hklin_unmerged) + "-"
-                  "" + twodec(res_high_from_hklin_unmerged) + " A")
+            print_my("Resolution of the unmerged diffraction data "
+                     "" + args.hklin_unmerged + ": "
+                     "" + twodec(res_low_from_hklin_unmerged) + "-"
+                     "" + twodec(res_high_from_hklin_unmerged) + " A")
 
     # Set initial high resolution limit
     if args.res_init:
-        print("Manual setting of initial high resolution limit will be "
-              "used: " + twodec(args.res_init) + " A.")
+        print_my("Manual setting of initial high resolution limit will be "
+                 "used: " + twodec(args.res_init) + " A.")
     else:
         args.res_init = res_high_from_xyzin(
             args.xyzin, format=settings["pdbORmmcif"])
         if args.res_init < 0:
-            sys.stderr.write(
-                "ERROR: An attempt to determine a resolution of data which "
+            raise InputError(
+                "An attempt to determine a resolution of data which "
                 "were used for refinement of the structure model "
                 "" + args.xyzin + " was not successful. Please specify the "
-                "initial high resolution limit manually using -i option."
-                "\nAborting.\n")
-            sys.exit(1)
-        print("Initial high resolution limit found in the structure model "
-              "" + args.xyzin + ": " + twodec(args.res_init) + " A.")
+                "initial high resolution limit manually using -i option.")
+        print_my("Initial high resolution limit found in the structure model "
+                 "" + args.xyzin + ": " + twodec(args.res_init) + " A.")
 
     # Check that resolution shell setting has sence
     # and determine resolution shells
     shells, n_bins_low, n_flag_sets, default_shells_definition = \
         def_res_shells(args, refinement, res_high_mtz, res_low)
-    print("High resolution diffraction limits:", end=" ")
+    if args.prescreen:
+        shells = prescreen_shells(args.hklin_unmerged, shells,
+                                  res_low_from_hklin_unmerged,
+                                  res_high_from_hklin_unmerged)
+    print_my("High resolution diffraction limits:", end=" ")
     for shell in shells[1:-1]:  # Skip the initial high resolution limit
-        print(twodec(shell) + " A", end=", ")
-    print(twodec(shells[-1]) + " A")  # Formatting issue
+        print_my(twodec(shell) + " A", end=", ")
+    print_my(twodec(shells[-1]) + " A")  # Formatting issue
 
     # Set FreeRflag sets
     if args.complete_cross_validation:
         if n_flag_sets <= 2:
-            sys.stderr.write(
+            raise InputError(
                 "Given input MTZ file " + args.hklin + " has too low number "
                 "of free reflection sets (" + str(n_flag_sets) + "). k-fold "
-                "cross-validation cannot be performed.\n"
-                "Aborting.\n")
-            sys.exit(1)
+                "cross-validation cannot be performed.")
         flag_sets = range(n_flag_sets)
         if args.quick:  # Faster testing
             flag_sets = range(3)
@@ -579,11 +1056,39 @@ def main(args):
         if not isinstance(args.flag, (int, long)):
             args.flag = 0
         flag_sets = [args.flag]
-        print(" * Data with FreeRflag set " + str(args.flag) + " will be "
-              "excluded during refinement.")
+        print_my(" * Data with FreeRflag set " + str(args.flag) + " will be "
+                 "excluded during refinement.")
+    # Share CPU cores among the refinement jobs of the free reflection sets
+    # that run at once
+    n_cores = args.nproc or cpu_count()
+    if args.retries is None:
+        args.retries = 1
+    job_runner.configure(
+        n_cores, args.threads or max(1, n_cores // len(flag_sets)),
+        timeout=args.timeout, stall_timeout=args.stall_timeout,
+        retries=args.retries)
+    print_my(" * Using " + str(job_runner.n_cores) + " CPU cores, "
+             "" + str(job_runner.threads) + " threads per refinement job.")
+    if args.plan:
+        plan(args, shells, list(flag_sets), refinement,
+             n_slots=max(1, job_runner.n_cores // job_runner.threads),
+             sfcheck=bool(find("sfcheck")))
+        return
+    # Size of the problem saved in the profile of the run (it is used to
+    # calibrate estimates of the runtime of next runs, see --plan)
+    profiler.metadata["refinement"] = refinement
+    profiler.metadata["reflections"], profiler.metadata["n_atoms"] = \
+        describe_data(args.hklin, args.xyzin, list(flag_sets)[0])
 
     # Check the input files?
 
+    # Run the jobs in a scratch directory whose files are copied to the
+    # working directory in the background
+    if args.scratch:
+        rundir = stage(workdir, args.scratch, args.project)
+    else:
+        rundir = workdir
+
     # Copy input files to the working directory
     # and take only basename of the filenames
     in_files = ["hklin", "xyzin"]
@@ -592,37 +1097,44 @@ def main(args):
         if vars(args)[f]:
             in_files.append(f)
     for f in in_files:
-        shutil.copy2(vars(args)[f], workdir)
+        if f == "hklin" and not args.keep_hklin:
+            # Only the columns used for refinement are kept
+            args.hklin = slim_hklin(args.hklin, rundir,
+                                    [args.comin, args.defin])
+            continue
+        link_or_copy(vars(args)[f], rundir)
         vars(args)[f] = os.path.basename(vars(args)[f])
     # Symlink HKLIN_unmerged
     if args.hklin_unmerged:
-        try_symlink(os.path.join(os.getcwd(), args.hklin_unmerged),
-                    os.path.join(os.getcwd(), workdir,
+        try_symlink(os.path.abspath(args.hklin_unmerged),
+                    os.path.join(rundir,
                                  os.path.basename(args.hklin_unmerged)))
         args.hklin_unmerged = os.path.basename(args.hklin_unmerged)
-    print("")
-    # Change the working directory
-    os.chdir(workdir)
-    print("Current working directory: " + os.getcwd())
+    print_my("")
+    # Change the working directory - relative names of the files of the run
+    # refer to it from now on (see pairef.settings.workpath)
+    current_context().workdir = rundir
+    print_my("Current working directory: " + rundir)
 
     write_log_html(shells, [], args, versions_dict, flag_sets)
-    htmlfilepath = os.path.abspath("PAIREF_" + args.project + ".html")
-    print("------> RESULTS AND THE CURRENT STATUS OF CALCULATIONS ARE LISTED "
-          "IN A HTML LOG FILE "
-          "" + htmlfilepath)
+    htmlfilepath = os.path.join(results_dir(),
+                                "PAIREF_" + args.project + ".html")
+    print_my("------> RESULTS AND THE CURRENT STATUS OF CALCULATIONS ARE "
+             "LISTED IN A HTML LOG FILE "
+             "" + htmlfilepath)
     
     if args.open_browser and "ccp4" in sys.executable:  # cctbx.python fails
         import webbrowser
-        print("Opening web browser...")
+        print_my("Opening web browser...")
         webbrowser.open(htmlfilepath)
-    print("")
+    print_my("")
 
     # Modification of the input structure model - Define starting XYZIN
     if args.no_modification:
         xyzin_start = args.xyzin
     else:
         if args.complete_cross_validation or args.reset_bfactor:
-            if not which("baverage"):  # typically PHENIX without CCP4 paths
+            if not find("baverage"):  # typically PHENIX without CCP4 paths
                 from .preparation import run_bmean_iotbx
                 baverage = run_bmean_iotbx(args.project, args.xyzin)
             else:  # typically refmac
@@ -634,45 +1146,50 @@ def main(args):
     pdbfilename_renamed = args.project + "_" + twodecname(shells[0]) + "A" + \
         settings["pdbORmmcif"]
     if args.xyzin != pdbfilename_renamed:
-        shutil.copy2(args.xyzin, pdbfilename_renamed)
+        link_or_copy(args.xyzin, pdbfilename_renamed)
     if args.test:
-        sys.exit(0)
+        return
+    if getattr(args, "shard_plan", False):
+        # Command `pairef prepare-shards` - the shards are run later
+        from .shards import write_schedule
+        if not args.hklin_unmerged:
+            res_low_from_hklin_unmerged = res_high_from_hklin_unmerged = None
+        write_schedule(args, refinement, shells, flag_sets, n_bins_low,
+                       res_low, xyzin_start, versions_dict,
+                       (res_low_from_hklin_unmerged,
+                        res_high_from_hklin_unmerged))
+        return
 
-    print("\nRefinement using " + refinement_name + ":\n")
+    print_my("\nRefinement using " + refinement_name + ":\n")
     res_cur = shells[0]
     if args.complete_cross_validation or args.prerefinement_ncyc:
-        print("   * Performing pre-refinement at "
-              "" + twodec(res_cur) + " A resolution...")
+        print_my("   * Performing pre-refinement at "
+                 "" + twodec(res_cur) + " A resolution...")
     else:
-        print("   * Calculating initial statistics at "
-              "" + twodec(res_cur) + " A resolution...")
+        print_my("   * Calculating initial statistics at "
+                 "" + twodec(res_cur) + " A resolution...")
+    def refine_first_flag(flag):
+        return refine_first(flag, args, refinement, shells, n_bins_low,
+                            res_low, xyzin_start)
+
+    # Refinement jobs of the free reflection sets are independent
+    results_flag_sets = job_runner.map(refine_first_flag, flag_sets,
+                                       catch=JobError)
+    for results in results_flag_sets:
+        if isinstance(results, dict):
+            if refinement == "refmac":
+                versions_dict["refmac_version"] = results["version"]
+            if "label" in results:
+                args.label = results["label"]
+    flag_sets = exclude_failed_flag_sets(flag_sets, results_flag_sets,
+                                         res_cur)
+    if not flag_sets:
+        raise RefinementError("Refinement at the initial resolution "
+                              "" + twodec(res_cur) + " A failed. See the "
+                              "warnings above for the details.")
+    if args.ncyc_auto and len(shells) > 1:
+        choose_next_ncyc(args, res_cur, flag_sets, refinement)
     for flag in flag_sets:
-        if refinement == "refmac":
-            results = refinement_refmac(res_cur=res_cur,
-                                        res_prev=args.xyzin,
-                                        res_high=shells[0],
-                                        args=args,
-                                        n_bins_low=n_bins_low,
-                                        mode="first",
-                                        res_low=res_low,
-                                        res_highest=shells[-1],
-                                        flag=flag,
-                                        xyzin_start=xyzin_start)
-            # bfac_set=bfac_set)
-            versions_dict["refmac_version"] = results["version"]
-        elif refinement == "phenix":
-            n_bins = n_bins_low
-            results = refinement_phenix(res_cur=res_cur,
-                                        res_prev=args.xyzin,
-                                        res_high=shells[0],
-                                        args=args,
-                                        n_bins=n_bins_low,
-                                        mode="first",
-                                        res_low=res_low,
-                                        res_highest=shells[-1],
-                                        flag=flag,
-                                        xyzin_start=xyzin_start)
-            # versions_dict["phenix_version"] = results["version"]
         collect_stat_OVERALL([res_cur], args, flag, refinement)
         if args.complete_cross_validation or args.prerefinement_ncyc:
             matplotlib_line(
@@ -710,32 +1227,12 @@ def main(args):
             args.prerefinement_ncyc):
         check_refinement_software(args, versions_dict, refinement)
 
-    if refinement == "refmac":
-        logfilename = args.project + "_R" + str(flag_sets[0]).zfill(2) + "_" \
-            "" + twodecname(shells[0]) + "A_comparison" \
-            "_at_" + twodecname(shells[0]) + "A.log"
-        mtzfilename = \
-            args.project + "_R" + str(flag_sets[0]).zfill(2) + "_" \
-            "" + twodecname(shells[0]) + "A.mtz"
-        bins_low = collect_stat_binned_refmac_low(
-            logfilename, mtzfilename, args.hklin, n_bins_low, res_low, flag)[1]
-    elif refinement == "phenix":
-        mtzfilename = \
-            args.project + "_R" + str(flag_sets[0]).zfill(2) + "_" \
-            "" + twodecname(shells[0]) + "A_001.mtz"
-        fobs, fmodel, flags = get_f_cctbx(mtzfilename)
-        bins_low = \
-                calculate_stats_cctbx(fobs, fmodel, flags, n_bins=n_bins_low, bins=True)
-        # pdbfilename = args.project + "_R" + str(flag_sets[0]).zfill(2) + "_" \
-        #     "" + twodecname(shells[0]) + "A_comparison" \
-        #     "_at_" + twodecname(shells[0]) + "A_001.pdb"
-        # bins_low = collect_stat_binned_phenix_low(pdbfilename, n_bins_low)[0]
-        # bins_low = [float(bin) for bin in bins_low]
-    bins_low = [float(bin) for bin in bins_low]
+    bins_low = initial_bins(args, refinement, shells, flag_sets[0],
+                            n_bins_low, res_low)
     if not args.complete_cross_validation:
         collect_stat_BINNED([res_cur], args.project, args.hklin,
                                    n_bins_low, flag, res_low, refinement)
-        if which("sfcheck"):
+        if find("sfcheck"):
             res_opt(shells[0], args, refinement)
             matplotlib_line(shells=[shells[0]],
                             project=args.project,
@@ -776,6 +1273,8 @@ def main(args):
                         flag=flag, multiscale=True)
     write_log_html(shells, shells_ready_with_res_init, args,
                    versions_dict, flag_sets)
+    for flag in flag_sets:
+        prune_step(args, flag, shells[0])
 
     for i in range(len(shells) - 1):
         # TODO: check files
@@ -783,30 +1282,31 @@ def main(args):
         res_prev = shells[i]
 
         # Real refinement
-        print("\n   * Refining using data up to "
-              "" + twodec(shells[i + 1]) + " A resolution...")
+        print_my("\n   * Refining using data up to "
+                 "" + twodec(shells[i + 1]) + " A resolution...")
+
+        def refine_shell_flag(flag):
+            return refine_shell(flag, i, args, refinement, shells,
+                                n_bins_low, res_low)
+
+        # Refinement jobs of the free reflection sets are independent
+        flag_sets = exclude_failed_flag_sets(
+            flag_sets, job_runner.map(refine_shell_flag, flag_sets,
+                                      catch=JobError), res_cur)
+        if not flag_sets:
+            if i == 0:
+                raise RefinementError("Refinement at "
+                                      "" + twodec(res_cur) + " A failed. See "
+                                      "the warnings above for the details.")
+            warning_my("failed", "Paired refinement was stopped at "
+                       "" + twodec(res_prev) + " A as the refinement at "
+                       "" + twodec(res_cur) + " A failed. The suggested "
+                       "cutoff is based only on the previous shells.")
+            shells = shells[:i + 1]
+            break
+        if args.ncyc_auto and i + 2 < len(shells):
+            choose_next_ncyc(args, res_cur, flag_sets, refinement)
         for flag in flag_sets:
-            if refinement == "refmac":
-                results = refinement_refmac(res_cur=res_cur,
-                                            res_prev=res_prev,
-                                            res_high=shells[i + 1],
-                                            args=args,
-                                            n_bins_low=n_bins_low,
-                                            mode="refine",
-                                            res_low=res_low,
-                                            res_highest=shells[-1],
-                                            flag=flag)
-            elif refinement == "phenix":
-                n_bins += 1
-                results = refinement_phenix(res_cur=res_cur,
-                                            res_prev=res_prev,
-                                            res_high=shells[i + 1],
-                                            args=args,
-                                            n_bins=n_bins,
-                                            mode="refine",
-                                            res_low=res_low,
-                                            res_highest=shells[-1],
-                                            flag=flag)
             matplotlib_line(
                 shells=[res_cur],
                 project=args.project,
@@ -825,50 +1325,6 @@ def main(args):
             else:
                 write_log_html(shells, shells_ready_with_res_init, args,
                                versions_dict, flag_sets, res_cur)
-            print("       Calculating statistics of the refined structure "
-                  "model...", end="")
-            if refinement == "refmac":
-                # Statistics up to prev. res. limit
-                results = refinement_refmac(res_cur=res_cur,
-                                            res_prev=res_prev,
-                                            res_high=shells[i],
-                                            args=args,
-                                            n_bins_low=n_bins_low,
-                                            mode="prev_pair",
-                                            res_low=res_low,
-                                            res_highest=shells[-1],
-                                            flag=flag)
-                # Statistics for `n_bins_low` shells up to init. res. limit
-                results = refinement_refmac(res_cur=res_cur,
-                                            res_prev=res_prev,
-                                            res_high=shells[0],
-                                            args=args,
-                                            n_bins_low=n_bins_low,
-                                            mode="comp",
-                                            res_low=res_low,
-                                            res_highest=shells[-1],
-                                            flag=flag)
-            elif refinement == "phenix":
-                # Statistics up to prev. res. limit
-                results = refinement_phenix(res_cur=res_cur,
-                                            res_prev=res_prev,
-                                            res_high=shells[i],
-                                            args=args,
-                                            n_bins=n_bins-1,
-                                            mode="prev_pair",
-                                            res_low=res_low,
-                                            res_highest=shells[-1],
-                                            flag=flag)
-                # Statistics for `n_bins_low` shells up to init. res. limit
-                results = refinement_phenix(res_cur=res_cur,
-                                            res_prev=res_prev,
-                                            res_high=shells[0],
-                                            args=args,
-                                            n_bins=n_bins_low,
-                                            mode="comp",
-                                            res_low=res_low,
-                                            res_highest=shells[-1],
-                                            flag=flag)
             collect_stat_OVERALL(shells[:i + 2], args, flag, refinement)
             if not args.complete_cross_validation:
                 # Update csv files
@@ -884,33 +1340,10 @@ def main(args):
                 for src, dst in zip(symlinks_src, symlinks_dst):
                     try_symlink(src, dst)
                 # Optical resolution
-                if which("sfcheck"):
+                if find("sfcheck"):
                     res_opt(res_cur, args, refinement)
-                # Statistics for high resolution shells
-                n_high_resolution_shells_ready = i + 1
-                for j in range(n_high_resolution_shells_ready):
-                    if refinement == "refmac":
-                        results = refinement_refmac(res_cur=shells[i + 1],
-                                                    res_prev=shells[i],
-                                                    res_high=shells[j + 1],
-                                                    args=args,
-                                                    n_bins_low=n_bins_low,
-                                                    mode="comp",
-                                                    res_low=shells[j],
-                                                    res_highest=shells[-1],
-                                                    flag=flag)
-                    elif refinement == "phenix":
-                        results = refinement_phenix(res_cur=shells[i + 1],
-                                                    res_prev=shells[i],
-                                                    res_high=shells[j + 1],
-                                                    args=args,
-                                                    n_bins=1,
-                                                    mode="comp",
-                                                    res_low=shells[j],
-                                                    res_highest=shells[-1],
-                                                    flag=flag)
         shells_ready_with_res_init = shells[:i + 2]
-        print("")
+        print_my("")
         if args.complete_cross_validation:
             collect_stat_OVERALL_AVG(shells_ready_with_res_init,
                                             args.project, flag_sets)
@@ -918,14 +1351,16 @@ def main(args):
             collect_stat_BINNED(
                 shells_ready_with_res_init, args.project, args.hklin,
                 n_bins_low, flag, res_low, refinement)
+        for flag in flag_sets:
+            prune_step(args, flag, res_cur)
 
-        print("       Updating graphs...")
+        print_my("       Updating graphs...")
         matplotlib_bar(args)
         if args.complete_cross_validation:
             matplotlib_bar(args=args, flag_sets=flag_sets,
                            ready_shells=shells_ready_with_res_init)
         else:
-            if which("sfcheck"):
+            if find("sfcheck"):
                 matplotlib_line(shells=shells_ready_with_res_init,
                                 project=args.project,
                                 statistics=["res_opt"],
@@ -973,89 +1408,45 @@ def main(args):
                         filename_suffix="Rgap", flag=flag)
         cutoff, accepted, reason = suggest_cutoff(
             args, shells[:i + 2], n_bins_low, flag)
-        print("       Preliminary suggested cutoff: " + twodec(cutoff[0]) + " A")
+        print_my("       Preliminary suggested cutoff: " +
+                 twodec(cutoff[0]) + " A")
         write_log_html(shells, shells_ready_with_res_init, args,
                        versions_dict, flag_sets, cutoff=cutoff,
                        accepted=accepted, reason=reason)
 
-    # cutoff, accepted, reason = suggest_cutoff(args, shells, n_bins_low, flag)
-    # If unmerged data are in disposal, calculate CC1/2 and CC*
-    # for future graphs of CCwork, CCfree
-    if args.hklin_unmerged:
-        write_log_html(shells, shells, args, versions_dict, flag_sets,
-                       cutoff=cutoff, accepted=accepted, reason=reason)
-        calculate_merging_stats(args.hklin_unmerged, shells, args.project,
-                                bins_low, res_low_from_hklin_unmerged,
-                                res_high_from_hklin_unmerged)
-        matplotlib_line(shells=[shells[0]], project=args.project,
-                        statistics=["Rmerge", "Rmeas", "Rpim"],
-                        n_bins_low=n_bins_low, title="$\it{R}$-values",
-                        filename_suffix="Rmerge_Rmeas_Rpim")
-        matplotlib_line(shells=[shells[0]], project=args.project,
-                        statistics=["<I/sI>", "<I>"],
-                        n_bins_low=n_bins_low, title="Average intensities",
-                        filename_suffix="Intensities", multiscale=True)
-        matplotlib_line(shells=[shells[0]], project=args.project,
-                        statistics=["Completeness", "Multiplicity"],
-                        n_bins_low=n_bins_low,
-                        title="Completeness and multiplicity",
-                        filename_suffix="Comp_Mult", multiscale=True)
-        matplotlib_line(shells=[shells[0]], project=args.project,
-                        statistics=["CChalf", "CC*"], n_bins_low=n_bins_low,
-                        title="Correlation coefficent", filename_suffix="CC")
-        matplotlib_line(shells=[shells[0]], project=args.project,
-                        statistics=["n_unique", "n_obs"],
-                        n_bins_low=n_bins_low,
-                        title="Number of reflections in resol. bins",
-                        filename_suffix="No_reflections",
-                        multiscale=True)
-
-        if not args.complete_cross_validation:
-            matplotlib_line(shells=shells_ready_with_res_init,
-                            project=args.project,
-                            statistics=["CCwork", "CC*"],
-                            n_bins_low=n_bins_low,
-                            title=r"CC$_\mathrm{work}$",
-                            filename_suffix="CCwork", flag=flag)
-            matplotlib_line(shells=shells_ready_with_res_init,
-                            project=args.project,
-                            statistics=["CCfree", "CC*"],
-                            n_bins_low=n_bins_low,
-                            title=r"CC$_\mathrm{free}$",
-                            filename_suffix="CCfree", flag=flag)
-        cutoff, accepted, reason = suggest_cutoff(
-            args, shells, n_bins_low, flag)
-        write_log_html(shells, shells, args, versions_dict, flag_sets,
-                       ready_merging_statistics=True, done=True,
-                       cutoff=cutoff, accepted=accepted, reason=reason)
-    else:
-        cutoff, accepted, reason = suggest_cutoff(
-            args, shells, n_bins_low, flag)
-        write_log_html(shells, shells, args, versions_dict, flag_sets,
-                       done=True,
-                       cutoff=cutoff, accepted=accepted, reason=reason)
-    print("Suggested cutoff: ")
-    if cutoff[0] == cutoff[1]:
-        print(twodec(cutoff[0]) + " A")
-    else:
-        print(twodec(cutoff[0]) + " A  (strict)")
-        print(twodec(cutoff[1]) + " A  (benevolent)")
-    if warning_dict:
-        print("\nCalculation ended.")
-        print("These warning messages appeared during calculation:")
-        for key in warning_dict:
-            print(warning_dict[key])
-    else:
-        print("\nCalculation ended successfully.")
-    print("\nResults are listed "
-          "in logfile " + os.getcwd() + "/PAIREF_" + args.project + ".html\n")
-    return
+    if not args.hklin_unmerged:
+        res_low_from_hklin_unmerged = res_high_from_hklin_unmerged = None
+    return shells, flag_sets, finish_run(
+        args, shells, flag_sets, flag, versions_dict, n_bins_low, bins_low,
+        (res_low_from_hklin_unmerged, res_high_from_hklin_unmerged),
+        cutoff, accepted, reason)
 
 
 def run_pairef(input_args=None):
     """**THE LAUNCHING FUNCTION** - to process input arguments
     using :func:`launcher.process_arguments` and launch
-    the :func:`launcher.main` function.
+    the :func:`launcher.main` function. Errors of PAIREF
+    (:class:`pairef.commons.PairefError`) are written to the standard error
+    output and the process exits.
+
+    Args:
+        input_args (list): List of input arguments - parameters
+    """
+    try:
+        with RunContext():
+            launch(input_args)
+    except ArgumentsError as e:
+        sys.stderr.write('error: %s\n' % e)
+        print_my('Run `ccp4-python -m pairef -h` to show the help message.')
+        sys.exit(2)
+    except PairefError as e:
+        sys.stderr.write("ERROR: " + str(e) + "\nAborting.\n")
+        sys.exit(1)
+
+
+def launch(input_args=None):
+    """Processes input arguments and launches the command (see
+    :func:`run_pairef`).
 
     Args:
         input_args (list): List of input arguments - parameters
@@ -1066,6 +1457,32 @@ def run_pairef(input_args=None):
     # (Option for specifying arguments via `input_args` is due to testing)
     if not input_args:
         input_args = sys.argv
+    # Many datasets sharing one pool of CPU cores
+    if len(input_args) > 1 and input_args[1] == "batch":
+        from .batch import batch
+        batch(input_args[1:])
+        return
+    # Suggestion of the cutoff of a finished run with other thresholds
+    if len(input_args) > 1 and input_args[1] == "recut":
+        from .cutoff import recut_command
+        recut_command(input_args[1:])
+        return
+    # Commands of the sharded workflow of complete cross-validation
+    if len(input_args) > 1 and input_args[1] in SUBCOMMANDS:
+        if input_args[1] != "prepare-shards":
+            run_subcommand(input_args[1:])
+            return
+        input_args = input_args[:1] + input_args[2:]
+        args = process_arguments(input_args)
+        if not args.complete_cross_validation:
+            raise InputError("Only complete cross-validation "
+                             "(option --complete) can be split into shards.")
+        if args.plan:
+            raise InputError("The option --plan cannot be used with the "
+                             "command prepare-shards.")
+        args.shard_plan = True
+        main(args)
+        return
     args = process_arguments(input_args)
 
     if args.gui:
@@ -1074,6 +1491,9 @@ def run_pairef(input_args=None):
         gui()
     else:
         # Run the protocol
-        main(args)
+        if args.profile:
+            profile_call((args.project or "project") + "_python_profile",
+                         main, args)
+        else:
+            main(args)
     return
- 
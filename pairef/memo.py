@@ -0,0 +1,154 @@
+# coding: utf-8
+"""Memo of the statistics of structure models calculated during a run.
+
+Some statistics of a model are needed at more steps of the protocol, *e.g.*
+overall CCwork and CCfree of the model refined at the previous step are
+calculated by :func:`pairef.refinement.collect_stat_BINNED` and again by
+:func:`pairef.refinement.collect_stat_OVERALL` at the next step. A value is
+saved in the file `PAIREF_statistics.json` in the working directory under a
+key made of the kind of the statistics, the names of the model and data
+files, the flag and the resolution range, so it is calculated only once
+(also if the run is continued or a shard runs in another process). A saved
+value is used only if the model and data files have not been changed since
+it was calculated (their sizes and modification times are compared).
+"""
+import json
+import os
+import threading
+from .commons import fourdec
+from .settings import current_context, workpath
+
+MEMO_FILENAME = "PAIREF_statistics.json"
+
+_lock = threading.Lock()
+
+
+def signature(filename):
+    """Returns the size and the modification time of a file or `None` if it
+    does not exist."""
+    try:
+        stat = os.stat(workpath(filename))
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+def memo_key(kind, model, data=None, flag=None, res_low=None, res_high=None):
+    """Returns the key of a statistics value in the memo.
+
+    Args:
+        kind (str): Kind of the statistics (*e.g.* `"CC"`)
+        model (str): Name of the file of the model (MTZ)
+        data (str): Name of the file with diffraction data
+        flag (int): Free reflection flag set
+        res_low (float): Low resolution limit
+        res_high (float): High resolution limit
+
+    Returns:
+        str
+    """
+    def resolution(value):
+        if value is None:
+            return "-"
+        return fourdec(value)
+    return "|".join([kind, os.path.basename(str(model)),
+                     os.path.basename(str(data)) if data else "-",
+                     str(flag) if flag is not None else "-",
+                     resolution(res_low), resolution(res_high)])
+
+
+class StatisticsMemo(object):
+    """Statistics of the models of a run saved in the file `filename`.
+
+    Args:
+        filename (str): Name of the JSON file of the memo
+    """
+    def __init__(self, filename=MEMO_FILENAME):
+        self.filename = os.path.abspath(workpath(filename))
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        """Reads the entries saved in the file (written also by other
+        processes, *e.g.* shards) to the memo."""
+        try:
+            with open(self.filename, "r") as f:
+                self.entries.update(json.load(f))
+        except (IOError, OSError, ValueError):
+            pass
+
+    def save(self):
+        """Writes the memo to the file, together with the entries saved
+        meanwhile by other processes."""
+        entries = dict(self.entries)
+        self.entries = {}
+        self.load()
+        self.entries.update(entries)
+        tmpname = self.filename + "." + str(os.getpid()) + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.rename(tmpname, self.filename)
+
+    def get(self, key, files):
+        """Returns the saved value or `None` if it is not saved or the
+        files have been changed since it was calculated.
+
+        Args:
+            key (str): See :func:`memo_key`
+            files (list): Names of the files the value is calculated from
+
+        Returns:
+            list or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry["files"] != [signature(f) for f in files]:
+            return None
+        return entry["value"]
+
+    def put(self, key, files, value):
+        """Saves a value calculated from the `files`."""
+        self.entries[key] = {"files": [signature(f) for f in files],
+                             "value": value}
+        self.save()
+
+
+def current_memo():
+    """Returns the memo of the current run (kept in
+    :class:`pairef.settings.RunContext`), a new one is made if the working
+    directory of the run has been changed."""
+    context = current_context()
+    memo = getattr(context, "statistics", None)
+    if memo is None or \
+            memo.filename != os.path.abspath(workpath(MEMO_FILENAME)):
+        memo = StatisticsMemo()
+        context.statistics = memo
+    return memo
+
+
+def memoized(key, files, function, *args, **kwargs):
+    """Returns the value `function(*args, **kwargs)` saved in the memo of
+    the current run under `key`, it is calculated only if it is not saved
+    yet.
+
+    Args:
+        key (str): See :func:`memo_key`
+        files (list): Names of the files the value is calculated from
+        function: Function calculating the value, it must return a tuple
+                  of values which can be saved in JSON
+
+    Returns:
+        tuple: Values are not saved if all of them are `"N/A"`
+    """
+    with _lock:
+        memo = current_memo()
+        value = memo.get(key, files)
+    if value is not None:
+        return tuple(value)
+    value = function(*args, **kwargs)
+    if all(v == "N/A" for v in value):  # calculated again next time
+        return tuple(value)
+    with _lock:
+        current_memo().put(key, files, list(value))
+    return tuple(value)
@@ -0,0 +1,395 @@
+# coding: utf-8
+from __future__ import print_function
+from __future__ import division
+import glob
+import json
+import math
+import re
+from .commons import twodec, print_my
+from .settings import workpath
+
+# Default cost model used if there is no profile of a previous run,
+# seconds per (reflection * atom * (cycle + 1)) and a constant overhead
+# of a job (seconds)
+DEFAULT_COSTS = {"refmac": (3.8e-8, 2.0), "phenix": (1.0e-6, 30.0),
+                 "sfcheck": 5.0, "calculate_merging_stats": 10.0}
+
+
+def count_atoms(xyzin):
+    """Returns a number of atoms in a structure model (PDB or mmCIF).
+
+    Args:
+        xyzin (str): Name of the file
+
+    Returns:
+        int
+    """
+    n_atoms = 0
+    with open(workpath(xyzin), "r") as f:
+        for line in f:
+            if line.startswith("ATOM") or line.startswith("HETATM"):
+                n_atoms += 1
+    return n_atoms
+
+
+def keywords_ncyc(com, refinement="refmac"):
+    """Returns the number of refinement cycles given by keywords `com`
+    (the last setting is valid).
+
+    Args:
+        com (str): Keywords for REFMAC5 or phenix.refine
+        refinement (str): "refmac" or "phenix"
+
+    Returns:
+        int or None: *None* if the number is not given
+    """
+    if refinement == "phenix":
+        found = re.findall(r"number_of_macro_cycles\s*=\s*(\d+)", com)
+    else:
+        found = re.findall(r"^\s*ncyc\s+(\d+)", com,
+                           re.IGNORECASE | re.MULTILINE)
+    if found:
+        return int(found[-1])
+    return None
+
+
+def reflection_curve(d_spacings, n_points=50):
+    """Describes the number of reflections vs. resolution by `n_points`
+    points so that it can be saved in a profile of the run.
+
+    Args:
+        d_spacings (numpy.ndarray): Sorted d-spacings of all the reflections
+
+    Returns:
+        list: Pairs [d, number of reflections with d-spacing >= d]
+    """
+    import numpy as np
+    n = len(d_spacings)
+    if not n:
+        return []
+    indices = np.unique(np.linspace(0, n - 1, n_points).astype(int))
+    return [[float(d_spacings[i]), int(n - i)] for i in indices]
+
+
+def describe_data(hklin, xyzin, flag=0):
+    """Returns the size of the problem that the cost model of refinement
+    jobs depends on.
+
+    Args:
+        hklin (str): Name of the MTZ file
+        xyzin (str): Name of the structure model file
+        flag (int): Free reflection flag
+
+    Returns:
+        (tuple):
+            * curve (*list*): See :func:`reflection_curve` (empty if the
+              reflections could not be read)
+            * n_atoms (*int*)
+    """
+    import numpy as np
+    from .reflections import mtz_d_spacings_work_free
+    try:
+        d_work, d_free = mtz_d_spacings_work_free(workpath(hklin), flag)
+        curve = reflection_curve(np.sort(np.concatenate((d_work, d_free))))
+    except (IOError, OSError, ValueError, KeyError):
+        curve = []
+    return curve, count_atoms(xyzin)
+
+
+def n_reflections(curve, res_high, res_low=None):
+    """Returns the number of reflections in a resolution range using
+    a curve given by :func:`reflection_curve`.
+
+    Args:
+        curve (list)
+        res_high (float)
+        res_low (float): (no limit if *None*)
+
+    Returns:
+        float
+    """
+    import numpy as np
+    if not curve:
+        return 0.0
+    d = [point[0] for point in curve]
+    n = [point[1] for point in curve]
+    count = float(np.interp(res_high, d, n, right=0))
+    if res_low:
+        count -= float(np.interp(res_low, d, n, right=0))
+    return max(count, 0.0)
+
+
+class CostModel(object):
+    """Estimates wall-clock time of jobs of PAIREF.
+
+    A refinement job takes `t0 + k * n_reflections * n_atoms * (ncyc + 1)`
+    seconds. The constants `k` and `t0` are fitted to refinement jobs
+    recorded in profiles of previous runs (see
+    :class:`pairef.timing.Profiler`), :data:`DEFAULT_COSTS` are used
+    otherwise. Other jobs take their average time from the profiles.
+    """
+    def __init__(self):
+        self.costs = dict(DEFAULT_COSTS)
+        self.calibrated = []
+
+    def calibrate(self, profiles):
+        """Fits the constants to the profiles of previous runs.
+
+        Args:
+            profiles (list): Loaded JSON profiles
+
+        Returns:
+            list: Names of calibrated job types
+        """
+        samples = {}
+        for profile in profiles:
+            metadata = profile.get("metadata", {})
+            refinement = metadata.get("refinement")
+            curve = metadata.get("reflections")
+            n_atoms = metadata.get("n_atoms")
+            for event in profile.get("events", []):
+                details = event.get("details", {})
+                if event["category"] == "program" and "kind" in details:
+                    if not (refinement and curve and n_atoms):
+                        continue
+                    x = n_reflections(curve, details["res_high"],
+                                      details.get("res_low")) * n_atoms * \
+                        ((details.get("ncyc") or 0) + 1)
+                    samples.setdefault(refinement, []).append(
+                        (x, event["wall"]))
+                elif event["name"] in ("sfcheck", "calculate_merging_stats"):
+                    samples.setdefault(event["name"], []).append(
+                        (None, event["wall"]))
+        for name, values in samples.items():
+            if name in ("refmac", "phenix"):
+                self.costs[name] = self.fit(values, name)
+            else:
+                self.costs[name] = sum(wall for _, wall in values) / \
+                    len(values)
+            self.calibrated.append(name)
+        return self.calibrated
+
+    @staticmethod
+    def fit(values, name="refmac"):
+        """Least squares fit of `wall = t0 + k * x`.
+
+        Args:
+            values (list): Pairs `x`, `wall`
+            name (str): "refmac" or "phenix" - the program whose
+                        :data:`DEFAULT_COSTS` are returned if the constants
+                        cannot be fitted
+
+        Returns:
+            (tuple): `k` and `t0`
+        """
+        import numpy as np
+        x = np.array([value[0] for value in values], dtype=float)
+        y = np.array([value[1] for value in values], dtype=float)
+        if len(set(x)) >= 2:
+            k, t0 = np.polyfit(x, y, 1)
+            if k > 0 and t0 >= 0:
+                return float(k), float(t0)
+        x_sum = x.sum()
+        if x_sum > 0:
+            return float(y.sum() / x_sum), 0.0
+        return DEFAULT_COSTS[name]
+
+    def time(self, job, curve, n_atoms, refinement="refmac"):
+        """Returns the estimated wall-clock time of `job` in seconds."""
+        if job["program"] in ("sfcheck", "calculate_merging_stats"):
+            return self.costs[job["program"]]
+        k, t0 = self.costs[refinement]
+        return t0 + k * n_reflections(curve, job["res_high"],
+                                      job.get("res_low")) * n_atoms * \
+            (job["ncyc"] + 1)
+
+
+def load_profiles(pattern="pairef_*/*_profile.json"):
+    """Loads profiles of previous runs (by default from the working
+    directories of other projects in the current directory).
+
+    Returns:
+        list
+    """
+    profiles = []
+    for filename in sorted(glob.glob(pattern)):
+        try:
+            with open(filename, "r") as f:
+                profiles.append(json.load(f))
+        except (IOError, OSError, ValueError):
+            continue
+    return profiles
+
+
+def plan_jobs(args, shells, flag_sets, refinement="refmac", sfcheck=True):
+    """Lists the jobs that :func:`pairef.launcher.main` launches.
+
+    Args:
+        args: Input arguments processed by `argparse`
+        shells (list): High resolution limits (the first is the initial one)
+        flag_sets (list)
+        refinement (str): "refmac" or "phenix"
+        sfcheck (bool): sfcheck is available
+
+    Returns:
+        list: Stages (dictionaries with keys `name` and `jobs` - the jobs of
+        every free reflection set which run one after another)
+    """
+    keywords = args.defin if refinement == "phenix" else args.comin
+    ncyc_keywords = None
+    if keywords:
+        with open(workpath(keywords), "r") as f:
+            ncyc_keywords = keywords_ncyc(f.read(), refinement)
+    if args.ncyc and args.ncyc != "auto":
+        ncyc = args.ncyc
+    elif ncyc_keywords:
+        ncyc = ncyc_keywords
+    elif keywords:
+        ncyc = 3 if refinement == "phenix" else 10  # defaults of programs
+    else:
+        ncyc = 3 if refinement == "phenix" else 20
+    if args.prerefinement_ncyc:
+        ncyc_first = args.prerefinement_ncyc
+    elif args.complete_cross_validation:
+        if args.ncyc and args.ncyc != "auto" or keywords:
+            ncyc_first = ncyc
+        else:
+            ncyc_first = 6 if refinement == "phenix" else 20
+    else:
+        ncyc_first = 0
+    if args.quick:
+        ncyc = ncyc_first = 1
+    program = {"refmac": "REFMAC5", "phenix": "phenix.refine"}[refinement]
+    sfcheck = sfcheck and refinement == "refmac" and \
+        not args.complete_cross_validation
+
+    def job(kind, res_high, ncyc=0, res_low=None, name=None):
+        return {"kind": kind, "program": name or program,
+                "res_high": res_high, "res_low": res_low, "ncyc": ncyc}
+
+    stages = [{"name": "initial resolution " + twodec(shells[0]) + " A",
+               "jobs": dict((flag, [job("first", shells[0], ncyc_first)])
+                            for flag in flag_sets)}]
+    if sfcheck:
+        stages[0]["jobs"][flag_sets[-1]].append(
+            job("sfcheck", shells[0], name="sfcheck"))
+    for i in range(len(shells) - 1):
+        jobs = {}
+        for flag in flag_sets:
+            jobs[flag] = [job("refine", shells[i + 1], ncyc),
+                          job("prev_pair", shells[i]),
+                          job("comp", shells[0])]
+            if not args.complete_cross_validation:
+                jobs[flag] += [job("comp", shells[j + 1], res_low=shells[j])
+                               for j in range(i + 1)]
+            if sfcheck:
+                jobs[flag].append(job("sfcheck", shells[i + 1],
+                                      name="sfcheck"))
+        stages.append({"name": "resolution " + twodec(shells[i + 1]) + " A",
+                       "jobs": jobs})
+    if args.hklin_unmerged:
+        stages.append({"name": "merging statistics", "jobs": {
+            flag_sets[0]: [job("merging", shells[-1],
+                               name="calculate_merging_stats")]}})
+    return stages
+
+
+def estimate(stages, model, curve, n_atoms, n_slots, refinement="refmac"):
+    """Estimates the runtime of the planned jobs.
+
+    Jobs of the free reflection sets of a stage run in parallel (at most
+    `n_slots` at once), stages run one after another.
+
+    Returns:
+        (tuple):
+            * total (*float*): Sum of times of all the jobs
+            * wall (*float*): Expected wall-clock time with `n_slots`
+            * critical (*float*): Critical path (wall-clock time with
+              unlimited number of cores)
+    """
+    total = wall = critical = 0.0
+    for stage in stages:
+        chains = []
+        for flag, jobs in stage["jobs"].items():
+            chain = 0.0
+            for job in jobs:
+                job["time"] = model.time(job, curve, n_atoms, refinement)
+                chain += job["time"]
+            chains.append(chain)
+        stage["time"] = max(chains)
+        total += sum(chains)
+        critical += max(chains)
+        wall += max(max(chains), sum(chains) / n_slots)
+    return total, wall, critical
+
+
+def format_time(seconds):
+    """Returns a time in seconds as a string h:mm:ss."""
+    seconds = int(math.ceil(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+
+def print_plan(stages, totals, n_slots, calibrated, n_reflections_all,
+               n_atoms):
+    """Prints the planned jobs and the runtime estimate."""
+    print_my("\nPlanned jobs (" + str(n_reflections_all) + " reflections, " +
+             str(n_atoms) + " atoms, " + str(n_slots) + " jobs at once):")
+    n_jobs = 0
+    for stage in stages:
+        print_my("\n   * " + stage["name"] + " (" +
+                 format_time(stage["time"]) + " per free reflection set)")
+        for flag in sorted(stage["jobs"]):
+            jobs = stage["jobs"][flag]
+            n_jobs += len(jobs)
+            descriptions = []
+            for job in jobs:
+                description = job["kind"] + " " + twodec(job["res_high"]) + \
+                    " A"
+                if job["res_low"]:
+                    description = job["kind"] + " " + \
+                        twodec(job["res_low"]) + "-" + \
+                        twodec(job["res_high"]) + " A"
+                if job["ncyc"]:
+                    description += " (" + str(job["ncyc"]) + " cycles)"
+                descriptions.append(description)
+            print_my("       flag " + str(flag) + ": " +
+                     ", ".join(descriptions))
+    total, wall, critical = totals
+    print_my("\nNumber of jobs: " + str(n_jobs))
+    print_my("Estimated sum of job times: " + format_time(total))
+    print_my("Estimated wall-clock time:  " + format_time(wall))
+    print_my("Critical path:              " + format_time(critical))
+    if calibrated:
+        print_my("The cost model was calibrated using profiles of previous "
+                 "runs (" + ", ".join(sorted(calibrated)) + ").")
+    else:
+        print_my("No profile of a previous run was found, the estimate uses "
+                 "default costs and it is only rough.")
+
+
+def plan(args, shells, flag_sets, refinement="refmac", n_slots=1,
+         sfcheck=True, pattern="pairef_*/*_profile.json"):
+    """Prints the jobs that would be run by :func:`pairef.launcher.main`
+    and estimates the runtime (option `--plan`).
+
+    Args:
+        args: Input arguments processed by `argparse`
+        shells (list): High resolution limits
+        flag_sets (list)
+        refinement (str): "refmac" or "phenix"
+        n_slots (int): Number of jobs that can run at once
+        sfcheck (bool): sfcheck is available
+        pattern (str): Glob pattern of profiles of previous runs
+
+    Returns:
+        (tuple): See :func:`estimate`
+    """
+    curve, n_atoms = describe_data(args.hklin, args.xyzin, flag_sets[0])
+    model = CostModel()
+    calibrated = model.calibrate(load_profiles(pattern))
+    stages = plan_jobs(args, shells, flag_sets, refinement, sfcheck)
+    totals = estimate(stages, model, curve, n_atoms, n_slots, refinement)
+    print_plan(stages, totals, n_slots, calibrated,
+               curve[0][1] if curve else 0, n_atoms)
+    return totals
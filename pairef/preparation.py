@@ -2,47 +2,30 @@
 from __future__ import print_function
 import sys
 import os
-import subprocess
 import datetime
 from math import sqrt, pow
 from collections import OrderedDict  # Python 2.7
-from .settings import warning_dict, date_time, settings
+from .settings import warning_dict, settings, current_context, workpath
 from .commons import twodec, twodecname, fourdec, extract_from_file
-from .commons import warning_my, Popen_my, pick_work_free_from_csv_line
+from .commons import warning_my, print_my
+from .commons import InputError, RefinementError
+from .commons import which
+from .tools import find
+from .artefacts import link_or_copy
+from .jobs import job_runner
+from .timing import timed
+from .reflections import is_mtz, is_xds_ascii, xds_ascii_header
+from .reflections import resolution_range_unmerged, merging_stats_unmerged
+from .reflections import format_merging_stats_bin, read_mtz_header
+from .reflections import mtz_column_summary, mtz_free_flag_sets
+from .reflections import mtz_reflection_counts
+from .reflections import refinement_mtz_labels, write_mtz_subset
+from .reflections import mtz_d_spacings_work_free, equal_count_shells
 
 
 BINS_LOW = 10
 
 
-def which(program):
-    """Checks if `program` exists and finds its location. Analogy of the
-    `which` GNU/Linux command.
-
-    Args:
-        program (str): Name of an executable
-
-    Returns:
-        str: Path of an executable location
-    """
-
-    def is_exe(fpath):
-        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
-
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program) or is_exe(program + ".exe"):
-            return program
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
-            exe_file = os.path.join(path, program + ".exe")
-            if is_exe(exe_file):
-                return exe_file
-    return None
-
-
 def welcome(args, pairef_version):
     '''Print introduction information about the module and
     input parameters.
@@ -59,81 +42,82 @@ def welcome(args, pairef_version):
     import socket
 
 
-    print("""
+    print_my("""
  __   _  ___ __  ___ ___
  )_) /_)  )  )_) )_  )_
 /   / / _(_ / \ (__ (
 """)
-    print("automatic PAIRed REFinement protocol")
-    print("version: " + pairef_version)
-    print("run date and time: " + date_time)
-    print("user@host: " + getpass.getuser() + "@" + socket.gethostname())
-    print("")
-    print('Please cite: "Paired refinement under the control of PAIREF"')
-    print("M. Maly, K. Diederichs, J. Dohnalek, P. Kolenko (2020) IUCrJ 7")
-    print("")
-    print("Command line arguments: " + " ".join(sys.argv[1:]))
-    print("")
-    print("Program has been executed with following input parameters:")
+    print_my("automatic PAIRed REFinement protocol")
+    print_my("version: " + pairef_version)
+    print_my("run date and time: " + current_context().date_time)
+    print_my("user@host: " + getpass.getuser() + "@" + socket.gethostname())
+    print_my("")
+    print_my('Please cite: "Paired refinement under the control of PAIREF"')
+    print_my("M. Maly, K. Diederichs, J. Dohnalek, P. Kolenko (2020) IUCrJ 7")
+    print_my("")
+    print_my("Command line arguments: " + " ".join(sys.argv[1:]))
+    print_my("")
+    print_my("Program has been executed with following input parameters:")
     if args.refmac:
-        print(" * Refinement software: REFMAC5")
+        print_my(" * Refinement software: REFMAC5")
     if args.phenix:
-        print(" * Refinement software: phenix.refine")
-    print(" * XYZIN: " + args.xyzin)
-    print(" * HKLIN: " + args.hklin)
+        print_my(" * Refinement software: phenix.refine")
+    print_my(" * XYZIN: " + args.xyzin)
+    print_my(" * HKLIN: " + args.hklin)
     if args.hklin_unmerged:
-        print(" * HKLIN unmerged: " + args.hklin_unmerged)
+        print_my(" * HKLIN unmerged: " + args.hklin_unmerged)
     if args.libin:
-        print(" * LIBIN: " + args.libin)
+        print_my(" * LIBIN: " + args.libin)
     if args.tlsin:
-        print(" * TLSIN: " + args.tlsin)
-    print(" * Project name: " + str(args.project))
+        print_my(" * TLSIN: " + args.tlsin)
+    print_my(" * Project name: " + str(args.project))
     # if args.step:
     #     print(" * Resolution step in angstroem: " + str(args.step))
     # if args.n_shells:
     #     print(" * Number of res. shells: " + str(args.n_shells))
     if args.res_shells:
-        print(" * Resolution shells: " + str(args.res_shells))
+        print_my(" * Resolution shells: " + str(args.res_shells))
     if args.weight:
-        print(" * Weight matrix: " + str(args.weight))
+        print_my(" * Weight matrix: " + str(args.weight))
     if args.tls_ncyc:
-        print(" * Number of number of cycles of TLS refinement: "
-              "" + str(args.tls_ncyc))
+        print_my(" * Number of number of cycles of TLS refinement: "
+                 "" + str(args.tls_ncyc))
     if args.ncyc:
-        print(" * Number of refinement cycles that will be performed in "
-              "every resolution step: " + str(args.ncyc))
+        print_my(" * Number of refinement cycles that will be performed in "
+                 "every resolution step: " + str(args.ncyc))
     if args.prerefinement_ncyc:
-        print(" * Number of pre-refinement cycles that will be performed "
-              "before the paired refinement protocol: "
-              "" + str(args.prerefinement_ncyc))
+        print_my(" * Number of pre-refinement cycles that will be performed "
+                 "before the paired refinement protocol: "
+                 "" + str(args.prerefinement_ncyc))
     if args.complete_cross_validation:
-        print(" * Complete cross-validation will be performed.")
+        print_my(" * Complete cross-validation will be performed.")
 
     if (args.complete_cross_validation or args.no_modification or
             args.reset_bfactor or args.add_to_bfactor or args.set_bfactor or
             args.shake_sites):
-        print(" * Modification of the input structure model:")
+        print_my(" * Modification of the input structure model:")
     if args.reset_bfactor:
-        print("   - Reset B-factors to the mean value")
+        print_my("   - Reset B-factors to the mean value")
     if args.add_to_bfactor:
-        print("   - Add value to B-factors: " +
-              twodec(args.add_to_bfactor))
+        print_my("   - Add value to B-factors: " +
+                 twodec(args.add_to_bfactor))
     if args.set_bfactor:
-        print("   - Set B-factors to the value: " + twodec(args.set_bfactor))
+        print_my("   - Set B-factors to the value: " +
+                 twodec(args.set_bfactor))
     if args.shake_sites:
-        print("   - Randomize coordinates with the "
-              "given mean error value: " + twodec(args.shake_sites))
+        print_my("   - Randomize coordinates with the "
+                 "given mean error value: " + twodec(args.shake_sites))
 
     if args.constant_grid:
-        print(" * The same FFT grid will be kept through the whole paired "
-              "refinement.")
+        print_my(" * The same FFT grid will be kept through the whole paired "
+                 "refinement.")
     if args.comin:
-        print(" * Com file for REFMAC5: " + args.comin)
+        print_my(" * Com file for REFMAC5: " + args.comin)
     if args.defin:
-        print(" * Keyword file for phenix.refine: " + args.defin)
+        print_my(" * Keyword file for phenix.refine: " + args.defin)
     if args.test:
-        print(" * Light-testing mode (REFMAC5 will not be executed).")
-    print("")
+        print_my(" * Light-testing mode (REFMAC5 will not be executed).")
+    print_my("")
     return True
 
 
@@ -160,26 +144,66 @@ def create_workdir(project):
     return workdir
 
 
+@timed("preparation")
+def slim_hklin(hklin, workdir, keywords=None):
+    """Writes a working copy of the input MTZ file `hklin` to the directory
+    `workdir` containing only the columns which are used by REFMAC5
+    or phenix.refine and by the calculation of statistics (see
+    :func:`pairef.reflections.refinement_mtz_labels`). All later jobs read
+    this smaller file. If the columns cannot be recognized or if a file with
+    keywords is given (it can refer to any column, *e.g.* by LABIN), the
+    whole file is copied.
+
+    Args:
+        hklin (str): Name of diffraction data MTZ file
+        workdir (str): Name of the working directory
+        keywords (list): Names of the files with keywords for REFMAC5 or
+                         phenix.refine given by the user (options `--comin`
+                         and `--def`)
+
+    Returns:
+        str: Basename of the working copy
+    """
+    hklin_copy = os.path.join(workdir, os.path.basename(hklin))
+    try:
+        header = read_mtz_header(workpath(hklin))
+        labels = refinement_mtz_labels(header)
+    except (IOError, ValueError, IndexError):
+        labels = []
+    if keywords and any(keywords):
+        labels = []
+    if labels and len(labels) < header["ncol"]:
+        write_mtz_subset(workpath(hklin), workpath(hklin_copy), labels)
+        print_my("Working copy of " + hklin + " contains columns: " + \
+                 " ".join(labels[3:]))
+    else:
+        link_or_copy(hklin, hklin_copy)
+    return os.path.basename(hklin)
+
+
 class output_log:
-    "Set to write `sys.stdout` to screen and also in file `PAIREF_out.log`."
+    """Writes the messages of a run to screen and also in file
+    `PAIREF_out.log` (it is set as the output of the run context, see
+    :func:`pairef.settings.current_output`)."""
     # Not working for STDERR! TODO! write on internet...
     def __init__(self, stdout, filename):
         self.stdout = stdout
-        self.logfile = open(filename, 'a')
+        self.logfile = open(workpath(filename), 'a')
 
     def write(self, text):
         self.stdout.write(text)
         self.logfile.write(text)
 
     def close(self):
-        self.stdout.close()
+        # The screen is not closed, it is shared by other runs
         self.logfile.close()
 
     def flush(self):
-        self.stdout.close()
-        self.logfile.close()
+        self.stdout.flush()
+        self.logfile.flush()
 
 
+@timed("preparation")
 def def_res_shells(args, refinement, res_high_mtz, res_low=999):
     """Determine high resolution shells and number of low resolution bins.
 
@@ -187,6 +211,8 @@ def def_res_shells(args, refinement, res_high_mtz, res_low=999):
     were used for the refinement of the input structure model.
     If explicit definition (args.res_shells) is set, test its correctness.
     If it is valid, use, if not, define it automatically (shell step 0.05 A)
+    or, if args.shell_nfree or args.shell_nwork is set, so that every shell
+    contains the given numbers of free and work reflections.
 
     Args:
         args (parser): Input arguments (including e. g. name of the project) \
@@ -201,16 +227,17 @@ def def_res_shells(args, refinement, res_high_mtz, res_low=999):
             * n_bins_low (*int*)
             * n_flag_sets (*int*)
             * default_shells_definition (*bool*)
+
+    Raises:
+        InputError: The shells cannot be defined
     """
     # If the resolution of input model == resolution of diffr. data, abort
     if twodec(args.res_init) <= twodec(res_high_mtz):
-        sys.stderr.write(
-            "ERROR: Given input MTZ file " + args.hklin + " contain data "
+        raise InputError(
+            "Given input MTZ file " + args.hklin + " contain data "
             "only up to resolution " + twodec(res_high_mtz) + " A that is "
             "the same or lower than the initial high-resolution diffraction "
-            "limit " + twodec(args.res_init) + " A. Nothing to do.\n"
-            "Aborting.\n")
-        sys.exit(1)
+            "limit " + twodec(args.res_init) + " A. Nothing to do.")
     # Estimation of
     #   1. a number of low resolution bins and
     #   2. a number of free reflection sets
@@ -220,73 +247,19 @@ def def_res_shells(args, refinement, res_high_mtz, res_low=999):
     n_i_obs_low = 0
     n_flag_sets = 0
 
-    if refinement == "refmac":
-        # using `mtzdump` from CCP4 to get both n_i_obs_low and n_flag_sets
-        tool = "mtzdump"
-        p = Popen_my(["mtzdump", "HKLIN", args.hklin],
-                     stdin=subprocess.PIPE,
-                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                     shell=settings["sh"])
-        com = "STATS NBIN 1 RESO " + twodec(res_low) + " " \
-            "" + twodec(args.res_init) + "\n end\n"
-        output, err = p.communicate(com)
-        # rc = p.returncode
-        try:
-            for line in output.splitlines():
-                if " * Number of Reflections = " in line:
-                    n_i_obs = int(line.split()[-1])
-                elif len(line.split()) == 12:
-                    if "free" in line.split()[-1].lower():
-                        n_flag_sets = int(float(line.split()[3])) - \
-                            int(float(line.split()[2])) + 1
-                elif " No. of reflections used in FILE STATISTICS" in line:
-                    n_i_obs_low = int(line.split()[-1])
-                    break
-        except ValueError:
-            n_bins_low = 12
-            warning_my("mtzdump",
-                       "Definition of binning "
-                       "and search for number of sets of free reflection "
-                       "using mtzdump were not successful. "
-                       "Data will be divided into " + str(n_bins_low) + " "
-                       "resolution bins. "
-                       "Is the input MTZ file " + args.hklin + " OK?")
-    elif refinement == "phenix":
-        from iotbx.reflection_file_reader import any_reflection_file
-        from iotbx import mtz
-        tool = "CCTBX"
-        # 1. get n_i_obs_low using CCTBX
-        n_i_obs_low_list = []
-        n_i_obs_list = []
-        hkl_in = any_reflection_file(file_name=args.hklin)
-        miller_arrays = hkl_in.as_miller_arrays()
-        for column in miller_arrays:
-            if "xray" in str(column.observation_type()):
-                n_i_obs_list.append(column.size())
-                column_res_init = column.resolution_filter(
-                    d_max=float(res_low), d_min=float(args.res_init))
-                n_i_obs_low_list.append(column_res_init.size())
-        n_i_obs = min(n_i_obs_list)
-        n_i_obs_low = min(n_i_obs_low_list)
-        # 2. get n_flag_sets using CCTBX
-        mtz_object = mtz.object(file_name=args.hklin)
-        try:  # Python 3
-            import io
-            out = io.StringIO()
-            mtz_object.show_summary(out=out)
-        except TypeError:  # Python 2.7 (CCP4 7, Phenix 1.20)
-            import cStringIO
-            out = cStringIO.StringIO()
-            mtz_object.show_summary(out=out)
-        out = out.getvalue()
-        out_lines = out.splitlines()
-        for i in range(len(out_lines)):
-            if "free" in out_lines[i].lower():
-                j = i
-        if "j" in vars():
-            n_flag_sets = int(float(out_lines[j].split()[4])) - \
-                int(float(out_lines[j].split()[3])) + 1
-
+    # Both numbers are obtained from the MTZ header and memory-mapped
+    # reflection data (no external programs are launched)
+    tool = "MTZ file reader"
+    try:
+        mtz_header = read_mtz_header(workpath(args.hklin))
+        # Only the mean amplitudes or intensities are counted, a column of
+        # anomalous data would contain fewer values
+        n_i_obs, n_i_obs_low = mtz_reflection_counts(
+            workpath(args.hklin), res_low=float(res_low),
+            res_high=float(args.res_init), header=mtz_header)
+        n_flag_sets = mtz_free_flag_sets(mtz_header)
+    except (IOError, ValueError, IndexError):
+        pass  # n_i_obs == 0 is handled below
     if n_flag_sets == 0:
         n_flag_sets = 20
         if args.complete_cross_validation:
@@ -297,8 +270,8 @@ def def_res_shells(args, refinement, res_high_mtz, res_low=999):
                        "are present in the input MTZ file " + args.hklin + ".")
     else:
         if args.complete_cross_validation:
-            print(str(n_flag_sets) + " sets of free reflection were found and "
-                  "will be used in complete cross-validation.")
+            print_my(str(n_flag_sets) + " sets of free reflection were found "
+                     "and will be used in complete cross-validation.")
     if n_i_obs == 0 or n_i_obs_low == 0:
         n_bins_low = 12
         warning_my("binning",
@@ -306,15 +279,10 @@ def def_res_shells(args, refinement, res_high_mtz, res_low=999):
                    "ful. Data will be divided into " + str(n_bins_low) + " "
                    "resolution bins. "
                    "Is the input MTZ file " + args.hklin + " OK?")
-    else:  # If run of mtzdump was succesful
-        n_bins_low_start = 12
-        n_i_obs_thinner_shell_start = 0
-        n_bins_low = n_bins_low_start
-        n_i_obs_thinner_shell = n_i_obs_thinner_shell_start
-        while n_i_obs_thinner_shell < 2000:
-            n_bins_low = n_bins_low - 1
-            n_i_obs_thinner_shell = \
-                sqrt(2) * n_i_obs_low / pow(n_bins_low, 1.5)
+    else:  # If counting of reflections was succesful
+        # The highest number of bins (at most 11) such that the thinnest bin
+        # sqrt(2) * n_i_obs_low / pow(n_bins_low, 1.5) has 2000 reflections
+        n_bins_low = min(11, int(pow(sqrt(2) * n_i_obs_low / 2000, 2 / 3.)))
     if n_bins_low <= 1:
         n_bins_low = 2
     # Now `n_bins_low` is ready
@@ -327,56 +295,45 @@ def def_res_shells(args, refinement, res_high_mtz, res_low=999):
             try:
                 shells_high[i] = round(float(shells_high[i]), 2)
             except ValueError:
-                sys.stderr.write(
-                    "ERROR: Explicit definition of high "
-                    "resolution shells (option -r) is not correct. ")
-                sys.stderr.write(
+                raise InputError(
+                    "Explicit definition of high "
+                    "resolution shells (option -r) is not correct. "
                     "Values must be divided using commas without "
                     "any spaces (e.g. 2.1,2.0,1.9).")
-                sys.stderr.write("\nAborting.\n")
-                sys.exit(1)
             if i != 0:
                 if float(shells_high[i - 1]) <= float(shells_high[i]):
-                    sys.stderr.write(
-                        "ERROR: Explicit definition of high "
-                        "resolution shells (option -r) is not correct. ")
-                    sys.stderr.write(
+                    raise InputError(
+                        "Explicit definition of high "
+                        "resolution shells (option -r) is not correct. "
                         "Values must be set in the decreasing order "
                         "(e.g. 2.1,2.0,1.9).")
-                    sys.stderr.write("\nAborting.\n")
-                    sys.exit(1)
         for i in range(len(shells_high)):
             if twodec(shells_high[i]) <= twodec(res_high_mtz):
                 shells_high = shells_high[:i] + [round(float(res_high_mtz), 2)]
                 break
         if shells_high[0] >= args.res_init:
-            sys.stderr.write(
-                "ERROR: Explicit definition of high "
-                "resolution shells (option -r) is not correct. ")
-            sys.stderr.write(
+            raise InputError(
+                "Explicit definition of high "
+                "resolution shells (option -r) is not correct. "
                 "Resolution of the first shell (" + twodec(shells_high[0]) + ""
                 " A), "
                 "which was explicitely defined, is lower than or the same as "
                 "the resolution of data which were used for refinement of the "
                 "input structure model (" + twodec(args.res_init) + " A).")
-            sys.stderr.write("\nAborting.\n")
-            sys.exit(1)
 
     elif args.step and args.n_shells:
         # Defined step (in A) and number of shells to be added
         default_shells_definition = False
         res_fin = args.res_init - args.step * args.n_shells
         if res_fin < 0:
-            sys.stderr.write("ERROR: Current setup of resolution shells is "
+            raise InputError("Current setup of resolution shells is "
                              "not valid. High resolution limit of the last "
-                             "shell would be negative.\n")
-            sys.stderr.write("\nRESOLUTION_INITIAL - (RESOLUTION_STEP * NUM"
+                             "shell would be negative.\n"
+                             "\nRESOLUTION_INITIAL - (RESOLUTION_STEP * NUM"
                              "BER_OF_SHELLS) = " + twodec(args.res_init) + ""
                              " - ( " + str(args.step) + " * "
                              "" + str(args.n_shells) + ""
                              " ) = " + twodec(res_fin) + " < 0")
-            sys.stderr.write("\nAborting.\n")
-            sys.exit(1)
         shells_high = []
         for i in range(args.n_shells):
             new_shell = args.res_init - (i + 1) * args.step
@@ -389,6 +346,27 @@ def def_res_shells(args, refinement, res_high_mtz, res_low=999):
                 if twodec(res_high_mtz) != twodec(shells_high[i - 1]):
                     shells_high.append(round(float(twodec(res_high_mtz)), 2))
                 break
+    elif args.shell_nfree or args.shell_nwork:
+        # Shells containing the given numbers of free and work reflections
+        default_shells_definition = False
+        try:
+            d_work, d_free = mtz_d_spacings_work_free(
+                workpath(args.hklin), flag=args.flag or 0)
+        except (IOError, ValueError, IndexError):
+            raise InputError(
+                "Free reflection flags or observations could not be "
+                "found in the input MTZ file " + args.hklin + ". High "
+                "resolution shells cannot be designed using the options "
+                "--shell-nfree and --shell-nwork.")
+        shells_high, counts = equal_count_shells(
+            d_work, d_free, args.res_init, res_high_mtz,
+            n_free=args.shell_nfree or 0, n_work=args.shell_nwork or 0)
+        print_my("Projected numbers of reflections in high resolution shells:")
+        res_prev = args.res_init
+        for shell, (n_work, n_free) in zip(shells_high, counts):
+            print_my("   " + twodec(res_prev) + "-" + twodec(shell) + " A: "
+                     "Nwork " + str(n_work) + ", Nfree " + str(n_free))
+            res_prev = shell
     else:
         # Default setting - 0.05A wide high resolution shells
         shell_width = 0.05
@@ -438,13 +416,11 @@ def def_res_shells(args, refinement, res_high_mtz, res_low=999):
             # sys.stderr.write("\nAborting.\n")
             # sys.exit(1)
     if shells_high == []:
-        sys.stderr.write(
-            "ERROR: The given definition of high-resolution shells requires "
+        raise InputError(
+            "The given definition of high-resolution shells requires "
             "more data in high resolution than are available in the given "
             "input MTZ file " + args.hklin + " that contain data "
-            "only up to resolution " + twodec(res_high_mtz) + " A. Nothing to do.\n"
-            "Aborting.\n")
-        sys.exit(1)
+            "only up to resolution " + twodec(res_high_mtz) + " A. Nothing to do.")
     shells = [args.res_init] + shells_high
     return shells, n_bins_low, n_flag_sets, default_shells_definition
 
@@ -478,8 +454,12 @@ def res_high_from_xyzin(xyzin, format=".pdb"):
     return res_high
 
 
+@timed("preparation")
 def res_from_mtz(hklin):
-    """Finds the low resolution diffraction limit of data `hklin` using CCTBX.
+    """Finds the resolution range of data `hklin` - the first column
+    of observations (amplitudes or intensities) is considered.
+    Only the MTZ header and memory-mapped Miller indices and observations
+    are read.
 
     Args:
         hklin (str): Name of diffraction data MTZ file
@@ -489,26 +469,29 @@ def res_from_mtz(hklin):
             * res_low (*float*): Low resolution diffraction limit
             * res_high (*float*): High resolution diffraction limit
     """
-    from iotbx.reflection_file_reader import any_reflection_file
-    hkl_in = any_reflection_file(file_name=hklin)
-    miller_arrays = hkl_in.as_miller_arrays()
     res_low = None
     res_high = None
-    for column in miller_arrays:
-        if "xray" in str(column.observation_type()):
-            res_low = column.d_max_min()[0]
-            res_high = column.d_max_min()[1]
+    try:
+        summary = mtz_column_summary(workpath(hklin))
+    except (IOError, ValueError, IndexError):
+        return res_low, res_high
+    for stats in summary.values():
+        if stats["n"]:
+            res_low = stats["d_max"]
+            res_high = stats["d_min"]
             break
     return res_low, res_high
 
 
+@timed("statistics")
 def res_from_hklin_unmerged(hklin_unmerged):
     """
     Finds a resolution range for given unmerged diffr. data file 
     `hklin_unmerged`.
     In the case of an ASCII file from XDS, find it by
-    searching the option `INCLUDE_RESOLUTION_RANGE` in the file.
-    In the case of an MTZ file, find it using `xia2`.
+    searching the option `INCLUDE_RESOLUTION_RANGE` in the file header
+    or, if it is missing, by streaming through the observations.
+    In the case of an MTZ file, read it from the MTZ header.
     In the case of a SCA file, do not check.
 
     Args:
@@ -523,47 +506,26 @@ def res_from_hklin_unmerged(hklin_unmerged):
     res_low_from_hklin_unmerged = None
     # may be an MTZ file
     if  "mtz" in hklin_unmerged.split(".")[-1].lower():
-        ### Solution 1 - CCTBX
-        ### res_low_from_hklin_unmerged, res_high_from_hklin_unmerged = \
-        ###     res_from_mtz(hklin_unmerged)  # This needs to much RAM...
-
-        ## Solution 2 - mtzdump
-        ## p = Popen_my(["mtzdump", "HKLIN", hklin_unmerged],
-        ##                      stdin=subprocess.PIPE,
-        ##                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        ## com = "end\n"
-        ## output, err = p.communicate(com)
-        ## for i in range(len(output.splitlines())):
-        ##     if " *  Resolution Range :" in output.splitlines()[i]:
-        ##         res_low_from_hklin_unmerged = \
-        ##             float(output.splitlines()[i + 2].split()[-5])
-        ##         res_high_from_hklin_unmerged = \
-        ##             float(output.splitlines()[i + 2].split()[-3])
-        ##         break
-
-        # Solution 3 - xia2 - works with both CCP4 and phenix
-        from xia2.Wrappers.CCP4.Mtzdump import Mtzdump
-        m = Mtzdump()
-        m.set_hklin(hklin_unmerged)
-        m.dump()
-        res_low_from_hklin_unmerged, res_high_from_hklin_unmerged = \
-            m.get_resolution_range()
-        
+        # The resolution range is stored in the MTZ header
+        try:
+            res_low_from_hklin_unmerged, res_high_from_hklin_unmerged = \
+                read_mtz_header(workpath(hklin_unmerged))["res_range"]
+        except (IOError, ValueError, IndexError):
+            pass
+
     # may be an XDS ASCII file
-    elif "hkl" in hklin_unmerged.split(".")[-1].lower():
-        hklin_unmerged_head = []
-        try:  # Python 2 and 3 support
-            xrange
-        except NameError:
-            xrange = range
-        with open(hklin_unmerged, "r") as hklin_unmerged_file:
-            hklin_unmerged_head = \
-                [next(hklin_unmerged_file) for x in xrange(1000)]
-        for line in hklin_unmerged_head:
-            if "INCLUDE_RESOLUTION_RANGE" in line:
-                res_high_from_hklin_unmerged = float(line.split()[-1])
-                res_low_from_hklin_unmerged = float(line.split()[-2])
-                break
+    elif is_xds_ascii(workpath(hklin_unmerged)):
+        # Only the header is read if it contains INCLUDE_RESOLUTION_RANGE,
+        # otherwise the observations are streamed by chunks
+        res_range = xds_ascii_header(workpath(hklin_unmerged))["res_range"]
+        if not res_range:
+            try:
+                res_range = resolution_range_unmerged(
+                    workpath(hklin_unmerged))
+            except (ValueError, IndexError):
+                res_range = (None, None)
+        res_low_from_hklin_unmerged, res_high_from_hklin_unmerged = \
+            res_range
     if not res_high_from_hklin_unmerged or not res_low_from_hklin_unmerged:
         warning_my("merging_stats",
                    "The check of a resolution range of the unmerged data "
@@ -666,6 +628,7 @@ def check_refinement_software(args, versions_dict, refinement="refmac"):
     return version_xyzin
 
 
+@timed("statistics")
 def res_opt(shell, args, refinement="refmac"):
     """
     Finds optical resolution running command
@@ -689,41 +652,45 @@ def res_opt(shell, args, refinement="refmac"):
     xyzin = prefix + ".pdb"
     command = ["sfcheck", "-f", hklin, "-m", xyzin]
     logfilename = prefix + "_sfcheck.out"
-    with open(logfilename, "w") as logfile:
-        p = Popen_my(
-            command, stdout=logfile, stderr=logfile, shell=settings["sh"])
-        out, err = p.communicate()
+    with open(workpath(logfilename), "w") as logfile:
+        job_runner.run(command, stdout=logfile, stderr=logfile, threads=1,
+                       shell=settings["sh"])
 
     res_opt = 0
-    with open(logfilename, "r") as logfile:
+    with open(workpath(logfilename), "r") as logfile:
         for line in logfile.readlines():
             if "Optical Resolution" in line:
                 res_opt = float(line.split()[-1])
                 break
-    if os.path.isfile("sfcheck.xml"):
-        os.rename("sfcheck.xml", prefix + "_sfcheck.xml")
-    if os.path.isfile("sfcheck_xxxx.ps"):
-        os.rename("sfcheck_xxxx.ps", prefix + "_sfcheck.ps")
-    if os.path.isfile("sfcheck.log"):
-        os.rename("sfcheck.log", prefix + "_sfcheck.log")
+    if os.path.isfile(workpath("sfcheck.xml")):
+        os.rename(workpath("sfcheck.xml"), workpath(prefix + "_sfcheck.xml"))
+    if os.path.isfile(workpath("sfcheck_xxxx.ps")):
+        os.rename(workpath("sfcheck_xxxx.ps"),
+                  workpath(prefix + "_sfcheck.ps"))
+    if os.path.isfile(workpath("sfcheck.log")):
+        os.rename(workpath("sfcheck.log"), workpath(prefix + "_sfcheck.log"))
     # TODO: warning
     # TODO help
     csvfilename = args.project + "_Optical_resolution.csv"
-    if not os.path.isfile(csvfilename):
-        with open(csvfilename, "w") as csvfile:
+    if not os.path.isfile(workpath(csvfilename)):
+        with open(workpath(csvfilename), "w") as csvfile:
             csvfile.write("# Nominal resolution          Optical resolution\n")
-    with open(csvfilename, "a") as csvfile:
+    with open(workpath(csvfilename), "a") as csvfile:
         csvfile.write(
             twodec(shell) + 26 * " " + twodec(res_opt) + "\n")
     return float(twodec(res_opt))
 
 
+@timed("statistics")
 def calculate_merging_stats(hklin_unmerged, shells, project, bins_low,
                             res_low_from_hklin_unmerged=float("inf"),
                             res_high_from_hklin_unmerged=0):
     """
-    For given file `hklin_unmerged`, calculate the merging statistics
-    using CCTBX.
+    For given file `hklin_unmerged`, calculate the merging statistics.
+    XDS_ASCII and unmerged MTZ files are read by chunks using
+    :func:`pairef.reflections.merging_stats_unmerged`, so the memory usage
+    does not grow with the number of observations. Other formats (e.g. SCA)
+    are processed using CCTBX.
 
     Args:
         hklin_unmerged (str): Name of the unmerged diffraction data file
@@ -735,7 +702,7 @@ def calculate_merging_stats(hklin_unmerged, shells, project, bins_low,
     Returns:
         str: Name of a CSV file where the calculated statistics has been saved
     """
-    print("\n     * Calculating merging statistics...", end="")
+    print_my("\n     * Calculating merging statistics...", end="")
 
     ## Calculate statistics
     def calculate_merging_stats_run_cctbx(project, hklin, res_high,
@@ -749,7 +716,8 @@ def calculate_merging_stats(hklin_unmerged, shells, project, bins_low,
         if "mtz" in hklin.split(".")[-1] and not data_labels:
             try:
                 from iotbx.reflection_file_reader import any_reflection_file
-                miller_arrays = any_reflection_file(hklin).as_miller_arrays()
+                miller_arrays = any_reflection_file(
+                    workpath(hklin)).as_miller_arrays()
                 labels_i = []
                 for label in miller_arrays:
                     if "xray.intensity" in str(label.observation_type()):
@@ -758,8 +726,9 @@ def calculate_merging_stats(hklin_unmerged, shells, project, bins_low,
                             label_here = label_here.replace(",merged", "")
                         labels_i.append(label_here)
                 if len(labels_i) == 0:
-                    print("No intensity arrays were found in the file " + hklin)
-                    print(".\nMerging statistics could not be calculated.")
+                    print_my("No intensity arrays were found in the file " +
+                             hklin)
+                    print_my(".\nMerging statistics could not be calculated.")
                     return False
                 elif len(labels_i) == 1:  # Default behaviour is OK
                     # label_imean = label_imean[0]
@@ -773,8 +742,8 @@ def calculate_merging_stats(hklin_unmerged, shells, project, bins_low,
                     data_labels = labels_imean[0]
             except:
                 pass  # Try to continue...
-        i_obs = iotbx.merging_statistics.select_data(file_name=hklin,
-                                                     data_labels=data_labels)
+        i_obs = iotbx.merging_statistics.select_data(
+            file_name=workpath(hklin), data_labels=data_labels)
         result = iotbx.merging_statistics.dataset_statistics(
             i_obs=i_obs,
             # crystal_symmetry=symm,
@@ -785,13 +754,18 @@ def calculate_merging_stats(hklin_unmerged, shells, project, bins_low,
             )
         logfilename = project + "_merging_stats_" + twodecname(res_high) + "" \
             "A.log"
-        with open(logfilename, "w") as logfile:
+        with open(workpath(logfilename), "w") as logfile:
             result.show(out=logfile, header=False)
         return data_labels
 
     bins_total_proposed = bins_low + shells
     bins_total = []
     labels = None
+    # XDS_ASCII and unmerged MTZ files are streamed by chunks
+    # (see pairef.reflections), other formats are loaded by CCTBX
+    streaming = is_mtz(workpath(hklin_unmerged)) or \
+        is_xds_ascii(workpath(hklin_unmerged))
+    bins_streaming = []
     for i in range(len(bins_total_proposed)-1):
         if res_low_from_hklin_unmerged < bins_total_proposed[i + 1] \
                 or res_high_from_hklin_unmerged > bins_total_proposed[i]:
@@ -807,17 +781,35 @@ def calculate_merging_stats(hklin_unmerged, shells, project, bins_low,
             bins_total.append(bins_total_proposed[i + 1])
             # Remove duplicates from bins_total and keep order
             bins_total = list(OrderedDict.fromkeys(bins_total))
+            if streaming:
+                bins_streaming.append((bins_total_proposed[i],
+                                       bins_total_proposed[i + 1]))
+                continue
             labels = calculate_merging_stats_run_cctbx(
                 project, hklin_unmerged, res_high=bins_total[i + 1],
                 res_low=bins_total[i], n_bins=1, data_labels=labels)
-        print(" .", end="")
+        print_my(" .", end="")
+    lines_streaming = []
+    if streaming and bins_streaming:
+        try:
+            stats = merging_stats_unmerged(workpath(hklin_unmerged),
+                                           bins_streaming)
+        except (ValueError, IndexError) as e:
+            warning_my("merging_stats",
+                       "Merging statistics could not be calculated as "
+                       "the unmerged data file " + hklin_unmerged + " "
+                       "could not be read. (" + str(e) + ")")
+            stats = []
+        for stats_bin in stats:
+            lines_streaming.append(format_merging_stats_bin(stats_bin))
+            print_my(" .", end="")
     if labels:
-        print("\n       Using labels=" + str(labels))
-    print("")
+        print_my("\n       Using labels=" + str(labels))
+    print_my("")
 
     # Prepare a csv file header
     csvfilename = project + "_merging_stats.csv"
-    with open(csvfilename, "w") as csvfile:
+    with open(workpath(csvfilename), "w") as csvfile:
         csvfile.writelines("#shell d_max  d_min   #obs  #uniq   mult.  %comp"
                            "       <I>  <I/sI>    r_mrg   r_meas    r_pim   "
                            "r_anom   cc1/2   cc_ano     cc* \n")
@@ -839,7 +831,7 @@ def calculate_merging_stats(hklin_unmerged, shells, project, bins_low,
         for i in range(len(lines)):
             # Compute CC*
             bin_CChalf = lines[i].split()[-2]
-            if float(bin_CChalf) < 0:
+            if bin_CChalf != "N/A" and float(bin_CChalf) < 0:
                 bin_CCstar = "N/A"
                 warning_my("CC*", "A CC*-value for a particular shell "
                            "could not be calculated as it is undefined "
@@ -862,19 +854,92 @@ def calculate_merging_stats(hklin_unmerged, shells, project, bins_low,
         return lines
 
     # Insert statistics relating up to resolution res_init
+    if streaming:
+        lines_streaming = calculate_CCstar(lines_streaming, shell=1)
+        with open(workpath(csvfilename), "a") as csvfile:
+            csvfile.writelines(lines_streaming)
+        return csvfilename
     for i in range(len(bins_total) - 1):
         logfilename = project + "_merging_stats_" \
             "" + twodecname(bins_total[i + 1]) + "A.log"
         line = extract_from_file(logfilename,
                                  searched="Statistics by resolution bin:",
                                  skip_lines=2, n_lines=1)
-        os.remove(logfilename)  # Little clean-up
+        os.remove(workpath(logfilename))  # Little clean-up
         line = calculate_CCstar(line, shell=i + 1)
-        with open(csvfilename, "a") as csvfile:
+        with open(workpath(csvfilename), "a") as csvfile:
             csvfile.writelines(line)
     return csvfilename
 
 
+@timed("statistics")
+def prescreen_shells(hklin_unmerged, shells,
+                     res_low_from_hklin_unmerged=float("inf"),
+                     res_high_from_hklin_unmerged=0):
+    """Calculates CC1/2 of the unmerged data `hklin_unmerged` in the high
+    resolution shells and removes the trailing shells in which CC1/2 is
+    negative or undefined or which lie outside the resolution range of the
+    unmerged data, so that no refinement is performed in shells that could
+    never be accepted. At least one high resolution shell is kept. Removed
+    shells are reported as a warning.
+
+    Args:
+        hklin_unmerged (str): Name of the unmerged diffraction data file
+        shells (list): Initial high resolution limit followed by the high
+                       resolution shells
+        res_low_from_hklin_unmerged (float)
+        res_high_from_hklin_unmerged (float)
+
+    Returns:
+        list: Shells without the hopeless trailing shells
+    """
+    if not (is_mtz(workpath(hklin_unmerged)) or
+            is_xds_ascii(workpath(hklin_unmerged))):
+        warning_my("prescreen", "Pre-screening of high resolution shells "
+                   "is supported only for XDS_ASCII and unmerged MTZ files. "
+                   "All the shells will be refined.")
+        return shells
+    print_my("Pre-screening of high resolution shells using the unmerged data "
+             "" + hklin_unmerged + "...")
+    bins = [(shells[i], shells[i + 1]) for i in range(len(shells) - 1)]
+    try:
+        stats = merging_stats_unmerged(workpath(hklin_unmerged), bins,
+                                       completeness=False)
+    except (ValueError, IndexError, TypeError) as e:
+        warning_my("prescreen", "Pre-screening of high resolution shells "
+                   "was not successful as the unmerged data file "
+                   "" + hklin_unmerged + " could not be read. "
+                   "(" + str(e) + ") All the shells will be refined.")
+        return shells
+    n_shells = len(shells)
+    while n_shells > 2:
+        cc_half = stats[n_shells - 2]["cc_half"]
+        d_max, d_min = bins[n_shells - 2]
+        outside = (res_low_from_hklin_unmerged < d_min or
+                   res_high_from_hklin_unmerged > d_max)
+        if cc_half is not None and cc_half > 0 and not outside:
+            break
+        if outside:
+            warning_my("prescreen", "The resolution shell " + twodec(d_max) +
+                       "-" + twodec(d_min) + " A was excluded from paired "
+                       "refinement as it lies outside the resolution range "
+                       "of the unmerged data (" +
+                       twodec(res_low_from_hklin_unmerged) + "-" +
+                       twodec(res_high_from_hklin_unmerged) + " A).")
+        else:
+            if cc_half is None:
+                cc_half = "N/A"
+            else:
+                cc_half = fourdec(cc_half)
+            warning_my("prescreen", "The resolution shell " + twodec(d_max) +
+                       "-" + twodec(d_min) + " A was excluded from paired "
+                       "refinement as CC1/2 of the unmerged data is negative "
+                       "or undefined in this shell (CC1/2 = " + cc_half + ").")
+        n_shells -= 1
+    return shells[:n_shells]
+
+
+@timed("preparation")
 def run_baverage(project, xyzin, res_init):
     """Finds average value of B-factors of all the atoms in the structure
     model `xyzin` using `baverage` from the CCP4 package.
@@ -899,10 +964,9 @@ def run_baverage(project, xyzin, res_init):
     command = ["baverage", "XYZIN", xyzin, "RMSTAB",
                prefix + ".tab", "XYZOUT", xyzout]
     com = "end\n"
-    with open(logout, "w") as logfile:
-        p = Popen_my(command, stdin=subprocess.PIPE,
-                     stdout=logfile, shell=settings["sh"])
-        p.communicate(com)
+    with open(workpath(logout), "w") as logfile:
+        job_runner.run(command, com=com, stdout=logfile, threads=1,
+                       shell=settings["sh"])
 
     baverage = extract_from_file(filename=logout,
                                  searched="AVERAGE B VALUE FOR ALL ATOMS",
@@ -910,7 +974,7 @@ def run_baverage(project, xyzin, res_init):
                                  n_lines=1,
                                  nth_word=-1)
     baverage = float(baverage)
-    print("Average B-factor for all atoms: " + twodec(baverage))
+    print_my("Average B-factor for all atoms: " + twodec(baverage))
     # if add_to_bfactor:
         # baverage = str(float(baverage) + add_to_bfactor)
     #     bfac_set = baverage + add_to_bfactor
@@ -939,6 +1003,7 @@ def run_baverage(project, xyzin, res_init):
     return baverage
 
 
+@timed("preparation")
 def run_bmean_iotbx(project, xyzin):
     """Finds average value of B-factors of all the atoms in the structure
     model `xyzin` using `pdb` from `iotbx`.
@@ -953,13 +1018,14 @@ def run_bmean_iotbx(project, xyzin):
         float: Mean B-factor for all the atoms
     """
     from iotbx import pdb
-    pdb_inp = pdb.input(file_name=xyzin)
+    pdb_inp = pdb.input(file_name=workpath(xyzin))
     atoms = pdb_inp.atoms()
     bfactors = atoms.extract_b()
     baverage = float(bfactors.format_mean("%5.2f"))
     return baverage
 
 
+@timed("preparation")
 def run_pdbtools(args, baverage=0):
     """Modify the input structure model `args.xyzin` by `mmtbx.pdbtools`.
     The procces is controlled by `args.reset_bfactor`, `args.add_to_bfactor`,
@@ -975,7 +1041,6 @@ def run_pdbtools(args, baverage=0):
     Returns:
         str: Filename of the modified structure model (PDB or mmCIF format)
     """
-    import shutil
     if not (args.reset_bfactor or args.add_to_bfactor or args.set_bfactor or
             args.shake_sites):
         # Nothing to do
@@ -1000,7 +1065,7 @@ def run_pdbtools(args, baverage=0):
     if phil_import_successful:
         dm = DataManager()
         dm.set_overwrite(True)
-        model = dm.get_model(args.xyzin)
+        model = dm.get_model(workpath(args.xyzin))
         phil_master = phil.parse(pdbtools.Program.master_phil_str,
                                  process_includes=True)
         obj_work = phil_master.extract()
@@ -1010,8 +1075,8 @@ def run_pdbtools(args, baverage=0):
             bfactor = baverage
             if args.add_to_bfactor:
                 bfactor += float(args.add_to_bfactor)
-                print("B-factor after application of the parameter "
-                      "--prerefinement-add-to-bfactor: " + twodec(bfactor))
+                print_my("B-factor after application of the parameter "
+                         "--prerefinement-add-to-bfactor: " + twodec(bfactor))
             adp_obj.set_b_iso = float(bfactor)
             # pdbtools_args.append("set_b_iso=" + twodec(bfactor))
         elif args.set_bfactor:
@@ -1027,10 +1092,10 @@ def run_pdbtools(args, baverage=0):
             sites_obj.shake = float(args.shake_sites)
             obj_work.modify.sites.append(sites_obj)
             # pdbtools_args.append("shake=" + twodec(args.shake_sites))
-        obj_work.output.prefix = prefix_phil
+        obj_work.output.prefix = workpath(prefix_phil)
         obj_work.output.suffix = "_modified"
         return_phil = phil_master.format(obj_work)
-        print("Modification of the input structure model using pdbtools...")
+        print_my("Modification of the input structure model using pdbtools...")
         Pdbtools = pdbtools.Program(data_manager=dm, params=obj_work)
         Pdbtools.run()
         return xyzout
@@ -1041,8 +1106,8 @@ def run_pdbtools(args, baverage=0):
             bfactor = baverage
             if args.add_to_bfactor:
                 bfactor += args.add_to_bfactor
-                print("B-factor after application of the parameter "
-                      "--prerefinement-add-to-bfactor: " + twodec(bfactor))
+                print_my("B-factor after application of the parameter "
+                         "--prerefinement-add-to-bfactor: " + twodec(bfactor))
             pdbtools_args.append("set_b_iso=" + twodec(bfactor))
         elif args.set_bfactor:
             pdbtools_args.append("set_b_iso=" + twodec(args.set_bfactor))
@@ -1051,275 +1116,53 @@ def run_pdbtools(args, baverage=0):
         if args.shake_sites:
             pdbtools_args.append("shake=" + twodec(args.shake_sites))
 
-        pdbtools_args.append("file_name=" + xyzout)
-        print("Modification of the input structure model - pdbtools arguments: " + 
-            " ".join(pdbtools_args))
-        if which("phenix.pdbtools"):
-            with open(logout, "w") as logfile:
-                p = Popen_my(["phenix.pdbtools", args.xyzin] + pdbtools_args,
-                             stdout=logfile, shell=settings["sh"])
-                p.communicate()
+        pdbtools_args.append("file_name=" + workpath(xyzout))
+        print_my("Modification of the input structure model - pdbtools "
+                 "arguments: " + " ".join(pdbtools_args))
+        if find("phenix.pdbtools"):
+            with open(workpath(logout), "w") as logfile:
+                job_runner.run(["phenix.pdbtools", args.xyzin] + pdbtools_args,
+                               stdout=logfile, threads=1, shell=settings["sh"])
         else:
             import mmtbx.command_line.pdbtools
-            pdbtools_args.append("model_file_name=" + args.xyzin)
-            with open(logout, "w") as logfile:
+            pdbtools_args.append("model_file_name=" + workpath(args.xyzin))
+            with open(workpath(logout), "w") as logfile:
                 mmtbx.command_line.pdbtools.run(pdbtools_args, out=logfile,
                                                 replace_stderr=False)
     
-    if os.path.isfile(xyzout):
+    if os.path.isfile(workpath(xyzout)):
         if "cif" in settings["pdbORmmcif"]:
             # refmac required .mmcif (.cif does not work)
-            shutil.copy2(xyzout, xyzout[:-4] + ".mmcif")
+            link_or_copy(xyzout, xyzout[:-4] + ".mmcif")
             xyzout = xyzout[:-4] + ".mmcif"
         return xyzout
     else:
-        sys.stderr.write("ERROR: File " + xyzout + " has not been created "
-                         "by pdbtools. Check the log file " + logout + "."
-                         "\nAborting.\n")
-        sys.exit(1)
+        raise RefinementError("File " + xyzout + " has not been created "
+                              "by pdbtools. Check the log file " + logout +
+                              ".")
 
 
+@timed("statistics")
 def suggest_cutoff(args, shells, n_bins_low, flag):
-    shells_high = shells[1:]
-
-    # Pick overall R-values
-    csvfilename = args.project + "_R-values.csv"
-    Rwork_overall_list = []
-    Rfree_overall_list = []
-    errors_Rwork_overall_list = []
-    errors_Rfree_overall_list = []
-    errors = False
-    with open(csvfilename, "r") as csvfile:
-        for line in csvfile.readlines():
-            Rwork_overall_list, Rfree_overall_list, errors_Rwork_overall_list, \
-                errors_Rfree_overall_list, continue_sign = \
-                pick_work_free_from_csv_line(
-                    line, Rwork_overall_list, Rfree_overall_list,
-                    errors_Rwork_overall_list, errors_Rfree_overall_list, errors)
-            if continue_sign:
-                continue
+    """Suggests the high resolution cutoff from the statistics of the
+    finished steps using the cutoff engine of the run (only the shells
+    whose statistics are new are rated, see :mod:`pairef.cutoff`) and
+    saves the strict cutoff in a file `PAIREF_cutoff.txt`.
 
-    # Pick CCstar (and CC1/2)
-    csvfilename_merg = args.project + "_merging_stats.csv"
-    if os.path.isfile(csvfilename_merg):
-        CChalf_list = []
-        CCstar_list = []
-        with open(csvfilename_merg, "r") as csvfile:
-            for line in csvfile.readlines()[1 + n_bins_low:]:  #  high-res only
-                if line.lstrip()[0] == "#":  # If it is a comment
-                    continue                 # do not load data
-                try:
-                    CCstar_list.append(float(line.split()[-1]))
-                except ValueError:
-                    CCstar_list.append((float("nan")))
-                try:
-                    CChalf_list.append(float(line.split()[-3]))
-                except ValueError:
-                    CChalf_list.append((float("nan")))
-
-    # Pick R-values and CCwork for the highest resolution shells
-    if not args.complete_cross_validation:
-        Nfree_shell_list = []
-        Rwork_shell_list = []
-        Rfree_shell_list = []
-        CCwork_shell_list = []
-        # CCfree_shell_list = []
-        for shell in shells_high:
-            csvfilename = args.project + "_R" + str(flag).zfill(2) + "_" \
-                "" + twodecname(shell) + "A.csv"
-            with open(csvfilename, "r") as csvfile:
-                # for line in csvfile.readlines()[7 + n_bins_low:]:  #  high-res only
-                line = csvfile.readlines()[-1]  # highest-res only
-            try:
-                Nfree_shell_list.append(float(line.split()[5]))
-            except ValueError:
-                Nfree_shell_list.append((float("nan")))
-            try:
-                Rwork_shell_list.append(float(line.split()[6]))
-            except ValueError:
-                Rwork_shell_list.append((float("nan")))
-            try:
-                Rfree_shell_list.append(float(line.split()[7]))
-            except ValueError:
-                Rfree_shell_list.append((float("nan")))
-            try:
-                CCwork_shell_list.append(float(line.split()[8]))
-            except ValueError:
-                CCwork_shell_list.append((float("nan")))
-
-    # Rate shells
-    # 1  overall Rfree decreased
-    # 2  overall Rfree did not increase more than 0.0002 (including) and
-    #    Rwork increased
-    # 3  0.40 >= Rfree > 0.45 in the highest resolution shell but Nfree < 50
-    # 4  Rfree > 0.45 in the highest resolution shell but Nfree < 50
-    # ---
-    # 5  0.40 >= Rfree > 0.45 in the highest resolution shell
-    # 6  0.40 >= Rwork > 0.45 in the highest resolution shell
-    # 7  overall Rfree increased > 0.0002
-    # ---
-    # 8  Rfree >= 0.45 in the highest resolution shell
-    # 9  Rwork >= 0.45 in the highest resolution shell
-    # 10 CCwork > CC*
-    # 11 CC1/2 <= 0, CC* undefined
-    # 12 overall Rwork increased > 0.0100 (increased pretty much)
-    # cutoff = shells[0]
-    # rating = [[]] * len(shells_high)
-    # reason = [[]] * len(shells_high)
-    # accepted = [None] * len(shells_high)
-    rating = []
-    reason = []
-    for i, shell in enumerate(shells_high):
-        rating.append([])
-        reason.append([])
-        reason_phrase =  " while using data in the shell " + \
-            twodec(shells[i]) + "-" + twodec(shells[i + 1]) + " A"
-        # If CC* is undefined or smaller than CCwork
-        if os.path.isfile(csvfilename_merg):
-            if CChalf_list[i] <= 0 or CChalf_list[i] == float("nan"):
-                rating[i].append(11)
-                reason[i].append("CC1/2 in high resolution is negative or "
-                                 "undefined" + reason_phrase)
-            else:
-                if not args.complete_cross_validation:
-                    if CCstar_list[i] < CCwork_shell_list[i] or \
-                            CCstar_list[i] == float("nan"):
-                        rating[i].append(10)
-                        reason[i].append("CC* in high resolution is lower "
-                                         "than CCwork" + reason_phrase)
-        # If an R-value >= 0.45 or >= 40
-        if not args.complete_cross_validation:
-            # Rwork
-            if Rwork_shell_list[i] >= 0.45 or \
-                    Rwork_shell_list[i] == float("nan"):
-                rating[i].append(9)
-                reason[i].append("Rwork in high resolution is higher than "
-                                 "0.45" + reason_phrase)
-            elif Rwork_shell_list[i] >= 0.40:
-                rating[i].append(6)
-                reason[i].append("Rwork in high resolution is higher than "
-                                 "0.40" + reason_phrase)
-            # Rfree
-            if Nfree_shell_list[i] < 50:
-                warning_phrase = \
-                    "here are only " + str(int(Nfree_shell_list[i])) + "" + \
-                    " < 50 free reflections in the resolution shell " + \
-                    "" + twodec(shells[i]) + "-" + \
-                    "" + twodec(shells[i + 1]) + " A. Values of " + \
-                    "statistics Rfree and CCfree in this shell " + \
-                    "could be misleading. Consider setting " + \
-                    "thicker resolution shells."
-            if Rfree_shell_list[i] >= 0.45 or \
-                    Rfree_shell_list[i] == float("nan"):
-                if Nfree_shell_list[i] >= 50:
-                    rating[i].append(8)
-                    reason[i].append("Rfree in high resolution is higher than "
-                                     "0.45" + reason_phrase)
-                else:
-                    rating[i].append(4)
-                    reason[i].append(
-                        "Rfree in high resolution is higher than "
-                        "0.45" + reason_phrase + ". But t" + warning_phrase)
-                    warning_my(
-                        "lowNfree" + twodec(shell), "T" + warning_phrase)
-            elif Rfree_shell_list[i] >= 0.40:
-                if Nfree_shell_list[i] >= 50:
-                    rating[i].append(5)
-                    reason[i].append("Rfree in high resolution is higher than "
-                                     "0.40" + reason_phrase)
-                else:
-                    rating[i].append(3)
-                    reason[i].append(
-                        "Rfree in high resolution is higher than "
-                        "0.40" + reason_phrase + ". But t" + warning_phrase)
-                    warning_my(
-                        "lowNfree" + twodec(shell), "T" + warning_phrase)
-        # Differences in overall R-values
-        if Rwork_overall_list[i] > 0.01:
-            rating[i].append(12)
-            reason[i].append("Overall Rwork increased pretty much" + \
-                             reason_phrase)
-        elif Rfree_overall_list[i] <= 0.000009:
-            rating[i].append(1)
-            reason[i].append("Overall Rfree decreased" + reason_phrase)
-        elif Rfree_overall_list[i] <= 0.000209 and Rwork_overall_list[i] > 0:
-            rating[i].append(2)
-            reason[i].append("Overall Rwork increased and Rfree remained " + \
-                             "constant" + reason_phrase)
-        else:
-            rating[i].append(7)
-            reason[i].append("Overall Rfree increased" + reason_phrase)
-    # Suggest cutoff(s)
-    cutoff = [shells[0], shells[0]]
-    accepted = []  # order in list: [strict, benevolent] algorithm
-    reason_phrase_bad_previous = "But statistics deteriorate in a previous resolution shell."
-    for i, shell in enumerate(shells_high):
-        accepted.append([None, None])
-        # strict
-        if i != 0 and not accepted[i - 1][0]:
-            accepted[i][0] = False
-            reason[i].insert(0, reason_phrase_bad_previous)
-        elif max(rating[i]) < 5:
-            accepted[i][0] = True
-            cutoff[0] = shell
-        elif max(rating[i]) >= 5:
-            accepted[i][0] = False
-        # benevolent
-        if max(rating[i]) >= 7:
-            accepted[i][1] = False
-        elif max(rating[i]) < 7:
-            if i >= 2 and not accepted[i - 1][1] and not accepted[i - 2][1]:
-                accepted[i][1] = False
-                reason[i].insert(0, reason_phrase_bad_previous)
-            elif i != 0 and not accepted[i - 1][1] and max(rating[i - 1]) > 7:
-                accepted[i][1] = False
-                reason[i].insert(0, reason_phrase_bad_previous)
-            elif i != 0 and not accepted[i - 1][1] and max(rating[i - 1]) == 7:
-                # Analyse R-values at initial resolution
-                # Pick them
-                csvfilename = args.project + "_Rgap.csv"
-                Rwork_overall_alt_list = []
-                Rfree_overall_alt_list = []
-                with open(csvfilename, "r") as csvfile:
-                    for line in csvfile.readlines():
-                        if line.lstrip()[0] == "#":  # If it is a comment
-                            continue                 # do not load data
-                        try:
-                            Rwork_overall_alt_list.append(float(line.split()[1]))
-                        except ValueError:
-                            Rwork_overall_alt_list.append((float("nan")))
-                        try:
-                            Rfree_overall_alt_list.append(float(line.split()[2]))
-                        except ValueError:
-                            Rfree_overall_alt_list.append((float("nan")))
-                # Be aware: Rwork_overall_alt_list and Rfree_overall_alt_list
-                # has an extra element in the beggining - for the initial resol.!
-                # (in comparison with other lists of statistics in this function)
-                Rfree_overall_alt_diff = \
-                    Rfree_overall_alt_list[i + 1] - Rfree_overall_alt_list[i - 1]
-                Rwork_overall_alt_diff = \
-                    Rwork_overall_alt_list[i + 1] - Rwork_overall_alt_list[i - 1]
-                # Decide about the current and previous shell
-                if Rfree_overall_alt_diff < 0:
-                    accepted[i - 1][1] = True
-                    reason[i - 1][-1] += ". But the next shell compensates it."
-                    accepted[i][1] = True
-                    cutoff[1] = shell
-                elif Rfree_overall_alt_diff <= 0.000209 and Rwork_overall_alt_diff > 0:
-                    accepted[i - 1][1] = True
-                    reason[i - 1][-1] += ". But the next shell compensates it."
-                    accepted[i][1] = True
-                    cutoff[1] = shell
-                else:
-                    accepted[i][1] = False
-                    reason[i].insert(0, reason_phrase_bad_previous)
-            else:
-                accepted[i][1] = True
-                cutoff[1] = shell
-    with open("PAIREF_cutoff.txt", "w") as f:
+    Args:
+        args: Input arguments processed by `argparse`
+        shells (list): High resolution limits of the finished steps
+        n_bins_low (int): Number of resolution bins
+        flag (int): Free reflection set whose statistics are used
+
+    Returns:
+        (tuple): Strict and benevolent cutoff, accepted shells and reasons
+        (see :meth:`pairef.cutoff.CutoffEngine.suggest`)
+    """
+    from .cutoff import engine_for
+    engine = engine_for(args.project, n_bins_low, flag,
+                        bool(args.complete_cross_validation))
+    cutoff, accepted, reason = engine.suggest(shells)
+    with open(workpath("PAIREF_cutoff.txt"), "w") as f:
         f.write(twodec(cutoff[0]))
-    # print(twodec(cutoff[0]), twodec(cutoff[1]))
-    # for i, shell in enumerate(shells_high):
-    #     print(twodec(shell) + "     " + str(accepted[i][0]) + "     " + \
-    #           str(accepted[i][1]) + "     " + str(reason[i]))
     return(cutoff, accepted, reason)
@@ -0,0 +1,308 @@
+# coding: utf-8
+from __future__ import print_function
+import os
+import re
+import threading
+from .settings import ContextDict, workpath
+
+# Monitors of the refinement jobs of the active run context (see
+# :class:`pairef.settings.RunContext`), the key is the absolute path of the
+# prefix of the job files
+monitors = ContextDict("monitors")
+lock = threading.Lock()
+
+REFMAC_TABLE = "    Ncyc    Rfact    Rfree     FOM      -LL     " \
+    "-LLfree  rmsBOND  zBOND rmsANGL  zANGL rmsCHIRAL $$"
+PHENIX_TABLE = " stage r-work r-free bonds angles " \
+    "b_min b_max b_ave n_water shift"
+PHENIX_R = re.compile(r"r[_-]work\s*=\s*([0-9.]+),?\s+r[_-]free\s*=\s*"
+                      r"([0-9.]+)", re.IGNORECASE)
+
+
+class CycleMonitor(object):
+    """Collects R-values of refinement cycles from the standard output of
+    REFMAC5 or phenix.refine while the program is running.
+
+    Lines are passed to the monitor (it is callable) one by one, see
+    `on_line` in :meth:`pairef.jobs.JobRunner.run`. Preliminary values are
+    taken from the messages printed after every cycle, the final table of
+    statistics vs. cycle replaces them as soon as it is read. Every new cycle
+    is published in the HTML file `htmlfilename`.
+
+    Args:
+        prefix (str): Prefix of the files of the refinement job
+        refinement (str): "refmac" or "phenix"
+        htmlfilename (str): Name of the HTML file showing running jobs
+                            (nothing is written if *None*)
+    """
+    def __init__(self, prefix, refinement="refmac", htmlfilename=None):
+        self.prefix = prefix
+        self.refinement = refinement
+        self.htmlfilename = htmlfilename
+        self.labels = []
+        self.rwork = []
+        self.rfree = []
+        self.final = False  # values from the final table were read
+        self.running = True
+        self._cycle = None
+        self._rwork = None
+        self._table = None
+        self._offset = None
+        with lock:
+            monitors[os.path.abspath(workpath(prefix))] = self
+
+    def __call__(self, line):
+        if self.refinement == "refmac":
+            self._refmac(line)
+        else:
+            self._phenix(line)
+
+    def _refmac(self, line):
+        if self._table is not None:
+            words = line.split()
+            if not words:
+                return
+            if words[0] == "$$":
+                if self._table:  # the closing line
+                    self._set_table(self._table)
+                    self._table = None
+                return
+            self._table.append((words[0], float(words[1]), float(words[2])))
+        elif REFMAC_TABLE in line:
+            self._table = []
+        elif "CGMAT cycle number =" in line:
+            # R-values printed during the n-th cycle belong to the model
+            # from the (n-1)-th cycle
+            self._cycle = str(int(line.split()[-1]) - 1)
+        elif line.startswith("Overall R factor") and self._cycle is not None:
+            self._rwork = float(line.split()[-1])
+        elif line.startswith("Free R factor") and self._rwork is not None:
+            self._add(self._cycle, self._rwork, float(line.split()[-1]))
+            self._cycle = self._rwork = None
+
+    def _phenix(self, line):
+        if self._table is not None:
+            if not line.strip() or line.split()[-1][-1] == "-":  # hline
+                if self._table:
+                    self._set_table(self._table)
+                self._table = None
+                return
+            if self._offset is None:
+                self._offset = line.index(":")
+            offset = self._offset
+            self._table.append((line[:offset].strip(),
+                                float(line[offset + 2:offset + 8]),
+                                float(line[offset + 9:offset + 15])))
+        elif PHENIX_TABLE in line:
+            self._table = []
+            self._offset = None
+        else:
+            match = PHENIX_R.search(line)
+            if match:
+                self._add(str(len(self.labels)), float(match.group(1)),
+                          float(match.group(2)))
+
+    def _add(self, label, rwork, rfree):
+        with lock:
+            self.labels.append(label)
+            self.rwork.append(rwork)
+            self.rfree.append(rfree)
+        self.publish()
+
+    def _set_table(self, rows):
+        with lock:
+            self.labels = [row[0] for row in rows]
+            self.rwork = [row[1] for row in rows]
+            self.rfree = [row[2] for row in rows]
+            self.final = True
+        self.publish()
+
+    def finish(self):
+        """Marks the job as finished."""
+        self.running = False
+        self.publish()
+
+    def publish(self):
+        if self.htmlfilename:
+            write_progress_html(self.htmlfilename)
+
+
+def progress_html(project):
+    """Returns the name of the HTML file showing running jobs of the project
+    `project`."""
+    return "PAIREF_" + project + "_progress.html"
+
+
+def get_cycles(prefix):
+    """Returns R-values vs. cycle of a finished refinement job read from
+    its standard output.
+
+    Args:
+        prefix (str): Prefix of the files of the refinement job
+
+    Returns:
+        (tuple or None): *None* if the final table of statistics has not been
+        read, otherwise a tuple containing
+
+            * labels of cycles (*list*)
+            * Rwork values (*list*)
+            * Rfree values (*list*)
+    """
+    with lock:
+        monitor = monitors.get(os.path.abspath(workpath(prefix)))
+        if monitor is None or not monitor.final:
+            return None
+        return list(monitor.labels), list(monitor.rwork), list(monitor.rfree)
+
+
+def forget_cycles(prefix):
+    """Drops the monitor of a finished refinement job when its R-values
+    are not needed any more (see :func:`pairef.retention.prune_step`).
+
+    Args:
+        prefix (str): Prefix of the files of the refinement job
+    """
+    with lock:
+        monitor = monitors.get(os.path.abspath(workpath(prefix)))
+        if monitor is not None and not monitor.running:
+            del monitors[os.path.abspath(workpath(prefix))]
+
+
+def read_cycles(prefix, refinement="refmac"):
+    """Returns R-values vs. cycle of a finished refinement job. Values
+    collected while the job was running are used, otherwise the log file of
+    the job is read.
+
+    Args:
+        prefix (str): Prefix of the files of the refinement job
+        refinement (str): "refmac" or "phenix"
+
+    Returns:
+        (tuple or None): See :func:`get_cycles`
+    """
+    cycles = get_cycles(prefix)
+    if cycles:
+        return cycles
+    if refinement == "phenix":
+        logfilename = prefix + "_001.log"
+    else:
+        logfilename = prefix + ".log"
+    if not os.path.isfile(workpath(logfilename)):
+        return None
+    monitor = CycleMonitor(prefix, refinement)
+    with open(workpath(logfilename), "r") as logfile:
+        for line in logfile:
+            monitor(line)
+    monitor.running = False
+    return get_cycles(prefix)
+
+
+def converged_ncyc(labels, rfree, tolerance=0.001):
+    """Returns the smallest number of cycles after which Rfree stays within
+    `tolerance` from its final value.
+
+    Labels of phenix.refine steps (*e.g.* "1_bss", "1_xyz") are grouped
+    by the number of the macro-cycle, its last step is used.
+
+    Args:
+        labels (list): Labels of cycles (see :func:`get_cycles`)
+        rfree (list): Rfree values
+        tolerance (float)
+
+    Returns:
+        int or None: *None* if Rfree was still changing in the last cycle
+        or there are not enough cycles
+    """
+    numbers = []
+    rfree_cycles = []
+    for label, value in zip(labels, rfree):
+        match = re.match(r"\s*(\d+)", label)
+        if match:
+            number = int(match.group(1))
+        elif numbers:  # e.g. "end" of phenix.refine
+            number = numbers[-1]
+        else:
+            continue
+        if numbers and numbers[-1] == number:
+            rfree_cycles[-1] = value
+        else:
+            numbers.append(number)
+            rfree_cycles.append(value)
+    if len(rfree_cycles) < 2:
+        return None
+    final = rfree_cycles[-1]
+    if abs(final - rfree_cycles[-2]) > tolerance:
+        return None
+    for k in range(len(rfree_cycles)):
+        if all(abs(value - final) <= tolerance
+               for value in rfree_cycles[k:]):
+            return max(1, numbers[k])
+
+
+def choose_ncyc(traces, ncyc_max, tolerance=0.001):
+    """Chooses a number of refinement cycles that is sufficient for all
+    the given Rfree vs. cycle traces (see :func:`converged_ncyc`).
+
+    Args:
+        traces (list): Tuples returned by :func:`get_cycles`
+        ncyc_max (int): The upper limit, used also for traces that have not
+                        converged
+        tolerance (float): Convergence tolerance of Rfree
+
+    Returns:
+        int
+    """
+    counts = []
+    for labels, rwork, rfree in traces:
+        ncyc = converged_ncyc(labels, rfree, tolerance)
+        if ncyc is None:
+            ncyc = ncyc_max
+        counts.append(ncyc)
+    if not counts:
+        return ncyc_max
+    return min(ncyc_max, max(counts))
+
+
+def write_progress_html(htmlfilename):
+    """Writes a small HTML page with the last cycles of the running
+    refinement jobs. It is shown within the main HTML log while the
+    calculations are in progress.
+
+    Args:
+        htmlfilename (str)
+    """
+    page = """<!DOCTYPE html>
+<head>
+    <meta charset="utf-8">
+    <meta http-equiv="refresh" content="15">
+    <link rel="stylesheet" type="text/css" href="styles.css">
+</head>
+<body class="progressframe">\n"""
+    with lock:
+        running = sorted((monitor.prefix, monitor) for monitor
+                         in monitors.values() if monitor.running)
+        if running:
+            page += "\t<table>\n\t\t<tr><th>Refinement</th><th>Cycle</th>" \
+                "<th>R<sub>work</sub></th><th>R<sub>free</sub></th></tr>\n"
+            for prefix, monitor in running:
+                if monitor.labels:
+                    page += "\t\t<tr><td>{}</td><td>{}</td><td>{:.4f}</td>" \
+                        "<td>{:.4f}</td></tr>\n".format(
+                            prefix, monitor.labels[-1], monitor.rwork[-1],
+                            monitor.rfree[-1])
+                else:
+                    page += "\t\t<tr><td>" + prefix + "</td><td>-</td>" \
+                        "<td>-</td><td>-</td></tr>\n"
+            page += "\t</table>\n"
+        else:
+            page += "\tNo refinement job is running.\n"
+        page += "</body>\n</html>"
+        # Write a temporary file first so that a browser never reads
+        # an incomplete page (shards may write the page at the same time)
+        tmpfilename = htmlfilename + "." + str(os.getpid()) + ".tmp"
+        with open(workpath(tmpfilename), "w") as htmlfile:
+            htmlfile.write(page)
+        if os.name == "nt" and os.path.isfile(workpath(htmlfilename)):
+            # os.rename() does not replace files
+            os.remove(workpath(htmlfilename))
+        os.rename(workpath(tmpfilename), workpath(htmlfilename))
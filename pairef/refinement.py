@@ -2,17 +2,53 @@
 from __future__ import print_function
 from __future__ import division
 import os
-import sys
 import re
 import subprocess
-import shutil
 from math import sqrt
-from .settings import warning_dict, settings
+from .settings import warning_dict, settings, workpath
 from .commons import twodec, twodecname, fourdec, extract_from_file, warning_my
-from .commons import Popen_my
-from .preparation import which
+from .commons import print_my
+from .jobs import job_runner, JobError
+from .timing import timed
+from .progress import CycleMonitor, progress_html
+from .planning import keywords_ncyc
+from .tools import find
+from .artefacts import link_or_copy
+from .memo import memo_key, memoized
 
 
+def default_ncyc(args, refinement):
+    """Returns the number of refinement cycles to be used if the option
+    `--ncyc` is not set but the keywords given by the option `--comin`
+    (REFMAC5) or `--def` (phenix.refine) do not set the number of cycles,
+    *i.e.* 20 cycles of REFMAC5 or 3 macro cycles of phenix.refine.
+
+    It is called once before refinement, so that the jobs of the free
+    reflection sets running in parallel do not change `args`.
+
+    Args:
+        args: Input arguments processed by `argparse`
+        refinement (str): "refmac" or "phenix"
+
+    Returns:
+        int or None: `None` if `args.ncyc` should not be changed
+    """
+    if args.ncyc:
+        return None
+    if refinement == "refmac" and args.comin:
+        with open(workpath(args.comin), "r") as comfile:
+            lines = comfile.read().splitlines()
+        if not any(["ncyc" in line.lower() for line in lines]):
+            return 20
+    elif refinement == "phenix" and args.defin:
+        with open(workpath(args.defin), "r") as deffile:
+            lines = deffile.read().splitlines()
+        if not any(["number_of_macro_cycle" in line for line in lines]):
+            return 3
+    return None
+
+
+@timed("refinement")
 def refinement_refmac(res_cur,
                       res_prev,
                       res_high,
@@ -87,6 +123,7 @@ def refinement_refmac(res_cur,
             by REFMAC5 and a version of REFMAC5, *e. i.*
             `HKLOUT`, `XYZOUT`, `LOGOUT`, and `version` (all `str`)
     """
+    details = {"kind": mode, "res_high": res_high, "res_low": res_low}
     if res_low:
         reso = twodec(res_low) + " " + twodec(res_high)
     else:
@@ -110,19 +147,17 @@ scal -
 solvent YES
 """
     else:                                 # args.comin is str, name of the file
-        with open(args.comin, "r") as comfile:  # comfile is the opened file
+        # comfile is the opened file
+        with open(workpath(args.comin), "r") as comfile:
             com = comfile.read()   # com is str (modified content of the file)
         re_end = re.compile(re.escape("end"), re.IGNORECASE)
         com = re_end.sub("", com)
         # com = re.sub("(?i)end","", com) # case-insensitive
         com += "\n refi reso " + reso + " \n"
-        if not any(["ncyc" in line.lower() for line in com.splitlines()]) \
-           and not args.ncyc:
-            args.ncyc = 20
     prefix = args.project + "_R" + str(flag).zfill(2) + "_" \
         "" + twodecname(res_cur) + "A"
     if mode == "comp":
-        print(" .", end="")
+        print_my(" .", end="")
         # print("       Calculating statistics of the refined structure model."
         ncyc_not_zero = False
         prefix += "_comparison" \
@@ -131,9 +166,9 @@ solvent YES
         com += "\n bins " + str(n_bins_low)
     elif mode == "prev_pair":
         if args.complete_cross_validation:
-            print(" .")
+            print_my(" .")
         else:
-            print(" .", end="")
+            print_my(" .", end="")
         ncyc_not_zero = False
         prefix += "_comparison_at_" + twodecname(res_high) + "A_prev_pair"
         com += "\n ncyc 0"
@@ -202,7 +237,7 @@ solvent YES
     elif mode == "comp" or mode == "prev_pair":
         xyzin = args.project + "_R" + str(flag).zfill(2) + "_" + \
             twodecname(res_cur) + "A" + settings["pdbORmmcif"]
-    if which("refmacat"):
+    if find("refmacat"):
         refmac_executable = "refmacat"
     else:
         refmac_executable = "refmac5"
@@ -221,28 +256,30 @@ solvent YES
             tlsout = prefix + ".tlsout"
             command.append(tlsout)
         elif mode == "first":  # and ncyc 0
-            shutil.copy2(args.tlsin, prefix + ".tlsout")
+            link_or_copy(args.tlsin, prefix + ".tlsout")
 
     if (mode == "refine" or
             (mode == "first" and args.complete_cross_validation)):
         if args.complete_cross_validation:
-            print("     – FreeRflag set " + str(flag))
-        print("       Running command:")
-        print("       " + " ".join(command))
-    with open(logout, "w") as logfile:
-        p = Popen_my(command, stdin=subprocess.PIPE, stdout=logfile)
-        p.communicate(com)
-    for fileout in [logout, hklout, xyzout]:
-        if not os.path.isfile(fileout):
-            sys.stderr.write("ERROR: File " + fileout + " has not been created"
-                             " by REFMAC5. Check a file " + logout + " for "
-                             "the details.\nAborting.\n")
-            sys.exit(1)
+            print_my("     – FreeRflag set " + str(flag))
+        print_my("       Running command:")
+        print_my("       " + " ".join(command))
+    def new_monitor():
+        return CycleMonitor(prefix, "refmac", progress_html(args.project))
+    monitor = new_monitor if mode in ("refine", "first") else None
+    details["ncyc"] = (keywords_ncyc(com, "refmac") or 10) \
+        if ncyc_not_zero else 0
+    missing = run_refinement_job(command, logout, [logout, hklout, xyzout],
+                                 com=com, monitor=monitor, details=details)
+    if missing:
+        raise JobError("File " + missing[0] + " has not been created by "
+                       "REFMAC5. Check a file " + logout + " for the "
+                       "details.")
     # Copy log and tls while running REFMAC5 at the starting resolution
     if mode == "first":
         prefix_copy = prefix + "_comparison_at_" + twodecname(res_high) + "A"
-        shutil.copy2(logout, prefix_copy + ".log")
-        shutil.copy2(hklout, prefix_copy + ".mtz")
+        link_or_copy(logout, prefix_copy + ".log")
+        link_or_copy(hklout, prefix_copy + ".mtz")
     version = extract_from_file(logout, "  version", 0, 1, nth_word=5,
                                 get_first=True)
     results = {"HKLOUT": hklout, "XYZOUT": xyzout, "LOGOUT": logout,
@@ -252,11 +289,12 @@ solvent YES
         if "tlsout" in vars():
             to_be_removed += [tlsout]
         for filename in files_to_be_removed:
-            if os.path.exists(filename):
-                os.remove(filename)
+            if os.path.exists(workpath(filename)):
+                os.remove(workpath(filename))
     return results
 
 
+@timed("refinement")
 def refinement_phenix(res_cur,
                       res_prev,
                       res_high,
@@ -329,13 +367,18 @@ def refinement_phenix(res_cur,
                            for `mode="first"`)
         bfac_set (float): Value of B-factor that will be set to all atoms
                           before refinement (not used now)
+        label (str): Labels of the observed data (`args.label` by default,
+                     if it is set)
 
     Returns:
         (dict):
             Dictionary containing names of files that have been created
             by phenix.refine and a version of phenix.refine, *e. i.*
-            `HKLOUT`, `XYZOUT`, `LOGOUT`, and `version` (all `str`)
+            `HKLOUT`, `XYZOUT`, `LOGOUT`, and `version` (all `str`), and
+            `label` if the labels had to be chosen automatically
     """
+    if label is None:
+        label = getattr(args, "label", None)
     prefix = args.project + "_R" + str(flag).zfill(2) + "_" \
         "" + twodecname(res_cur) + "A"
     if mode == "refine":
@@ -363,25 +406,19 @@ def refinement_phenix(res_cur,
     if settings["phenix_version"] >= 1.21:
         com += "\n    }"
         com += "\n  }"
-    if hasattr(args, "label"):  # always false for the very first mode="refine"
+    if label:  # always false for the very first mode="refine"
         if settings["phenix_version"] >= 1.21:
             com += "\n  miller_array {"
             com += "\n    file=" + args.hklin
-            com += "\n    labels.name='" + args.label.split(":")[1] + "'"
+            com += "\n    labels.name='" + label.split(":")[1] + "'"
             com += "\n  }"
         else:
-            com += "\nrefinement.input.xray_data.labels=" + args.label
+            com += "\nrefinement.input.xray_data.labels=" + label
     if settings["phenix_version"] >= 1.21:
         com += "\n}"
-    if args.defin:
-        with open(args.defin, "r") as deffile:
-            deff = deffile.read()
-            if not any(["number_of_macro_cycle" in line for line in deff.splitlines()]) \
-               and not args.ncyc:
-                args.ncyc = 3
 
     if mode == "comp":
-        print(" .", end="")
+        print_my(" .", end="")
         # print("       Calculating statistics of the refined structure model."
         ncyc_not_zero = False
         prefix += "_comparison" \
@@ -391,9 +428,9 @@ def refinement_phenix(res_cur,
         com += "\nrefinement.main.ordered_solvent=False"
     elif mode == "prev_pair":
         if args.complete_cross_validation:
-            print(" .")
+            print_my(" .")
         else:
-            print(" .", end="")
+            print_my(" .", end="")
         ncyc_not_zero = False
         prefix += "_comparison_at_" + twodecname(res_high) + "A_prev_pair"
         com += "\nrefinement.main.number_of_macro_cycles=1"
@@ -471,7 +508,8 @@ def refinement_phenix(res_cur,
             com += "\ndata_manager.phil_files=" + args.defin
         else:
             command.append(args.defin)
-    with open(params, "w") as pars:
+    com += "\nrefinement.main.nproc=" + str(job_runner.threads)
+    with open(workpath(params), "w") as pars:
         pars.write(com)
     command.append(params)
     # command.append("output.overwrite=True")
@@ -479,63 +517,141 @@ def refinement_phenix(res_cur,
     if (mode == "refine" or
             (mode == "first" and args.complete_cross_validation)):
         if args.complete_cross_validation:
-            print("     – FreeRflag set " + str(flag))
-        print("       Running command:")
-        print("       " + " ".join(command))
-    with open(outout, 'w') as out:
-        p = Popen_my(command, stdout=out, stderr=out, shell=settings["sh"])
-        p.communicate()
-    for fileout in [logout, hklout, xyzout, outout]:
-        if not os.path.isfile(fileout):
-            error = True
-            if mode == "first" and not hasattr(args, "label"):
-                label, labels_all = refinement_phenix_get_label(outout)
-                if label:
-                    warning_my(
-                        "amb_labels", "Multiple equally suitable arrays of "
-                        "observed xray data found. Possible choices: " + \
-                        labels_all + " . Automatically choosing "
-                        "refinement.input.xray_data.labels=" + label)
-                    args.label = label  # a bit dirty hack but it works
-                    if os.path.isfile(logout):
-                        os.rename(logout, prefix + "_001_warning.log")
-                    if os.path.isfile(outout):
-                        os.rename(outout, prefix + "_001_warning.out")
-                    results = refinement_phenix(res_cur=res_cur,
-                                                res_prev=res_prev,
-                                                res_high=res_high,
-                                                args=args,
-                                                n_bins=n_bins,
-                                                mode="first",
-                                                res_low=res_low,
-                                                res_highest=res_highest,
-                                                flag=flag,
-                                                xyzin_start=xyzin_start)
-                    error = False
-            if error:
-                sys.stderr.write("ERROR: File " + fileout + " has not been "
-                                 "created by phenix.refine. Check a file " + \
-                                 outout + " for the details."
-                                 "\nAborting.\n")
-                sys.exit(1)
+            print_my("     – FreeRflag set " + str(flag))
+        print_my("       Running command:")
+        print_my("       " + " ".join(command))
+
+    def ambiguous_labels():
+        # Running the job again would not help
+        return (mode == "first" and not label and
+                refinement_phenix_get_label(outout)[0])
+
+    def new_monitor():
+        return CycleMonitor(prefix, "phenix", progress_html(args.project))
+    monitor = new_monitor if mode in ("refine", "first") else None
+    details = {"kind": mode, "res_high": res_high, "res_low": res_low,
+               "ncyc": (keywords_ncyc(com, "phenix") or 3)
+               if ncyc_not_zero else 0}
+    missing = run_refinement_job(command, outout,
+                                 [logout, hklout, xyzout, outout],
+                                 stderr_to_log=True, shell=settings["sh"],
+                                 watch=logout, no_retry=ambiguous_labels,
+                                 monitor=monitor, details=details)
+    for fileout in missing[:1]:
+        error = True
+        if mode == "first" and not label:
+            label, labels_all = refinement_phenix_get_label(outout)
+            if label:
+                warning_my(
+                    "amb_labels", "Multiple equally suitable arrays of "
+                    "observed xray data found. Possible choices: " + \
+                    labels_all + " . Automatically choosing "
+                    "refinement.input.xray_data.labels=" + label)
+                if os.path.isfile(workpath(logout)):
+                    os.rename(workpath(logout),
+                              workpath(prefix + "_001_warning.log"))
+                if os.path.isfile(workpath(outout)):
+                    os.rename(workpath(outout),
+                              workpath(prefix + "_001_warning.out"))
+                results = refinement_phenix(res_cur=res_cur,
+                                            res_prev=res_prev,
+                                            res_high=res_high,
+                                            args=args,
+                                            n_bins=n_bins,
+                                            mode="first",
+                                            res_low=res_low,
+                                            res_highest=res_highest,
+                                            flag=flag,
+                                            xyzin_start=xyzin_start,
+                                            label=label)
+                error = False
+        if error:
+            raise JobError("File " + fileout + " has not been created "
+                           "by phenix.refine. Check a file " + outout + ""
+                           " for the details.")
     # Copy log and tls while running phenix.refine at the starting resolution
-    if mode == "first":
+    if mode == "first" and not missing:
         pdbout = prefix + "_001" + ".pdb"
         prefix_copy = prefix + "_comparison_at_" + twodecname(res_high) + "A"
-        shutil.copy2(pdbout, prefix_copy + "_001.pdb")
-        shutil.copy2(hklout, prefix_copy + "_001.mtz")
+        link_or_copy(pdbout, prefix_copy + "_001.pdb")
+        link_or_copy(hklout, prefix_copy + "_001.mtz")
     results = {"HKLOUT": hklout, "XYZOUT": xyzout, "LOGOUT": logout}
     #           "version": version}
+    if label and not hasattr(args, "label"):
+        results["label"] = label
     if mode == "comp" or mode == "prev_pair":
         files_to_be_removed = [geoout]
         if "tlsout" in vars():
             to_be_removed += [tlsout]
         for filename in files_to_be_removed:
-            if os.path.exists(filename):
-                os.remove(filename)
+            if os.path.exists(workpath(filename)):
+                os.remove(workpath(filename))
     return results
 
 
+def run_refinement_job(command, logout, fileouts, com=None,
+                       stderr_to_log=False, shell=False, watch=None,
+                       no_retry=None, monitor=None, details=None):
+    """Runs a REFMAC5 or phenix.refine job (standard output is saved in the
+    file `logout`) and checks that the files `fileouts` have been created.
+    A job that has been killed (see :class:`pairef.jobs.JobRunner`) or that
+    has not created the files is run again up to `job_runner.retries` times.
+
+    Args:
+        command (list): Program and its arguments
+        logout (str): Name of the file for the standard output
+        fileouts (list): Names of the files that the job should create
+        com (str): Standard input of the program (keywords)
+        stderr_to_log (bool): Save also the standard error output to `logout`
+        shell (bool): Execute through the shell
+        watch (str): Name of a log file whose growth is watched (`logout`
+                     by default)
+        no_retry (callable): Function returning *True* if a failed job should
+                             not be run again
+        monitor (callable): Function returning a new
+                            :class:`pairef.progress.CycleMonitor` which
+                            parses the standard output while the job is
+                            running
+        details (dict): Further information about the job saved in the
+                        profile of the run (see
+                        :meth:`pairef.jobs.JobRunner.run`)
+
+    Returns:
+        list: Names of the files from `fileouts` that have not been created
+    """
+    attempt = 0
+    while True:
+        reason = None
+        on_line = monitor() if monitor else None
+        with open(workpath(logout), "w") as logfile:
+            try:
+                job_runner.run(command, com=com, stdout=logfile,
+                               stderr=logfile if stderr_to_log else None,
+                               shell=shell, watch=watch or logout,
+                               on_line=on_line, details=details)
+            except JobError as e:
+                reason = str(e)
+            finally:
+                if on_line:
+                    on_line.finish()
+        missing = [fileout for fileout in fileouts
+                   if not os.path.isfile(workpath(fileout))]
+        if not reason and missing:
+            reason = "File " + missing[0] + " has not been created."
+        if not reason:
+            return []
+        if attempt >= job_runner.retries or (no_retry and no_retry()):
+            if missing:
+                return missing
+            return fileouts
+        attempt += 1
+        warning_my("retry", reason + " Running the job again (attempt " + ""
+                   "" + str(attempt + 1) + ").")
+        for fileout in fileouts:
+            if fileout != logout and os.path.isfile(workpath(fileout)):
+                os.remove(workpath(fileout))
+
+
 def refinement_phenix_get_label(outout):
     """Get possible choices of refinement.input.xray_data.labels from 
     standard output from phenix.refine (saved in file `outout`) if
@@ -553,7 +669,7 @@ def refinement_phenix_get_label(outout):
         skip_lines=0, n_lines=0, not_found="N/A")
     if signal == ["N/A"]:
         return None, None
-    with open(outout, "r") as o:
+    with open(workpath(outout), "r") as o:
         lines = o.read().splitlines()
     for i in range(len(lines)):
         if "Possible choices:" in lines[i]:
@@ -572,6 +688,7 @@ def refinement_phenix_get_label(outout):
     return label, labels_all
 
 
+@timed("statistics")
 def collect_stat_BINNED(shells, project, hklin, n_bins_low, flag,
                         res_low, refinement="refmac"):
     """Collects statistics of a particular structure model depending on
@@ -598,7 +715,7 @@ def collect_stat_BINNED(shells, project, hklin, n_bins_low, flag,
     Returns:
         str: Name of the created CSV file
     """
-    print("       Collecting statistics from logfiles...")
+    print_my("       Collecting statistics from logfiles...")
     prefix = project + "_R" + str(flag).zfill(2) + "_" \
         "" + twodecname(shells[-1]) + "A"
     if refinement == "refmac":
@@ -634,16 +751,14 @@ def collect_stat_BINNED(shells, project, hklin, n_bins_low, flag,
         # (to be comparable pairwisely)
         # pdbfilename = prefix + "_001.pdb"
         mtzfilename = prefix + "_001.mtz"
-        fobs, fmodel, flags = get_f_cctbx(mtzfilename)
-        overall_Rwork, overall_Rfree = \
-            calculate_stats_cctbx(fobs, fmodel, flags, n_bins=1, overall=True)
+        overall_Rwork, overall_Rfree = calculate_overall_cctbx(mtzfilename)
         #   collect_stat_overall_phenix(pdbfilename)
         overall_CCwork = "N/A"
         overall_CCfree = "N/A"
         overall_CCavg = "N/A"
     # Write the statistics to a csv file
     csvfilename = prefix + ".csv"
-    with open(csvfilename, "w") as csvfile:
+    with open(workpath(csvfilename), "w") as csvfile:
         csvfile.write("# Statistics of refined structure model calculated "
                       "at resolution range " + twodec(res_low) + "-"
                       "" + twodec(shells[-1]) + " A.\n")
@@ -687,6 +802,7 @@ def collect_stat_BINNED(shells, project, hklin, n_bins_low, flag,
     return csvfilename
 
 
+@timed("statistics")
 def collect_stat_binned_refmac_low(logfilename, mtzfilename, hklin,
                                    n_bins_low, res_low=999, flag=0):
     """Picks and returns statistics values in the given `REFMAC5` logfile.
@@ -844,8 +960,8 @@ def collect_stat_binned_phenix_low(pdbfilename, n_bins_low, res_low=999):
         pdbfilename, "REMARK   3   BIN  RESOLUTION RANGE  COMPL.    "
         "NWORK NFREE   RWORK  RFREE  CCWORK CCFREE", 1, n_bins_low)
     for i in range(n_bins_low):
-        print(pdbfile_lines[i])####################
-        print(pdbfile_lines[i].split())
+        print_my(pdbfile_lines[i])####################
+        print_my(pdbfile_lines[i].split())
         bin_res_low.append(pdbfile_lines[i].split()[3])
         bin_res_high.append(pdbfile_lines[i].split()[5])
         bin_Nwork.append(pdbfile_lines[i].split()[7])
@@ -909,7 +1025,7 @@ def collect_stat_write(csvfilename, bin_res_low, bin_res_high,
     Returns:
         str: Filename of the created CSV file.
     """
-    with open(csvfilename, "a") as csvfile:
+    with open(workpath(csvfilename), "a") as csvfile:
         for i in range(len(bin_Rwork)):
             csvfile.write(
                 str(shell_number).zfill(2) + "        " + str(bin_res_low[i]) + ""
@@ -929,6 +1045,7 @@ def collect_stat_write(csvfilename, bin_res_low, bin_res_high,
     return csvfilename
 
 
+@timed("statistics")
 def collect_stat_OVERALL(shells, args, flag, refinement="refmac"):
     """Collects overall statistics of a particular structure model
     from a REFMAC5 logfile or using CCTBX (phenix.refine).
@@ -971,17 +1088,13 @@ def collect_stat_OVERALL(shells, args, flag, refinement="refmac"):
             # get Rwork, Rfree                (not CCwork, CCfree, CCavg)
             # pdbfilename = prefix + "_" + twodecname(shells[-2]) + "A_001.pdb"
             mtzfilename = prefix + "_" + twodecname(shells[-2]) + "A_001.mtz"
-            fobs, fmodel, flags = get_f_cctbx(mtzfilename)
-            Rwork_before, Rfree_before = \
-                calculate_stats_cctbx(fobs, fmodel, flags, n_bins=1, overall=True)
+            Rwork_before, Rfree_before = calculate_overall_cctbx(mtzfilename)
             #     collect_stat_overall_phenix(pdbfilename)
             # pdbfilename = prefix + "_" + twodecname(shells[-1]) + "A_comparison" \
             #     "_at_" + twodecname(shells[-2]) + "A_prev_pair_001.pdb"
             mtzfilename = prefix + "_" + twodecname(shells[-1]) + "A_comparison" \
                 "_at_" + twodecname(shells[-2]) + "A_prev_pair_001.mtz"
-            fobs, fmodel, flags = get_f_cctbx(mtzfilename)
-            Rwork_after, Rfree_after = \
-                calculate_stats_cctbx(fobs, fmodel, flags, n_bins=1, overall=True)
+            Rwork_after, Rfree_after = calculate_overall_cctbx(mtzfilename)
             #   collect_stat_overall_phenix(pdbfilename)
 
         # Rwork, Rfree
@@ -991,8 +1104,8 @@ def collect_stat_OVERALL(shells, args, flag, refinement="refmac"):
         csvfilename = prefix + "_R-values.csv"
         csvfilenames.append(csvfilename)
         # Write the begining of the csv file if it does not exist yet
-        if not os.path.isfile(csvfilename):
-            with open(csvfilename, "w") as csvfile:
+        if not os.path.isfile(workpath(csvfilename)):
+            with open(workpath(csvfilename), "w") as csvfile:
                 csvfile.write("# Shell      Rwork(init) Rwork(fin) Rwork(diff)"
                               "   Rfree(init) Rfree(fin) Rfree(diff)\n")
         # Formating issues
@@ -1003,7 +1116,7 @@ def collect_stat_OVERALL(shells, args, flag, refinement="refmac"):
         if float(Rfree_change) >= 0:
             space_Rfree = " "
         # Write values in the csv file
-        with open(csvfilename, "a") as csvfile:
+        with open(workpath(csvfilename), "a") as csvfile:
             csvfile.write(twodec(shells[-2]) + "A->" + twodec(shells[-1]) + "A"
                           "      " + Rwork_before + "     " + Rwork_after + ""
                           "     " + space_Rwork + Rwork_change + "        "
@@ -1022,15 +1135,14 @@ def collect_stat_OVERALL(shells, args, flag, refinement="refmac"):
         # Rwork, Rfree = collect_stat_overall_phenix(pdbfilename)
         mtzfilename = prefix + "_" + twodecname(shells[-1]) + "A" \
             "_comparison_at_" + twodecname(shells[0]) + "A_001.mtz"
-        fobs, fmodel, flags = get_f_cctbx(mtzfilename)
-        Rwork, Rfree = calculate_stats_cctbx(fobs, fmodel, flags, overall=True)
+        Rwork, Rfree = calculate_overall_cctbx(mtzfilename)
     Rgap = fourdec(float(Rfree) - float(Rwork))
     csvfilename_gap = prefix + "_Rgap.csv"
     # Write the begining of the csv file if it does not exist yet
-    if not os.path.isfile(csvfilename_gap):
-        with open(csvfilename_gap, "w") as csvfile:
+    if not os.path.isfile(workpath(csvfilename_gap)):
+        with open(workpath(csvfilename_gap), "w") as csvfile:
             csvfile.write("# Resolution   Rwork   Rfree   Rfree-Rwork\n")
-    with open(csvfilename_gap, "a") as csvfile:
+    with open(workpath(csvfilename_gap), "a") as csvfile:
         csvfile.write(twodec(shells[-1]) + "          " + Rwork + "   "
                       "" + Rfree + "   " + Rgap + "\n")
     csvfilenames.append(csvfilename_gap)
@@ -1062,6 +1174,28 @@ def collect_stat_overall_refmac(logfilename, flag=0):
 
 def calculate_correlation(hkl_calc, hklin,
                           flag=0, res_low=None, res_high=None):
+    """Returns CCwork and CCfree of the model `hkl_calc`. The values are
+    calculated by :func:`calculate_correlation_sftools` only once for each
+    model, flag and resolution range (see :mod:`pairef.memo`).
+
+    Args:
+        hkl_calc (str): Name of the MTZ file from a REFMAC5 run
+        hklin (str): Name of the MTZ file with diffraction data
+        flag (int): free reflection flag set
+        res_low (float): low-resolution cutoff
+        res_high (float): high-resolution cutoff
+
+    Returns:
+        (tuple): tuple containing `CCwork` and `CCfree` \
+                 (both are `float` or `str`: "N/A")
+    """
+    key = memo_key("CC", hkl_calc, hklin, flag, res_low, res_high)
+    return memoized(key, [hkl_calc, hklin], calculate_correlation_sftools,
+                    hkl_calc, hklin, flag, res_low, res_high)
+
+
+def calculate_correlation_sftools(hkl_calc, hklin,
+                                  flag=0, res_low=None, res_high=None):
     """Calculates CCwork and CCfree using `sftools`.
 
     Args:
@@ -1080,7 +1214,8 @@ def calculate_correlation(hkl_calc, hklin,
 
     # i_obs from HKLIN
     i_obs = None
-    miller_arrays = any_reflection_file(file_name=hklin).as_miller_arrays()
+    miller_arrays = any_reflection_file(
+        file_name=workpath(hklin)).as_miller_arrays()
     for i, column in enumerate(miller_arrays):
         if column.is_xray_intensity_array() and \
                 column.anomalous_flag() == False:
@@ -1099,9 +1234,6 @@ def calculate_correlation(hkl_calc, hklin,
         com_resolution = " resolution 999 " + fourdec(res_high)
     else:
         com_resolution = ""
-    p = Popen_my(["sftools"], stdin=subprocess.PIPE,
-                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                 shell=settings["sh"])
     com = "read " + hkl_calc + " col 1 FC_ALL\n" \
         "calc col FC_ALLsq = col FC_ALL col FC_ALL *\n" \
         "read " + hklin + " col " + i_obs_label + "\n" \
@@ -1111,7 +1243,9 @@ def calculate_correlation(hkl_calc, hklin,
         "correl col " + i_obs_label + " FC_ALLsq shells 1" + com_resolution + "\n" \
         "stop\n" \
         "y\n"
-    output, err = p.communicate(com)
+    output, err, returncode = job_runner.run(
+        ["sftools"], com=com, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        threads=1, shell=settings["sh"])
 
     # pick values
     CCwork = None
@@ -1176,7 +1310,7 @@ def collect_stat_overall_phenix(pdbfilename):
 def get_f_cctbx(mtzfilename, d_max=0, d_min=0):
     from iotbx.reflection_file_utils import get_r_free_flags_scores
     from iotbx.file_reader import any_file
-    mtz_in = any_file(mtzfilename)
+    mtz_in = any_file(workpath(mtzfilename))
     ma = mtz_in.file_server.miller_arrays
     flags = fmodel = fobs = None
     # select the output arrays from phenix.refine
@@ -1199,6 +1333,23 @@ def get_f_cctbx(mtzfilename, d_max=0, d_min=0):
     return fobs, fmodel, flags
 
 
+def calculate_overall_cctbx(mtzfilename):
+    """Returns overall Rwork and Rfree of the model in the MTZ file from
+    phenix.refine. The values are calculated using CCTBX only once for each
+    model (see :mod:`pairef.memo`).
+
+    Args:
+        mtzfilename (str)
+
+    Returns:
+        (tuple): tuple containing `Rwork` and `Rfree` (both are `str`)
+    """
+    def calculate():
+        fobs, fmodel, flags = get_f_cctbx(mtzfilename)
+        return calculate_stats_cctbx(fobs, fmodel, flags, overall=True)
+    return memoized(memo_key("R", mtzfilename), [mtzfilename], calculate)
+
+
 def calculate_stats_cctbx(fobs, fmodel, flags, n_bins=10, overall=False, bins=False):
     """Based on iotbx/examples/recalculate_phenix_refine_r_factors.py"""
     fmodel, fobs = fmodel.common_sets(other=fobs)
@@ -1257,6 +1408,7 @@ def calculate_stats_cctbx(fobs, fmodel, flags, n_bins=10, overall=False, bins=Fa
            bin_Rwork, bin_Rfree, bin_CCwork, bin_CCfree)
 
 
+@timed("statistics")
 def collect_stat_OVERALL_AVG(shells, project, flag_sets):
     """Calculates and saves average overall values from CSV files prepared by
     the function `collect_stat_OVERALL()`.
@@ -1283,7 +1435,7 @@ def collect_stat_OVERALL_AVG(shells, project, flag_sets):
     Rfree_diff = []
     for flag in flag_sets:
         csvfilename = project + "_R" + str(flag).zfill(2) + "_R-values.csv"
-        with open(csvfilename, "r") as csvfile:
+        with open(workpath(csvfilename), "r") as csvfile:
             csvfile_last_line = csvfile.readlines()[-1]
             Rwork_init.append(float(csvfile_last_line.split()[1]))
             Rwork_fin.append(float(csvfile_last_line.split()[2]))
@@ -1305,8 +1457,8 @@ def collect_stat_OVERALL_AVG(shells, project, flag_sets):
     # Rfree_diff_avg2 = fourdec(float(Rfree_fin_avg) - float(Rfree_init_avg))
 
     csvfilename = project + "_R-values.csv"
-    if not os.path.isfile(csvfilename):
-        with open(csvfilename, "w") as csvfile:
+    if not os.path.isfile(workpath(csvfilename)):
+        with open(workpath(csvfilename), "w") as csvfile:
             csvfile.write("# Shell      Rwork(init) Rwork(fin) Rwork(diff)"
                           "   Rfree(init) Rfree(fin) Rfree(diff)   "
                           "Rwork(StDev)   Rfree(StDev)  "
@@ -1319,7 +1471,7 @@ def collect_stat_OVERALL_AVG(shells, project, flag_sets):
         space_Rwork = " "
     if float(Rfree_diff_avg) >= 0:
         space_Rfree = " "
-    with open(csvfilename, "a") as csvfile:
+    with open(workpath(csvfilename), "a") as csvfile:
         csvfile.write(twodec(shells[-2]) + "A->" + twodec(shells[-1]) + "A"
                       "      " + Rwork_init_avg + "     " + Rwork_fin_avg + ""
                       "     " + space_Rwork + Rwork_diff_avg + "        "
@@ -1331,13 +1483,13 @@ def collect_stat_OVERALL_AVG(shells, project, flag_sets):
     # === Rgap ===
     Rgap_fin_avg = fourdec(float(Rfree_fin_avg) - float(Rwork_fin_avg))
     csvfilename_gap = project + "_Rgap.csv"
-    if not os.path.isfile(csvfilename_gap):
-        with open(csvfilename_gap, "w") as csvfile:
+    if not os.path.isfile(workpath(csvfilename_gap)):
+        with open(workpath(csvfilename_gap), "w") as csvfile:
             Rgap_init_avg = fourdec(float(Rfree_init_avg) - float(Rwork_init_avg))
             csvfile.write("# Resolution   Rwork   Rfree   Rfree-Rwork\n")
             csvfile.write(twodec(shells[0]) + "          " + Rwork_init_avg + "   "
                           "" + Rfree_init_avg + "   " + Rgap_init_avg + "\n")
-    with open(csvfilename_gap, "a") as csvfile:
+    with open(workpath(csvfilename_gap), "a") as csvfile:
         csvfile.write(twodec(shells[-1]) + "          " + Rwork_fin_avg + "   "
                       "" + Rfree_fin_avg + "   " + Rgap_fin_avg + "\n")
     return csvfilename, csvfilename_gap
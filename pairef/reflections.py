@@ -0,0 +1,905 @@
+# coding: utf-8
+from __future__ import print_function
+from __future__ import division
+import re
+import struct
+import numpy as np
+from math import sqrt
+
+
+CHUNK_SIZE = 500000  # observations read at once by the streaming readers
+
+
+def xds_ascii_header(filename):
+    """Reads the header of an `XDS_ASCII.HKL` file (lines up to
+    `!END_OF_HEADER`). Data records are not read.
+
+    Args:
+        filename (str): Name of the XDS_ASCII file
+
+    Returns:
+        dict: Dictionary containing keys `space_group_number` (*int*),
+        `unit_cell` (*tuple*), `res_range` (*tuple* or *None*) taken from
+        `INCLUDE_RESOLUTION_RANGE`, `n_items` (*int*), `items` (*dict*
+        mapping names of items, e.g. `IOBS`, to column indices from 0)
+        and `n_header_lines` (*int*)
+    """
+    header = {"space_group_number": None, "unit_cell": None,
+              "res_range": None, "n_items": None, "items": {},
+              "n_header_lines": 0}
+    keyword = re.compile(r"([A-Z][A-Z0-9_()'/]*)=")
+    with open(filename, "r") as hklfile:
+        for line in hklfile:
+            header["n_header_lines"] += 1
+            if not line.startswith("!"):
+                break
+            if line.startswith("!END_OF_HEADER"):
+                break
+            # A line can contain more keywords, e.g.
+            # !FORMAT=XDS_ASCII    MERGE=FALSE    FRIEDEL'S_LAW=TRUE
+            matches = list(keyword.finditer(line))
+            for i, match in enumerate(matches):
+                if i + 1 < len(matches):
+                    value = line[match.end():matches[i + 1].start()]
+                else:
+                    value = line[match.end():]
+                key = match.group(1)
+                value = value.split()
+                if key == "SPACE_GROUP_NUMBER":
+                    header["space_group_number"] = int(value[0])
+                elif key == "UNIT_CELL_CONSTANTS":
+                    header["unit_cell"] = tuple(float(v) for v in value[:6])
+                elif key == "INCLUDE_RESOLUTION_RANGE":
+                    header["res_range"] = (float(value[-2]), float(value[-1]))
+                elif key == "NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD":
+                    header["n_items"] = int(value[0])
+                elif key.startswith("ITEM_"):
+                    header["items"][key[5:]] = int(value[0]) - 1
+    return header
+
+
+def iter_xds_ascii(filename, chunk_size=CHUNK_SIZE):
+    """Reads data records of an `XDS_ASCII.HKL` file by chunks so that
+    the memory usage does not depend on the size of the file.
+    Rejected observations (negative sigma) are skipped.
+
+    Args:
+        filename (str): Name of the XDS_ASCII file
+        chunk_size (int): Maximal number of observations in one chunk
+
+    Yields:
+        tuple: `h`, `k`, `l` (*numpy.ndarray* of int) and `i_obs`, `sig_i`
+        (*numpy.ndarray* of float)
+    """
+    header = xds_ascii_header(filename)
+    n_items = header["n_items"]
+    items = header["items"]
+    col_h = items.get("H", 0)
+    col_k = items.get("K", 1)
+    col_l = items.get("L", 2)
+    col_i = items.get("IOBS", 3)
+    col_sig = items.get("SIGMA(IOBS)", 4)
+    with open(filename, "r") as hklfile:
+        lines = []
+        for line in hklfile:
+            if line.startswith("!"):
+                if line.startswith("!END_OF_DATA"):
+                    break
+                continue
+            lines.append(line)
+            if len(lines) == chunk_size:
+                yield _xds_ascii_chunk(lines, n_items, col_h, col_k, col_l,
+                                       col_i, col_sig)
+                lines = []
+        if lines:
+            yield _xds_ascii_chunk(lines, n_items, col_h, col_k, col_l,
+                                   col_i, col_sig)
+
+
+def _xds_ascii_chunk(lines, n_items, col_h, col_k, col_l, col_i, col_sig):
+    values = np.array(" ".join(lines).split(), dtype=float)
+    if not n_items:
+        n_items = len(lines[0].split())
+    values = values.reshape(-1, n_items)
+    values = values[values[:, col_sig] > 0]  # rejected observations
+    return (values[:, col_h].astype(int), values[:, col_k].astype(int),
+            values[:, col_l].astype(int), values[:, col_i],
+            values[:, col_sig])
+
+
+def read_mtz_header(filename):
+    """Reads the header of an MTZ file. Reflection data are not read.
+
+    Args:
+        filename (str): Name of the MTZ file
+
+    Returns:
+        dict: Dictionary containing keys `ncol`, `nref`, `nbatch` (*int*),
+        `unit_cell` (*tuple*), `space_group_number` (*int*),
+        `space_group_name` (*str*), `res_range` (*tuple*, low and high
+        resolution in angstrom), `columns` (*list* of *dict* with keys
+        `label`, `type`, `min`, `max`, `dataset`), `records` (*list* of
+        header records) and `dtype` (*numpy.dtype* of the data)
+    """
+    with open(filename, "rb") as mtzfile:
+        start = mtzfile.read(20)
+        if start[:4] != b"MTZ ":
+            raise ValueError("File " + filename + " is not an MTZ file.")
+        # Machine stamp - real numbers: 1 = big endian, 4 = little endian
+        if (bytearray(start[8:9])[0] >> 4) == 1:
+            endian = ">"
+        else:
+            endian = "<"
+        header_position = struct.unpack(endian + "i", start[4:8])[0]
+        if header_position == -1:  # MTZ files larger than 8 GB
+            header_position = struct.unpack(endian + "q", start[12:20])[0]
+        mtzfile.seek((header_position - 1) * 4)
+        records = []
+        while True:
+            record = mtzfile.read(80)
+            if len(record) < 80:
+                break
+            record = record.decode("ascii", "replace").rstrip()
+            records.append(record)
+            if record.startswith("END"):
+                break
+    header = {"ncol": 0, "nref": 0, "nbatch": 0, "unit_cell": None,
+              "space_group_number": None, "space_group_name": None,
+              "res_range": (None, None), "columns": [], "records": records,
+              "dtype": np.dtype(endian + "f4"), "header_position":
+              header_position}
+    for record in records:
+        words = record.split()
+        if not words:
+            continue
+        if words[0] == "NCOL":
+            header["ncol"] = int(words[1])
+            header["nref"] = int(words[2])
+            header["nbatch"] = int(words[3])
+        elif words[0] == "CELL":
+            header["unit_cell"] = tuple(float(w) for w in words[1:7])
+        elif words[0] == "SYMINF":
+            header["space_group_number"] = int(words[4])
+            name = re.search(r"'([^']*)'", record)
+            if name:
+                header["space_group_name"] = name.group(1)
+        elif words[0] == "RESO":
+            reso = sorted([float(words[1]), float(words[2])])
+            if reso[0] > 0 and reso[1] > 0:
+                header["res_range"] = (1 / sqrt(reso[0]), 1 / sqrt(reso[1]))
+        elif words[0] == "COLUMN":
+            header["columns"].append({"label": words[1], "type": words[2],
+                                      "min": float(words[3]),
+                                      "max": float(words[4]),
+                                      "dataset": int(words[5])
+                                      if len(words) > 5 else 0})
+    return header
+
+
+def mtz_memmap(filename, header=None):
+    """Maps reflection data of an MTZ file to the memory. Nothing is read
+    until the returned array is accessed.
+
+    Args:
+        filename (str): Name of the MTZ file
+        header (dict): Header returned by :func:`read_mtz_header` (it is
+                       read if not given)
+
+    Returns:
+        numpy.memmap: Array of shape (`nref`, `ncol`)
+    """
+    if header is None:
+        header = read_mtz_header(filename)
+    return np.memmap(filename, dtype=header["dtype"], mode="r",
+                     offset=80,  # data begins at the 21st word
+                     shape=(header["nref"], header["ncol"]))
+
+
+def iter_mtz_columns(filename, labels, chunk_size=CHUNK_SIZE, header=None):
+    """Reads the given columns of an MTZ file by chunks so that the memory
+    usage does not depend on the size of the file.
+
+    Args:
+        filename (str): Name of the MTZ file
+        labels (list): Labels of the columns to be read (`str`)
+        chunk_size (int): Maximal number of reflections in one chunk
+        header (dict): Header returned by :func:`read_mtz_header` (it is
+                       read if not given)
+
+    Yields:
+        list: *numpy.ndarray* of float for every column in `labels`
+    """
+    if header is None:
+        header = read_mtz_header(filename)
+    all_labels = [column["label"] for column in header["columns"]]
+    indices = [all_labels.index(label) for label in labels]
+    data = mtz_memmap(filename, header)
+    for start in range(0, header["nref"], chunk_size):
+        chunk = data[start:start + chunk_size]
+        yield [chunk[:, i].astype(float) for i in indices]
+    del data
+
+
+def mtz_observation_labels(header, anomalous=True):
+    """Returns labels of columns containing observations (amplitudes
+    or intensities, i.e. column types `F`, `J`, `G` and `K`).
+
+    Args:
+        header (dict): Header returned by :func:`read_mtz_header`
+        anomalous (bool): Include also the anomalous observations (column
+                          types `G` and `K`)
+
+    Returns:
+        list
+    """
+    types = ("F", "J", "G", "K") if anomalous else ("F", "J")
+    return [column["label"] for column in header["columns"]
+            if column["type"] in types]
+
+
+def mtz_free_flag_sets(header):
+    """Finds a number of sets of free reflections using the range of values
+    of the free reflection flag column stored in the MTZ header.
+
+    Args:
+        header (dict): Header returned by :func:`read_mtz_header`
+
+    Returns:
+        int: Number of sets of free reflections (0 if not found)
+    """
+    for column in header["columns"]:
+        if column["type"] == "I" and "free" in column["label"].lower():
+            return int(column["max"]) - int(column["min"]) + 1
+    return 0
+
+
+def mtz_column_summary(filename, res_low=None, res_high=None,
+                       chunk_size=CHUNK_SIZE, header=None, labels=None):
+    """Counts measured values of observation columns (see
+    :func:`mtz_observation_labels`) of an MTZ file and finds their
+    resolution range. Reflection data are memory-mapped and processed
+    by chunks.
+
+    Args:
+        filename (str): Name of the MTZ file
+        res_low (float): Low resolution limit of the range in which
+                         the values are counted (optional)
+        res_high (float): High resolution limit of the range in which
+                          the values are counted (optional)
+        chunk_size (int): Maximal number of reflections in one chunk
+        header (dict): Header returned by :func:`read_mtz_header` (it is
+                       read if not given)
+        labels (list): Labels of the columns (all the observation columns
+                       by default)
+
+    Returns:
+        collections.OrderedDict: Dictionary for every observation column
+        with keys `n` (number of measured values), `n_range` (number of
+        measured values in the given resolution range), `d_max` and `d_min`
+    """
+    from collections import OrderedDict
+    if header is None:
+        header = read_mtz_header(filename)
+    if labels is None:
+        labels = mtz_observation_labels(header)
+    summary = OrderedDict()
+    for label in labels:
+        summary[label] = {"n": 0, "n_range": 0, "d_max": None, "d_min": None}
+    if not labels:
+        return summary
+    hkl_labels = [column["label"] for column in header["columns"]
+                  if column["type"] == "H"][:3]
+    for columns in iter_mtz_columns(filename, hkl_labels + labels,
+                                    chunk_size, header):
+        d = d_spacings(columns[0], columns[1], columns[2],
+                       header["unit_cell"])
+        in_range = np.ones(d.size, dtype=bool)
+        if res_low is not None:
+            in_range &= d <= res_low
+        if res_high is not None:
+            in_range &= d >= res_high
+        for label, values in zip(labels, columns[3:]):
+            measured = np.isfinite(values) & np.isfinite(d)
+            if not np.any(measured):
+                continue
+            stats = summary[label]
+            stats["n"] += int(np.count_nonzero(measured))
+            stats["n_range"] += int(np.count_nonzero(measured & in_range))
+            d_max = float(d[measured].max())
+            d_min = float(d[measured].min())
+            if stats["d_max"] is None or d_max > stats["d_max"]:
+                stats["d_max"] = d_max
+            if stats["d_min"] is None or d_min < stats["d_min"]:
+                stats["d_min"] = d_min
+    return summary
+
+
+def mtz_reflection_counts(filename, res_low=None, res_high=None,
+                          chunk_size=CHUNK_SIZE, header=None):
+    """Counts observed reflections of an MTZ file as the measured values of
+    the mean amplitudes or intensities (column types `F` and `J`, the
+    smallest count if there are more such columns). If the file contains
+    only anomalous observations, the values of both Bijvoet mates are
+    counted (as in the anomalous arrays of CCTBX).
+
+    Args:
+        filename (str): Name of the MTZ file
+        res_low (float): Low resolution limit of the range (optional)
+        res_high (float): High resolution limit of the range (optional)
+        chunk_size (int): Maximal number of reflections in one chunk
+        header (dict): Header returned by :func:`read_mtz_header`
+
+    Returns:
+        (tuple):
+            * n (*int*): Number of observed reflections
+            * n_range (*int*): Number of observed reflections in the range
+    """
+    if header is None:
+        header = read_mtz_header(filename)
+    labels = mtz_observation_labels(header, anomalous=False)
+    if not labels:
+        # Bijvoet mates of the first kind of observations, F(+) and F(-)
+        # or I(+) and I(-)
+        labels = mtz_observation_labels(header)
+        types = dict((column["label"], column["type"])
+                     for column in header["columns"])
+        labels = [label for label in labels
+                  if types[label] == types[labels[0]]]
+        summary = mtz_column_summary(filename, res_low, res_high,
+                                     chunk_size, header, labels)
+        return (sum(stats["n"] for stats in summary.values()),
+                sum(stats["n_range"] for stats in summary.values()))
+    summary = mtz_column_summary(filename, res_low, res_high, chunk_size,
+                                 header, labels)
+    return (min(stats["n"] for stats in summary.values()),
+            min(stats["n_range"] for stats in summary.values()))
+
+
+def mtz_d_spacings_work_free(filename, flag=0, chunk_size=CHUNK_SIZE,
+                             header=None):
+    """Calculates d-spacings of measured reflections (the first column of
+    observations, see :func:`mtz_observation_labels`) of an MTZ file
+    separately for work and free reflections. Reflection data are
+    memory-mapped and read only once.
+
+    Args:
+        filename (str): Name of the MTZ file
+        flag (int): Free reflection flag of the set excluded from refinement
+        chunk_size (int): Maximal number of reflections in one chunk
+        header (dict): Header returned by :func:`read_mtz_header` (it is
+                       read if not given)
+
+    Returns:
+        (tuple):
+            * d_work (*numpy.ndarray*): Sorted d-spacings of work reflections
+            * d_free (*numpy.ndarray*): Sorted d-spacings of free reflections
+    """
+    if header is None:
+        header = read_mtz_header(filename)
+    columns = header["columns"]
+    labels = [column["label"] for column in columns
+              if column["type"] == "H"][:3]
+    labels += [column["label"] for column in columns
+               if column["type"] == "I" and
+               "free" in column["label"].lower()][:1]
+    labels += mtz_observation_labels(header)[:1]
+    if len(labels) != 5:
+        raise ValueError("Miller indices, free reflection flags or "
+                         "observations were not found.")
+    d_work = []
+    d_free = []
+    for h, k, l, free, obs in iter_mtz_columns(filename, labels, chunk_size,
+                                               header):
+        d = d_spacings(h, k, l, header["unit_cell"])
+        measured = np.isfinite(obs) & np.isfinite(free) & np.isfinite(d)
+        is_free = free == flag
+        d_work.append(d[measured & ~is_free])
+        d_free.append(d[measured & is_free])
+    return np.sort(np.concatenate(d_work)), np.sort(np.concatenate(d_free))
+
+
+def equal_count_shells(d_work, d_free, res_init, res_high, n_free=0,
+                       n_work=0):
+    """Places limits of high resolution shells so that every shell contains
+    at least `n_free` free and `n_work` work reflections. Limits are rounded
+    down to two decimals. Reflections of the last incomplete shell
+    are added to the previous shell.
+
+    Args:
+        d_work (numpy.ndarray): Sorted d-spacings of work reflections
+        d_free (numpy.ndarray): Sorted d-spacings of free reflections
+        res_init (float): Initial high resolution limit
+        res_high (float): High resolution limit of data
+        n_free (int): Target number of free reflections in a shell
+        n_work (int): Target number of work reflections in a shell
+
+    Returns:
+        (tuple):
+            * shells_high (*list*): High resolution limits of shells
+            * counts (*list*): Tuples (`n_work`, `n_free`) for every shell
+    """
+    res_high = round(float(res_high), 2)
+
+    def count(d_sorted, d_low, d_high):  # d_high <= d < d_low
+        return int(np.searchsorted(d_sorted, d_low, side="left") -
+                   np.searchsorted(d_sorted, d_high, side="left"))
+
+    def edge(d_sorted, upper, n_target):
+        # the highest limit such that the shell contains n_target reflections
+        below = np.searchsorted(d_sorted, upper, side="left")
+        if n_target <= 0:
+            return upper - 0.01
+        if below < n_target:
+            return None
+        return float(np.floor(d_sorted[below - n_target] * 100) / 100)
+
+    shells_high = []
+    upper = res_init
+    while True:
+        edges = [edge(d_free, upper, n_free), edge(d_work, upper, n_work)]
+        if None in edges:
+            break
+        limit = round(min(edges + [round(upper - 0.01, 2)]), 2)
+        if limit <= res_high:
+            break
+        shells_high.append(limit)
+        upper = limit
+    if not shells_high or shells_high[-1] != res_high:
+        if shells_high:
+            # The remaining reflections would make an incomplete shell
+            shells_high[-1] = res_high
+        else:
+            shells_high = [res_high]
+    counts = []
+    upper = res_init
+    for limit in shells_high:
+        counts.append((count(d_work, upper, limit),
+                       count(d_free, upper, limit)))
+        upper = limit
+    return shells_high, counts
+
+
+def refinement_mtz_labels(header):
+    """Picks labels of columns needed for refinement and for the calculation
+    of statistics - Miller indices, the free reflection flag and the first
+    pairs of mean amplitudes and intensities with their sigmas. Anomalous
+    data, map coefficients and further datasets are left out.
+
+    Args:
+        header (dict): Header returned by :func:`read_mtz_header`
+
+    Returns:
+        list: Labels of the columns (empty if Miller indices, free flags or
+        observations were not found)
+    """
+    columns = header["columns"]
+    labels_hkl = [column["label"] for column in columns
+                  if column["type"] == "H"][:3]
+    labels_free = [column["label"] for column in columns
+                   if column["type"] == "I" and
+                   "free" in column["label"].lower()][:1]
+    labels_obs = []
+    for obs_type in ("F", "J"):
+        for i, column in enumerate(columns[:-1]):
+            if column["type"] == obs_type and columns[i + 1]["type"] == "Q":
+                labels_obs += [column["label"], columns[i + 1]["label"]]
+                break
+    if len(labels_hkl) != 3 or not labels_free or not labels_obs:
+        return []
+    return labels_hkl + labels_free + labels_obs
+
+
+def write_mtz_subset(filename, filename_out, labels, chunk_size=CHUNK_SIZE):
+    """Writes a copy of an MTZ file containing only the given columns.
+    All reflections, symmetry, datasets and history are kept.
+
+    Args:
+        filename (str): Name of the input MTZ file
+        filename_out (str): Name of the output MTZ file
+        labels (list): Labels of the columns to be kept
+        chunk_size (int): Maximal number of reflections in one chunk
+
+    Returns:
+        str: `filename_out`
+    """
+    header = read_mtz_header(filename)
+    endian = header["dtype"].str[0]
+    columns = [column for column in header["columns"]
+               if column["label"] in labels]
+    labels = [column["label"] for column in columns]  # keep the file order
+    records = []
+    for record in header["records"]:
+        words = record.split()
+        if not words:
+            continue
+        if words[0] == "NCOL":
+            record = "NCOL {0:8d} {1:12d} {2:8d}".format(
+                len(labels), header["nref"], header["nbatch"])
+        elif words[0] in ("COLUMN", "COLSRC") and words[1] not in labels:
+            continue
+        elif words[0] == "COLGRP":
+            continue
+        records.append(record)
+    with open(filename, "rb") as mtzfile:
+        start = bytearray(mtzfile.read(20))
+        # history and batch headers following the END record
+        mtzfile.seek((header["header_position"] - 1) * 4 +
+                     80 * len(header["records"]))
+        trailer = mtzfile.read()
+    header_position = 21 + header["nref"] * len(labels)
+    if header_position < 2 ** 31:
+        start[4:8] = struct.pack(endian + "i", header_position)
+    else:
+        start[4:8] = struct.pack(endian + "i", -1)
+        start[12:20] = struct.pack(endian + "q", header_position)
+    with open(filename_out, "wb") as mtzout:
+        mtzout.write(bytes(start) + b"\0" * 60)
+        for chunk in iter_mtz_columns(filename, labels, chunk_size, header):
+            mtzout.write(np.array(chunk, dtype=header["dtype"]).T.tobytes())
+        for record in records:
+            mtzout.write(record.ljust(80)[:80].encode("ascii"))
+        mtzout.write(trailer)
+    return filename_out
+
+
+def unmerged_mtz_labels(header):
+    """Picks labels of Miller indices, intensities and their sigmas
+    in an unmerged MTZ file.
+
+    Args:
+        header (dict): Header returned by :func:`read_mtz_header`
+
+    Returns:
+        list: Labels of columns `H`, `K`, `L`, `I`, `SIGI`
+    """
+    columns = header["columns"]
+    labels = [column["label"] for column in columns if column["type"] == "H"]
+    labels = labels[:3]
+    for i, column in enumerate(columns):
+        if column["type"] == "J" and i + 1 < len(columns) and \
+                columns[i + 1]["type"] == "Q":
+            labels += [column["label"], columns[i + 1]["label"]]
+            break
+    if len(labels) != 5:
+        raise ValueError("Miller indices and intensities were not found.")
+    return labels
+
+
+def iter_unmerged(filename, chunk_size=CHUNK_SIZE):
+    """Reads observations from an unmerged data file (`XDS_ASCII.HKL`
+    or unmerged MTZ) by chunks.
+
+    Args:
+        filename (str): Name of the unmerged diffraction data file
+        chunk_size (int): Maximal number of observations in one chunk
+
+    Yields:
+        tuple: `h`, `k`, `l`, `i_obs`, `sig_i` (*numpy.ndarray*)
+    """
+    if is_mtz(filename):
+        header = read_mtz_header(filename)
+        labels = unmerged_mtz_labels(header)
+        for h, k, l, i_obs, sig_i in iter_mtz_columns(
+                filename, labels, chunk_size, header):
+            selection = np.isfinite(i_obs) & np.isfinite(sig_i) & (sig_i > 0)
+            yield (h[selection].astype(int), k[selection].astype(int),
+                   l[selection].astype(int), i_obs[selection],
+                   sig_i[selection])
+    else:
+        for chunk in iter_xds_ascii(filename, chunk_size):
+            yield chunk
+
+
+def unmerged_symmetry(filename):
+    """Returns the unit cell parameters and the space group number
+    of an unmerged data file (`XDS_ASCII.HKL` or unmerged MTZ).
+
+    Args:
+        filename (str): Name of the unmerged diffraction data file
+
+    Returns:
+        (tuple):
+            * unit_cell (*tuple*)
+            * space_group_number (*int*)
+    """
+    if is_mtz(filename):
+        header = read_mtz_header(filename)
+    else:
+        header = xds_ascii_header(filename)
+    return header["unit_cell"], header["space_group_number"]
+
+
+def is_mtz(filename):
+    return "mtz" in filename.split(".")[-1].lower()
+
+
+def is_xds_ascii(filename):
+    return "hkl" in filename.split(".")[-1].lower()
+
+
+def d_spacings(h, k, l, unit_cell):
+    """Calculates interplanar spacings for the given Miller indices.
+
+    Args:
+        h, k, l (numpy.ndarray): Miller indices
+        unit_cell (tuple): Unit cell parameters a, b, c, alpha, beta, gamma
+                           (in angstrom and degrees)
+
+    Returns:
+        numpy.ndarray: d-spacings (in angstrom)
+    """
+    a, b, c = unit_cell[:3]
+    alpha, beta, gamma = np.radians(unit_cell[3:6])
+    g = np.array([
+        [a * a, a * b * np.cos(gamma), a * c * np.cos(beta)],
+        [a * b * np.cos(gamma), b * b, b * c * np.cos(alpha)],
+        [a * c * np.cos(beta), b * c * np.cos(alpha), c * c]])
+    g_star = np.linalg.inv(g)  # reciprocal metric tensor
+    h = np.asarray(h, dtype=float)
+    k = np.asarray(k, dtype=float)
+    l = np.asarray(l, dtype=float)
+    s2 = (g_star[0, 0] * h * h + g_star[1, 1] * k * k + g_star[2, 2] * l * l +
+          2 * g_star[0, 1] * h * k + 2 * g_star[0, 2] * h * l +
+          2 * g_star[1, 2] * k * l)
+    with np.errstate(divide="ignore"):
+        return 1 / np.sqrt(s2)
+
+
+def resolution_range_unmerged(filename, chunk_size=CHUNK_SIZE):
+    """Finds the resolution range of an unmerged data file by streaming
+    through all its observations.
+
+    Args:
+        filename (str): Name of the unmerged diffraction data file
+        chunk_size (int): Maximal number of observations in one chunk
+
+    Returns:
+        (tuple):
+            * res_low (*float* or *None*)
+            * res_high (*float* or *None*)
+    """
+    unit_cell, space_group_number = unmerged_symmetry(filename)
+    res_low = None
+    res_high = None
+    for h, k, l, i_obs, sig_i in iter_unmerged(filename, chunk_size):
+        d = d_spacings(h, k, l, unit_cell)
+        d = d[np.isfinite(d)]
+        if not d.size:
+            continue
+        if res_low is None or d.max() > res_low:
+            res_low = float(d.max())
+        if res_high is None or d.min() < res_high:
+            res_high = float(d.min())
+    return res_low, res_high
+
+
+def _map_to_asu(h, k, l, unit_cell, space_group_number):
+    """Maps Miller indices to the asymmetric unit (Friedel mates are merged)
+    using CCTBX. Only one chunk of data is processed at once."""
+    from cctbx import crystal, miller
+    from cctbx.array_family import flex
+    symmetry = crystal.symmetry(unit_cell=unit_cell,
+                                space_group_symbol=str(space_group_number))
+    indices = flex.miller_index(list(zip(h.tolist(), k.tolist(), l.tolist())))
+    miller_set = miller.set(symmetry, indices, anomalous_flag=False)
+    indices = miller_set.map_to_asu().indices()
+    hkl = np.array(indices.as_vec3_double().as_double(), dtype=float)
+    hkl = hkl.reshape(-1, 3).astype(int)
+    return hkl[:, 0], hkl[:, 1], hkl[:, 2]
+
+
+def _n_possible_reflections(unit_cell, space_group_number, bins):
+    """Numbers of unique reflections that are theoretically possible in
+    resolution bins `bins` (list of (d_max, d_min) tuples)."""
+    from cctbx import crystal, miller
+    symmetry = crystal.symmetry(unit_cell=unit_cell,
+                                space_group_symbol=str(space_group_number))
+    d_min = min(b[1] for b in bins)
+    complete_set = miller.build_set(crystal_symmetry=symmetry,
+                                    anomalous_flag=False, d_min=d_min)
+    d = complete_set.d_spacings().data().as_numpy_array()
+    return [int(np.count_nonzero((d <= d_max) & (d > d_min_bin)))
+            for d_max, d_min_bin in bins]
+
+
+def _hkl_keys(h, k, l):
+    """Packs Miller indices into integer keys."""
+    return ((np.asarray(h, dtype=np.int64) + 2048) * 4096 +
+            (np.asarray(k, dtype=np.int64) + 2048)) * 4096 + \
+        (np.asarray(l, dtype=np.int64) + 2048)
+
+
+def _hkl_from_keys(keys):
+    """Unpacks Miller indices from integer keys made by `_hkl_keys()`."""
+    return (keys // (4096 * 4096) - 2048, (keys // 4096) % 4096 - 2048,
+            keys % 4096 - 2048)
+
+
+def _reduce_by_key(keys, values):
+    """Sums columns of `values` (2D array - a row for every quantity)
+    belonging to identical `keys`."""
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.zeros((values.shape[0], unique_keys.size))
+    for i in range(values.shape[0]):
+        sums[i] = np.bincount(inverse, weights=values[i],
+                              minlength=unique_keys.size)
+    return unique_keys, sums
+
+
+def _sum_by_key(chunks, n_rows):
+    """Sums columns of values belonging to identical keys over all `chunks`
+    (iterable of tuples (keys, values) - see `_reduce_by_key()`, `values`
+    have `n_rows` rows). The sums of the chunks are merged with the sums of
+    the previous chunks only when they outnumber them, so the merges cost
+    O(n log n) in total (n - number of the sums of all the chunks) instead
+    of sorting all the unique keys again after every chunk, and the memory
+    stays proportional to the number of unique keys.
+
+    Returns:
+        (tuple): Sorted unique keys and sums of values (2D array)
+    """
+    keys = np.zeros(0, dtype=np.int64)
+    sums = np.zeros((n_rows, 0))
+    pending_keys = []
+    pending_sums = []
+    n_pending = 0
+    for chunk_keys, values in chunks:
+        chunk_keys, chunk_sums = _reduce_by_key(chunk_keys, values)
+        pending_keys.append(chunk_keys)
+        pending_sums.append(chunk_sums)
+        n_pending += chunk_keys.size
+        if n_pending > keys.size:
+            keys, sums = _reduce_by_key(
+                np.concatenate([keys] + pending_keys),
+                np.hstack([sums] + pending_sums))
+            pending_keys = []
+            pending_sums = []
+            n_pending = 0
+    if pending_keys:
+        keys, sums = _reduce_by_key(np.concatenate([keys] + pending_keys),
+                                    np.hstack([sums] + pending_sums))
+    return keys, sums
+
+
+def merging_stats_unmerged(filename, bins, chunk_size=CHUNK_SIZE, seed=0,
+                           completeness=True):
+    """Calculates merging statistics of an unmerged data file
+    (`XDS_ASCII.HKL` or unmerged MTZ) in the given resolution bins.
+
+    Observations are streamed twice in chunks, so only the sums per unique
+    reflection are kept in the memory (not the observations). The first
+    pass accumulates the sums needed for the mean intensities and CC1/2
+    (random half-datasets), the second pass accumulates the deviations
+    needed for R-merge, R-meas and R-pim.
+
+    Args:
+        filename (str): Name of the unmerged diffraction data file
+        bins (list): Resolution bins - tuples (d_max, d_min) in angstrom
+        chunk_size (int): Maximal number of observations in one chunk
+        seed (int): Seed for the random split into half-datasets
+        completeness (bool): Calculate completeness (requires CCTBX)
+
+    Returns:
+        list: Dictionary for every bin containing keys `d_max`, `d_min`,
+        `n_obs`, `n_uniq`, `mult`, `comp`, `i_mean`, `i_sig_mean`,
+        `r_merge`, `r_meas`, `r_pim` and `cc_half` (values are *None* if
+        they could not be calculated)
+    """
+    unit_cell, space_group_number = unmerged_symmetry(filename)
+    map_to_asu = not is_mtz(filename)  # unmerged MTZ is already in ASU
+    d_max_all = max(b[0] for b in bins)
+    d_min_all = min(b[1] for b in bins)
+    random_state = np.random.RandomState(seed)
+
+    def read_chunks():
+        for h, k, l, i_obs, sig_i in iter_unmerged(filename, chunk_size):
+            if map_to_asu and h.size:
+                h, k, l = _map_to_asu(h, k, l, unit_cell, space_group_number)
+            d = d_spacings(h, k, l, unit_cell)
+            selection = (d <= d_max_all) & (d > d_min_all)
+            if np.any(selection):
+                yield (_hkl_keys(h[selection], k[selection], l[selection]),
+                       i_obs[selection], sig_i[selection])
+
+    # 1st pass - sums per unique reflection, rows:
+    # n, sum(I), sum(w), sum(w*I), n_half1, sum(I_half1), n_half2, sum(I_half2)
+    def first_pass_values():
+        for chunk_keys, i_obs, sig_i in read_chunks():
+            weight = 1 / (sig_i * sig_i)
+            half = random_state.randint(2, size=chunk_keys.size)
+            yield chunk_keys, np.vstack([
+                np.ones(chunk_keys.size), i_obs, weight, weight * i_obs,
+                half == 0, i_obs * (half == 0), half == 1, i_obs * (half == 1)])
+
+    keys, sums = _sum_by_key(first_pass_values(), 8)
+    n, sum_i, sum_w, sum_wi, n_1, sum_i_1, n_2, sum_i_2 = sums
+    h, k, l = _hkl_from_keys(keys)
+    d = d_spacings(h, k, l, unit_cell)
+    bin_of_unique = np.full(keys.size, -1)
+    for i_bin, (d_max, d_min) in enumerate(bins):
+        bin_of_unique[(d <= d_max) & (d > d_min)] = i_bin
+    i_mean_unweighted = sum_i / np.maximum(n, 1)
+
+    # 2nd pass - deviations from the mean intensities
+    # rows: sum|I-<I>|, sum(sqrt(n/(n-1))|I-<I>|), sum(sqrt(1/(n-1))|I-<I>|),
+    #       sum(I)  (only reflections measured more than once)
+    n_bins = len(bins)
+    deviations = np.zeros((4, n_bins))
+    for chunk_keys, i_obs, sig_i in read_chunks():
+        index = np.searchsorted(keys, chunk_keys)
+        n_obs = n[index]
+        multiple = n_obs > 1
+        index, n_obs, i_obs = index[multiple], n_obs[multiple], i_obs[multiple]
+        chunk_bins = bin_of_unique[index]
+        inside = chunk_bins >= 0
+        index, n_obs, i_obs = index[inside], n_obs[inside], i_obs[inside]
+        chunk_bins = chunk_bins[inside]
+        deviation = np.abs(i_obs - i_mean_unweighted[index])
+        for row, values in enumerate([
+                deviation, np.sqrt(n_obs / (n_obs - 1)) * deviation,
+                np.sqrt(1 / (n_obs - 1)) * deviation, i_obs]):
+            deviations[row] += np.bincount(chunk_bins, weights=values,
+                                           minlength=n_bins)
+
+    n_possible = [None] * n_bins
+    if completeness:
+        try:
+            n_possible = _n_possible_reflections(unit_cell,
+                                                 space_group_number, bins)
+        except ImportError:
+            pass
+    results = []
+    for i_bin, (d_max, d_min) in enumerate(bins):
+        sel = bin_of_unique == i_bin
+        stats = {"d_max": d_max, "d_min": d_min,
+                 "n_obs": int(n[sel].sum()), "n_uniq": int(sel.sum()),
+                 "mult": None, "comp": None, "i_mean": None,
+                 "i_sig_mean": None, "r_merge": None, "r_meas": None,
+                 "r_pim": None, "cc_half": None}
+        if stats["n_uniq"]:
+            stats["mult"] = stats["n_obs"] / stats["n_uniq"]
+            i_merged = sum_wi[sel] / sum_w[sel]
+            sig_merged = 1 / np.sqrt(sum_w[sel])
+            stats["i_mean"] = float(np.mean(i_merged))
+            stats["i_sig_mean"] = float(np.mean(i_merged / sig_merged))
+            if n_possible[i_bin]:
+                stats["comp"] = 100 * stats["n_uniq"] / n_possible[i_bin]
+        if deviations[3, i_bin] > 0:
+            stats["r_merge"] = deviations[0, i_bin] / deviations[3, i_bin]
+            stats["r_meas"] = deviations[1, i_bin] / deviations[3, i_bin]
+            stats["r_pim"] = deviations[2, i_bin] / deviations[3, i_bin]
+        both_halves = sel & (n_1 > 0) & (n_2 > 0)
+        if np.count_nonzero(both_halves) > 2:
+            mean_1 = sum_i_1[both_halves] / n_1[both_halves]
+            mean_2 = sum_i_2[both_halves] / n_2[both_halves]
+            if np.std(mean_1) > 0 and np.std(mean_2) > 0:
+                stats["cc_half"] = float(np.corrcoef(mean_1, mean_2)[0, 1])
+        results.append(stats)
+    return results
+
+
+def format_merging_stats_bin(stats):
+    """Formats merging statistics of one resolution bin (a dictionary
+    returned by :func:`merging_stats_unmerged`) as a line in the same
+    column order as the table `Statistics by resolution bin` from
+    `iotbx.merging_statistics` (anomalous statistics are not calculated).
+
+    Args:
+        stats (dict)
+
+    Returns:
+        str
+    """
+    def value(key, fmt):
+        if stats[key] is None:
+            return "N/A"
+        return fmt.format(stats[key])
+
+    return " " + "  ".join([
+        "{0:6.2f}".format(stats["d_max"]), "{0:6.2f}".format(stats["d_min"]),
+        "{0:6d}".format(stats["n_obs"]), "{0:6d}".format(stats["n_uniq"]),
+        value("mult", "{0:6.2f}"), value("comp", "{0:6.2f}"),
+        value("i_mean", "{0:8.1f}"), value("i_sig_mean", "{0:6.1f}"),
+        value("r_merge", "{0:7.3f}"), value("r_meas", "{0:7.3f}"),
+        value("r_pim", "{0:7.3f}"), "    N/A",
+        value("cc_half", "{0:6.3f}"), "   N/A"]) + "\n"
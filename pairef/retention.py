@@ -0,0 +1,96 @@
+# coding: utf-8
+"""Retention of the intermediate files of paired refinement.
+
+Statistics of every refined structure model are calculated from several
+extra jobs of REFMAC5 or phenix.refine with zero cycles (files with
+`_comparison_at_` in their names). When all the statistics of a step have
+been collected, these files are not needed any more - their logs are
+compressed using gzip (the functions reading the logs, *e.g.*
+:func:`pairef.commons.extract_from_file`, read the compressed files
+transparently) and the other files (MTZ, structure models, ...) are
+removed. The refined structure models, their MTZ and log files and the
+CSV files with statistics are always kept. Option `--keep-intermediates`
+turns this off.
+"""
+from __future__ import print_function
+import gzip
+import os
+import shutil
+from .commons import twodecname
+from .progress import forget_cycles
+from .settings import workpath
+
+# Files with these extensions are compressed, the other ones are removed
+COMPRESSED = (".log", ".out")
+
+
+def compress(filename):
+    """Compresses a file using gzip (the file `filename` is replaced by the
+    file `filename`.gz).
+
+    Args:
+        filename (str): Name of the file
+
+    Returns:
+        str: Name of the compressed file
+    """
+    gzfilename = filename + ".gz"
+    with open(workpath(filename), "rb") as src:
+        with gzip.open(workpath(gzfilename + ".tmp"), "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    os.rename(workpath(gzfilename + ".tmp"), workpath(gzfilename))
+    os.remove(workpath(filename))
+    return gzfilename
+
+
+def comparison_files(project, flag, res_cur, directory="."):
+    """Returns the intermediate files of the jobs calculating statistics of
+    the structure model `project`_R`flag`_`res_cur`A.
+
+    Args:
+        project (str): Name of the project
+        flag (int): Free reflection set
+        res_cur (float): High resolution limit of the model
+        directory (str)
+
+    Returns:
+        list: Names of the files (compressed files are omitted)
+    """
+    prefix = project + "_R" + str(flag).zfill(2) + "_" + \
+        twodecname(res_cur) + "A_comparison_at_"
+    return sorted(os.path.join(directory, filename)
+                  for filename in os.listdir(workpath(directory))
+                  if filename.startswith(prefix) and
+                  not filename.endswith(".gz"))
+
+
+def prune_step(args, flag, res_cur):
+    """Compresses the logs and removes the other intermediate files of the
+    jobs calculating statistics of the structure model refined at the
+    resolution `res_cur` (see :func:`comparison_files`). It is called when
+    all the statistics of the step have been collected. Nothing is done if
+    the option `--keep-intermediates` is set. R-values vs. cycle of the
+    refinement are dropped from the memory in any case (see
+    :func:`pairef.progress.forget_cycles`).
+
+    Args:
+        args: Input arguments processed by `argparse`
+        flag (int): Free reflection set
+        res_cur (float): High resolution limit of the model
+
+    Returns:
+        (tuple): Lists of the compressed and the removed files
+    """
+    forget_cycles(args.project + "_R" + str(flag).zfill(2) + "_" +
+                  twodecname(res_cur) + "A")
+    compressed = []
+    removed = []
+    if getattr(args, "keep_intermediates", False):
+        return compressed, removed
+    for filename in comparison_files(args.project, flag, res_cur):
+        if filename.endswith(COMPRESSED):
+            compressed.append(compress(filename))
+        else:
+            os.remove(workpath(filename))
+            removed.append(filename)
+    return compressed, removed
@@ -0,0 +1,182 @@
+# coding: utf-8
+"""Staging of a run in a scratch directory (option `--scratch DIR`).
+
+The refinement jobs write many small files, which is slow on a network
+filesystem. With the option `--scratch`, the run takes place in a new
+directory in `DIR` (*e.g.* a node-local disk or tmpfs) and a background
+thread copies the files which have not been changed for a while to the
+working directory `pairef_`project``. When the run ends (also after an
+error), all the remaining changes are copied, files removed in the scratch
+directory are removed in the working directory as well, the scratch
+directory is deleted and the working directory becomes the directory of
+the run again. The working directory then contains the same files as
+after a run without the option `--scratch`.
+"""
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import threading
+import time
+from .settings import current_context
+from .commons import print_my
+
+# Seconds between two synchronizations
+INTERVAL = 10.0
+# Files changed in the last SETTLE seconds are still being written
+SETTLE = 5.0
+
+
+class ScratchSync(object):
+    """Copies the files of a run from a scratch directory to the working
+    directory.
+
+    Args:
+        rundir (str): Scratch directory in which the run takes place
+        workdir (str): Working directory
+        interval (float): Seconds between two synchronizations
+        settle (float): Files changed in the last `settle` seconds are not
+                        copied by the background thread
+    """
+    def __init__(self, rundir, workdir, interval=INTERVAL, settle=SETTLE):
+        self.rundir = os.path.abspath(rundir)
+        self.workdir = os.path.abspath(workdir)
+        self.interval = interval
+        self.settle = settle
+        self.copied = {}  # relative path -> (size, mtime) or symlink target
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Starts the background thread.
+
+        Returns:
+            ScratchSync: self
+        """
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sync(settle=self.settle)
+            except (IOError, OSError):
+                pass  # the next synchronization will try again
+
+    def _files(self):
+        files = {}
+        for root, dirnames, filenames in os.walk(self.rundir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                files[os.path.relpath(path, self.rundir)] = path
+        return files
+
+    def sync(self, settle=0):
+        """Copies the new and changed files to the working directory and
+        removes the files which have been removed in the scratch directory.
+
+        Args:
+            settle (float): Skip files changed in the last `settle` seconds
+
+        Returns:
+            list: Relative paths of the copied files
+        """
+        copied = []
+        with self.lock:
+            files = self._files()
+            for relpath, path in sorted(files.items()):
+                target = os.path.join(self.workdir, relpath)
+                if os.path.islink(path):
+                    state = os.readlink(path)
+                else:
+                    try:
+                        stat = os.stat(path)
+                    except OSError:  # removed meanwhile
+                        continue
+                    if settle and time.time() - stat.st_mtime < settle:
+                        continue
+                    state = (stat.st_size, stat.st_mtime)
+                if self.copied.get(relpath) == state:
+                    continue
+                directory = os.path.dirname(target)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                if os.path.lexists(target):
+                    os.remove(target)
+                if os.path.islink(path):
+                    os.symlink(state, target)
+                else:
+                    # Readers of the working directory never see a half
+                    # copied file
+                    shutil.copy2(path, target + ".sync")
+                    os.rename(target + ".sync", target)
+                self.copied[relpath] = state
+                copied.append(relpath)
+            for relpath in sorted(set(self.copied) - set(files)):
+                target = os.path.join(self.workdir, relpath)
+                if os.path.lexists(target):
+                    os.remove(target)
+                del self.copied[relpath]
+        return copied
+
+    def stop(self):
+        """Stops the background thread, copies all the remaining changes and
+        deletes the scratch directory."""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.sync()
+        shutil.rmtree(self.rundir, ignore_errors=True)
+
+
+def stage(workdir, scratch, project):
+    """Creates a new directory for the run in the directory `scratch` and
+    starts copying its files to `workdir` (see :class:`ScratchSync`).
+
+    Args:
+        workdir (str): Working directory
+        scratch (str): Scratch directory (*e.g.* on a node-local disk)
+        project (str): Name of the project
+
+    Returns:
+        str: Absolute path of the new directory in which the run takes place
+    """
+    rundir = tempfile.mkdtemp(prefix="pairef_" + project + "_",
+                              dir=os.path.abspath(scratch))
+    current_context().scratch = ScratchSync(rundir, workdir).start()
+    return rundir
+
+
+def finish():
+    """Finishes the staging of the current run (if it is staged) - copies
+    the remaining files to the working directory, deletes the scratch
+    directory and moves the run to the working directory (see
+    :attr:`pairef.settings.RunContext.workdir`).
+    """
+    context = current_context()
+    sync = context.scratch
+    if sync is None:
+        return
+    context.scratch = None
+    sync.stop()
+    if context.workdir == sync.rundir:
+        context.workdir = sync.workdir
+    print_my("Files of the run were copied from the scratch directory " +
+             sync.rundir + " to the working directory " + sync.workdir)
+
+
+def results_dir():
+    """Returns the directory where the results of the current run are
+    saved - the working directory, also when the run takes place in a
+    scratch directory.
+
+    Returns:
+        str
+    """
+    context = current_context()
+    if context.scratch is not None:
+        return context.scratch.workdir
+    return context.workdir or os.getcwd()
@@ -1,7 +1,198 @@
 # coding: utf-8
+import os
+import sys
+import threading
+from contextlib import contextmanager
 from collections import OrderedDict
 from datetime import datetime
+try:  # Python 2/3 support
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
-warning_dict = OrderedDict()
-date_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-settings = {}
+
+class RunContext(object):
+    """State of one run of PAIREF - its settings (*e.g.* `pdbORmmcif`,
+    `sh`, `phenix_version`), warnings, the date and time of its start, the
+    found external programs, the staging in a scratch directory, the
+    ratings of the resolution shells, the memo of statistics, the runner of
+    the external programs, the profile, the monitors of the running
+    refinement jobs, the directory in which the run takes place and the
+    stream of its messages.
+
+    A context is activated in the current thread by the statement
+    `with context:`, the dictionaries :data:`settings` and
+    :data:`warning_dict` and the objects :data:`pairef.jobs.job_runner` and
+    :data:`pairef.timing.profiler` then refer to it. Threads started by
+    :meth:`pairef.jobs.JobRunner.map` use the context of the thread which
+    started them.
+
+    Args:
+        job_runner (JobRunner): Runner of the external programs (a new one
+                                is created when it is first used by default)
+    """
+    def __init__(self, job_runner=None):
+        self.settings = {}
+        self.warning_dict = OrderedDict()
+        self.date_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Registry of the external programs (see :mod:`pairef.tools`)
+        self.tools = None
+        # Staging in a scratch directory (see :mod:`pairef.scratch`)
+        self.scratch = None
+        # Ratings of the resolution shells (see :mod:`pairef.cutoff`)
+        self.cutoff = None
+        # Statistics of the models (see :mod:`pairef.memo`)
+        self.statistics = None
+        # Monitors of the running refinement jobs (see :mod:`pairef.progress`)
+        self.monitors = {}
+        # Directory in which the run takes place, relative names of the files
+        # of the run refer to it (see :func:`workpath`)
+        self.workdir = None
+        # Stream of the messages of the run (see :func:`current_output`)
+        self.output = None
+        self._job_runner = job_runner
+        self._profiler = None
+
+    @property
+    def job_runner(self):
+        """Runner of the external programs of the run (see
+        :class:`pairef.jobs.JobRunner`)."""
+        with _lock:
+            if self._job_runner is None:
+                from .jobs import JobRunner
+                self._job_runner = JobRunner()
+            return self._job_runner
+
+    @property
+    def profiler(self):
+        """Profile of the run (see :class:`pairef.timing.Profiler`)."""
+        with _lock:
+            if self._profiler is None:
+                from .timing import Profiler
+                self._profiler = Profiler()
+            return self._profiler
+
+    def __enter__(self):
+        _active_contexts().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _active_contexts().pop()
+        return False
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_default_context = RunContext()
+
+
+def _active_contexts():
+    """Returns the stack of the contexts activated in the current thread."""
+    if not hasattr(_local, "contexts"):
+        _local.contexts = []
+    return _local.contexts
+
+
+def current_context():
+    """Returns the run context active in the current thread (a context
+    shared by the whole process if none has been activated)."""
+    contexts = _active_contexts()
+    if contexts:
+        return contexts[-1]
+    return _default_context
+
+
+def workpath(filename):
+    """Returns the path of the file `filename` of the run active in the
+    current thread - a relative name refers to the directory in which the
+    run takes place (the current directory if it is not set, *e.g.* before
+    the working directory is created).
+
+    Args:
+        filename (str)
+
+    Returns:
+        str
+    """
+    workdir = current_context().workdir
+    if workdir is None:
+        return filename
+    return os.path.join(workdir, filename)
+
+
+def current_output():
+    """Returns the stream which the messages of the current thread are
+    written to (see :func:`pairef.commons.print_my`) - the stream set by
+    :func:`output_to`, the stream of the active run context or
+    `sys.stdout`."""
+    outputs = getattr(_local, "outputs", None)
+    if outputs:
+        return outputs[-1]
+    output = current_context().output
+    if output is None:
+        return sys.stdout
+    return output
+
+
+@contextmanager
+def output_to(stream):
+    """Writes the messages of the current thread to `stream` within the
+    `with` statement."""
+    if not hasattr(_local, "outputs"):
+        _local.outputs = []
+    _local.outputs.append(stream)
+    try:
+        yield stream
+    finally:
+        _local.outputs.pop()
+
+
+class ContextDict(MutableMapping):
+    """Dictionary `name` of the active run context (see :class:`RunContext`).
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def _dict(self):
+        return getattr(current_context(), self.name)
+
+    def __getitem__(self, key):
+        return self._dict()[key]
+
+    def __setitem__(self, key, value):
+        self._dict()[key] = value
+
+    def __delitem__(self, key):
+        del self._dict()[key]
+
+    def __iter__(self):
+        return iter(self._dict())
+
+    def __len__(self):
+        return len(self._dict())
+
+    def __repr__(self):
+        return repr(self._dict())
+
+
+class ContextObject(object):
+    """Object `name` of the active run context (see :class:`RunContext`),
+    its attributes are read and set in the object of the context."""
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+
+    def _object(self):
+        return getattr(current_context(), self._name)
+
+    def __getattr__(self, attribute):
+        return getattr(self._object(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._object(), attribute, value)
+
+    def __repr__(self):
+        return repr(self._object())
+
+
+warning_dict = ContextDict("warning_dict")
+settings = ContextDict("settings")
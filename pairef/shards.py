@@ -0,0 +1,367 @@
+# coding: utf-8
+"""Sharded workflow of complete cross-validation.
+
+The free reflection sets are refined independently of each other, so
+the paired refinement of every set (a *shard*) can run as a separate
+process, *e.g.* as a task of a job array of a batch system:
+
+1. `pairef prepare-shards ARGUMENTS --complete` prepares the working directory
+   and saves the resolution shells and the free reflection sets in a file
+   `PAIREF_shards.json`,
+2. `pairef run-shard WORKDIR --flag F` runs the whole chain of refinements
+   of the set `F` in the working directory,
+3. `pairef merge WORKDIR` averages the statistics of the finished shards,
+   suggests the cutoff and writes the final HTML log.
+
+`pairef run-shards WORKDIR` runs all the shards on the local computer and
+merges them.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+from collections import OrderedDict
+from .settings import warning_dict, settings, current_context
+from .settings import current_output, workpath
+from .commons import twodec, twodecname, warning_my, print_my
+from .commons import InputError, RefinementError
+from .jobs import job_runner, cpu_count, JobError, JobRunner
+from .timing import profiler
+
+SCHEDULE = "PAIREF_shards.json"
+SUBCOMMANDS = ("prepare-shards", "run-shard", "run-shards", "merge")
+
+
+def status_filename(flag):
+    """Returns the name of the file with the status of the shard `flag`."""
+    return "PAIREF_shard_R" + str(flag).zfill(2) + ".json"
+
+
+def write_schedule(args, refinement, shells, flag_sets, n_bins_low, res_low,
+                   xyzin_start, versions_dict, res_unmerged=(None, None)):
+    """Saves everything that the shards and the merge need in the file
+    `PAIREF_shards.json` in the current (working) directory.
+
+    Args:
+        args: Input arguments processed by `argparse`
+        refinement (str): "refmac" or "phenix"
+        shells (list): High resolution limits
+        flag_sets (list): Free reflection sets
+        n_bins_low (int): Number of resolution bins
+        res_low (float): Low resolution limit
+        xyzin_start (str): Starting (modified) structure model
+        versions_dict (dict)
+        res_unmerged (tuple): Resolution range of unmerged data
+
+    Returns:
+        str: Name of the file
+    """
+    arguments = dict(vars(args))
+    arguments["flag_sets"] = list(flag_sets)
+    schedule = OrderedDict([
+        ("refinement", refinement), ("shells", list(shells)),
+        ("flag_sets", list(flag_sets)), ("n_bins_low", n_bins_low),
+        ("res_low", res_low), ("xyzin_start", xyzin_start),
+        ("res_unmerged", list(res_unmerged)), ("versions", versions_dict),
+        ("settings", dict(settings)), ("args", arguments)])
+    with open(workpath(SCHEDULE), "w") as schedulefile:
+        json.dump(schedule, schedulefile, indent=1)
+    workdir = os.path.abspath(workpath("."))
+    print_my("\nSchedule of the shards was saved in a file " +
+             os.path.join(workdir, SCHEDULE))
+    print_my("Run every shard (e.g. as a task of a job array):")
+    for flag in flag_sets:
+        print_my("   pairef run-shard " + workdir + " --flag " + str(flag))
+    print_my("and then merge the results:")
+    print_my("   pairef merge " + workdir)
+    print_my("or run all the shards on this computer at once:")
+    print_my("   pairef run-shards " + workdir)
+    return SCHEDULE
+
+
+def load_schedule(workdir):
+    """Reads the schedule written by :func:`write_schedule` and restores
+    the settings.
+
+    Args:
+        workdir (str): Working directory
+
+    Returns:
+        (tuple):
+            * args (*argparse.Namespace*): Input arguments
+            * schedule (*dict*)
+
+    Raises:
+        InputError: The working directory has not been prepared
+    """
+    schedulefilename = os.path.join(workdir, SCHEDULE)
+    if not os.path.isfile(schedulefilename):
+        raise InputError("File " + schedulefilename + " does not "
+                         "exist. Prepare the shards using the command "
+                         "`pairef prepare-shards` first.")
+    with open(schedulefilename, "r") as schedulefile:
+        schedule = json.load(schedulefile)
+    settings.update(schedule["settings"])
+    return argparse.Namespace(**schedule["args"]), schedule
+
+
+def configure_job_runner(args, nproc=None):
+    """Configures the job runner of a shard (all the cores are used by
+    the only chain of refinements)."""
+    n_cores = nproc or args.nproc or cpu_count()
+    job_runner.configure(n_cores, args.threads or n_cores,
+                         timeout=args.timeout,
+                         stall_timeout=args.stall_timeout,
+                         retries=args.retries)
+
+
+def run_shard(workdir, flag, nproc=None):
+    """Runs the paired refinement with the free reflection set `flag`
+    (every step of the protocol up to the highest resolution). The
+    shells which have been finished are saved in a status file (see
+    :func:`status_filename`) after every step.
+
+    Args:
+        workdir (str): Working directory prepared by `pairef prepare-shards`
+        flag (int): Free reflection set
+        nproc (int): Number of CPU cores
+
+    Returns:
+        dict: Status of the shard
+    """
+    args, schedule = load_schedule(workdir)
+    if flag not in schedule["flag_sets"]:
+        raise InputError("FreeRflag set " + str(flag) + " is not "
+                         "scheduled in " + workdir + ".")
+    from .launcher import refine_first, refine_shell, choose_next_ncyc
+    from .refinement import collect_stat_OVERALL
+    from .graphs import matplotlib_line
+    from .planning import describe_data
+    from .preparation import output_log
+    from .retention import prune_step
+    context = current_context()
+    context.workdir = os.path.abspath(workdir)
+    refinement = schedule["refinement"]
+    shells = schedule["shells"]
+    n_bins_low = schedule["n_bins_low"]
+    context.output = output_log(current_output(), "PAIREF_shard_R" +
+                                str(flag).zfill(2) + "_out.log")
+    configure_job_runner(args, nproc)
+    profiler.reset()
+    profiler.metadata["refinement"] = refinement
+    profiler.metadata["reflections"], profiler.metadata["n_atoms"] = \
+        describe_data(args.hklin, args.xyzin, flag)
+    status = OrderedDict([("flag", flag), ("shells", []),
+                          ("versions", schedule["versions"]),
+                          ("ncyc_chosen", []), ("warnings", {})])
+
+    def save():
+        status["ncyc_chosen"] = args.ncyc_chosen
+        status["warnings"] = dict(warning_dict)
+        with open(workpath(status_filename(flag)), "w") as statusfile:
+            json.dump(status, statusfile, indent=1)
+
+    def plot_cycles(res_cur):
+        matplotlib_line(
+            shells=[res_cur], project=args.project,
+            statistics=["Rwork_cyc", "Rfree_cyc"], n_bins_low=n_bins_low,
+            title=r"$\mathrm{" + twodec(res_cur) + r"\ \AA\ -" +
+            r"\ flag\ " + str(flag) + "}$",
+            filename_suffix="R" + str(flag).zfill(2) + "_" +
+            twodecname(res_cur) + "A_stats_vs_cycle", flag=flag,
+            refinement=refinement)
+
+    try:
+        print_my("Shard with FreeRflag set " + str(flag) + ":")
+        print_my("   * Performing pre-refinement at "
+                 "" + twodec(shells[0]) + " A resolution...")
+        try:
+            results = refine_first(flag, args, refinement, shells,
+                                   n_bins_low, schedule["res_low"],
+                                   schedule["xyzin_start"])
+        except JobError as e:
+            warning_my("failed", "Refinement with the FreeRflag set "
+                       "" + str(flag) + " at " + twodec(shells[0]) + " A "
+                       "failed. " + str(e))
+            return status
+        if refinement == "refmac":
+            status["versions"]["refmac_version"] = results["version"]
+        if "label" in results:
+            args.label = results["label"]
+        if args.ncyc_auto and len(shells) > 1:
+            choose_next_ncyc(args, shells[0], [flag], refinement)
+        collect_stat_OVERALL([shells[0]], args, flag, refinement)
+        plot_cycles(shells[0])
+        prune_step(args, flag, shells[0])
+        status["shells"] = shells[:1]
+        save()
+        for i in range(len(shells) - 1):
+            print_my("\n   * Refining using data up to "
+                     "" + twodec(shells[i + 1]) + " A resolution...")
+            try:
+                refine_shell(flag, i, args, refinement, shells, n_bins_low,
+                             schedule["res_low"])
+            except JobError as e:
+                warning_my("failed", "Refinement with the FreeRflag set "
+                           "" + str(flag) + " at " + twodec(shells[i + 1]) +
+                           " A failed. " + str(e))
+                break
+            print_my("")
+            if args.ncyc_auto and i + 2 < len(shells):
+                choose_next_ncyc(args, shells[i + 1], [flag], refinement)
+            plot_cycles(shells[i + 1])
+            collect_stat_OVERALL(shells[:i + 2], args, flag, refinement)
+            prune_step(args, flag, shells[i + 1])
+            status["shells"] = shells[:i + 2]
+            save()
+    finally:
+        save()
+        profiler.write(args.project + "_R" + str(flag).zfill(2))
+        context.output.close()
+        context.output = None
+    return status
+
+
+def merge(workdir):
+    """Merges the finished shards - averages the statistics, suggests the
+    cutoff and writes the final HTML log. Shells which have not been
+    finished by all the shards are omitted, shards which have not finished
+    any step are excluded.
+
+    Args:
+        workdir (str): Working directory prepared by `pairef prepare-shards`
+
+    Returns:
+        (tuple): Suggested cutoff (see
+        :func:`pairef.preparation.suggest_cutoff`)
+    """
+    args, schedule = load_schedule(workdir)
+    from .launcher import initial_bins, finish_run
+    from .refinement import collect_stat_OVERALL_AVG
+    from .preparation import suggest_cutoff, output_log
+    from .graphs import matplotlib_bar, matplotlib_line, write_log_html
+    context = current_context()
+    context.workdir = os.path.abspath(workdir)
+    context.output = output_log(current_output(), "PAIREF_out.log")
+    try:
+        profiler.reset()
+        statuses = []
+        for flag in schedule["flag_sets"]:
+            status = None
+            if os.path.isfile(workpath(status_filename(flag))):
+                with open(workpath(status_filename(flag)),
+                          "r") as statusfile:
+                    status = json.load(statusfile)
+                warning_dict.update(status["warnings"])
+            if status and len(status["shells"]) > 1:
+                statuses.append(status)
+            else:
+                warning_my("failed", "Shard with the FreeRflag set " +
+                           str(flag) + " has not finished any step of "
+                           "paired refinement. The set is excluded.")
+        if not statuses:
+            raise RefinementError("No shard in " + workdir + " has "
+                                  "finished any step of paired refinement.")
+        flag_sets = [status["flag"] for status in statuses]
+        shells = min((status["shells"] for status in statuses), key=len)
+        if len(shells) < len(schedule["shells"]):
+            warning_my("failed", "Paired refinement was stopped at "
+                       "" + twodec(shells[-1]) + " A as not all the shards "
+                       "have finished the next step. The suggested cutoff is "
+                       "based only on the previous shells.")
+        versions_dict = statuses[0]["versions"]
+        args.ncyc_chosen = statuses[0]["ncyc_chosen"]
+        n_bins_low = schedule["n_bins_low"]
+        flag = flag_sets[-1]
+        print_my("\nMerging shards with FreeRflag sets " +
+                 ", ".join(str(flag_set) for flag_set in flag_sets) + "...")
+        collect_stat_OVERALL_AVG(shells, args.project, flag_sets)
+        matplotlib_bar(args)
+        matplotlib_bar(args=args, flag_sets=flag_sets, ready_shells=shells)
+        matplotlib_line(shells=[shells[0]], project=args.project,
+                        statistics=["Rgap"], n_bins_low=n_bins_low,
+                        title=r"$\it{R}_{\mathrm{free}}-"
+                        r"\it{R}_{\mathrm{work}}$",
+                        filename_suffix="Rgap", flag=flag)
+        cutoff, accepted, reason = suggest_cutoff(args, shells, n_bins_low,
+                                                  flag)
+        write_log_html(shells, shells, args, versions_dict, flag_sets,
+                       cutoff=cutoff, accepted=accepted, reason=reason)
+        if args.hklin_unmerged:
+            bins_low = initial_bins(args, schedule["refinement"], shells,
+                                    flag_sets[0], n_bins_low,
+                                    schedule["res_low"])
+        else:
+            bins_low = None
+        return finish_run(args, shells, flag_sets, flag, versions_dict,
+                          n_bins_low, bins_low, schedule["res_unmerged"],
+                          cutoff, accepted, reason)[0]
+    finally:
+        context.output.close()
+        context.output = None
+
+
+def run_shards(workdir, nproc=None):
+    """Runs all the shards as separate processes on this computer (at most
+    `nproc` cores are used together) and merges them.
+
+    Args:
+        workdir (str): Working directory prepared by `pairef prepare-shards`
+        nproc (int): Number of CPU cores
+
+    Returns:
+        (tuple): Suggested cutoff (see :func:`merge`)
+    """
+    args, schedule = load_schedule(workdir)
+    flag_sets = schedule["flag_sets"]
+    n_cores = nproc or args.nproc or cpu_count()
+    threads = max(1, n_cores // len(flag_sets))
+    runner = JobRunner(n_cores, threads)
+
+    def shard(flag):
+        logfilename = os.path.join(workdir, "PAIREF_shard_R" +
+                                   str(flag).zfill(2) + "_run.log")
+        with open(logfilename, "w") as logfile:
+            returncode = runner.run(
+                [sys.executable, "-m", "pairef", "run-shard", workdir,
+                 "--flag", str(flag), "--nproc", str(threads)],
+                stdout=logfile, stderr=logfile)[2]
+        if returncode:
+            print_my("Shard with FreeRflag set " + str(flag) + " ended with "
+                     "an error, see " + logfilename)
+        return returncode
+
+    print_my("Running " + str(len(flag_sets)) + " shards using " +
+             str(n_cores) + " CPU cores...")
+    runner.map(shard, flag_sets)
+    return merge(workdir)
+
+
+def run_subcommand(input_args):
+    """Processes the arguments of the commands `run-shard`, `run-shards`,
+    and `merge` and runs them (the command `prepare-shards` takes the same arguments
+    as a normal run of PAIREF, see :func:`pairef.launcher.run_pairef`).
+
+    Args:
+        input_args (list): Command and its arguments
+    """
+    parser = argparse.ArgumentParser(prog="pairef " + input_args[0])
+    parser.add_argument("workdir", help="working directory prepared by "
+                        "`pairef prepare-shards`")
+    if input_args[0] == "run-shard":
+        parser.add_argument("--flag", type=int, required=True,
+                            help="free reflection set of the shard")
+    if input_args[0] != "merge":
+        parser.add_argument("--nproc", type=int, default=None,
+                            help="number of CPU cores")
+    args = parser.parse_args(input_args[1:])
+    workdir = os.path.abspath(args.workdir)
+    if input_args[0] == "run-shard":
+        status = run_shard(workdir, args.flag, args.nproc)
+        if not status["shells"]:
+            sys.exit(1)
+    elif input_args[0] == "run-shards":
+        run_shards(workdir, args.nproc)
+    else:
+        merge(workdir)
@@ -0,0 +1,260 @@
+# coding: utf-8
+from __future__ import print_function
+from __future__ import division
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from .settings import ContextObject, workpath
+from .commons import print_my
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_self():
+    """Returns the peak resident set size of this process in MB (*None* if
+    it is not known)."""
+    if resource is None:
+        return None
+    return maxrss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def maxrss_mb(ru_maxrss):
+    """Converts `ru_maxrss` of :func:`resource.getrusage` or
+    :func:`os.wait4` to MB (it is given in kB on Linux, in bytes on macOS)."""
+    import platform
+    if platform.system() == "Darwin":
+        return ru_maxrss / 1024 / 1024
+    return ru_maxrss / 1024
+
+
+class Profiler(object):
+    """Records wall-clock time of stages of a PAIREF run and CPU time and
+    peak memory of external programs.
+
+    Stages are recorded by the decorator :func:`timed` or by the context
+    manager :meth:`stage`, external programs are recorded by
+    :meth:`pairef.jobs.JobRunner.run`. The profile is saved as JSON and as a
+    timeline in the Chrome trace format (it can be opened in
+    `chrome://tracing` or https://ui.perfetto.dev).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets all recorded events and starts the clock again."""
+        with self.lock:
+            self.start_time = time.time()
+            self.events = []
+            self.thread_ids = {}
+            # Description of the problem, e.g. size of the data
+            # (see :mod:`pairef.planning`)
+            self.metadata = {}
+
+    def record(self, name, category, start, end, cpu=None, maxrss=None,
+               details=None):
+        """Records one event.
+
+        Args:
+            name (str)
+            category (str): *e.g.* "refinement", "graphs", "program"
+            start (float): Start time (:func:`time.time`)
+            end (float): End time (:func:`time.time`)
+            cpu (float): CPU time of a child process in seconds
+            maxrss (float): Peak memory in MB
+            details (dict): Further information shown in the timeline
+        """
+        with self.lock:
+            ident = threading.current_thread().ident
+            if ident not in self.thread_ids:
+                self.thread_ids[ident] = len(self.thread_ids) + 1
+            self.events.append({
+                "name": name, "category": category,
+                "start": start - self.start_time, "wall": end - start,
+                "cpu": cpu, "maxrss": maxrss,
+                "thread": self.thread_ids[ident], "details": details or {}})
+
+    def stage(self, name, category="stage"):
+        """Context manager recording a stage of the run."""
+        profiler = self
+
+        class Stage(object):
+            def __enter__(self):
+                self.start = time.time()
+                return self
+
+            def __exit__(self, *exc):
+                profiler.record(name, category, self.start, time.time(),
+                                maxrss=peak_rss_self())
+                return False
+
+        return Stage()
+
+    def summary(self):
+        """Returns the events summed up by stage, the longest stages first.
+
+        Returns:
+            list: Dictionaries with keys `name`, `category`, `calls`, `wall`,
+            `cpu` and `maxrss`
+        """
+        stages = OrderedDict()
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            key = (event["category"], event["name"])
+            if key not in stages:
+                stages[key] = OrderedDict([
+                    ("name", event["name"]), ("category", event["category"]),
+                    ("calls", 0), ("wall", 0.0), ("cpu", None),
+                    ("maxrss", None)])
+            stage = stages[key]
+            stage["calls"] += 1
+            stage["wall"] += event["wall"]
+            if event["cpu"] is not None:
+                stage["cpu"] = (stage["cpu"] or 0.0) + event["cpu"]
+            if event["maxrss"] is not None:
+                stage["maxrss"] = max(stage["maxrss"] or 0.0, event["maxrss"])
+        return sorted(stages.values(), key=lambda stage: -stage["wall"])
+
+    def write(self, project):
+        """Writes the profile `project`_profile.json and the timeline
+        `project`_profile_trace.json in the working directory of the run.
+
+        Returns:
+            (tuple): Names of the created files
+        """
+        with self.lock:
+            events = list(self.events)
+        total = time.time() - self.start_time
+        jsonfilename = project + "_profile.json"
+        with open(workpath(jsonfilename), "w") as jsonfile:
+            json.dump(OrderedDict([("wall", total),
+                                   ("maxrss", peak_rss_self()),
+                                   ("metadata", self.metadata),
+                                   ("stages", self.summary()),
+                                   ("events", events)]),
+                      jsonfile, indent=1)
+        trace = []
+        for event in events:
+            details = dict(event["details"])
+            for key in ("cpu", "maxrss"):
+                if event[key] is not None:
+                    details[key] = round(event[key], 3)
+            trace.append({"name": event["name"], "cat": event["category"],
+                          "ph": "X", "pid": os.getpid(),
+                          "tid": event["thread"],
+                          "ts": int(event["start"] * 1e6),
+                          "dur": int(event["wall"] * 1e6),
+                          "args": details})
+        tracefilename = project + "_profile_trace.json"
+        with open(workpath(tracefilename), "w") as tracefile:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"},
+                      tracefile)
+        return jsonfilename, tracefilename
+
+
+# Profile of the active run context (see :class:`pairef.settings.RunContext`)
+profiler = ContextObject("profiler")
+
+
+def timed(category):
+    """Decorator recording every call of a function as a stage of the run
+    (see :class:`Profiler`).
+
+    Args:
+        category (str)
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.stage(function.__name__, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StackSampler(object):
+    """Samples the Python call stacks of all threads (except its own) every
+    `interval` seconds. The stacks are saved in the collapsed format (one
+    stack per line, frames separated by semicolons and followed by the
+    number of samples) used by flame graph tools (*e.g.* `flamegraph.pl`,
+    https://www.speedscope.app).
+
+    Args:
+        interval (float): Sampling interval in seconds
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample(self):
+        while not self.stopped.is_set():
+            names = dict((thread.ident, thread.name)
+                         for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == self.thread.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(os.path.basename(code.co_filename) + ":" +
+                                 code.co_name)
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.stopped.wait(self.interval)
+
+    def write(self, filename):
+        """Writes the sampled stacks in the collapsed format."""
+        with open(filename, "w") as collapsedfile:
+            for stack in sorted(self.counts):
+                collapsedfile.write(stack.replace(" ", "_") + " " +
+                                    str(self.counts[stack]) + "\n")
+
+
+def profile_call(project, function, *args, **kwargs):
+    """Calls `function` under the deterministic profiler :mod:`cProfile`
+    (only the calling thread) and :class:`StackSampler` (all threads). The
+    results are saved in the directory of the run (see
+    :func:`pairef.settings.workpath`) as `project`.pstats and
+    `project`.collapsed even if `function` ends with an exception.
+
+    Args:
+        project (str): Prefix of the created files
+        function (callable)
+
+    Returns:
+        The value returned by `function`
+    """
+    import cProfile
+    sampler = StackSampler()
+    profile = cProfile.Profile()
+    sampler.start()
+    profile.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profile.disable()
+        sampler.stop()
+        profile.dump_stats(workpath(project + ".pstats"))
+        sampler.write(workpath(project + ".collapsed"))
+        print_my("Python profile was saved in files " +
+                 os.path.abspath(workpath(project)) + ".pstats and " +
+                 project + ".collapsed")
@@ -0,0 +1,183 @@
+# coding: utf-8
+"""Registry of the external programs used by PAIREF.
+
+Locations of the programs are searched in `PATH` only once per run and
+together with the program versions they are cached in a file
+`tools.json` in the directory given by the environment variable
+`PAIREF_CACHE_DIR` (`~/.cache/pairef` by default, an empty value turns the
+cache off). The cache is valid as long as `PATH`, the modification times
+of its directories and the modification times of the found programs do
+not change.
+"""
+from __future__ import print_function
+import hashlib
+import json
+import os
+import subprocess
+import threading
+from .commons import which
+from .settings import current_context, settings
+
+CACHE_FILENAME = "tools.json"
+_registry_lock = threading.Lock()
+
+
+def cache_dir():
+    """Returns the directory of the cache (*None* if it is turned off)."""
+    directory = os.environ.get("PAIREF_CACHE_DIR")
+    if directory is None:
+        directory = os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or
+            os.path.join(os.path.expanduser("~"), ".cache"), "pairef")
+    return directory or None
+
+
+def mtime(path):
+    """Returns the modification time of `path` (*None* if it does not
+    exist)."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def environment_key():
+    """Returns a key describing `PATH` and the modification times of its
+    directories (it changes if a program is installed or removed)."""
+    path = os.environ.get("PATH", "")
+    description = [path] + [str(mtime(directory))
+                            for directory in path.split(os.pathsep)]
+    return hashlib.sha1("\n".join(description).encode("utf-8")).hexdigest()
+
+
+class ToolRegistry(object):
+    """Locations and versions of the external programs.
+
+    Args:
+        cachefilename (str): File with the cache (*None* - no cache)
+    """
+    def __init__(self, cachefilename=None):
+        self.cachefilename = cachefilename
+        self.environ_path = os.environ.get("PATH", "")
+        self.key = environment_key()
+        self.lock = threading.Lock()
+        self.tools = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        """Reads the entries of the current environment from the cache.
+        Entries of programs which have been modified are dropped."""
+        if not self.cachefilename:
+            return
+        try:
+            with open(self.cachefilename, "r") as cachefile:
+                tools = json.load(cachefile).get(self.key, {})
+        except (IOError, OSError, ValueError):
+            return
+        for program, tool in tools.items():
+            if tool["path"] is None or mtime(tool["path"]) == tool["mtime"]:
+                self.tools[program] = tool
+
+    def save(self):
+        """Writes the entries of the current environment in the cache (the
+        entries of other environments are kept). Failures are ignored."""
+        if not self.cachefilename or not self.changed:
+            return
+        with self.lock:
+            try:
+                with open(self.cachefilename, "r") as cachefile:
+                    cache = json.load(cachefile)
+            except (IOError, OSError, ValueError):
+                cache = {}
+            cache[self.key] = self.tools
+            try:
+                directory = os.path.dirname(self.cachefilename)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                tmpfilename = self.cachefilename + "." + str(os.getpid())
+                with open(tmpfilename, "w") as cachefile:
+                    json.dump(cache, cachefile, indent=1)
+                if os.path.exists(self.cachefilename):
+                    os.remove(self.cachefilename)  # Windows
+                os.rename(tmpfilename, self.cachefilename)
+                self.changed = False
+            except (IOError, OSError):
+                pass
+
+    def _tool(self, program):
+        with self.lock:
+            tool = self.tools.get(program)
+            if tool is None:
+                path = which(program)
+                tool = {"path": path, "mtime": mtime(path) if path else None}
+                self.tools[program] = tool
+                self.changed = True
+        if self.changed:
+            self.save()
+        return tool
+
+    def path(self, program):
+        """Returns the location of `program` (*None* if it is not found).
+
+        Args:
+            program (str): Name of an executable
+
+        Returns:
+            str
+        """
+        return self._tool(program)["path"]
+
+    def version(self, program, command=None):
+        """Returns the version of `program` printed by `command` (the last
+        word of the last line containing "ersion").
+
+        Args:
+            program (str): Name of an executable
+            command (list): Command printing the version (`program` by
+                            default)
+
+        Returns:
+            str: Version (*None* if it could not be found)
+        """
+        tool = self._tool(program)
+        if "version" not in tool:
+            from .jobs import job_runner
+            version = None
+            try:  # the program is not always found on Windows (shell=True)
+                output = job_runner.run(
+                    command or [program], stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT, threads=1,
+                    shell=settings.get("sh", False))[0]
+            except OSError:
+                output = None
+            for line in (output or "").splitlines():
+                if "ersion" in line and line.split():
+                    version = line.split()[-1]  # the last match
+            with self.lock:
+                tool["version"] = version
+                self.changed = True
+            self.save()
+        return tool["version"]
+
+
+def registry():
+    """Returns the registry of the current run (see
+    :class:`pairef.settings.RunContext`), it is created at the first use
+    and again if `PATH` changes.
+    """
+    context = current_context()
+    with _registry_lock:
+        if context.tools is None or \
+                context.tools.environ_path != os.environ.get("PATH", ""):
+            directory = cache_dir()
+            context.tools = ToolRegistry(
+                os.path.join(directory, CACHE_FILENAME) if directory
+                else None)
+        return context.tools
+
+
+def find(program):
+    """Returns the location of `program` using the registry of the current
+    run (see :meth:`ToolRegistry.path`)."""
+    return registry().path(program)
@@ -0,0 +1,10 @@
+import os
+import pytest
+
+
+@pytest.fixture
+def tmpcwd(tmp_path, monkeypatch):
+    """Temporary directory which is the current directory during a test."""
+    tmpdir = os.path.realpath(str(tmp_path))
+    monkeypatch.chdir(tmpdir)
+    return tmpdir
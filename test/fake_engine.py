@@ -0,0 +1,169 @@
+# coding: utf-8
+"""Stand-in for REFMAC5 and phenix.refine used by the benchmarks.
+
+It accepts the same command line and keywords as the real programs do when
+they are run by PAIREF, writes a log based on a real REFMAC5 log
+(fixtures/lysozyme_1-40A.log) with the requested number of cycles and
+creates all the output files (copies of the input files). Every cycle takes
+`PAIREF_FAKE_DELAY` seconds (0 by default).
+
+Usage:
+    python fake_engine.py refmac HKLIN ... XYZIN ... < keywords
+    python fake_engine.py phenix data.mtz model.pdb params.params
+"""
+from __future__ import print_function
+import os
+import re
+import shutil
+import stat
+import sys
+import time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        "fixtures", "lysozyme_1-40A.log")
+
+
+def install(bindir):
+    """Creates executables `refmac5` and `phenix.refine` in the folder
+    `bindir` running this script. `bindir` has to be added to `PATH`."""
+    if not os.path.isdir(bindir):
+        os.makedirs(bindir)
+    for name, engine in (("refmac5", "refmac"), ("phenix.refine", "phenix")):
+        if sys.platform == "win32":
+            filename = os.path.join(bindir, name + ".bat")
+            with open(filename, "w") as f:
+                f.write('@"' + sys.executable + '" "' +
+                        os.path.realpath(__file__) + '" ' + engine + ' %*\n')
+        else:
+            filename = os.path.join(bindir, name)
+            with open(filename, "w") as f:
+                f.write('#!/bin/sh\nexec "' + sys.executable + '" "' +
+                        os.path.realpath(__file__) + '" ' + engine +
+                        ' "$@"\n')
+            os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+    return bindir
+
+
+def delay():
+    time.sleep(float(os.environ.get("PAIREF_FAKE_DELAY", 0)))
+
+
+def template():
+    """Splits the template log into the preamble, blocks of cycles, the
+    header of the final table, its rows and the rest."""
+    with open(TEMPLATE, "r") as f:
+        lines = f.readlines()
+    starts = [i for i, line in enumerate(lines)
+              if "CGMAT cycle number =" in line]
+    table = [i for i, line in enumerate(lines)
+             if "$TABLE: Rfactor analysis, stats vs cycle" in line][0]
+    header_end = [i for i, line in enumerate(lines)
+                  if "    Ncyc    Rfact    Rfree" in line][0] + 2
+    rows_end = header_end
+    while lines[rows_end].split()[0] != "$$":
+        rows_end += 1
+    blocks = [lines[start:end]
+              for start, end in zip(starts, starts[1:] + [table])]
+    return (lines[:starts[0]], blocks, lines[table:header_end],
+            lines[header_end:rows_end], lines[rows_end:])
+
+
+def refmac(argv):
+    files = dict((argv[i].upper(), argv[i + 1])
+                 for i in range(0, len(argv) - 1, 2))
+    keywords = sys.stdin.read()
+    ncyc = re.findall(r"^\s*ncyc\s+(\d+)", keywords,
+                      re.IGNORECASE | re.MULTILINE)
+    ncyc = int(ncyc[-1]) if ncyc else 10
+    preamble, blocks, header, rows, rest = template()
+    out = sys.stdout
+    out.writelines(preamble)
+    out.flush()
+    for cycle in range(1, max(ncyc, 1) + 1):
+        delay()
+        block = blocks[min(cycle, len(blocks)) - 1]
+        block[0] = re.sub(r"=\s*\d+", "= " + str(cycle).rjust(6), block[0])
+        out.writelines(block)
+        out.flush()
+    out.writelines(header)
+    final = rows[min(ncyc, len(rows) - 1)].split()
+    for cycle in range(ncyc + 1):
+        row = rows[min(cycle, len(rows) - 1)]
+        out.write(str(cycle).rjust(8) + row[8:])
+    for line in rest:
+        if line.strip().startswith("R factor"):
+            line = "           R factor    " + rows[0].split()[1] + "   " + \
+                final[1] + "\n"
+        elif line.strip().startswith("R free"):
+            line = "             R free    " + rows[0].split()[2] + "   " + \
+                final[2] + "\n"
+        out.write(line)
+    out.flush()
+    shutil.copy2(files["HKLIN"], files["HKLOUT"])
+    shutil.copy2(files["XYZIN"], files["XYZOUT"])
+    open(files["LIBOUT"], "w").close()
+    if "TLSOUT" in files:
+        shutil.copy2(files["TLSIN"], files["TLSOUT"])
+
+
+def phenix(argv):
+    hklin, xyzin = argv[0], argv[1]
+    params = ""
+    for arg in argv[2:]:
+        if os.path.isfile(arg):
+            with open(arg, "r") as f:
+                params += f.read() + "\n"
+        else:
+            params += arg + "\n"
+    prefix = re.findall(r"output\.prefix=(\S+)", params)[-1]
+    ncyc = re.findall(r"number_of_macro_cycles=(\d+)", params)
+    ncyc = int(ncyc[-1]) if ncyc else 3
+    r_work = [0.2500 - 0.0040 * (1 - 0.5 ** i) for i in range(ncyc + 1)]
+    r_free = [0.2800 - 0.0030 * (1 - 0.5 ** i) for i in range(ncyc + 1)]
+    lines = ["phenix.refine (fake engine)\n",
+             "Start R-work = %.4f, R-free = %.4f\n" % (r_work[0], r_free[0])]
+    sys.stdout.writelines(lines)
+    sys.stdout.flush()
+    for cycle in range(1, ncyc + 1):
+        delay()
+        line = "| r_work = %.4f r_free = %.4f |\n" % (r_work[cycle],
+                                                     r_free[cycle])
+        lines.append(line)
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    table = [" stage r-work r-free bonds angles b_min b_max b_ave n_water "
+             "shift\n"]
+    for cycle in range(ncyc + 1):
+        label = "0" if cycle == 0 else str(cycle) + "_adp"
+        table.append("%-9s: %.4f %.4f %5.3f %5.2f %6.2f %6.2f %6.2f %5d "
+                     "%6.3f\n" % (label, r_work[cycle], r_free[cycle], 0.008,
+                                  1.1, 10.0, 80.0, 30.0, 100, 0.0))
+    table.append("-" * 79 + "\n")
+    lines += table
+    lines.append("Final R-work = %.4f, R-free = %.4f\n" % (r_work[-1],
+                                                          r_free[-1]))
+    sys.stdout.writelines(table + lines[-1:])
+    sys.stdout.flush()
+    with open(prefix + "_001.log", "w") as f:
+        f.writelines(lines)
+    with open(xyzin, "r") as f:
+        model = f.read()
+    with open(prefix + "_001.pdb", "w") as f:
+        f.write("REMARK   3   R VALUE            (WORKING SET) : %.4f\n"
+                "REMARK   3   FREE R VALUE                     : %.4f\n"
+                % (r_work[-1], r_free[-1]) + model)
+    shutil.copy2(prefix + "_001.pdb", prefix + "_001.cif")
+    shutil.copy2(hklin, prefix + "_001.mtz")
+    open(prefix + "_001.geo", "w").close()
+
+
+def main(argv=None):
+    argv = argv or sys.argv[1:]
+    if argv[0] == "refmac":
+        refmac(argv[1:])
+    else:
+        phenix(argv[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -65,3 +65,13 @@ class AttrDict(dict):
     def __init__(self, *args, **kwargs):
         super(AttrDict, self).__init__(*args, **kwargs)
         self.__dict__ = self
+
+
+def write(filename, content="content\n"):
+    with open(filename, "w") as f:
+        f.write(content)
+
+
+def read(filename):
+    with open(filename, "r") as f:
+        return f.read()
@@ -0,0 +1,83 @@
+import pytest
+import os
+import sys
+from helper import config
+from pairef.api import make_config, read_shell_statistics, run
+from pairef.commons import PairefError, InputError, ArgumentsError
+from pairef.launcher import run_pairef
+from pairef.settings import settings, warning_dict
+
+
+def test_make_config():
+    args = make_config(config("mdm2_1-60A.pdb"), config("mdm2_merged.mtz"),
+                       res_init=1.6, project="api", phenix=True,
+                       complete_cross_validation=False, ncyc=5)
+    assert args.res_init == 1.6
+    assert args.project == "api"
+    assert args.phenix and not args.complete_cross_validation
+    assert args.ncyc == 5
+
+
+@pytest.mark.parametrize(["options", "error"], [
+    ({"foo": 1}, InputError),
+    ({"prescreen": True}, ArgumentsError),
+    ({"res_init": "abc"}, ArgumentsError),
+    ({"hklin_unmerged": "missing.HKL"}, ArgumentsError),
+    ({"scratch": "missing_scratch"}, ArgumentsError)])
+def test_make_config_errors(options, error):
+    with pytest.raises(error):
+        make_config(config("mdm2_1-60A.pdb"), config("mdm2_merged.mtz"),
+                    **options)
+
+
+def test_read_shell_statistics():
+    statistics = read_shell_statistics("A", os.path.dirname(config("")))
+    assert list(statistics)[:2] == [1.9, 1.8]
+    assert statistics[1.9]["Rfree(diff)"] == -0.006
+    assert statistics[1.4]["Rwork(fin)"] == 0.1499
+    assert read_shell_statistics("missing") == {}
+
+
+def test_run_restores_state(tmpcwd):
+    config_run = make_config(config("mdm2_1-60A.pdb"),
+                             config("mdm2_merged.mtz"), res_init=1.6,
+                             res_shells="1.7,1.6", project="api")
+    stdout = sys.stdout
+    settings["pdbORmmcif"] = "foo"
+    warning_dict["foo"] = "WARNING: foo"
+    try:
+        # Shells are not valid (or CCTBX is not available here)
+        with pytest.raises(PairefError):
+            run(config_run, workdir="work")
+        assert os.getcwd() == tmpcwd
+        assert sys.stdout is stdout
+        assert settings["pdbORmmcif"] == "foo"
+        assert list(warning_dict) == ["foo"]
+        assert config_run.project == "api"
+        assert not hasattr(config_run, "workdir")
+    finally:
+        settings.pop("pdbORmmcif")
+        warning_dict.clear()
+
+
+def test_run_pairef_errors(tmpcwd, capsys):
+    with pytest.raises(SystemExit) as e:
+        run_pairef(["pairef", "prepare-shards",
+                    "--XYZIN", config("mdm2_1-60A.pdb"),
+                    "--HKLIN", config("mdm2_merged.mtz")])
+    assert e.value.code == 1
+    assert capsys.readouterr().err == \
+        "ERROR: Only complete cross-validation (option --complete) can be " \
+        "split into shards.\nAborting.\n"
+    with pytest.raises(SystemExit) as e:
+        run_pairef(["pairef", "prepare-shards", "--complete", "--plan",
+                    "--XYZIN", config("mdm2_1-60A.pdb"),
+                    "--HKLIN", config("mdm2_merged.mtz")])
+    assert e.value.code == 1
+    assert capsys.readouterr().err == \
+        "ERROR: The option --plan cannot be used with the command " \
+        "prepare-shards.\nAborting.\n"
+    with pytest.raises(SystemExit) as e:
+        run_pairef(["pairef", "--XYZIN", config("mdm2_1-60A.pdb")])
+    assert e.value.code == 2
+    assert capsys.readouterr().err.startswith("error: ")
@@ -0,0 +1,71 @@
+import pytest
+import os
+import sys
+from helper import write, read
+import pairef.artefacts
+from pairef.artefacts import link_or_copy, file_hash, same_content
+from pairef.commons import try_symlink
+
+
+def test_link_or_copy(tmpcwd):
+    write("data.mtz")
+    os.makedirs("workdir")
+    dst = link_or_copy("data.mtz", "workdir")
+    assert dst == os.path.join("workdir", "data.mtz")
+    assert read(dst) == "content\n"
+    assert os.stat(dst).st_mtime == os.stat("data.mtz").st_mtime
+    # An existing file is replaced
+    write("other.mtz", "other\n")
+    link_or_copy("other.mtz", dst)
+    assert read(dst) == "other\n"
+    assert read("data.mtz") == "content\n"
+    assert link_or_copy("other.mtz", dst) == dst  # the same file already
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="symlinks")
+def test_link_or_copy_symlink(tmpcwd):
+    os.makedirs("inputs")
+    write("inputs/model.pdb")
+    os.symlink("model.pdb", "inputs/link.pdb")
+    os.makedirs("workdir")
+    dst = link_or_copy("inputs/link.pdb", "workdir")
+    assert not os.path.islink(dst)
+    assert read(dst) == "content\n"
+
+
+def test_link_or_copy_fallback(tmpcwd, monkeypatch):
+    def link(src, dst):
+        raise OSError(18, "Invalid cross-device link")
+    monkeypatch.setattr(pairef.artefacts, "reflink", lambda src, dst: False)
+    monkeypatch.setattr(os, "link", link)
+    write("model.pdb")
+    link_or_copy("model.pdb", "copy.pdb")
+    assert read("copy.pdb") == "content\n"
+    write("copy.pdb", "changed\n")
+    assert read("model.pdb") == "content\n"
+
+
+def test_same_content(tmpcwd):
+    write("a.csv", "1\n")
+    write("b.csv", "1\n")
+    write("c.csv", "2\n")
+    write("d.csv", "22\n")
+    os.utime("a.csv", (1000, 1000))
+    os.utime("b.csv", (2000, 2000))
+    os.utime("c.csv", (3000, 3000))
+    assert same_content("a.csv", "a.csv")
+    assert same_content("a.csv", "b.csv")
+    assert not same_content("a.csv", "c.csv")
+    assert not same_content("a.csv", "d.csv")
+    assert file_hash("a.csv") == file_hash("b.csv")
+    # The hash is computed again when the file changes
+    write("b.csv", "3\n")
+    os.utime("b.csv", (4000, 4000))
+    assert not same_content("a.csv", "b.csv")
+
+
+def test_try_symlink(tmpcwd):
+    write("p_R00_R-values.csv")
+    assert try_symlink("p_R00_R-values.csv", "p_R-values.csv")
+    assert read("p_R-values.csv") == "content\n"
+    assert try_symlink("p_R00_R-values.csv", "p_R-values.csv")
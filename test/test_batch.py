@@ -0,0 +1,77 @@
+import pytest
+import os
+from helper import config
+from pairef.batch import read_manifest, run_batch, write_batch_summary
+from pairef.launcher import write_summary
+from pairef.commons import InputError
+
+
+def write_manifest(lines):
+    with open("manifest.txt", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return "manifest.txt"
+
+
+def test_read_manifest(tmpcwd):
+    inputs = "--XYZIN " + config("mdm2_1-60A.pdb") + " --HKLIN " + \
+        config("mdm2_merged.mtz")
+    entries = read_manifest(write_manifest([
+        "# dataset from the first crystal", "",
+        inputs + " -i 1.6 -p first",
+        inputs + " -i 1.6 --nproc 3"]))
+    assert [entry["line"] for entry in entries] == [3, 4]
+    assert [entry["project"] for entry in entries] == ["first", "mdm2_1-60A"]
+    assert entries[1]["arguments"][-2:] == ["-p", "mdm2_1-60A"]
+    assert [entry["nproc"] for entry in entries] == [None, 3]
+
+
+@pytest.mark.parametrize("lines", [
+    ["-p first"],
+    [" -p same", " -p same"],
+    []])
+def test_read_manifest_errors(tmpcwd, lines):
+    inputs = "--XYZIN " + config("mdm2_1-60A.pdb") + " --HKLIN " + \
+        config("mdm2_merged.mtz")
+    if lines and lines[0] != "-p first":
+        lines = [inputs + line for line in lines]
+    with pytest.raises(InputError):
+        read_manifest(write_manifest(lines))
+
+
+def test_read_manifest_existing_workdir(tmpcwd):
+    os.makedirs("pairef_first")
+    with pytest.raises(InputError):
+        read_manifest(write_manifest([
+            "--XYZIN " + config("mdm2_1-60A.pdb") + " --HKLIN " +
+            config("mdm2_merged.mtz") + " -p first"]))
+
+
+def test_write_batch_summary(tmpcwd):
+    os.makedirs("pairef_first")
+    os.chdir("pairef_first")
+    write_summary("first", [1.6, 1.5, 1.4], [0], (1.5, 1.4))
+    os.chdir(tmpcwd)
+    entries = [{"project": "first", "returncode": 0, "wall": 12.3},
+               {"project": "second", "returncode": 1, "wall": 1.0}]
+    rows = write_batch_summary(entries)
+    assert rows == [("first", "finished", "1.50", "1.40", "12"),
+                    ("second", "failed", "N/A", "N/A", "1")]
+    with open("PAIREF_batch_summary.csv", "r") as f:
+        lines = f.readlines()
+    assert lines[0].startswith("# project")
+    assert lines[2].split() == ["second", "failed", "N/A", "N/A", "1"]
+
+
+def test_run_batch(tmpcwd):
+    # A run with a non-existing input file fails immediately
+    entries = [{"project": "p" + str(i), "nproc": None,
+                "arguments": ["--XYZIN", "missing.pdb", "--HKLIN",
+                              "missing.mtz", "-p", "p" + str(i)],
+                "hklin": config("mdm2_merged.mtz"),
+                "xyzin": config("mdm2_1-60A.pdb")} for i in range(3)]
+    run_batch(entries, n_cores=2)
+    for entry in entries:
+        assert entry["returncode"] != 0
+        assert entry["cost"] > 0
+        with open("PAIREF_batch_" + entry["project"] + ".log", "r") as f:
+            assert "missing.pdb" in f.read()
@@ -0,0 +1,175 @@
+"""Benchmarks of PAIREF using a stand-in refinement program (see
+fake_engine.py), so neither CCP4 nor PHENIX is needed.
+
+The benchmarks are run only if the environment variable PAIREF_BENCHMARK
+is set, e.g.:
+
+    PAIREF_BENCHMARK=1 python -m pytest -s test/test_benchmark.py
+
+The whole protocol is run by :func:`pairef.api.run` with phenix.refine (a
+run with REFMAC5 would require also other programs of CCP4 - baverage,
+mtzdump and sfcheck) and it requires Python from CCTBX. The size of the
+problem is controlled by the environment variables PAIREF_BENCHMARK_SHELLS
+(number of high resolution shells, default 3), PAIREF_BENCHMARK_NCYC
+(cycles, 5), PAIREF_BENCHMARK_CORES (cores of the parallel run, 4) and
+PAIREF_FAKE_DELAY (seconds per cycle of the fake program, 0.02). Results
+are printed and, if PAIREF_BENCHMARK_OUTPUT is set, saved in that JSON file
+so that runs of different versions can be compared.
+"""
+import pytest
+import json
+import os
+import shutil
+import tempfile
+import time
+from helper import config
+import fake_engine
+from pairef.api import make_config, run
+from pairef.commons import extract_from_file
+from pairef.progress import CycleMonitor
+from pairef.refinement import collect_stat_overall_refmac
+from pairef.reflections import read_mtz_header, mtz_column_summary
+from pairef.graphs import matplotlib_line
+
+
+N_SHELLS = int(os.environ.get("PAIREF_BENCHMARK_SHELLS", 3))
+NCYC = int(os.environ.get("PAIREF_BENCHMARK_NCYC", 5))
+N_CORES = int(os.environ.get("PAIREF_BENCHMARK_CORES", 4))
+DELAY = float(os.environ.get("PAIREF_FAKE_DELAY", 0.02))
+RES_INIT = 1.6
+results = {}
+
+benchmark = pytest.mark.skipif(not os.environ.get("PAIREF_BENCHMARK"),
+                               reason="set PAIREF_BENCHMARK to run the "
+                               "benchmarks")
+
+
+@pytest.fixture
+def fake_environ():
+    """Temporary working directory with the fake programs in PATH."""
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    try:
+        os.chdir(tmpdir)
+        bindir = fake_engine.install(os.path.join(tmpdir, "bin"))
+        os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+        os.environ["PAIREF_FAKE_DELAY"] = str(DELAY)
+        yield tmpdir
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(tmpdir)
+
+
+def report(name, **values):
+    results[name] = values
+    print("\n" + name + ": " + ", ".join(
+        key + " = " + ("%.4g" % value if isinstance(value, float)
+                       else str(value))
+        for key, value in sorted(values.items())))
+    if os.environ.get("PAIREF_BENCHMARK_OUTPUT"):
+        with open(os.environ["PAIREF_BENCHMARK_OUTPUT"], "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+
+def paired_refinement(name, n_cores, **options):
+    """Runs the whole protocol in the working directory `name` and returns
+    the wall-clock time, the number of refinement jobs and the time the
+    jobs were running (summed up over the jobs)."""
+    shells = ",".join("%.2f" % (RES_INIT - 0.05 * (i + 1))
+                      for i in range(N_SHELLS))
+    run_config = make_config(config("mdm2_1-60A.pdb"),
+                             config("mdm2_merged.mtz"), project="bench",
+                             phenix=True, res_init=RES_INIT,
+                             res_shells=shells, ncyc=NCYC, nproc=n_cores,
+                             threads=1, **options)
+    start = time.time()
+    run_results = run(run_config, workdir=name)
+    wall = time.time() - start
+    assert run_results.shells[-1] == pytest.approx(RES_INIT - 0.05 * N_SHELLS)
+    with open(os.path.join(run_results.workdir, "bench_profile.json"),
+              "r") as f:
+        programs = [event for event in json.load(f)["events"]
+                    if event["category"] == "program"]
+    return wall, len(programs), sum(event["wall"] for event in programs)
+
+
+@benchmark
+def test_benchmark_protocol(fake_environ):
+    """Overhead of PAIREF around the refinement program."""
+    pytest.importorskip("cctbx")  # the protocol requires Python from CCTBX
+    wall, n_jobs, busy = paired_refinement("protocol", 1)
+    report("protocol", jobs=n_jobs, wall=wall,
+           overhead_per_job=(wall - busy) / n_jobs)
+
+
+@benchmark
+def test_benchmark_complete_cross_validation(fake_environ):
+    """Scaling of the complete cross-validation with the number of cores."""
+    pytest.importorskip("cctbx")  # the protocol requires Python from CCTBX
+    walls = {}
+    for n_cores in sorted(set([1, N_CORES])):
+        walls[n_cores], n_jobs, busy = paired_refinement(
+            "complete_" + str(n_cores), n_cores,
+            complete_cross_validation=True, no_modification=True)
+    report("complete_cross_validation", jobs=n_jobs, wall_1_core=walls[1],
+           wall_n_cores=walls[N_CORES], speedup=walls[1] / walls[N_CORES],
+           overhead_per_job=(walls[1] - busy) / n_jobs)
+
+
+@benchmark
+def test_benchmark_parsers(fake_environ):
+    """Throughput of parsing of logs and MTZ files."""
+    logfilename = config("lysozyme_1-40A.log")
+    with open(logfilename, "r") as f:
+        lines = f.readlines()
+    repeat = 20
+    start = time.time()
+    for _ in range(repeat):
+        monitor = CycleMonitor("bench_parser", "refmac")
+        for line in lines:
+            monitor(line)
+    monitor_time = (time.time() - start) / repeat
+    assert monitor.final
+    start = time.time()
+    for _ in range(repeat):
+        collect_stat_overall_refmac(logfilename)
+        extract_from_file(logfilename, "  version", 0, 1, nth_word=5,
+                          get_first=True)
+    extract_time = (time.time() - start) / repeat
+    start = time.time()
+    for _ in range(repeat):
+        header = read_mtz_header(config("mdm2_merged.mtz"))
+        mtz_column_summary(config("mdm2_merged.mtz"), header=header)
+    mtz_time = (time.time() - start) / repeat
+    report("parsers", log_lines=len(lines),
+           monitor_lines_per_s=len(lines) / monitor_time,
+           extract_from_file_s=extract_time,
+           mtz_summary_s=mtz_time)
+
+
+@benchmark
+def test_benchmark_plotting(fake_environ):
+    """Throughput of plotting of binned statistics."""
+    n_bins = 10
+    shells = [round(RES_INIT - 0.05 * i, 2) for i in range(N_SHELLS + 1)]
+    for shell in shells:
+        with open("bench_R00_" + ("%.2f" % shell).replace(".", "-") +
+                  "A.csv", "w") as f:
+            f.write("# Statistics of refined structure model\n#\n")
+            for k in range(n_bins):
+                f.write("%02d %8.2f - %.2f %8d %8d %8.4f %8.4f %8.4f "
+                        "%8.4f\n" % (k + 1, 40.0 / (k + 1), 40.0 / (k + 2),
+                                     1000 + 10 * k, 50 + k, 0.2 + 0.01 * k,
+                                     0.25 + 0.01 * k, 0.9 - 0.02 * k,
+                                     0.88 - 0.02 * k))
+    start = time.time()
+    for statistics in (["Rwork"], ["Rfree"]):
+        matplotlib_line(shells=shells, project="bench",
+                        statistics=statistics, n_bins_low=n_bins,
+                        title=statistics[0], filename_suffix=statistics[0])
+    report("plotting", shells=len(shells), bins=n_bins,
+           seconds_per_plot=(time.time() - start) / 2)
+    assert os.path.isfile("bench_Rfree.png")
@@ -5,6 +5,7 @@ import os
 import tempfile
 import shutil
 from pairef.commons import twodec, twodecname, fourdec, extract_from_file
+from pairef.commons import StatisticsError
 from helper import run, config
 
 
@@ -122,3 +123,15 @@ def test_extract_from_file(filename, searched, skip_lines, n_lines,
                              get_first=get_first)
     if returncode == 0:
         assert "".join(text) == text_test
+
+
+@pytest.mark.parametrize(["filename", "searched", "nth_word"],
+                         [(filename_fake, searched_stats, False),
+                          (filename, "foooooo", False),
+                          (filename, searched_Rfree, 999)],
+                         ids=["file_not_found", "searched_not_found",
+                              "index_error"])
+def test_extract_from_file_stop(filename, searched, nth_word):
+    with pytest.raises(StatisticsError):
+        extract_from_file(filename=filename, searched=searched,
+                          skip_lines=0, n_lines=1, nth_word=nth_word)
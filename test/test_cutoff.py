@@ -0,0 +1,135 @@
+import pytest
+import json
+import os
+import shutil
+import tempfile
+from pairef.commons import InputError
+from pairef.cutoff import TableReader, CutoffEngine, recut, recut_command
+from pairef.cutoff import read_summary
+from pairef.launcher import write_summary
+
+SHELLS = [1.8, 1.7, 1.6, 1.5]
+
+
+@pytest.fixture
+def workdir():
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+        write_run()
+        yield tmpdir
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def write(filename, lines, mode="w"):
+    with open(filename, mode) as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_run():
+    write("p_R-values.csv", [
+        "# Shell      Rwork(init) Rwork(fin) Rwork(diff)   Rfree(init) "
+        "Rfree(fin) Rfree(diff)",
+        "1.80A->1.70A      0.1669     0.1718        0.0049      0.2055     "
+        "0.2044     -0.0011",
+        "1.70A->1.60A      0.1718     0.1762        0.0044      0.2044     "
+        "0.2062      0.0018",
+        "1.60A->1.50A      0.1762     0.1803        0.0041      0.2062     "
+        "0.2093      0.0031"])
+    write("p_Rgap.csv", [
+        "# Resolution   Rwork   Rfree   Rfree-Rwork",
+        "1.80          0.1669   0.2055   0.0386",
+        "1.70          0.1718   0.2044   0.0326",
+        "1.60          0.1762   0.2062   0.0300",
+        "1.50          0.1803   0.2093   0.0290"])
+    for shell, Rfree in zip(SHELLS[1:], ["0.3100", "0.4300", "0.4700"]):
+        write("p_R00_" + str(shell).replace(".", "-") + "0A.csv", [
+            "#Shell Res_low - Res_hig      Nwork    Nfree  Rwork    Rfree   "
+            "CCwork  CCfree",
+            "01        44.72 - 5.63         1104     37     0.21     0.16     "
+            "0.9207     0.9230",
+            "02        1.80 - " + str(shell) + "0         5781     289     "
+            "0.2900     " + Rfree + "     0.8881     0.8757"])
+    write_summary("p", SHELLS, [0], (1.7, 1.7), n_bins_low=1, flag=0,
+                  complete_cross_validation=False)
+
+
+def test_table_reader(workdir):
+    reader = TableReader("p_Rgap.csv")
+    assert [row[0] for row in reader.read()] == ["1.80", "1.70", "1.60",
+                                                 "1.50"]
+    offset = reader.offset
+    with open("p_Rgap.csv", "a") as f:
+        f.write("1.40          0.18   0.21   0.03\n1.30")  # incomplete line
+    assert len(reader.read()) == 5
+    assert reader.offset == offset + len("1.40          0.18   0.21   0.03\n")
+    # A rewritten file is read from the beginning
+    write("p_Rgap.csv", ["# Resolution   Rwork   Rfree   Rfree-Rwork",
+                         "2.00          0.1   0.2   0.1"])
+    assert reader.read() == [["2.00", "0.1", "0.2", "0.1"]]
+    os.remove("p_Rgap.csv")
+    assert reader.read() == []
+
+
+def test_engine(workdir):
+    engine = CutoffEngine("p", 1, 0)
+    cutoff, accepted, reason = engine.suggest(SHELLS[:2])
+    assert cutoff == [1.7, 1.7]
+    assert accepted == [[True, True]]
+    assert reason == [["Overall Rfree decreased while using data in the "
+                       "shell 1.80-1.70 A"]]
+    cutoff, accepted, reason = engine.suggest(SHELLS)
+    assert cutoff == [1.7, 1.7]
+    assert accepted == [[True, True], [False, False], [False, False]]
+    assert reason[1] == ["Rfree in high resolution is higher than 0.40 while "
+                         "using data in the shell 1.70-1.60 A",
+                         "Overall Rfree increased while using data in the "
+                         "shell 1.70-1.60 A"]
+    assert reason[2][0].startswith("But statistics deteriorate")
+    # Only new or changed shells are rated again
+    calls = []
+    rate = engine._rate
+    engine._rate = lambda *args: calls.append(args) or rate(*args)
+    assert engine.suggest(SHELLS)[1] == accepted
+    assert calls == []
+
+
+def test_recut(workdir):
+    assert recut(workdir)[0] == [1.7, 1.7]
+    cutoff, accepted, reason = recut(workdir, {"r_shell_warn": 0.44,
+                                               "rfree_constant": 0.002})
+    assert cutoff == [1.6, 1.6]
+    assert accepted == [[True, True], [True, True], [False, False]]
+    with pytest.raises(InputError):
+        recut(workdir, {"foo": 1})
+
+
+def test_recut_command(workdir, capsys):
+    recut_command(["recut", workdir, "--r-shell-max", "0.5",
+                   "--r-shell-warn", "0.5", "--rfree-constant", "0.004"])
+    out = capsys.readouterr()[0]
+    assert "1.60-1.50 A: accepted (strict), accepted (benevolent)" in out
+    assert out.endswith("Suggested cutoff: \n1.50 A\n")
+
+
+def test_read_summary(workdir):
+    with open("PAIREF_p_summary.json", "r") as f:
+        summary = json.load(f)
+    del summary["n_bins_low"], summary["flag"]
+    del summary["complete_cross_validation"]
+    with open("PAIREF_p_summary.json", "w") as f:
+        json.dump(summary, f)
+    summary = read_summary(workdir)
+    assert summary["flag"] == 0
+    assert summary["n_bins_low"] == 0
+    assert not summary["complete_cross_validation"]
+    os.makedirs("empty")
+    with pytest.raises(InputError):
+        read_summary("empty")
+    shutil.copy2("PAIREF_p_summary.json", "PAIREF_q_summary.json")
+    with pytest.raises(InputError):
+        read_summary(workdir)
+    assert read_summary(workdir, "q")["project"] == "p"
@@ -0,0 +1,36 @@
+import pytest
+import os
+import subprocess
+import sys
+
+HEAVY = ("numpy", "matplotlib", "cctbx", "iotbx", "mmtbx", "PyQt4",
+         "PySide2")
+SCRIPT = """
+import sys
+from pairef.launcher import run_pairef
+try:
+    run_pairef(["pairef"] + sys.argv[1:])
+except SystemExit:
+    pass
+heavy = [m for m in {heavy!r} if m in sys.modules]
+sys.stderr.write("HEAVY " + " ".join(heavy) + "\\n")
+"""
+
+
+@pytest.mark.parametrize("arguments", [
+    ["-h"], ["--version"], ["--XYZIN", "missing.pdb"], ["merge", "missing"],
+    ["recut", "missing"]],
+    ids=["help", "version", "argument_error", "subcommand_error",
+         "recut_error"])
+def test_no_heavy_imports(arguments):
+    # Help, version and argument errors must not wait for NumPy, matplotlib,
+    # CCTBX or Qt
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(
+        os.path.realpath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, "-c", SCRIPT.format(heavy=HEAVY)] + arguments,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, env=env)
+    stderr = process.communicate()[1]
+    assert "HEAVY \n" in stderr
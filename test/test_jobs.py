@@ -0,0 +1,202 @@
+import pytest
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pairef.jobs import JobRunner, JobError, cpu_count, job_runner
+from pairef.refinement import run_refinement_job, default_ncyc
+from pairef.commons import print_my
+
+
+def test_cpu_count():
+    assert cpu_count() >= 1
+
+
+@pytest.mark.parametrize(["n_cores", "threads", "n_slots"],
+                         [(8, 2, 4), (8, 3, 2), (4, 8, 1), (1, None, 1)])
+def test_n_slots(n_cores, threads, n_slots):
+    runner = JobRunner(n_cores, threads)
+    assert runner.n_slots == n_slots
+    assert runner.threads <= runner.n_cores
+
+
+def test_run_sets_threads():
+    runner = JobRunner(4, 2)
+    command = [sys.executable, "-c",
+               "import os, sys; print(os.environ['OMP_NUM_THREADS']); "
+               "print(sys.stdin.read().strip())"]
+    output, err, returncode = runner.run(command, com="keyword\n",
+                                         stdout=subprocess.PIPE)
+    assert returncode == 0
+    assert output.split() == ["2", "keyword"]
+    assert runner.n_cores_free == 4
+
+
+def test_map_keeps_order_and_core_budget():
+    runner = JobRunner(4, 2)
+    running = []
+    lock = threading.Lock()
+
+    def job(item):
+        threads = runner.acquire()
+        with lock:
+            running.append(runner.n_cores - runner.n_cores_free)
+        time.sleep(0.01)
+        runner.release(threads)
+        return item * 2
+
+    assert runner.map(job, range(10)) == [2 * i for i in range(10)]
+    assert max(running) <= 4
+    assert runner.n_cores_free == 4
+
+
+def test_pool_shared_by_runners():
+    pool = JobRunner(4, 1)
+    runners = [JobRunner(2, 2, pool=pool), JobRunner(1, 1, pool=pool)]
+    runners[0].configure(2, 2)  # does not change the pool
+    assert runners[0].n_slots == 2
+    assert runners[1].n_slots == 4
+    assert runners[0].acquire() == 2
+    assert runners[1].acquire() == 1
+    assert pool.n_cores_free == 1
+    runners[0].release(2)
+    runners[1].release(1)
+    assert pool.n_cores_free == 4
+
+
+def test_map_raises_system_exit():
+    runner = JobRunner(4, 1)
+
+    def job(item):
+        if item == 3:
+            sys.exit(1)
+        return item
+
+    with pytest.raises(SystemExit):
+        runner.map(job, range(6))
+
+
+def test_map_catch():
+    runner = JobRunner(4, 1)
+
+    def job(item):
+        if item % 2:
+            raise JobError("odd")
+        return item
+
+    results = runner.map(job, range(4), catch=JobError)
+    assert results[0::2] == [0, 2]
+    assert all(isinstance(result, JobError) for result in results[1::2])
+
+
+def test_map_output(capsys):
+    runner = JobRunner(4, 1)
+
+    def job(item):
+        time.sleep(0.01 * (4 - item))
+        print_my("Item " + str(item) + ":", end="")
+        time.sleep(0.01)
+        print_my(" done")
+        return item
+
+    assert runner.map(job, range(4)) == [0, 1, 2, 3]
+    assert capsys.readouterr().out == \
+        "".join("Item " + str(i) + ": done\n" for i in range(4))
+
+
+def test_default_ncyc():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        comin = os.path.join(tmpdir, "keywords.com")
+        with open(comin, "w") as f:
+            f.write("weight auto\n")
+        args = argparse.Namespace(ncyc=None, comin=comin, defin=None)
+        assert default_ncyc(args, "refmac") == 20
+        args.ncyc = 5
+        assert default_ncyc(args, "refmac") is None
+        with open(comin, "w") as f:
+            f.write("NCYC 8\n")
+        args.ncyc = None
+        assert default_ncyc(args, "refmac") is None
+        args = argparse.Namespace(ncyc=None, comin=None, defin=comin)
+        assert default_ncyc(args, "phenix") == 3
+        args = argparse.Namespace(ncyc=None, comin=None, defin=None)
+        assert default_ncyc(args, "refmac") is None
+        assert default_ncyc(args, "phenix") is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_run_timeout():
+    runner = JobRunner(1, timeout=0.5)
+    start = time.time()
+    with pytest.raises(JobError):
+        runner.run([sys.executable, "-c", "import time; time.sleep(30)"])
+    assert time.time() - start < 10
+    assert runner.n_cores_free == 1
+
+
+def test_run_stall_timeout():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        log = os.path.join(tmpdir, "job.log")
+        runner = JobRunner(1, stall_timeout=1.5)
+        with open(log, "w") as logfile:
+            with pytest.raises(JobError) as e:
+                runner.run([sys.executable, "-u", "-c",
+                            "import time; print('cycle 1'); time.sleep(30)"],
+                           stdout=logfile, watch=log)
+        assert "has not grown" in str(e.value)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_run_on_line():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        log = os.path.join(tmpdir, "job.log")
+        lines = []
+        runner = JobRunner(1, stall_timeout=30)
+        with open(log, "w") as logfile:
+            output, err, returncode = runner.run(
+                [sys.executable, "-c",
+                 "import sys; print(sys.stdin.read().strip()); "
+                 "sys.stderr.write('error\\n'); print('cycle 2')"],
+                com="cycle 1\n", stdout=logfile, stderr=logfile,
+                watch=log, on_line=lines.append)
+        assert returncode == 0
+        assert "cycle 1\n" in lines and "cycle 2\n" in lines
+        with open(log, "r") as logfile:
+            assert sorted(logfile.readlines()) == sorted(lines)
+        assert len(lines) == 3
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_run_refinement_job_retry():
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    retries = job_runner.retries
+    try:
+        os.chdir(tmpdir)
+        job_runner.retries = 1
+        # The first run fails (no output), the second one succeeds
+        command = [sys.executable, "-c",
+                   "import os\n"
+                   "if os.path.isfile('attempt'): open('out.mtz', 'w')\n"
+                   "open('attempt', 'w')"]
+        assert run_refinement_job(command, "job.log",
+                                  ["job.log", "out.mtz"]) == []
+        os.remove("out.mtz")
+        os.remove("attempt")
+        job_runner.retries = 0
+        assert run_refinement_job(command, "job.log",
+                                  ["job.log", "out.mtz"]) == ["out.mtz"]
+    finally:
+        job_runner.retries = retries
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,75 @@
+import os
+from helper import write
+from pairef.memo import memo_key, memoized, current_memo, StatisticsMemo
+from pairef.memo import MEMO_FILENAME
+from pairef.settings import RunContext
+
+
+def test_memo_key():
+    assert memo_key("CC", "dir/p_R00_1-70A.mtz", "/data/p.mtz", 0) == \
+        "CC|p_R00_1-70A.mtz|p.mtz|0|-|-"
+    assert memo_key("CC", "m.mtz", "p.mtz", 1, 999, 1.8) == \
+        "CC|m.mtz|p.mtz|1|999.0000|1.8000"
+    assert memo_key("R", "m_001.mtz") == "R|m_001.mtz|-|-|-|-"
+
+
+def test_memoized(tmpcwd):
+    write("model.mtz")
+    write("data.mtz")
+    calls = []
+
+    def calculate(value):
+        calls.append(value)
+        return value, value + 1
+
+    with RunContext():
+        key = memo_key("CC", "model.mtz", "data.mtz", 0)
+        files = ["model.mtz", "data.mtz"]
+        assert memoized(key, files, calculate, 1) == (1, 2)
+        assert memoized(key, files, calculate, 5) == (1, 2)
+        assert calls == [1]
+        # Another resolution range
+        key_range = memo_key("CC", "model.mtz", "data.mtz", 0, res_high=1.8)
+        assert memoized(key_range, files, calculate, 3) == (3, 4)
+        assert calls == [1, 3]
+    # Values are saved alongside the results of the run
+    assert os.path.isfile(MEMO_FILENAME)
+    with RunContext():
+        assert memoized(key, files, calculate, 7) == (1, 2)
+        assert calls == [1, 3]
+        # Model has been rewritten
+        write("model.mtz", "another model\n")
+        assert memoized(key, files, calculate, 7) == (7, 8)
+        assert calls == [1, 3, 7]
+
+
+def test_memoized_not_available(tmpcwd):
+    write("model.mtz")
+    calls = []
+
+    def calculate():
+        calls.append(True)
+        return "N/A", "N/A"
+
+    with RunContext():
+        key = memo_key("R", "model.mtz")
+        assert memoized(key, ["model.mtz"], calculate) == ("N/A", "N/A")
+        assert memoized(key, ["model.mtz"], calculate) == ("N/A", "N/A")
+        assert len(calls) == 2
+
+
+def test_memo_merge(tmpcwd):
+    write("a.mtz")
+    write("b.mtz")
+    with RunContext():
+        memo = current_memo()
+        memo.put("a", ["a.mtz"], [0.1, 0.2])
+        # Another process (e.g. a shard) saves its value meanwhile
+        other = StatisticsMemo()
+        other.put("b", ["b.mtz"], [0.3, 0.4])
+        memo.put("c", ["a.mtz"], [0.5, 0.6])
+    saved = StatisticsMemo()
+    assert saved.get("a", ["a.mtz"]) == [0.1, 0.2]
+    assert saved.get("b", ["b.mtz"]) == [0.3, 0.4]
+    assert saved.get("c", ["a.mtz"]) == [0.5, 0.6]
+    assert saved.get("c", ["b.mtz"]) is None
@@ -0,0 +1,143 @@
+import pytest
+import json
+import os
+import shutil
+import tempfile
+from helper import config
+from pairef.launcher import process_arguments
+from pairef.planning import keywords_ncyc, count_atoms, reflection_curve
+from pairef.planning import n_reflections, describe_data, plan_jobs
+from pairef.planning import CostModel, DEFAULT_COSTS, estimate, plan
+
+
+def make_args(*options):
+    return process_arguments(["pairef", "--HKLIN", config("mdm2_merged.mtz"),
+                              "--XYZIN", config("mdm2_1-60A.pdb"),
+                              "-p", "plan"] + list(options))
+
+
+@pytest.mark.parametrize("com, refinement, expected", [
+    ("make hydr Y\n ncyc 5\n NCYC 7\n", "refmac", 7),
+    ("make hydr Y\n", "refmac", None),
+    ("refinement.main.number_of_macro_cycles=1\n"
+     "refinement.main.number_of_macro_cycles = 4", "phenix", 4)])
+def test_keywords_ncyc(com, refinement, expected):
+    assert keywords_ncyc(com, refinement) == expected
+
+
+def test_reflection_curve():
+    d = [float(i) for i in range(1, 1001)]
+    curve = reflection_curve(d, n_points=11)
+    assert curve[0] == [1.0, 1000]
+    assert curve[-1] == [1000.0, 1]
+    assert n_reflections(curve, 1.0) == 1000
+    assert n_reflections(curve, 500.5) == pytest.approx(500.5, abs=1)
+    assert n_reflections(curve, 1.0, 500.5) == pytest.approx(499.5, abs=1)
+    assert n_reflections(curve, 2000.0) == 0
+    assert n_reflections([], 1.0) == 0
+
+
+def test_describe_data():
+    curve, n_atoms = describe_data(config("mdm2_merged.mtz"),
+                                   config("mdm2_1-60A.pdb"))
+    assert n_atoms == count_atoms(config("mdm2_1-60A.pdb")) > 0
+    assert curve[0][1] > curve[-1][1] > 0
+    assert curve[0][0] < curve[-1][0]
+
+
+@pytest.mark.parametrize("options, n_jobs", [
+    ([], 1 + 1 + 3 * (4 + 1) + 0 + 1 + 2),
+    (["--complete", "--ncyc", "7"], 3 + 3 * 3 * 3)])
+def test_plan_jobs(options, n_jobs):
+    args = make_args(*options)
+    flag_sets = [0, 1, 2] if args.complete_cross_validation else [0]
+    stages = plan_jobs(args, [1.6, 1.5, 1.4, 1.3], flag_sets, "refmac",
+                       sfcheck=True)
+    assert len(stages) == 4
+    assert sum(len(jobs) for stage in stages
+               for jobs in stage["jobs"].values()) == n_jobs
+    refine = stages[1]["jobs"][0][0]
+    assert refine["kind"] == "refine" and refine["res_high"] == 1.5
+    if args.complete_cross_validation:
+        assert refine["ncyc"] == 7
+        assert stages[0]["jobs"][0][0]["ncyc"] == 7
+    else:
+        assert refine["ncyc"] == 20
+        assert stages[0]["jobs"][0][0]["ncyc"] == 0
+        assert stages[3]["jobs"][0][-2]["res_low"] == 1.4
+
+
+def test_calibrate():
+    curve = [[1.0, 10000], [2.0, 5000], [4.0, 1000], [50.0, 1]]
+    events = []
+    for res_high, ncyc in ((1.0, 10), (2.0, 10), (1.0, 0)):
+        x = n_reflections(curve, res_high) * 100 * (ncyc + 1)
+        events.append({"name": "refmac5", "category": "program",
+                       "wall": 3.0 + 1e-6 * x,
+                       "details": {"kind": "refine", "res_high": res_high,
+                                   "res_low": None, "ncyc": ncyc}})
+    events.append({"name": "sfcheck", "category": "program", "wall": 2.0,
+                   "details": {}})
+    events.append({"name": "graphs", "category": "graphs", "wall": 9.0,
+                   "details": {}})
+    profile = {"metadata": {"refinement": "refmac", "reflections": curve,
+                            "n_atoms": 100}, "events": events}
+    model = CostModel()
+    assert sorted(model.calibrate([profile])) == ["refmac", "sfcheck"]
+    k, t0 = model.costs["refmac"]
+    assert k == pytest.approx(1e-6)
+    assert t0 == pytest.approx(3.0)
+    assert model.costs["sfcheck"] == 2.0
+    job = {"kind": "refine", "program": "REFMAC5", "res_high": 2.0,
+           "res_low": None, "ncyc": 5}
+    assert model.time(job, curve, 200) == pytest.approx(3.0 + 6.0)
+
+
+@pytest.mark.parametrize("name", ["refmac", "phenix"])
+def test_fit_degenerate(name):
+    assert CostModel.fit([(0.0, 40.0), (0.0, 50.0)], name) == \
+        DEFAULT_COSTS[name]
+
+
+def test_estimate():
+    model = CostModel()
+    model.costs["refmac"] = (0.0, 10.0)
+    job = {"kind": "refine", "program": "REFMAC5", "res_high": 2.0,
+           "res_low": None, "ncyc": 5}
+    stages = [{"name": "s", "jobs": {0: [dict(job), dict(job)],
+                                     1: [dict(job)], 2: [dict(job)]}}]
+    total, wall, critical = estimate(stages, model, [], 100, n_slots=2)
+    assert total == 40.0
+    assert critical == 20.0
+    assert wall == 20.0
+    total, wall, critical = estimate(stages, model, [], 100, n_slots=1)
+    assert wall == 40.0
+
+
+def test_plan(capsys):
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+        args = make_args("--ncyc", "5")
+        os.makedirs("pairef_old")
+        curve, n_atoms = describe_data(args.hklin, args.xyzin)
+        with open(os.path.join("pairef_old", "old_profile.json"), "w") as f:
+            json.dump({"metadata": {"refinement": "refmac",
+                                    "reflections": curve,
+                                    "n_atoms": n_atoms},
+                       "events": [{"name": "refmac5", "category": "program",
+                                   "wall": 4.0, "details": {
+                                       "kind": "comp", "res_high": 1.6,
+                                       "res_low": None, "ncyc": 0}}]}, f)
+        total, wall, critical = plan(args, [1.6, 1.5], [0], "refmac",
+                                     sfcheck=False)
+        assert critical == wall == total > 4.0 * 3
+        out = capsys.readouterr().out
+        assert "refine 1.50 A (5 cycles)" in out
+        assert "Number of jobs: 5" in out
+        assert "calibrated" in out
+        assert not os.path.isdir("pairef_plan")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
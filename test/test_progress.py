@@ -0,0 +1,138 @@
+import pytest
+import os
+import shutil
+import tempfile
+from helper import config
+from pairef.progress import CycleMonitor, get_cycles, forget_cycles
+from pairef.progress import read_cycles, converged_ncyc, choose_ncyc
+from pairef.launcher import choose_next_ncyc
+import argparse
+import pairef.launcher
+
+
+def test_cycle_monitor_refmac():
+    monitor = CycleMonitor("test_refmac", "refmac")
+    with open(config("lysozyme_1-40A.log"), "r") as logfile:
+        for line in logfile:
+            monitor(line)
+            if "CGMAT cycle number =      3" in line:
+                # Preliminary values while the job is running
+                assert monitor.labels == ["0", "1"]
+                assert monitor.rwork == [0.2103, 0.2102]
+                assert monitor.rfree == [0.2236, 0.2227]
+                assert get_cycles("test_refmac") is None
+    monitor.finish()
+    labels, rwork, rfree = get_cycles("test_refmac")
+    assert labels[:3] == ["0", "1", "2"]
+    assert rwork[:3] == [0.2103, 0.2102, 0.2099]
+    assert rfree[:3] == [0.2236, 0.2227, 0.2223]
+    assert len(labels) == len(rwork) == len(rfree)
+
+
+def test_cycle_monitor_phenix():
+    monitor = CycleMonitor("test_phenix", "phenix")
+    lines = ["Start R-work = 0.2500, R-free = 0.2800\n",
+             "   stage r-work r-free bonds angles b_min b_max b_ave "
+             "n_water shift\n",
+             "      0    : 0.2500 0.2800 0.008  1.1   10.0  80.0  "
+             "30.0   100   0.000\n",
+             "      1_bss: 0.2400 0.2750 0.008  1.1   10.0  80.0  "
+             "30.0   100   0.000\n",
+             "------------------------------------------------------------"
+             "-----------\n"]
+    for line in lines:
+        monitor(line)
+    monitor.finish()
+    labels, rwork, rfree = get_cycles("test_phenix")
+    assert labels == ["0", "1_bss"]
+    assert rwork == [0.25, 0.24]
+    assert rfree == [0.28, 0.275]
+
+
+def test_forget_cycles():
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        monitor = CycleMonitor("test_forget", "phenix")
+        monitor._set_table([("0", 0.25, 0.28)])
+        # Another directory (e.g. another run of the same project)
+        os.chdir(tmpdir)
+        assert get_cycles("test_forget") is None
+        os.chdir(cwd)
+        forget_cycles("test_forget")  # still running
+        assert get_cycles("test_forget") == (["0"], [0.25], [0.28])
+        monitor.finish()
+        forget_cycles("test_forget")
+        assert get_cycles("test_forget") is None
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def test_write_progress_html():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        htmlfilename = os.path.join(tmpdir, "progress.html")
+        monitor = CycleMonitor("test_running", "refmac", htmlfilename)
+        monitor("     CGMAT cycle number =      1\n")
+        monitor("Overall R factor                     =     0.2103\n")
+        monitor("Free R factor                        =     0.2236\n")
+        with open(htmlfilename, "r") as htmlfile:
+            page = htmlfile.read()
+        assert "<td>test_running</td><td>0</td><td>0.2103</td>" \
+            "<td>0.2236</td>" in page
+        monitor.finish()
+        with open(htmlfilename, "r") as htmlfile:
+            assert "test_running" not in htmlfile.read()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@pytest.mark.parametrize(["labels", "rfree", "ncyc"], [
+    (["0", "1", "2", "3", "4"], [0.30, 0.28, 0.2705, 0.2702, 0.2700], 2),
+    (["0", "1", "2", "3"], [0.30, 0.29, 0.28, 0.27], None),
+    (["0", "1"], [0.30, 0.3], 1),
+    (["0"], [0.30], None),
+    (["0", "1_bss", "1_xyz", "1_adp", "2_bss", "2_xyz", "2_adp", "end"],
+     [0.30, 0.29, 0.28, 0.275, 0.2745, 0.2743, 0.2742, 0.2742], 1)])
+def test_converged_ncyc(labels, rfree, ncyc):
+    assert converged_ncyc(labels, rfree) == ncyc
+
+
+def test_choose_ncyc():
+    converged = (["0", "1", "2", "3"], [], [0.30, 0.28, 0.2801, 0.2801])
+    changing = (["0", "1", "2", "3"], [], [0.30, 0.29, 0.28, 0.27])
+    assert choose_ncyc([converged], 20) == 1
+    assert choose_ncyc([converged, changing], 20) == 20
+    assert choose_ncyc([], 3) == 3
+
+
+def test_choose_next_ncyc(monkeypatch, capsys):
+    converged = (["0", "1", "2", "3"], [], [0.30, 0.28, 0.2801, 0.2801])
+    changing = (["0", "1", "2", "3"], [], [0.30, 0.29, 0.28, 0.27])
+    traces = {"p_R00_1-60A": changing, "p_R01_1-60A": converged,
+              "p_R00_1-50A": converged, "p_R01_1-50A": converged,
+              "p_R00_1-40A": None, "p_R01_1-40A": None}
+    monkeypatch.setattr(pairef.launcher, "read_cycles",
+                        lambda prefix, refinement: traces[prefix])
+    args = argparse.Namespace(project="p", ncyc=None, ncyc_max=20,
+                              ncyc_chosen=[])
+    assert choose_next_ncyc(args, 1.6, [0, 1], "refmac") == 20
+    # The step which needed more cycles does not count any more
+    assert choose_next_ncyc(args, 1.5, [0, 1], "refmac") == 1
+    assert choose_next_ncyc(args, 1.4, [0, 1], "refmac") == 20
+    assert args.ncyc_chosen == [(1.6, 20), (1.5, 1), (1.4, 20)]
+    assert not hasattr(args, "ncyc_traces")
+
+
+def test_read_cycles():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        shutil.copy2(config("lysozyme_1-40A.log"),
+                     os.path.join(tmpdir, "lysozyme_1-40A.log"))
+        labels, rwork, rfree = read_cycles(
+            os.path.join(tmpdir, "lysozyme_1-40A"), "refmac")
+        assert labels[0] == "0"
+        assert rfree[:2] == [0.2236, 0.2227]
+    finally:
+        shutil.rmtree(tmpdir)
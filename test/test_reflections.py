@@ -0,0 +1,303 @@
+import pytest
+import os
+import tempfile
+import shutil
+import numpy as np
+from pairef.reflections import xds_ascii_header, iter_xds_ascii
+from pairef.reflections import d_spacings, resolution_range_unmerged
+from pairef.reflections import _hkl_keys, _hkl_from_keys
+from pairef.reflections import _reduce_by_key, _sum_by_key
+from pairef.reflections import read_mtz_header, mtz_column_summary
+from pairef.reflections import mtz_free_flag_sets, mtz_observation_labels
+from pairef.reflections import refinement_mtz_labels, write_mtz_subset
+from pairef.reflections import mtz_memmap, mtz_d_spacings_work_free
+from pairef.reflections import equal_count_shells, mtz_reflection_counts
+from pairef.preparation import res_from_mtz, prescreen_shells, slim_hklin
+from pairef.settings import RunContext
+import pairef.preparation
+from helper import config
+
+
+xds_ascii_lines = [
+    "!FORMAT=XDS_ASCII    MERGE=FALSE    FRIEDEL'S_LAW=TRUE\n",
+    "!SPACE_GROUP_NUMBER=    1\n",
+    "!UNIT_CELL_CONSTANTS=    40.000    50.000    60.000  90.000  90.000  "
+    "90.000\n",
+    "!NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD=5\n",
+    "!ITEM_H=1\n",
+    "!ITEM_K=2\n",
+    "!ITEM_L=3\n",
+    "!ITEM_IOBS=4\n",
+    "!ITEM_SIGMA(IOBS)=5\n",
+    "!END_OF_HEADER\n",
+    "     1     0     0  1.000E+03  1.000E+01\n",
+    "     0     2     0  5.000E+02  1.000E+01\n",
+    "     0     0     3  2.000E+02 -1.000E+00\n",
+    "     1     1     1  3.000E+02  1.000E+01\n",
+    "     0     0    20  1.000E+01  1.000E+00\n",
+    "!END_OF_DATA\n"]
+
+
+@pytest.fixture
+def xds_ascii_file():
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, "XDS_ASCII.HKL")
+    with open(filename, "w") as hklfile:
+        hklfile.writelines(xds_ascii_lines)
+    yield filename
+    shutil.rmtree(tmpdir)
+
+
+def test_xds_ascii_header(xds_ascii_file):
+    header = xds_ascii_header(xds_ascii_file)
+    assert header["space_group_number"] == 1
+    assert header["unit_cell"] == (40, 50, 60, 90, 90, 90)
+    assert header["res_range"] is None
+    assert header["n_items"] == 5
+    assert header["items"]["IOBS"] == 3
+    assert header["items"]["SIGMA(IOBS)"] == 4
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 100])
+def test_iter_xds_ascii(xds_ascii_file, chunk_size):
+    chunks = list(iter_xds_ascii(xds_ascii_file, chunk_size=chunk_size))
+    i_obs = np.concatenate([chunk[3] for chunk in chunks])
+    # The rejected observation (negative sigma) is skipped
+    assert list(i_obs) == [1000, 500, 300, 10]
+    assert max(len(chunk[0]) for chunk in chunks) <= chunk_size
+
+
+def test_d_spacings():
+    d = d_spacings(np.array([1, 0, 0]), np.array([0, 2, 0]),
+                   np.array([0, 0, 3]), (40, 50, 60, 90, 90, 90))
+    assert d == pytest.approx([40, 25, 20])
+
+
+def test_resolution_range_unmerged(xds_ascii_file):
+    res_low, res_high = resolution_range_unmerged(xds_ascii_file,
+                                                  chunk_size=2)
+    assert res_low == pytest.approx(40)
+    assert res_high == pytest.approx(3)
+
+
+def fake_merging_stats(cc_halfs):
+    def merging_stats(filename, bins, completeness=True):
+        return [{"d_max": d_max, "d_min": d_min, "cc_half": cc_half}
+                for (d_max, d_min), cc_half in zip(bins, cc_halfs)]
+    return merging_stats
+
+
+@pytest.mark.parametrize(["cc_halfs", "n_shells", "n_warnings"], [
+    ([0.9, 0.5, 0.2], 4, 0),
+    ([0.9, 0.5, -0.01, None], 3, 2),
+    ([0.9, -0.2, 0.3, 0.0], 4, 1),
+    ([-0.1, None, 0.0], 2, 2)])
+def test_prescreen_shells(xds_ascii_file, monkeypatch, capsys, cc_halfs,
+                          n_shells, n_warnings):
+    monkeypatch.setattr(pairef.preparation, "merging_stats_unmerged",
+                        fake_merging_stats(cc_halfs))
+    shells = [2.0, 1.9, 1.8, 1.7, 1.6][:len(cc_halfs) + 1]
+    with RunContext() as context:
+        assert prescreen_shells(xds_ascii_file, shells) == shells[:n_shells]
+        warnings = context.warning_dict.get("prescreen", "")
+    assert warnings.count("WARNING") == n_warnings
+    assert warnings.count("negative or undefined") == n_warnings
+
+
+def test_prescreen_shells_outside(xds_ascii_file, monkeypatch):
+    monkeypatch.setattr(pairef.preparation, "merging_stats_unmerged",
+                        fake_merging_stats([0.9, 0.5, None]))
+    shells = [2.0, 1.9, 1.8, 1.7]
+    with RunContext() as context:
+        assert prescreen_shells(xds_ascii_file, shells, 40.0, 1.85) == \
+            [2.0, 1.9, 1.8]
+        warnings = context.warning_dict["prescreen"]
+    assert "1.80-1.70 A" in warnings
+    assert "outside the resolution range of the unmerged data " \
+        "(40.00-1.85 A)" in warnings
+    assert "CC1/2" not in warnings
+
+
+@pytest.mark.parametrize("error", [ValueError, IndexError, TypeError])
+def test_prescreen_shells_unreadable(xds_ascii_file, monkeypatch, error):
+    def merging_stats(filename, bins, completeness=True):
+        raise error("no unit cell")
+    monkeypatch.setattr(pairef.preparation, "merging_stats_unmerged",
+                        merging_stats)
+    shells = [2.0, 1.9, 1.8]
+    with RunContext() as context:
+        assert prescreen_shells(xds_ascii_file, shells) == shells
+        assert "could not be read" in context.warning_dict["prescreen"]
+
+
+def test_prescreen_shells_unsupported(monkeypatch):
+    monkeypatch.setattr(pairef.preparation, "merging_stats_unmerged",
+                        fake_merging_stats([None, None]))
+    shells = [2.0, 1.9, 1.8]
+    with RunContext() as context:
+        assert prescreen_shells("data.sca", shells) == shells
+        assert "supported only for XDS_ASCII and unmerged MTZ" in \
+            context.warning_dict["prescreen"]
+
+
+def test_hkl_keys():
+    h, k, l = np.array([-5, 0, 30]), np.array([7, -40, 0]), np.array([0, 1, -2])
+    h_2, k_2, l_2 = _hkl_from_keys(_hkl_keys(h, k, l))
+    assert list(h_2) == list(h)
+    assert list(k_2) == list(k)
+    assert list(l_2) == list(l)
+
+
+def test_sum_by_key():
+    random_state = np.random.RandomState(0)
+    keys = random_state.randint(50, size=1000)
+    values = random_state.rand(2, 1000)
+    chunks = [(keys[i:i + 30], values[:, i:i + 30])
+              for i in range(0, 1000, 30)]
+    unique_keys, sums = _sum_by_key(chunks, 2)
+    expected_keys, expected_sums = _reduce_by_key(keys, values)
+    assert list(unique_keys) == list(expected_keys)
+    assert np.allclose(sums, expected_sums)
+    unique_keys, sums = _sum_by_key([], 2)
+    assert unique_keys.size == 0 and sums.shape == (2, 0)
+
+
+mtz = config("mdm2_merged.mtz")
+
+
+def test_read_mtz_header():
+    header = read_mtz_header(mtz)
+    assert header["ncol"] == 8
+    assert header["nref"] == 44609
+    assert header["space_group_number"] == 179
+    assert header["unit_cell"] == pytest.approx(
+        (71.512, 71.512, 104.2934, 90, 90, 120))
+    assert header["res_range"][1] == pytest.approx(1.246, abs=0.001)
+    assert mtz_observation_labels(header) == ["F_NATIVE", "IMEAN_NATIVE"]
+    assert mtz_free_flag_sets(header) == 20
+
+
+def test_mtz_column_summary():
+    summary = mtz_column_summary(mtz, res_low=999, res_high=1.6,
+                                 chunk_size=10000)
+    assert summary["F_NATIVE"]["n"] == 33926
+    assert summary["F_NATIVE"]["n_range"] == 21404
+    assert summary["IMEAN_NATIVE"]["n"] == 33928
+    assert summary == mtz_column_summary(mtz, res_low=999, res_high=1.6)
+
+
+def anomalous_mtz(filename_out):
+    """Writes a copy of the MTZ file in which the sigmas are replaced by
+    anomalous amplitudes F(+) and F(-), each of them measured for every
+    other reflection."""
+    header = read_mtz_header(mtz)
+    size = header["nref"] * header["ncol"] * 4
+    with open(mtz, "rb") as mtzfile:
+        content = mtzfile.read()
+    data = np.frombuffer(content[80:80 + size], dtype=header["dtype"])
+    data = data.reshape(header["nref"], header["ncol"]).copy()
+    even = np.arange(header["nref"]) % 2 == 0
+    data[:, 5] = np.where(even, data[:, 4], np.nan)
+    data[:, 7] = np.where(~even, data[:, 4], np.nan)
+    content = content[:80] + data.tobytes() + content[80 + size:]
+    for label, label_new in (("SIGF_NATIVE", "F(+)"),
+                             ("SIGIMEAN_NATIVE", "F(-)")):
+        record = [record for record in header["records"]
+                  if record.split()[:2] == ["COLUMN", label]][0]
+        record_new = record.replace(label.ljust(30), label_new.ljust(30))
+        record_new = record_new.replace(" Q ", " G ")
+        content = content.replace(record.ljust(80).encode("ascii"),
+                                  record_new.ljust(80).encode("ascii"))
+    with open(filename_out, "wb") as mtzout:
+        mtzout.write(content)
+    return filename_out
+
+
+def test_mtz_reflection_counts(tmp_path):
+    summary = mtz_column_summary(mtz, res_low=999, res_high=1.6)
+    counts = (summary["F_NATIVE"]["n"], summary["F_NATIVE"]["n_range"])
+    assert mtz_reflection_counts(mtz, res_low=999, res_high=1.6) == counts
+    # Sparse anomalous columns are not counted
+    mtz_anomalous = anomalous_mtz(str(tmp_path / "anomalous.mtz"))
+    header = read_mtz_header(mtz_anomalous)
+    assert mtz_observation_labels(header) == \
+        ["F_NATIVE", "F(+)", "IMEAN_NATIVE", "F(-)"]
+    summary = mtz_column_summary(mtz_anomalous, res_low=999, res_high=1.6)
+    assert summary["F(+)"]["n"] + summary["F(-)"]["n"] == counts[0]
+    assert mtz_reflection_counts(mtz_anomalous, res_low=999,
+                                 res_high=1.6) == counts
+    # Only anomalous data - both Bijvoet mates are counted
+    mtz_only = write_mtz_subset(mtz_anomalous, str(tmp_path / "only.mtz"),
+                                ["H", "K", "L", "FreeR_flag", "F(+)", "F(-)"])
+    assert mtz_reflection_counts(mtz_only, res_low=999,
+                                 res_high=1.6) == counts
+
+
+def test_res_from_mtz():
+    res_low, res_high = res_from_mtz(mtz)
+    assert res_low == pytest.approx(61.93, abs=0.01)
+    assert res_high == pytest.approx(1.246, abs=0.001)
+
+
+def test_write_mtz_subset():
+    header = read_mtz_header(mtz)
+    labels = refinement_mtz_labels(header)
+    assert labels == ["H", "K", "L", "FreeR_flag", "F_NATIVE", "SIGF_NATIVE",
+                      "IMEAN_NATIVE", "SIGIMEAN_NATIVE"]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        mtz_out = write_mtz_subset(mtz, os.path.join(tmpdir, "slim.mtz"),
+                                   ["H", "K", "L", "FreeR_flag",
+                                    "IMEAN_NATIVE", "SIGIMEAN_NATIVE"],
+                                   chunk_size=10000)
+        header_out = read_mtz_header(mtz_out)
+        assert header_out["ncol"] == 6
+        assert header_out["nref"] == header["nref"]
+        assert header_out["unit_cell"] == header["unit_cell"]
+        assert [column["label"] for column in header_out["columns"]] == \
+            ["H", "K", "L", "FreeR_flag", "IMEAN_NATIVE", "SIGIMEAN_NATIVE"]
+        data = np.array(mtz_memmap(mtz))[:, [0, 1, 2, 3, 6, 7]]
+        data_out = np.array(mtz_memmap(mtz_out, header_out))
+        assert np.array_equal(np.isnan(data), np.isnan(data_out))
+        assert np.array_equal(np.nan_to_num(data), np.nan_to_num(data_out))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@pytest.mark.parametrize(["keywords", "ncol"], [
+    (None, 6), ([None, None], 6), (["keywords.com", None], 8),
+    ([None, "keywords.def"], 8)])
+def test_slim_hklin(monkeypatch, capsys, keywords, ncol):
+    # Pretend that the amplitudes are not used for refinement
+    monkeypatch.setattr(pairef.preparation, "refinement_mtz_labels",
+                        lambda header: ["H", "K", "L", "FreeR_flag",
+                                        "IMEAN_NATIVE", "SIGIMEAN_NATIVE"])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        assert slim_hklin(mtz, tmpdir, keywords) == "mdm2_merged.mtz"
+        header_out = read_mtz_header(os.path.join(tmpdir, "mdm2_merged.mtz"))
+        assert header_out["ncol"] == ncol
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@pytest.mark.parametrize(["n_free", "n_work"], [(100, 0), (100, 3000),
+                                                (0, 2000)])
+def test_equal_count_shells(n_free, n_work):
+    d_work, d_free = mtz_d_spacings_work_free(mtz, flag=0)
+    assert len(d_work) == 32312
+    assert len(d_free) == 1614
+    shells_high, counts = equal_count_shells(d_work, d_free, 1.6, 1.246,
+                                             n_free=n_free, n_work=n_work)
+    assert shells_high[-1] == 1.25
+    assert shells_high == sorted(shells_high, reverse=True)
+    for n_work_shell, n_free_shell in counts:
+        assert n_free_shell >= n_free
+        assert n_work_shell >= n_work
+
+
+def test_equal_count_shells_too_few():
+    d_work, d_free = mtz_d_spacings_work_free(mtz, flag=0)
+    shells_high, counts = equal_count_shells(d_work, d_free, 1.6, 1.246,
+                                             n_free=100000)
+    assert shells_high == [1.25]
@@ -0,0 +1,43 @@
+import argparse
+import os
+from helper import write
+from pairef.commons import extract_from_file, open_text
+from pairef.retention import compress, comparison_files, prune_step
+
+
+MODEL = ["p_R00_1-70A.log", "p_R00_1-70A.mtz", "p_R00_1-70A.pdb",
+         "p_R00_1-70A.csv", "p_R01_1-70A_comparison_at_1-80A.log",
+         "p_R00_1-80A_comparison_at_1-80A.log"]
+COMPARISON = ["p_R00_1-70A_comparison_at_1-80A.log",
+              "p_R00_1-70A_comparison_at_1-80A.mtz",
+              "p_R00_1-70A_comparison_at_1-80A_prev_pair.log",
+              "p_R00_1-70A_comparison_at_1-80A_prev_pair.mtz",
+              "p_R00_1-70A_comparison_at_1-80A_prev_pair_001.pdb"]
+
+
+def test_compress(tmpcwd):
+    write("a.log", "R factor 0.2\nR free 0.25\n")
+    assert compress("a.log") == "a.log.gz"
+    assert not os.path.exists("a.log")
+    with open_text("a.log") as f:
+        assert f.readlines() == ["R factor 0.2\n", "R free 0.25\n"]
+    assert extract_from_file("a.log", "R free", 0, 1, -1) == "0.25"
+
+
+def test_prune_step(tmpcwd):
+    for filename in MODEL + COMPARISON:
+        write(filename)
+    args = argparse.Namespace(project="p", keep_intermediates=True)
+    assert prune_step(args, 0, 1.7) == ([], [])
+    assert sorted(comparison_files("p", 0, 1.7)) == \
+        sorted(os.path.join(".", f) for f in COMPARISON)
+    args.keep_intermediates = False
+    compressed, removed = prune_step(args, 0, 1.7)
+    assert sorted(compressed) == [
+        "./p_R00_1-70A_comparison_at_1-80A.log.gz",
+        "./p_R00_1-70A_comparison_at_1-80A_prev_pair.log.gz"]
+    assert len(removed) == 3
+    assert sorted(os.listdir(".")) == sorted(
+        MODEL + [os.path.basename(f) for f in compressed])
+    assert comparison_files("p", 0, 1.7) == []
+    assert prune_step(args, 0, 1.7) == ([], [])
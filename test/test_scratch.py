@@ -0,0 +1,58 @@
+import pytest
+import os
+import sys
+import time
+from helper import write, read
+from pairef.scratch import ScratchSync, stage, finish, results_dir
+from pairef.settings import RunContext, workpath
+
+
+def test_sync(tmpcwd):
+    os.makedirs("scratch")
+    os.makedirs("workdir")
+    sync = ScratchSync("scratch", "workdir")
+    write("scratch/a.log")
+    write("scratch/b.mtz")
+    assert sync.sync() == ["a.log", "b.mtz"]
+    assert sync.sync() == []
+    # Changed, removed and recently changed files
+    write("scratch/a.log", "longer content\n")
+    os.remove("scratch/b.mtz")
+    write("scratch/c.csv")
+    old = time.time() - 60
+    os.utime("scratch/a.log", (old, old))
+    assert sync.sync(settle=30) == ["a.log"]
+    assert read("workdir/a.log") == "longer content\n"
+    assert sorted(os.listdir("workdir")) == ["a.log"]
+    assert sync.sync() == ["c.csv"]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="symlinks")
+def test_sync_symlink(tmpcwd):
+    os.makedirs("scratch")
+    os.makedirs("workdir")
+    write("scratch/p_R00_R-values.csv")
+    os.symlink("p_R00_R-values.csv", "scratch/p_R-values.csv")
+    ScratchSync("scratch", "workdir").sync()
+    assert os.readlink("workdir/p_R-values.csv") == "p_R00_R-values.csv"
+    assert read("workdir/p_R-values.csv") == "content\n"
+
+
+def test_stage_finish(tmpcwd):
+    os.makedirs("scratch")
+    os.makedirs("pairef_p")
+    with RunContext() as context:
+        rundir = stage("pairef_p", "scratch", "p")
+        assert os.path.dirname(rundir) == os.path.join(tmpcwd, "scratch")
+        assert context.scratch.thread.is_alive()
+        context.workdir = rundir
+        assert results_dir() == os.path.join(tmpcwd, "pairef_p")
+        write(workpath("PAIREF_p.html"))
+        finish()
+        assert context.scratch is None
+        assert context.workdir == os.path.join(tmpcwd, "pairef_p")
+        assert os.listdir(context.workdir) == ["PAIREF_p.html"]
+        assert os.listdir(os.path.join(tmpcwd, "scratch")) == []
+        assert results_dir() == context.workdir
+        assert os.getcwd() == tmpcwd
+        finish()  # nothing to do
@@ -0,0 +1,109 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+from pairef.settings import RunContext, current_context, settings
+from pairef.settings import warning_dict, workpath
+from pairef.commons import warning_my, print_my, open_text
+from pairef.jobs import JobRunner, job_runner
+from pairef.timing import profiler
+from pairef.progress import CycleMonitor, monitors
+
+
+def test_run_context():
+    default = current_context()
+    with RunContext() as outer:
+        settings["sh"] = True
+        warning_my("test", "Outer run.")
+        assert current_context() is outer
+        with RunContext() as inner:
+            assert "sh" not in settings and not warning_dict
+            settings["sh"] = False
+        assert settings["sh"] is True
+        assert inner.settings == {"sh": False}
+        assert list(outer.warning_dict) == ["test"]
+    assert current_context() is default
+    assert "test" not in warning_dict
+
+
+def test_run_context_threads():
+    results = {}
+
+    def run(name):
+        with RunContext() as context:
+            settings["name"] = name
+            # Jobs of the run are executed in other threads
+            JobRunner(4, 1).map(
+                lambda i: warning_my(str(i), name + " " + str(i)), range(4))
+            results[name] = (settings["name"], sorted(context.warning_dict))
+
+    threads = [threading.Thread(target=run, args=(name,))
+               for name in ("first", "second")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {"first": ("first", ["0", "1", "2", "3"]),
+                       "second": ("second", ["0", "1", "2", "3"])}
+
+
+def test_run_context_objects():
+    with RunContext() as outer:
+        job_runner.configure(4, 2)
+        profiler.reset()
+        profiler.metadata["run"] = "outer"
+        CycleMonitor("outer_R00_1-60A")
+        with RunContext() as inner:
+            job_runner.configure(1)
+            job_runner.retries = 3
+            assert "run" not in profiler.metadata
+            assert not monitors
+        assert job_runner.n_slots == 2 and job_runner.retries == 1
+        assert profiler.metadata == {"run": "outer"}
+        assert len(monitors) == 1
+    assert inner.job_runner.n_cores == 1 and inner.job_runner.retries == 3
+    assert outer.job_runner is not inner.job_runner
+    assert outer.profiler is not inner.profiler
+
+
+def test_warning_my_threads():
+    with RunContext() as context:
+        # Messages of the same key are joined by parallel jobs
+        JobRunner(8, 1).map(
+            lambda i: warning_my("failed", "Set " + str(i) + "."), range(40))
+    messages = context.warning_dict["failed"].split("<br />\n")
+    assert sorted(messages) == sorted("WARNING: Set " + str(i) + "."
+                                      for i in range(40))
+
+
+def test_run_context_workdir_threads():
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    barrier = threading.Event()
+
+    def run(name):
+        with RunContext() as context:
+            context.workdir = os.path.join(tmpdir, name)
+            context.output = io.StringIO()
+            os.makedirs(workpath("."))
+            barrier.wait()
+            with open(workpath("status.txt"), "w") as f:
+                f.write(name + "\n")
+            print_my("Run " + name)
+            with open_text("status.txt") as f:
+                results[name] = (f.read(), context.output.getvalue())
+
+    try:
+        assert workpath("status.txt") == "status.txt"
+        threads = [threading.Thread(target=run, args=(name,))
+                   for name in ("first", "second")]
+        for thread in threads:
+            thread.start()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+        assert results == {"first": ("first\n", "Run first\n"),
+                           "second": ("second\n", "Run second\n")}
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,89 @@
+import pytest
+import json
+import os
+import shutil
+import tempfile
+from helper import config
+import fake_engine
+from pairef.settings import settings, warning_dict
+from pairef.launcher import process_arguments, run_pairef
+from pairef.shards import write_schedule, load_schedule, run_shard, merge
+from pairef.shards import status_filename
+
+
+SHELLS = [1.6, 1.55, 1.5]
+FLAGS = [0, 1, 2]
+
+
+@pytest.fixture
+def workdir():
+    """Working directory prepared as by `pairef prepare-shards` (without the
+    modification of the input structure model) with the fake refinement
+    program in PATH."""
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    try:
+        os.chdir(tmpdir)
+        bindir = fake_engine.install(os.path.join(tmpdir, "bin"))
+        os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+        os.makedirs("pairef_shard")
+        args = process_arguments(
+            ["pairef", "--HKLIN", config("mdm2_merged.mtz"),
+             "--XYZIN", config("mdm2_1-60A.pdb"), "-p", "shard",
+             "--complete", "--ncyc", "2"])
+        args.ncyc_chosen = []
+        args.ncyc_auto = False
+        args.retries = 1
+        for f in ("hklin", "xyzin"):
+            shutil.copy2(vars(args)[f], "pairef_shard")
+            vars(args)[f] = os.path.basename(vars(args)[f])
+        settings["pdbORmmcif"] = ".pdb"
+        settings["sh"] = False
+        os.chdir("pairef_shard")
+        write_schedule(args, "refmac", SHELLS, FLAGS, 10, 61.93,
+                       args.xyzin, {"refmac_version": "N/A",
+                                    "phenix_version": "N/A",
+                                    "pairef_version": "test"})
+        os.chdir(tmpdir)
+        yield os.path.join(tmpdir, "pairef_shard")
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        warning_dict.clear()
+        shutil.rmtree(tmpdir)
+
+
+def test_schedule(workdir):
+    settings["pdbORmmcif"] = None
+    args, schedule = load_schedule(workdir)
+    assert settings["pdbORmmcif"] == ".pdb"
+    assert schedule["shells"] == SHELLS
+    assert schedule["flag_sets"] == FLAGS
+    assert args.project == "shard" and args.ncyc == 2
+
+
+def test_run_shard_and_merge(workdir):
+    pytest.importorskip("iotbx")  # statistics are calculated by CCTBX
+    for flag in FLAGS[:2]:
+        status = run_shard(workdir, flag, nproc=1)
+        assert status["shells"] == SHELLS
+    with open(os.path.join(workdir, status_filename(1)), "r") as f:
+        assert json.load(f)["shells"] == SHELLS
+    assert os.path.isfile(os.path.join(workdir, "shard_R01_1-50A.log"))
+    assert os.path.isfile(os.path.join(workdir,
+                                       "shard_R01_profile.json"))
+    cutoff = merge(workdir)
+    assert len(cutoff) == 2
+    # The shard with the set 2 has not been run
+    assert "failed" in warning_dict
+    with open(os.path.join(workdir, "PAIREF_shard.html"), "r") as f:
+        assert "Suggested cutoff" in f.read()
+
+
+def test_subcommand_errors(workdir):
+    with pytest.raises(SystemExit):
+        run_pairef(["pairef", "run-shard", workdir, "--flag", "5"])
+    with pytest.raises(SystemExit):
+        run_pairef(["pairef", "merge", os.path.dirname(workdir)])
@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pairef.jobs import JobRunner
+from pairef.timing import profiler, timed, profile_call
+
+
+def test_profile():
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+        profiler.reset()
+
+        @timed("test")
+        def stage():
+            JobRunner(1).run([sys.executable, "-c",
+                              "x = sum(range(3000000))"],
+                             stdout=subprocess.PIPE)
+            return 1
+
+        assert stage() == 1
+        assert stage.__name__ == "stage"
+        summary = profiler.summary()
+        assert [(s["category"], s["name"], s["calls"]) for s in summary] \
+            == [("test", "stage", 1),
+                ("program", os.path.basename(sys.executable), 1)]
+        program = summary[1]
+        assert summary[0]["wall"] >= program["wall"] > 0
+        if hasattr(os, "wait4"):
+            assert program["cpu"] > 0
+            assert program["maxrss"] > 0
+        jsonfilename, tracefilename = profiler.write("test")
+        with open(jsonfilename, "r") as jsonfile:
+            profile = json.load(jsonfile)
+        assert len(profile["events"]) == 2
+        with open(tracefilename, "r") as tracefile:
+            trace = json.load(tracefile)
+        assert set(event["ph"] for event in trace["traceEvents"]) == {"X"}
+        assert trace["traceEvents"][0]["args"]["returncode"] == 0
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def test_profile_call():
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+
+        def work(n):
+            return sum(i * i for i in range(n))
+
+        assert profile_call("test", work, 300000) == work(300000)
+        import pstats
+        stats = pstats.Stats("test.pstats")
+        assert any(function[2] == "work" for function in stats.stats)
+        with open("test.collapsed", "r") as collapsedfile:
+            lines = collapsedfile.readlines()
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0
+            assert " " not in stack
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,83 @@
+import pytest
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from pairef.settings import RunContext
+from pairef.tools import ToolRegistry, registry, find, environment_key
+
+
+@pytest.fixture
+def bindir(monkeypatch):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        bindir = os.path.join(tmpdir, "bin")
+        os.makedirs(bindir)
+        monkeypatch.setenv("PATH", bindir)
+        monkeypatch.setenv("PAIREF_CACHE_DIR", os.path.join(tmpdir, "cache"))
+        yield bindir
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def install(bindir, name, version="1.21.2-5419"):
+    filename = os.path.join(bindir, name)
+    with open(filename, "w") as f:
+        f.write("#!/bin/sh\necho 'Installation'\n"
+                "echo 'Version: " + version + "'\n")
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+    return filename
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="shell scripts")
+def test_registry(bindir):
+    cachefilename = os.path.join(os.environ["PAIREF_CACHE_DIR"], "tools.json")
+    filename = install(bindir, "phenix.version")
+    with RunContext():
+        tools = registry()
+        assert registry() is tools
+        assert tools.cachefilename == cachefilename
+        assert find("phenix.version") == filename
+        assert find("sfcheck") is None
+        assert tools.version("phenix.version") == "1.21.2-5419"
+    with open(cachefilename, "r") as f:
+        cache = json.load(f)
+    assert list(cache) == [environment_key()]
+    assert cache[environment_key()]["phenix.version"]["version"] == \
+        "1.21.2-5419"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="shell scripts")
+def test_registry_cache(bindir):
+    cachefilename = os.path.join(os.environ["PAIREF_CACHE_DIR"], "tools.json")
+    filename = install(bindir, "phenix.version")
+    assert ToolRegistry(cachefilename).version("phenix.version") == \
+        "1.21.2-5419"
+    # Cached version is used as long as the program is not modified
+    # (the modification time is kept here)
+    mtime = os.stat(filename).st_mtime
+    with open(filename, "a") as f:
+        f.write("echo 'Version: 2.0'\n")
+    os.utime(filename, (mtime, mtime))
+    tools = ToolRegistry(cachefilename)
+    assert tools.tools["phenix.version"]["version"] == "1.21.2-5419"
+    # New version after an update of the program
+    os.utime(filename, (time.time(), time.time() + 100))
+    assert ToolRegistry(cachefilename).version("phenix.version") == "2.0"
+    # Installing a new program changes the key of the environment
+    key = environment_key()
+    os.utime(bindir, (time.time(), time.time() + 200))
+    install(bindir, "sfcheck")
+    assert environment_key() != key
+    assert ToolRegistry(cachefilename).path("sfcheck")
+
+
+def test_registry_without_cache(bindir, monkeypatch):
+    monkeypatch.setenv("PAIREF_CACHE_DIR", "")
+    with RunContext():
+        assert registry().cachefilename is None
+        assert find("sfcheck") is None
+    assert os.listdir(os.path.dirname(bindir)) == ["bin"]